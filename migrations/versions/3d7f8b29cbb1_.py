@@ -0,0 +1,48 @@
+"""Allow several shards per event counter
+
+Revision ID: 3d7f8b29cbb1
+Revises: 849170064430
+Create Date: 2026-10-18 10:12:41.524356
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3d7f8b29cbb1'
+down_revision = '849170064430'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    try:
+        op.create_table('eventcounter_new',
+                        sa.Column('id', sa.Integer()),
+                        sa.Column('counter_name', sa.Unicode(length=80), nullable=False),
+                        sa.Column('counter_value', sa.Integer(), nullable=True),
+                        sa.Column('shard', sa.Integer(), nullable=False, server_default='0'),
+                        sa.PrimaryKeyConstraint('id'),
+                        sa.UniqueConstraint('counter_name', 'shard', name='evctr_1'),
+                        mysql_row_format='DYNAMIC'
+                        )
+        op.execute("INSERT INTO eventcounter_new (counter_name, counter_value, shard) "
+                   "SELECT counter_name, counter_value, 0 FROM eventcounter")
+        op.drop_table('eventcounter')
+        op.rename_table('eventcounter_new', 'eventcounter')
+    except Exception as exx:
+        print("Could not migrate table 'eventcounter'")
+        print(exx)
+
+
+def downgrade():
+    op.create_table('eventcounter_old',
+                    sa.Column('counter_name', sa.Unicode(length=80), nullable=False),
+                    sa.Column('counter_value', sa.Integer(), nullable=True),
+                    sa.PrimaryKeyConstraint('counter_name'),
+                    mysql_row_format='DYNAMIC'
+                    )
+    op.execute("INSERT INTO eventcounter_old (counter_name, counter_value) "
+               "SELECT counter_name, SUM(counter_value) FROM eventcounter "
+               "GROUP BY counter_name")
+    op.drop_table('eventcounter')
+    op.rename_table('eventcounter_old', 'eventcounter')
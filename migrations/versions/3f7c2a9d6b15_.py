@@ -0,0 +1,81 @@
+"""Add table tokenstats and count the existing tokens
+
+Revision ID: 3f7c2a9d6b15
+Revises: 9d2f5b8e1c40
+Create Date: 2026-10-18 20:14:51.236418
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3f7c2a9d6b15'
+down_revision = '9d2f5b8e1c40'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+token = sa.table('token',
+                 sa.column('id', sa.Integer),
+                 sa.column('active', sa.Boolean))
+tokeninfo = sa.table('tokeninfo',
+                     sa.column('token_id', sa.Integer),
+                     sa.column('Key', sa.Unicode),
+                     sa.column('Value', sa.UnicodeText))
+tokenowner = sa.table('tokenowner',
+                      sa.column('token_id', sa.Integer))
+tokenstats = sa.table('tokenstats',
+                      sa.column('tokenkind', sa.Unicode),
+                      sa.column('assigned', sa.Boolean),
+                      sa.column('active', sa.Boolean),
+                      sa.column('count', sa.Integer))
+
+
+def upgrade():
+    try:
+        op.create_table('tokenstats',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('tokenkind', sa.Unicode(length=30), nullable=False),
+        sa.Column('assigned', sa.Boolean(), nullable=False),
+        sa.Column('active', sa.Boolean(), nullable=False),
+        sa.Column('count', sa.Integer(), nullable=True),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('tokenkind', 'assigned', 'active', name='tsix_1'),
+        mysql_row_format='DYNAMIC'
+        )
+    except Exception as exx:
+        print("Could not create table tokenstats!")
+        print(exx)
+
+    try:
+        # Count the existing tokens like lib.tokenstats.reconcile_token_stats
+        owned = sa.select([tokenowner.c.token_id]).distinct().alias('owned')
+        tokenkind = sa.func.coalesce(tokeninfo.c.Value, u"")
+        assigned = owned.c.token_id != None
+        counts = sa.select([tokenkind, assigned, token.c.active,
+                            sa.func.count(token.c.id)]).select_from(
+            token.outerjoin(tokeninfo, sa.and_(tokeninfo.c.token_id == token.c.id,
+                                               tokeninfo.c.Key == u"tokenkind"))
+            .outerjoin(owned, owned.c.token_id == token.c.id)).group_by(
+            tokenkind, assigned, token.c.active)
+        op.execute(tokenstats.insert().from_select(['tokenkind', 'assigned',
+                                                    'active', 'count'], counts))
+        # Create the missing counters of the usual token kinds
+        existing = set(tuple(row) for row in op.get_bind().execute(
+            sa.select([tokenstats.c.tokenkind, tokenstats.c.assigned,
+                       tokenstats.c.active])))
+        missing = [{"tokenkind": tokenkind, "assigned": assigned,
+                    "active": active, "count": 0}
+                   for tokenkind in (u"software", u"hardware", u"virtual", u"")
+                   for assigned in (False, True)
+                   for active in (False, True)
+                   if (tokenkind, assigned, active) not in existing]
+        if missing:
+            op.bulk_insert(tokenstats, missing)
+    except Exception as exx:
+        print("Could not count the tokens! Please run the periodic task "
+              "TokenStats.")
+        print(exx)
+
+
+def downgrade():
+    op.drop_table('tokenstats')
@@ -0,0 +1,37 @@
+"""Add table authcounter
+
+Revision ID: 4b9e0d7c3a12
+Revises: 8f3a61c5d2e4
+Create Date: 2026-10-18 16:05:12.402817
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '4b9e0d7c3a12'
+down_revision = '8f3a61c5d2e4'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    try:
+        op.create_table('authcounter',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('username', sa.Unicode(length=64), nullable=False),
+        sa.Column('realm', sa.Unicode(length=120), nullable=False),
+        sa.Column('success', sa.Boolean(), nullable=False),
+        sa.Column('bucket', sa.Integer(), nullable=False),
+        sa.Column('count', sa.Integer(), nullable=True),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('username', 'realm', 'success', 'bucket',
+                            name='authctr_1'),
+        mysql_row_format='DYNAMIC'
+        )
+    except Exception as exx:
+        print("Could not create table authcounter!")
+        print(exx)
+
+
+def downgrade():
+    op.drop_table('authcounter')
@@ -0,0 +1,37 @@
+"""Add table periodictasklease for the periodic task scheduler
+
+Revision ID: 5a8d3e6f1b24
+Revises: 3f7c2a9d6b15
+Create Date: 2026-10-18 22:03:17.540912
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '5a8d3e6f1b24'
+down_revision = '3f7c2a9d6b15'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    try:
+        op.create_table('periodictasklease',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('periodictask_id', sa.Integer(), nullable=False),
+        sa.Column('node', sa.Unicode(length=255), nullable=False),
+        sa.Column('scheduled', sa.DateTime(), nullable=False),
+        sa.Column('expires', sa.DateTime(), nullable=False),
+        sa.Column('finished', sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(['periodictask_id'], ['periodictask.id'], ),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('periodictask_id', name='ptlsix_1'),
+        mysql_row_format='DYNAMIC'
+        )
+    except Exception as exx:
+        print("Could not create table periodictasklease!")
+        print(exx)
+
+
+def downgrade():
+    op.drop_table('periodictasklease')
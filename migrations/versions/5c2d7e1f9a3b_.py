@@ -0,0 +1,27 @@
+"""Add an index on the expiration of challenges
+
+Revision ID: 5c2d7e1f9a3b
+Revises: 3d7f8b29cbb1
+Create Date: 2026-10-18 11:02:17.834120
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '5c2d7e1f9a3b'
+down_revision = '3d7f8b29cbb1'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    try:
+        op.create_index(op.f('ix_challenge_expiration'), 'challenge',
+                        ['expiration'], unique=False)
+    except Exception as exx:
+        print("Could not create index on challenge.expiration!")
+        print(exx)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_challenge_expiration'), table_name='challenge')
@@ -0,0 +1,41 @@
+"""Add table monitoringstatsrollup
+
+Revision ID: 6e1a9c4f2b07
+Revises: 4b9e0d7c3a12
+Create Date: 2026-10-18 18:12:40.118204
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '6e1a9c4f2b07'
+down_revision = '4b9e0d7c3a12'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    try:
+        op.create_table('monitoringstatsrollup',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('stats_key', sa.Unicode(length=128), nullable=False),
+        sa.Column('resolution', sa.Integer(), nullable=False),
+        sa.Column('timestamp', sa.DateTime(), nullable=False),
+        sa.Column('count', sa.Integer(), nullable=False),
+        sa.Column('sum_value', sa.BigInteger(), nullable=False),
+        sa.Column('min_value', sa.Integer(), nullable=False),
+        sa.Column('max_value', sa.Integer(), nullable=False),
+        sa.Column('last_value', sa.Integer(), nullable=False),
+        sa.Column('last_timestamp', sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('stats_key', 'resolution', 'timestamp',
+                            name='msrix_1'),
+        mysql_row_format='DYNAMIC'
+        )
+    except Exception as exx:
+        print("Could not create table monitoringstatsrollup!")
+        print(exx)
+
+
+def downgrade():
+    op.drop_table('monitoringstatsrollup')
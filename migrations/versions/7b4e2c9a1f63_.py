@@ -0,0 +1,35 @@
+"""Add table tokenimportchunk for token files, which are imported by the job queue
+
+Revision ID: 7b4e2c9a1f63
+Revises: 5a8d3e6f1b24
+Create Date: 2026-10-19 09:12:44.318207
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '7b4e2c9a1f63'
+down_revision = '5a8d3e6f1b24'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    try:
+        op.create_table('tokenimportchunk',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('import_id', sa.Unicode(length=40), nullable=False),
+        sa.Column('position', sa.Integer(), nullable=False),
+        sa.Column('data', sa.UnicodeText(), nullable=False),
+        sa.Column('created', sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('import_id', 'position', name='tichix_1'),
+        mysql_row_format='DYNAMIC'
+        )
+    except Exception as exx:
+        print("Could not create table tokenimportchunk!")
+        print(exx)
+
+
+def downgrade():
+    op.drop_table('tokenimportchunk')
@@ -0,0 +1,44 @@
+"""Store the token types in lower case and add indexes for the token
+filters by realm and description
+
+Revision ID: 8f3a61c5d2e4
+Revises: 5c2d7e1f9a3b
+Create Date: 2026-10-18 14:21:43.118203
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '8f3a61c5d2e4'
+down_revision = '5c2d7e1f9a3b'
+
+from alembic import op
+import sqlalchemy as sa
+
+# Dialects which support indexes on expressions
+DESCRIPTION_INDEX_DIALECTS = ("postgresql", "sqlite")
+
+
+def upgrade():
+    token = sa.table('token', sa.column('tokentype', sa.Unicode(30)))
+    op.execute(token.update()
+               .where(token.c.tokentype != sa.func.lower(token.c.tokentype))
+               .values(tokentype=sa.func.lower(token.c.tokentype)))
+    try:
+        op.create_index(op.f('ix_tokenrealm_realm_id'), 'tokenrealm',
+                        ['realm_id'], unique=False)
+    except Exception as exx:
+        print("Could not create index on tokenrealm.realm_id!")
+        print(exx)
+    if op.get_bind().dialect.name in DESCRIPTION_INDEX_DIALECTS:
+        try:
+            op.execute("CREATE INDEX ix_token_description_lower ON token "
+                       "(lower(description))")
+        except Exception as exx:
+            print("Could not create index on lower(token.description)!")
+            print(exx)
+
+
+def downgrade():
+    if op.get_bind().dialect.name in DESCRIPTION_INDEX_DIALECTS:
+        op.drop_index('ix_token_description_lower', table_name='token')
+    op.drop_index(op.f('ix_tokenrealm_realm_id'), table_name='tokenrealm')
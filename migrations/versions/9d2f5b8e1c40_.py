@@ -0,0 +1,42 @@
+"""Add composite indexes on tokenowner and tokenrealm, which replace the
+indexes on tokenowner.resolver and tokenrealm.realm_id
+
+Revision ID: 9d2f5b8e1c40
+Revises: 6e1a9c4f2b07
+Create Date: 2026-10-18 19:03:27.551930
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '9d2f5b8e1c40'
+down_revision = '6e1a9c4f2b07'
+
+from alembic import op
+
+
+def upgrade():
+    try:
+        op.create_index('ix_tokenowner_resolver_user_id', 'tokenowner',
+                        ['resolver', 'user_id'], unique=False)
+        # The composite index makes the index on the resolver redundant
+        op.drop_index(op.f('ix_tokenowner_resolver'), table_name='tokenowner')
+    except Exception as exx:
+        print("Could not create index ix_tokenowner_resolver_user_id!")
+        print(exx)
+    try:
+        op.create_index('ix_tokenrealm_realm_id_token_id', 'tokenrealm',
+                        ['realm_id', 'token_id'], unique=False)
+        # The composite index makes the index on the realm_id redundant
+        op.drop_index(op.f('ix_tokenrealm_realm_id'), table_name='tokenrealm')
+    except Exception as exx:
+        print("Could not create index ix_tokenrealm_realm_id_token_id!")
+        print(exx)
+
+
+def downgrade():
+    op.create_index(op.f('ix_tokenrealm_realm_id'), 'tokenrealm',
+                    ['realm_id'], unique=False)
+    op.drop_index('ix_tokenrealm_realm_id_token_id', table_name='tokenrealm')
+    op.create_index(op.f('ix_tokenowner_resolver'), 'tokenowner',
+                    ['resolver'], unique=False)
+    op.drop_index('ix_tokenowner_resolver_user_id', table_name='tokenowner')
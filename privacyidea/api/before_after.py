@@ -28,6 +28,7 @@ It also contains the error handlers.
 """
 
 import six
+import time
 from .lib.utils import (send_error, get_all_params)
 from ..lib.user import get_user_from_param
 import logging
@@ -38,6 +39,7 @@ from flask import current_app
 from privacyidea.lib.policy import PolicyClass
 from privacyidea.lib.event import EventConfiguration
 from privacyidea.lib.lifecycle import call_finalizers
+from privacyidea.lib import metrics
 from privacyidea.api.auth import (user_required, admin_required)
 from privacyidea.lib.config import get_from_config, SYSCONF, update_config_object
 from privacyidea.lib.token import get_token_type
@@ -80,6 +82,18 @@ log = logging.getLogger(__name__)
 @token_blueprint.before_app_request
 def log_begin_request():
     log.debug(u"Begin handling of request {!r}".format(request.full_path))
+    request.start_time = time.time()
+
+
+@token_blueprint.after_app_request
+def observe_request_duration(response):
+    registry = metrics.get_registry()
+    if registry.enabled and hasattr(request, "start_time"):
+        registry.observe(metrics.REQUEST_DURATION, time.time() - request.start_time,
+                         method=request.method,
+                         endpoint=request.url_rule.rule if request.url_rule else "",
+                         status=response.status_code)
+    return response
 
 
 @token_blueprint.teardown_app_request
@@ -226,7 +240,8 @@ def after_request(response):
     # In certain error cases the before_request was not handled
     # completely so that we do not have an audit_object
     if "audit_object" in g:
-        g.audit_object.finalize_log()
+        with metrics.timer(metrics.PHASE_DURATION, phase="audit"):
+            g.audit_object.finalize_log()
 
     # No caching!
     response.headers['Cache-Control'] = 'no-cache'
@@ -45,7 +45,8 @@ import traceback
 from privacyidea.lib.error import PolicyError
 from flask import g, current_app, make_response
 from privacyidea.lib.policy import SCOPE, ACTION, AUTOASSIGNVALUE
-from privacyidea.lib.token import get_tokens, assign_token, get_realms_of_token, get_one_token
+from privacyidea.lib.token import (get_tokens, assign_token, get_realms_of_token, get_one_token,
+                                   get_user_token_summary)
 from privacyidea.lib.machine import get_hostname, get_auth_items
 from .prepolicy import check_max_token_user, check_max_token_realm
 import functools
@@ -58,6 +59,7 @@ from privacyidea.lib.auth import ROLE
 from privacyidea.lib.user import (split_user, User)
 from privacyidea.lib.realm import get_default_realm
 from privacyidea.lib.subscriptions import subscription_status
+from privacyidea.lib import metrics
 
 log = logging.getLogger(__name__)
 
@@ -100,7 +102,9 @@ class postpolicy(object):
         @functools.wraps(wrapped_function)
         def policy_wrapper(*args, **kwds):
             response = wrapped_function(*args, **kwds)
-            return self.function(self.request, response, *args, **kwds)
+            with metrics.timer(metrics.POLICY_DURATION, phase="postpolicy",
+                               function=self.function.__name__):
+                return self.function(self.request, response, *args, **kwds)
 
         return policy_wrapper
 
@@ -128,6 +132,7 @@ class postrequest(object):
         return policy_wrapper
 
 
+@metrics.timed(metrics.PHASE_DURATION, phase="signing")
 def sign_response(request, response):
     """
     This decorator is used to sign the response. It adds the nonce from the
@@ -169,6 +174,11 @@ def sign_response(request, response):
         response_object = response[0]
     else:
         response_object = response
+    if response_object.is_streamed:
+        # Streamed responses (like the CSV export) are no JSON and must not
+        # be read into memory.
+        log.info("We only sign JSON response data.")
+        return response
     try:
         content = json.loads(response_object.data)
         nonce = request.all_data.get("nonce")
@@ -577,8 +587,7 @@ def get_webui_settings(request, response):
             # If the user has no tokens, we run the wizard. If the user
             # already has tokens, we do not run the wizard.
             if token_wizard_pol:
-                token_wizard = get_tokens(user=User(loginname, realm),
-                                          count=True) == 0
+                token_wizard = get_user_token_summary(User(loginname, realm)).count() == 0
         user_details_pol = policy_object.get_policies(
             action=ACTION.USERDETAILS,
             scope=SCOPE.WEBUI,
@@ -710,7 +719,7 @@ def autoassign(request, response):
                                   unique=True)
 
             # check if the user has no token
-            if autoassign_values and get_tokens(user=user_obj, count=True) == 0:
+            if autoassign_values and get_user_token_summary(user_obj).count() == 0:
                 # Check is the token would match
                 # get all unassigned tokens in the realm and look for
                 # a matching OTP:
@@ -69,7 +69,8 @@ from flask import g, current_app
 from privacyidea.lib.policy import SCOPE, ACTION, PolicyClass
 from privacyidea.lib.user import (get_user_from_param, get_default_realm,
                                   split_user, User)
-from privacyidea.lib.token import (get_tokens, get_realms_of_token)
+from privacyidea.lib.token import (get_tokens, get_realms_of_token,
+                                   get_user_token_summary, get_realm_token_summary)
 from privacyidea.lib.utils import (get_client_ip,
                                    parse_timedelta, is_true, check_pin_policy, get_module_class)
 from privacyidea.lib.crypto import generate_password
@@ -77,6 +78,7 @@ from privacyidea.lib.auth import ROLE
 from privacyidea.api.lib.utils import getParam
 from privacyidea.lib.clientapplication import save_clientapplication
 from privacyidea.lib.config import (get_token_class, get_from_config, SYSCONF)
+from privacyidea.lib import metrics
 import functools
 import jwt
 import re
@@ -124,8 +126,10 @@ class prepolicy(object):
         """
         @functools.wraps(wrapped_function)
         def policy_wrapper(*args, **kwds):
-            self.function(request=self.request,
-                          action=self.action)
+            with metrics.timer(metrics.POLICY_DURATION, phase="prepolicy",
+                               function=self.function.__name__):
+                self.function(request=self.request,
+                              action=self.action)
             return wrapped_function(*args, **kwds)
 
         return policy_wrapper
@@ -701,12 +705,11 @@ def check_max_token_user(request=None, action=None):
                                                      client=g.client_ip)
         if limit_list:
             # we need to check how many tokens the user already has assigned!
-            tokenobject_list = get_tokens(user=user_object)
-            if serial and serial in [tok.token.serial for tok in tokenobject_list]:
+            if serial and get_tokens(user=user_object, serial=serial, count=True):
                 # If a serial is provided and this token already exists, the
                 # token can be regenerated
                 return True
-            already_assigned_tokens = len(tokenobject_list)
+            already_assigned_tokens = get_user_token_summary(user_object).count()
             max_value = max([int(x) for x in limit_list])
             if already_assigned_tokens >= max_value:
                 g.audit_object.add_policy(limit_list.get(str(max_value)))
@@ -747,8 +750,7 @@ def check_max_token_realm(request=None, action=None):
                                                      client=g.client_ip)
         if limit_list:
             # we need to check how many tokens the realm already has assigned!
-            tokenobject_list = get_tokens(realm=realm)
-            already_assigned_tokens = len(tokenobject_list)
+            already_assigned_tokens = get_realm_token_summary(realm).count()
             max_value = max([int(x) for x in limit_list])
             if already_assigned_tokens >= max_value:
                 g.audit_object.add_policy(limit_list.get(str(max_value)))
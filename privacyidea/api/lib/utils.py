@@ -27,7 +27,9 @@ from ...lib.error import (ParameterError,
                           AuthError, ERROR)
 from ...lib.log import log_with
 from privacyidea.lib import _
-from privacyidea.lib.utils import prepare_result, get_version
+from privacyidea.lib.utils import prepare_result, get_version, is_true
+from privacyidea.models import unit_of_work
+import functools
 import time
 import logging
 import json
@@ -36,7 +38,8 @@ import threading
 import six
 from flask import (jsonify,
                    current_app,
-                   Response)
+                   Response,
+                   stream_with_context)
 
 log = logging.getLogger(__name__)
 ENCODING = "utf-8"
@@ -47,6 +50,23 @@ optional = True
 required = False
 
 
+def transactional(wrapped_function):
+    """
+    Decorator for API views, which runs the view as one unit of work, if
+    ``PI_UNIT_OF_WORK`` is set in the config file. Then the database changes
+    of the request are committed in one transaction at the end of the view
+    and rolled back, if an exception is raised.
+    """
+    @functools.wraps(wrapped_function)
+    def transactional_wrapper(*args, **kwds):
+        if is_true(current_app.config.get("PI_UNIT_OF_WORK")):
+            with unit_of_work():
+                return wrapped_function(*args, **kwds)
+        return wrapped_function(*args, **kwds)
+
+    return transactional_wrapper
+
+
 def getParam(param, key, optional=True, default=None, allow_empty=True, allowed_values=None):
     """
     returns a parameter from the request parameters.
@@ -148,6 +168,39 @@ def send_error(errstring, rid=1, context=None, error_code=-311, details=None):
     return ret
 
 
+def _csv_line(values):
+    """
+    Return one line of a CSV document. All values are quoted and quotes
+    within the values are escaped by doubling them.
+    """
+    return u",".join(u'"{0!s}"'.format(u"{0!s}".format(value).replace(u'"', u'""'))
+                     for value in values) + u"\n"
+
+
+def iter_csv(rows):
+    """
+    Serialize a list of dictionaries (like the tokens of /token/) as CSV.
+    The header line is taken from the keys of the first dictionary. The CSV
+    document is generated line by line, so that ``rows`` can be a generator,
+    which does not need to hold all rows in memory.
+
+    :param rows: iterable of dictionaries
+    :return: generator of CSV lines
+    """
+    keys = None
+    for row in rows:
+        if keys is None:
+            keys = list(row.keys())
+            yield _csv_line(keys)
+        values = []
+        for key in keys:
+            val = row.get(key, u"")
+            if isinstance(val, six.string_types):
+                val = val.replace("\n", " ")
+            values.append(val)
+        yield _csv_line(values)
+
+
 def send_csv_result(obj, data_key="tokens",
                     filename="privacyidea-tokendata.csv"):
     """
@@ -158,8 +211,11 @@ def send_csv_result(obj, data_key="tokens",
       "count": 100,
       "....": .... }
 
+    or an iterable of the rows like ``get_token_dicts_generator``. In this
+    case the CSV document is streamed.
+
     :param obj: The data, that gets serialized as CSV
-    :type obj: dict
+    :type obj: dict or iterable of dicts
     :param data_key: The key, from which the list should be returned as CSV.
     Usually this is "tokens".
     :type data_key: basestring
@@ -168,26 +224,14 @@ def send_csv_result(obj, data_key="tokens",
     :return: The result serialized as a CSV
     :rtype: Response object
     """
-    delim = "'"
     content_type = "application/force-download"
     headers = {'Content-disposition': 'attachment; filename={0!s}'.format(filename)}
-    output = u""
-    # Do the header
-    for k, _v in obj.get(data_key, {})[0].items():
-        output += "{0!s}{1!s}{2!s}, ".format(delim, k, delim)
-    output += "\n"
-
-    # Do the data
-    for row in obj.get(data_key, {}):
-        for val in row.values():
-            if isinstance(val, six.string_types):
-                value = val.replace("\n", " ")
-            else:
-                value = val
-            output += "{0!s}{1!s}{2!s}, ".format(delim, value, delim)
-        output += "\n"
-
-    return Response(output, mimetype=content_type)
+    if isinstance(obj, dict):
+        rows = obj.get(data_key, [])
+    else:
+        rows = obj
+    return Response(stream_with_context(iter_csv(rows)), mimetype=content_type,
+                    headers=headers)
 
 
 @log_with(log)
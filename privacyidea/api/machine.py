@@ -25,7 +25,7 @@ __doc__ = """This REST API is used to list machines from Machine Resolvers.
 The code is tested in tests/test_api_machines
 """
 from flask import (Blueprint,
-                   request, g)
+                   request, g, Response)
 from .lib.utils import (getParam, send_result)
 from ..api.lib.prepolicy import prepolicy, check_base_action, mangle
 from ..lib.policy import ACTION
@@ -33,7 +33,7 @@ from ..lib.policy import ACTION
 from ..lib.machine import (get_machines, attach_token, detach_token,
                            add_option, delete_option,
                            list_token_machines, list_machine_tokens,
-                           get_auth_items)
+                           get_cached_auth_items)
 import logging
 import netaddr
 
@@ -324,6 +324,10 @@ def get_auth_items_api(application=None):
     :param hostname: The hostname of the machine
     :type hostname: basestring
 
+    :reqheader If-None-Match: The ETag of a previous response. If the
+        authentication items did not change, the response has the status
+        304 and no body.
+
     :return: dictionary with lists of authentication items
 
     **Example response**:
@@ -360,11 +364,22 @@ def get_auth_items_api(application=None):
         if key in filter_param:
             del(filter_param[key])
 
-    ret = get_auth_items(hostname, ip=g.client_ip,
-                         application=application, challenge=challenge,
-                         filter_param=filter_param)
+    etag, ret = get_cached_auth_items(hostname, ip=g.client_ip,
+                                      application=application,
+                                      challenge=challenge,
+                                      filter_param=filter_param)
+    if request.if_none_match.contains_weak(etag):
+        # The authentication items did not change
+        g.audit_object.log({'success': True,
+                            'info': "host: {0!s}, application: {1!s}, "
+                                    "not modified".format(hostname, application)})
+        response = Response(status=304)
+        response.set_etag(etag, weak=True)
+        return response
     g.audit_object.log({'success': True,
                         'info': "host: {0!s}, application: {1!s}".format(hostname,
                                                                application)})
-    return send_result(ret)
+    response = send_result(ret)
+    response.set_etag(etag, weak=True)
+    return response
 
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+#
+# This code is free software; you can redistribute it and/or
+# modify it under the terms of the GNU AFFERO GENERAL PUBLIC LICENSE
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or any later version.
+#
+# This code is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU AFFERO GENERAL PUBLIC LICENSE for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+This endpoint exports the in-process metrics of ``lib/metrics.py`` in the
+Prometheus text format. Unlike the ``/monitoring`` endpoints it does not
+require an authorization token, so that it can be scraped. Instead, only the
+clients in ``PI_METRICS_ALLOWED_CLIENTS`` may access it.
+
+Behind a reverse proxy every request comes from the address of the proxy,
+which is usually contained in the default allowed clients. So requests with
+an ``X-Forwarded-For`` header are refused, unless ``PI_METRICS_ALLOWED_CLIENTS``
+is set explicitly. The client IP is then mapped like for the other endpoints
+according to the system setting ``OverrideAuthorizationClient``.
+
+The code of this module is tested in tests/test_api_metrics.py
+"""
+from flask import Blueprint, Response, request, current_app
+import logging
+
+from privacyidea.lib.config import get_from_config, SYSCONF
+from privacyidea.lib.error import ResourceNotFoundError, AuthError
+from privacyidea.lib.metrics import get_registry
+from privacyidea.lib.utils import check_ip_in_policy, get_client_ip
+
+log = logging.getLogger(__name__)
+
+DEFAULT_ALLOWED_CLIENTS = "127.0.0.1, ::1"
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+metrics_blueprint = Blueprint('metrics_blueprint', __name__)
+
+
+@metrics_blueprint.route('/', methods=['GET'])
+def get_metrics():
+    """
+    Return the metrics in the Prometheus text format. If no metrics are
+    recorded, i.e. ``PI_METRICS_REGISTRY_CLASS`` is "null", the endpoint
+    returns the status 404.
+
+    **Example request**:
+
+    .. sourcecode:: http
+
+       GET /metrics/ HTTP/1.1
+       Host: example.com
+
+    **Example response**:
+
+    .. sourcecode:: http
+
+       HTTP/1.1 200 OK
+       Content-Type: text/plain; version=0.0.4
+
+       # HELP privacyidea_db_queries_total Number of executed SQL statements
+       # TYPE privacyidea_db_queries_total counter
+       privacyidea_db_queries_total 1042
+    """
+    registry = get_registry()
+    if not registry.enabled:
+        raise ResourceNotFoundError("No metrics are recorded.")
+    allowed_clients = current_app.config.get("PI_METRICS_ALLOWED_CLIENTS")
+    if allowed_clients is None:
+        if request.headers.get("X-Forwarded-For"):
+            # The default would allow all clients of a reverse proxy on localhost
+            log.warning(u"The metrics are requested via the proxy {0!s}. Set "
+                        u"PI_METRICS_ALLOWED_CLIENTS to allow "
+                        u"this.".format(request.remote_addr))
+            raise AuthError("The client is not allowed to read the metrics.")
+        allowed_clients = DEFAULT_ALLOWED_CLIENTS
+    client_ip = get_client_ip(request, get_from_config(SYSCONF.OVERRIDECLIENT))
+    allowed, excluded = check_ip_in_policy(client_ip,
+                                           [c.strip() for c in allowed_clients.split(",")
+                                            if c.strip()])
+    if not allowed or excluded:
+        log.warning(u"The client {0!s} is not allowed to read the "
+                    u"metrics.".format(client_ip))
+        raise AuthError("The client is not allowed to read the metrics.")
+    return Response(registry.render(), mimetype=None, content_type=CONTENT_TYPE)
@@ -54,6 +54,19 @@ def get_statistics(stats_key=None):
     If a stats_key is specified it returns the data of this key.
     The parameters "start" and "end" can be used to specify a time window,
     from which the statistics data should be fetched.
+
+    The parameter "resolution" can be set to "5min", "hour" or "day". Then
+    one value per time bucket is returned instead of all raw values. The
+    parameter "aggregate" specifies how the values of a bucket are combined:
+    "avg" (default), "min", "max", "last", "sum" or "count".
+
+    **Example request**:
+
+    .. sourcecode:: http
+
+       GET /monitoring/key1?resolution=hour&aggregate=max HTTP/1.1
+       Host: example.com
+       Accept: application/json
     """
     if stats_key is None:
         stats_keys = get_stats_keys()
@@ -67,7 +80,10 @@ def get_statistics(stats_key=None):
         end = getParam(param, "end")
         if end:
             end = parse_legacy_time(end, return_date=True)
-        values = get_values(stats_key=stats_key, start_timestamp=start, end_timestamp=end)
+        resolution = getParam(param, "resolution")
+        aggregate = getParam(param, "aggregate", default="avg")
+        values = get_values(stats_key=stats_key, start_timestamp=start, end_timestamp=end,
+                            resolution=resolution, aggregate=aggregate)
         # convert timestamps to strings
         values_w_string = [(s[0].strftime(AUTH_DATE_FORMAT), s[1]) for s in values]
         g.audit_object.log({"success": True})
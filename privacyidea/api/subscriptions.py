@@ -13,7 +13,7 @@ from flask import (Blueprint, request, g)
 from privacyidea.api.lib.utils import (send_result)
 from privacyidea.lib.log import log_with
 from privacyidea.lib.event import event
-from privacyidea.lib.token import get_tokens
+from privacyidea.lib.tokenstats import get_token_stats
 from privacyidea.api.lib.prepolicy import check_base_action, prepolicy
 from privacyidea.lib.policy import ACTION
 from privacyidea.lib.subscriptions import (get_subscription,
@@ -40,7 +40,7 @@ def api_get(application=None):
     Return the subscription object as JSON.
     """
     subscription = get_subscription()
-    active_tokens = get_tokens(count=True, active=True, assigned=True)
+    active_tokens = get_token_stats(active=True, assigned=True)
     for sub in subscription:
         # If subscription is valid, we have a negative timedelta
         sub["timedelta"] = (datetime.datetime.now() - sub.get("date_till")).days
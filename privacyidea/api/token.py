@@ -66,14 +66,19 @@ from ..lib.token import (init_token, get_tokens_paginate, assign_token,
                          copy_token_user, copy_token_pin, lost_token,
                          get_serial_by_otp, get_tokens,
                          set_validity_period_end, set_validity_period_start, add_tokeninfo,
-                         delete_tokeninfo, import_token)
+                         delete_tokeninfo, get_token_dicts_generator)
 from werkzeug.datastructures import FileStorage
 from cgi import FieldStorage
 from privacyidea.lib.error import (ParameterError, TokenAdminError)
-from privacyidea.lib.importotp import (parseOATHcsv, parseSafeNetXML,
-                                       parseYubicoCSV, parsePSKCdata, GPGImport)
+from privacyidea.lib.tokenimport import (iter_token_file, import_tokens,
+                                         store_token_file,
+                                         delete_stored_token_file,
+                                         IMPORT_TOKENS_JOB_NAME)
+from privacyidea.lib.queue import wrap_job, get_job_queue
+from io import BytesIO
 import logging
-from privacyidea.lib.utils import to_unicode
+import uuid
+from privacyidea.lib.utils import to_bytes, is_true
 from privacyidea.lib.policy import ACTION
 from privacyidea.lib.challenge import get_challenges_paginate
 from privacyidea.api.lib.prepolicy import (prepolicy, check_base_action,
@@ -345,7 +350,10 @@ def list_api():
     :query pagesize: limit the number of returned tokens
     :query user_fields: additional user fields from the userid resolver of
         the owner (user)
-    :query outform: if set to "csv", than the token list will be given in CSV
+    :query outform: if set to "csv", than the token list will be given in CSV.
+        In this case all matching tokens ordered by their database ID are
+        streamed and the parameters page, pagesize, sortby and sortdir are
+        ignored.
 
     :return: a json result with the data being a list of token dictionaries::
 
@@ -384,6 +392,17 @@ def list_api():
         filterRealm = [realm]
     g.audit_object.log({'info': "realm: {0!s}".format((filterRealm))})
 
+    if output_format == "csv":
+        # stream all matching tokens
+        tokens = get_token_dicts_generator(serial_wildcard=serial, realm=realm,
+                                           user=user, assigned=assigned,
+                                           tokentype=tokentype,
+                                           resolver=resolver,
+                                           description=description,
+                                           userid=userid)
+        g.audit_object.log({"success": True})
+        return send_csv_result(tokens)
+
     # get list of tokens as a dictionary
     tokens = get_tokens_paginate(serial=serial, realm=realm, page=page,
                                  user=user, assigned=assigned, psize=psize,
@@ -393,10 +412,7 @@ def list_api():
                                  description=description,
                                  userid=userid)
     g.audit_object.log({"success": True})
-    if output_format == "csv":
-        return send_csv_result(tokens)
-    else:
-        return send_result(tokens)
+    return send_result(tokens)
 
 
 @token_blueprint.route('/assign', methods=['POST'])
@@ -823,17 +839,19 @@ def loadtokens_api(filename=None):
         "oathcsv" or "yubikeycsv".
     :jsonparam tokenrealms: comma separated list of tokens.
     :jsonparam psk: Pre Shared Key, when importing PSKC
+    :jsonparam background: If set, the file is imported by the job queue.
+        The progress can be read from the monitoring statistics with the
+        returned ``stats_key``.
     :return: The number of the imported tokens
     :rtype: int
     """
     if not filename:
         filename = getParam(request.all_data, "filename", required)
-    known_types = ['aladdin-xml', 'oathcsv', "OATH CSV", 'yubikeycsv',
-                   'Yubikey CSV', 'pskc']
     file_type = getParam(request.all_data, "type", required)
     hashlib = getParam(request.all_data, "aladdin_hashlib")
     aes_psk = getParam(request.all_data, "psk")
     aes_password = getParam(request.all_data, "password")
+    background = is_true(getParam(request.all_data, "background"))
     if aes_psk and len(aes_psk) != 32:
         raise TokenAdminError("The Pre Shared Key must be 128 Bit hex "
                               "encoded. It must be 32 characters long!")
@@ -842,9 +860,7 @@ def loadtokens_api(filename=None):
     if trealms:
         tokenrealms = trealms.split(",")
 
-    TOKENS = {}
     token_file = request.files['file']
-    file_contents = ""
     # In case of form post requests, it is a "instance" of FieldStorage
     # i.e. the Filename is selected in the browser and the data is
     # transferred
@@ -852,62 +868,49 @@ def loadtokens_api(filename=None):
     #
     if type(token_file) == FieldStorage:  # pragma: no cover
         log.debug("Field storage file: %s", token_file)
-        file_contents = token_file.value
+        token_stream = BytesIO(to_bytes(token_file.value))
     elif type(token_file) == FileStorage:
         log.debug("Werkzeug File storage file: %s", token_file)
-        file_contents = token_file.read()
+        # The uploaded file is parsed as a stream
+        token_stream = token_file.stream
     else:  # pragma: no cover
-        file_contents = token_file
-
-    file_contents = to_unicode(file_contents)
-
-    if file_contents == "":
-        log.error("Error loading/importing token file. file {0!s} empty!".format(
-                  filename))
-        raise ParameterError("Error loading token file. File empty!")
-
-    if file_type not in known_types:
-        log.error("Unknown file type: >>{0!s}<<. We only know the types: {1!s}".format(file_type, ', '.join(known_types)))
-        raise TokenAdminError("Unknown file type: >>%s<<. We only know the "
-                              "types: %s" % (file_type,
-                                             ', '.join(known_types)))
-
-    # Decrypt file, if necessary
-    if file_contents.startswith("-----BEGIN PGP MESSAGE-----"):
-        GPG = GPGImport(current_app.config)
-        file_contents = GPG.decrypt(file_contents)
-
-    # Parse the tokens from file and get dictionary
-    if file_type == "aladdin-xml":
-        TOKENS = parseSafeNetXML(file_contents)
-    elif file_type in ["oathcsv", "OATH CSV"]:
-        TOKENS = parseOATHcsv(file_contents)
-    elif file_type in ["yubikeycsv", "Yubikey CSV"]:
-        TOKENS = parseYubicoCSV(file_contents)
-    elif file_type in ["pskc"]:
-        TOKENS = parsePSKCdata(file_contents, preshared_key_hex=aes_psk,
-                               password=aes_password)
-
-    # Now import the Tokens from the dictionary
-    ret = ""
-    for serial in TOKENS:
-        log.debug("importing token {0!s}".format(TOKENS[serial]))
-
-        log.info("initialize token. serial: {0!s}, realm: {1!s}".format(serial,
-                                                              tokenrealms))
-
-        import_token(serial,
-                     TOKENS[serial],
-                     tokenrealms=tokenrealms,
-                     default_hashlib=hashlib)
+        token_stream = BytesIO(to_bytes(token_file))
+
+    if background:
+        # The file and its secrets are stored encrypted in the database and
+        # imported by the job queue. Only the ID of the stored file is passed
+        # to the job queue. The number of imported tokens can be read from
+        # the monitoring statistics with the returned key.
+        # Fail early, if there is no job queue configured
+        get_job_queue()
+        stats_key = "token_import_{0!s}".format(uuid.uuid4().hex)
+        import_id = store_token_file(token_stream, psk=aes_psk,
+                                     password=aes_password)
+        try:
+            wrap_job(IMPORT_TOKENS_JOB_NAME, True)(
+                import_id, file_type, tokenrealms=tokenrealms,
+                default_hashlib=hashlib, stats_key=stats_key)
+        except Exception:
+            # The job will not delete the stored file and its secrets
+            delete_stored_token_file(import_id)
+            raise
+        g.audit_object.log({'info': u"{0!s}, {1!s} (queued: {2!s})".format(
+            file_type, token_file, stats_key)})
+        return send_result({"stats_key": stats_key})
+
+    # Parse the tokens from file and import them in batches
+    tokens = iter_token_file(token_stream, file_type, psk=aes_psk,
+                             password=aes_password)
+    serials = import_tokens(tokens, tokenrealms=tokenrealms,
+                            default_hashlib=hashlib)
 
     g.audit_object.log({'info': u"{0!s}, {1!s} (imported: {2:d})".format(file_type,
                                                            token_file,
-                                                           len(TOKENS)),
-                        'serial': ', '.join(TOKENS)})
+                                                           len(serials)),
+                        'serial': ', '.join(serials)})
     # logTokenNum()
 
-    return send_result(len(TOKENS))
+    return send_result(len(serials))
 
 
 @token_blueprint.route('/copypin', methods=['POST'])
@@ -66,7 +66,7 @@ In case if authenitcating a serial number:
 """
 from flask import (Blueprint, request, g, current_app)
 from privacyidea.lib.user import get_user_from_param, log_used_user
-from .lib.utils import send_result, getParam
+from .lib.utils import send_result, getParam, transactional
 from ..lib.decorators import (check_user_or_serial_in_request)
 from .lib.utils import required
 from privacyidea.lib.error import ParameterError
@@ -104,6 +104,7 @@ from privacyidea.lib.policy import ACTION
 from privacyidea.lib.token import get_tokens
 from privacyidea.lib.machine import list_token_machines
 from privacyidea.lib.applications.offline import MachineApplication
+from privacyidea.lib import metrics
 import json
 
 log = logging.getLogger(__name__)
@@ -120,7 +121,8 @@ def before_request():
     """
     update_config_object()
     request.all_data = get_all_params(request.values, request.data)
-    request.User = get_user_from_param(request.all_data)
+    with metrics.timer(metrics.PHASE_DURATION, phase="user"):
+        request.User = get_user_from_param(request.all_data)
     privacyidea_server = current_app.config.get("PI_AUDIT_SERVERNAME") or \
                          request.host
     # Create a policy_object, that reads the database audit settings
@@ -156,7 +158,8 @@ def after_request(response):
     # In certain error cases the before_request was not handled
     # completely so that we do not have an audit_object
     if "audit_object" in g:
-        g.audit_object.finalize_log()
+        with metrics.timer(metrics.PHASE_DURATION, phase="audit"):
+            g.audit_object.finalize_log()
 
     # No caching!
     response.headers['Cache-Control'] = 'no-cache'
@@ -208,6 +211,7 @@ def offlinerefill():
 
 @validate_blueprint.route('/check', methods=['POST', 'GET'])
 @validate_blueprint.route('/radiuscheck', methods=['POST', 'GET'])
+@transactional
 @postpolicy(mangle_challenge_response, request=request)
 @postpolicy(construct_radius_response, request=request)
 @postpolicy(no_detail_on_fail, request=request)
@@ -360,6 +364,7 @@ def check():
 
 
 @validate_blueprint.route('/samlcheck', methods=['POST', 'GET'])
+@transactional
 @postpolicy(no_detail_on_fail, request=request)
 @postpolicy(no_detail_on_success, request=request)
 @postpolicy(add_user_detail_to_response, request=request)
@@ -80,6 +80,11 @@ class MachineApplication(object):
     very host he is starting the request.
     '''
     allow_bulk_call = False
+    '''If allow_caching is true, the authentication items
+    of this application do not change between requests
+    and can be cached. See ``PI_AUTHITEM_CACHE_TTL``.
+    '''
+    allow_caching = False
 
     @classmethod
     def get_name(cls):
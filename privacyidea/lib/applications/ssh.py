@@ -43,6 +43,10 @@ class MachineApplication(MachineApplicationBase):
     If we would support OTP with SSH, this might be sensitive information!
     '''
     allow_bulk_call = True
+    '''The SSH public keys only change, if the token or
+    the machine token definition is changed.
+    '''
+    allow_caching = True
 
     @staticmethod
     def get_authentication_item(token_type,
@@ -19,14 +19,203 @@
 # You should have received a copy of the GNU Affero General Public
 # License along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
-from ..models import AuthCache, db
+__doc__ = """
+The AuthCache stores the credentials of successful authentications in the
+database table "authcache". See the policy ``auth_cache``.
+
+If ``PI_AUTHCACHE_MEMORY_SIZE`` is set, each process also keeps up to this
+number of cache entries in memory for ``PI_AUTHCACHE_MEMORY_TTL`` seconds.
+Authentications, which are found in memory, do not query the database. Their
+``last_auth`` timestamps are written to the database at most once per
+``PI_AUTHCACHE_FLUSH_INTERVAL`` seconds by a timer in the process and when
+the process exits.
+
+This module is tested in tests/test_lib_authcache.py.
+"""
+from ..models import AuthCache, db, commit_session
 from sqlalchemy import and_
 from privacyidea.lib.crypto import hash
+from privacyidea.lib.framework import get_app_local_store, get_app_config_value
+from collections import OrderedDict, namedtuple
+from flask import current_app
+from threading import Lock, Timer
+import atexit
 import datetime
 import logging
+import time
 
 log = logging.getLogger(__name__)
 
+DEFAULT_MEMORY_SIZE = 0
+DEFAULT_MEMORY_TTL = 60
+DEFAULT_FLUSH_INTERVAL = 10
+
+MemoryEntry = namedtuple("MemoryEntry", ["cache_id", "first_auth", "last_auth",
+                                         "loaded"])
+
+
+class MemoryAuthCache(object):
+    """
+    A bounded in-memory tier in front of the authcache table. The entries are
+    identified by the username, realm, resolver and hashed password. The
+    least recently used entries are removed, if the cache is full.
+
+    The new ``last_auth`` timestamps of the entries are collected and
+    written to the database later. The cache is shared among all threads of
+    a process.
+    """
+
+    def __init__(self, size, ttl, flush_interval):
+        """
+        :param size: The maximum number of entries
+        :param ttl: The number of seconds an entry is used without reading
+            it from the database again
+        :param flush_interval: The number of seconds after which the
+            collected ``last_auth`` timestamps should be written to the database
+        """
+        self.size = size
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+        self._lock = Lock()
+        self._entries = OrderedDict()
+        self._pending = {}
+        self._last_flush = time.time()
+        self._timer = None
+
+    def get(self, key):
+        """
+        :return: The MemoryEntry of the key or None
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            del self._entries[key]
+            if time.time() - entry.loaded > self.ttl:
+                return None
+            # Move the entry to the end, since it was used recently
+            self._entries[key] = entry
+            return entry
+
+    def set(self, key, cache_id, first_auth, last_auth):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = MemoryEntry(cache_id, first_auth, last_auth,
+                                             time.time())
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def touch(self, key, last_auth):
+        """
+        Set the ``last_auth`` of an entry. The timestamp is written to the
+        database later.
+
+        :return: True, if the collected timestamps should be written to the
+            database now
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries[key] = entry._replace(last_auth=last_auth)
+                self._pending[entry.cache_id] = last_auth
+            return time.time() - self._last_flush >= self.flush_interval
+
+    def start_timer(self, function, *args):
+        """
+        Start a timer, which calls the function after the flush interval, so
+        that the collected timestamps are written, even if no further
+        authentication happens. Nothing is done, if a timer is already running.
+        """
+        with self._lock:
+            if self._timer is None:
+                self._timer = Timer(self.flush_interval, function, args)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def remove(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._pending.pop(entry.cache_id, None)
+
+    def remove_older(self, last_auth):
+        """
+        Remove all entries, which were last used before the given time.
+        """
+        with self._lock:
+            for key, entry in list(self._entries.items()):
+                if entry.last_auth < last_auth:
+                    del self._entries[key]
+                    self._pending.pop(entry.cache_id, None)
+
+    def pop_pending(self):
+        """
+        Remove the collected ``last_auth`` timestamps and return them.
+
+        :return: dictionary of the cache ids and the timestamps
+        """
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._last_flush = time.time()
+            self._timer = None
+        return pending
+
+
+def get_memory_cache():
+    """
+    Return the ``MemoryAuthCache`` of the current application or None, if
+    the in-memory tier is disabled.
+    """
+    size = int(get_app_config_value("PI_AUTHCACHE_MEMORY_SIZE", DEFAULT_MEMORY_SIZE))
+    if size <= 0:
+        return None
+    store = get_app_local_store()
+    try:
+        return store["authcache_memory"]
+    except KeyError:
+        ttl = float(get_app_config_value("PI_AUTHCACHE_MEMORY_TTL", DEFAULT_MEMORY_TTL))
+        flush_interval = float(get_app_config_value("PI_AUTHCACHE_FLUSH_INTERVAL",
+                                                    DEFAULT_FLUSH_INTERVAL))
+        memory = store.setdefault("authcache_memory",
+                                  MemoryAuthCache(size, ttl, flush_interval))
+        # The janitor in another process can not write the timestamps of
+        # this process
+        atexit.register(_flush_last_auth_in_app, current_app._get_current_object())
+        return memory
+
+
+def flush_last_auth():
+    """
+    Write the ``last_auth`` timestamps, which were collected in the memory
+    of this process, to the database.
+
+    :return: The number of updated entries
+    """
+    memory = get_memory_cache()
+    if not memory:
+        return 0
+    pending = memory.pop_pending()
+    for cache_id, last_auth in pending.items():
+        AuthCache.query.filter(AuthCache.id == cache_id,
+                               AuthCache.last_auth < last_auth).update(
+            {"last_auth": last_auth}, synchronize_session=False)
+    if pending:
+        commit_session()
+    return len(pending)
+
+
+def _flush_last_auth_in_app(app):
+    """
+    Write the collected ``last_auth`` timestamps outside of a request, i.e.
+    in the timer thread or when the process exits.
+    """
+    try:
+        with app.app_context():
+            flush_last_auth()
+    except Exception as exx:  # pragma: no cover
+        log.warning(u"Could not write the last authentication times: "
+                    u"{0!r}".format(exx))
+
 
 def _hash_password(password):
     return hash(password, seed="")
@@ -40,6 +229,9 @@ def add_to_cache(username, realm, resolver, password):
     log.debug('Adding record to auth cache: ({!r}, {!r}, {!r}, {!r})'.format(
         username, realm, resolver, auth_hash))
     r = record.save()
+    memory = get_memory_cache()
+    if memory:
+        memory.set((username, realm, resolver, auth_hash), r, first_auth, first_auth)
     return r
 
 
@@ -47,16 +239,20 @@ def update_cache_last_auth(cache_id):
     last_auth = datetime.datetime.utcnow()
     AuthCache.query.filter(
         AuthCache.id == cache_id).update({"last_auth": last_auth})
-    db.session.commit()
+    commit_session()
 
 
 def delete_from_cache(username, realm, resolver, password):
+    auth_hash = _hash_password(password)
+    memory = get_memory_cache()
+    if memory:
+        memory.remove((username, realm, resolver, auth_hash))
     r = db.session.query(AuthCache).filter(AuthCache.username == username,
                                        AuthCache.realm == realm,
                                        AuthCache.resolver == resolver,
                                        AuthCache.authentication ==
-                                       _hash_password(password)).delete()
-    db.session.commit()
+                                       auth_hash).delete()
+    commit_session()
     return r
 
 
@@ -70,8 +266,14 @@ def cleanup(minutes):
     :return:
     """
     cleanuptime = datetime.datetime.utcnow() - datetime.timedelta(minutes=minutes)
+    # Write the last_auth timestamps of this process first, so that entries,
+    # which are still in use, are not deleted.
+    flush_last_auth()
+    memory = get_memory_cache()
+    if memory:
+        memory.remove_older(cleanuptime)
     r = db.session.query(AuthCache).filter(AuthCache.last_auth < cleanuptime).delete()
-    db.session.commit()
+    commit_session()
     return r
 
 
@@ -91,11 +293,25 @@ def verify_in_cache(username, realm, resolver, password,
         verified. Only find newer entries 
     :return: 
     """
+    auth_hash = _hash_password(password)
+    memory = get_memory_cache()
+    key = (username, realm, resolver, auth_hash)
+    if memory:
+        entry = memory.get(key)
+        if entry and (not first_auth or entry.first_auth > first_auth) and \
+                (not last_auth or entry.last_auth > last_auth):
+            # The entry is valid. The last_auth is written to the database later.
+            if memory.touch(key, datetime.datetime.utcnow()):
+                flush_last_auth()
+            else:
+                memory.start_timer(_flush_last_auth_in_app,
+                                   current_app._get_current_object())
+            return True
+
     conditions = []
     conditions.append(AuthCache.username == username)
     conditions.append(AuthCache.realm == realm)
     conditions.append(AuthCache.resolver == resolver)
-    auth_hash = _hash_password(password)
     conditions.append(AuthCache.authentication == auth_hash)
 
     if first_auth:
@@ -108,8 +324,11 @@ def verify_in_cache(username, realm, resolver, password,
     result = bool(r)
 
     if result:
+        cache_id, entry_first_auth = r.id, r.first_auth
         # Update the last_auth
-        update_cache_last_auth(r.id)
+        update_cache_last_auth(cache_id)
+        if memory:
+            memory.set(key, cache_id, entry_first_auth, datetime.datetime.utcnow())
 
     else:
         # Delete older entries
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+#
+# This code is free software; you can redistribute it and/or
+# modify it under the terms of the GNU AFFERO GENERAL PUBLIC LICENSE
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or any later version.
+#
+# This code is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU AFFERO GENERAL PUBLIC LICENSE for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+__doc__ = """
+This module counts the successful and failed authentications of the users
+in a sliding time window. It is used by the policies ``auth_max_success``
+and ``auth_max_fail``.
+
+The authentications are counted in time buckets of ``PI_AUTH_COUNTER_BUCKET``
+seconds in the table "authcounter". Each authentication increases the
+counter of the current bucket with an atomic SQL update. The number of
+authentications within a time window is the sum of the buckets, which
+overlap the window. So the window is extended to the start of its first
+bucket.
+
+This module is tested in tests/test_lib_authcounter.py.
+"""
+
+import logging
+import time
+
+from sqlalchemy import func
+from sqlalchemy.exc import IntegrityError
+
+from privacyidea.lib.framework import get_app_config_value
+from privacyidea.models import AuthCounter, db, commit_session
+
+log = logging.getLogger(__name__)
+
+DEFAULT_BUCKET_SIZE = 10
+
+
+def _get_bucket_size():
+    return max(1, int(get_app_config_value("PI_AUTH_COUNTER_BUCKET",
+                                           DEFAULT_BUCKET_SIZE)))
+
+
+def _get_bucket(timestamp, bucket_size):
+    """
+    Return the start of the bucket, which contains the timestamp.
+    """
+    return int(timestamp) // bucket_size * bucket_size
+
+
+def get_auth_count(username, realm, success, tdelta):
+    """
+    Return the number of successful or failed authentications of the user
+    within the given time.
+
+    :param username: The login name of the user
+    :param realm: The realm of the user
+    :param success: Count the successful (True) or failed (False) authentications
+    :param tdelta: The time window
+    :type tdelta: timedelta
+    :return: The number of authentications
+    :rtype: int
+    """
+    bucket_size = _get_bucket_size()
+    start = _get_bucket(time.time() - tdelta.total_seconds(), bucket_size)
+    count = db.session.query(func.sum(AuthCounter.count)).filter(
+        AuthCounter.username == username,
+        AuthCounter.realm == realm,
+        AuthCounter.success == bool(success),
+        AuthCounter.bucket >= start).scalar()
+    return int(count or 0)
+
+
+def add_auth(username, realm, success, max_age=None):
+    """
+    Count a successful or failed authentication of the user.
+
+    :param username: The login name of the user
+    :param realm: The realm of the user
+    :param success: Whether the authentication was successful
+    :param max_age: If given, the buckets of the user, which are older than
+        this time, are deleted
+    :type max_age: timedelta
+    """
+    bucket_size = _get_bucket_size()
+    now = time.time()
+    bucket = _get_bucket(now, bucket_size)
+    if max_age is not None:
+        oldest = _get_bucket(now - max_age.total_seconds(), bucket_size)
+        AuthCounter.query.filter(AuthCounter.username == username,
+                                 AuthCounter.realm == realm,
+                                 AuthCounter.bucket < oldest).delete(
+            synchronize_session=False)
+    query = AuthCounter.query.filter_by(username=username, realm=realm,
+                                        success=bool(success), bucket=bucket)
+    values = {AuthCounter.count: AuthCounter.count + 1}
+    if not query.update(values, synchronize_session=False):
+        # The bucket is created in a savepoint, which is rolled back, if a
+        # concurrent request created the bucket in the meantime. So the other
+        # changes of the request are kept.
+        try:
+            with db.session.begin_nested():
+                db.session.add(AuthCounter(username, realm, bool(success),
+                                           bucket, 1))
+        except IntegrityError:
+            if not query.update(values, synchronize_session=False):
+                log.warning(u"Could not count the authentication of "
+                            u"{0!r}@{1!r}.".format(username, realm))
+    commit_session()
+
+
+def delete_auth_counts(username=None, realm=None):
+    """
+    Delete the authentication counters of a user or of all users.
+
+    :param username: The login name of the user
+    :param realm: The realm of the user
+    :return: The number of deleted buckets
+    """
+    query = AuthCounter.query
+    if username is not None:
+        query = query.filter(AuthCounter.username == username)
+    if realm is not None:
+        query = query.filter(AuthCounter.realm == realm)
+    r = query.delete(synchronize_session=False)
+    commit_session()
+    return r
@@ -23,15 +23,30 @@
 This is a helper module for the challenges database table.
 It is used by the lib.tokenclass
 
+Expired challenges are deleted by the periodic task ``ChallengeJanitor`` or
+during authentication requests, at most once per
+``PI_CHALLENGE_CLEANUP_INTERVAL`` seconds.
+
 The method is tested in test_lib_challenges
 """
 
 import logging
 import six
+import time
+from threading import Lock
 from .log import log_with
-from ..models import Challenge
+from .framework import get_app_local_store, get_app_config_value
+from ..models import Challenge, cleanup_challenges
 log = logging.getLogger(__name__)
 
+#: Default number of seconds between two cleanups during requests.
+#: A negative value disables the cleanup during requests.
+DEFAULT_CHALLENGE_CLEANUP_INTERVAL = 60
+#: Default number of challenges, which are deleted in one statement
+DEFAULT_CHALLENGE_CLEANUP_CHUNKSIZE = 1000
+
+_cleanup_lock = Lock()
+
 
 @log_with(log)
 def get_challenges(serial=None, transaction_id=None, challenge=None):
@@ -150,3 +165,41 @@ def _create_challenge_query(serial=None, transaction_id=None):
             sql_query = sql_query.filter(Challenge.transaction_id == transaction_id)
 
     return sql_query
+
+
+def cleanup_expired_challenges(chunksize=None):
+    """
+    Delete all expired challenges in chunks.
+
+    :param chunksize: The number of challenges to delete in one statement.
+        Defaults to ``PI_CHALLENGE_CLEANUP_CHUNKSIZE``.
+    :return: The number of deleted challenges
+    """
+    chunksize = int(chunksize or get_app_config_value("PI_CHALLENGE_CLEANUP_CHUNKSIZE",
+                                                      DEFAULT_CHALLENGE_CLEANUP_CHUNKSIZE))
+    deleted = cleanup_challenges(chunksize)
+    log.debug(u"Deleted {0!s} expired challenges.".format(deleted))
+    return deleted
+
+
+def throttled_challenge_janitor():
+    """
+    Delete all expired challenges, if the last cleanup of this process is
+    older than ``PI_CHALLENGE_CLEANUP_INTERVAL`` seconds.
+    This is called during authentication requests, so that only one request
+    per interval pays for the cleanup.
+
+    :return: The number of deleted challenges
+    """
+    interval = float(get_app_config_value("PI_CHALLENGE_CLEANUP_INTERVAL",
+                                          DEFAULT_CHALLENGE_CLEANUP_INTERVAL))
+    if interval < 0:
+        # The expired challenges are only deleted by the periodic task
+        return 0
+    store = get_app_local_store()
+    now = time.time()
+    with _cleanup_lock:
+        if now < store.get("challenge_cleanup_due", 0):
+            return 0
+        store["challenge_cleanup_due"] = now + interval
+    return cleanup_expired_challenges()
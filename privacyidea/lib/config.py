@@ -39,7 +39,7 @@ import inspect
 
 from .log import log_with
 from ..models import (Config, db, Resolver, Realm, PRIVACYIDEA_TIMESTAMP,
-                      save_config_timestamp)
+                      save_config_timestamp, commit_session)
 from privacyidea.lib.framework import get_request_local_store, get_app_config_value
 from .crypto import encryptPassword
 from .crypto import decryptPassword
@@ -306,6 +306,53 @@ def get_resolver_classes():
     return list(this.config["pi_resolver_classes"].values())
 
 
+#: The token types and the names of their token classes. The token modules
+#: are only imported, when a token type is used for the first time.
+TOKEN_CLASS_MANIFEST = [
+    ("4eyes", "privacyidea.lib.tokens.foureyestoken.FourEyesTokenClass"),
+    ("certificate", "privacyidea.lib.tokens.certificatetoken.CertificateTokenClass"),
+    ("daplug", "privacyidea.lib.tokens.daplugtoken.DaplugTokenClass"),
+    ("email", "privacyidea.lib.tokens.emailtoken.EmailTokenClass"),
+    ("hotp", "privacyidea.lib.tokens.hotptoken.HotpTokenClass"),
+    ("motp", "privacyidea.lib.tokens.motptoken.MotpTokenClass"),
+    ("ocra", "privacyidea.lib.tokens.ocratoken.OcraTokenClass"),
+    ("paper", "privacyidea.lib.tokens.papertoken.PaperTokenClass"),
+    ("push", "privacyidea.lib.tokens.pushtoken.PushTokenClass"),
+    ("pw", "privacyidea.lib.tokens.passwordtoken.PasswordTokenClass"),
+    ("question", "privacyidea.lib.tokens.questionnairetoken.QuestionnaireTokenClass"),
+    ("radius", "privacyidea.lib.tokens.radiustoken.RadiusTokenClass"),
+    ("registration", "privacyidea.lib.tokens.registrationtoken.RegistrationTokenClass"),
+    ("remote", "privacyidea.lib.tokens.remotetoken.RemoteTokenClass"),
+    ("sms", "privacyidea.lib.tokens.smstoken.SmsTokenClass"),
+    ("spass", "privacyidea.lib.tokens.spasstoken.SpassTokenClass"),
+    ("sshkey", "privacyidea.lib.tokens.sshkeytoken.SSHkeyTokenClass"),
+    ("tan", "privacyidea.lib.tokens.tantoken.TanTokenClass"),
+    ("tiqr", "privacyidea.lib.tokens.tiqrtoken.TiqrTokenClass"),
+    ("totp", "privacyidea.lib.tokens.totptoken.TotpTokenClass"),
+    ("u2f", "privacyidea.lib.tokens.u2ftoken.U2fTokenClass"),
+    ("vasco", "privacyidea.lib.tokens.vascotoken.VascoTokenClass"),
+    ("yubico", "privacyidea.lib.tokens.yubicotoken.YubicoTokenClass"),
+    ("yubikey", "privacyidea.lib.tokens.yubikeytoken.YubikeyTokenClass")
+]
+TOKEN_TYPE_MANIFEST = dict(TOKEN_CLASS_MANIFEST)
+
+
+def _import_token_class(class_name):
+    """
+    Import the token class with the given full name like
+    "privacyidea.lib.tokens.hotptoken.HotpTokenClass".
+
+    :return: The token class or None, if the module can not be imported
+    """
+    module_name, _, name = class_name.rpartition(".")
+    try:
+        log.debug("import module: {0!s}".format(module_name))
+        return getattr(importlib.import_module(module_name), name)
+    except Exception as exx:  # pragma: no cover
+        log.warning('unable to load token module : {0!r} ({1!r})'.format(module_name, exx))
+        return None
+
+
 #@cache.cached(key_prefix="classes")
 def get_token_class_dict():
     """
@@ -324,24 +371,13 @@ def get_token_class_dict():
 
     :return: tuple of two dicts
     """
-    from .tokenclass import TokenClass
-
     tokenclass_dict = {}
     tokentype_dict = {}
-    modules = get_token_module_list()
-    for module in modules:
-        for name in dir(module):
-            obj = getattr(module, name)
-            # We must not process imported classes!
-            if (inspect.isclass(obj) and issubclass(obj, TokenClass) and
-                        obj.__module__ == module.__name__):
-                try:
-                    class_name = "{0!s}.{1!s}".format(module.__name__, obj.__name__)
-                    tokenclass_dict[class_name] = obj
-                    if hasattr(obj, 'get_class_type'):
-                        tokentype_dict[class_name] = obj.get_class_type()
-                except Exception as e:  # pragma: no cover
-                    log.error("error constructing token_class_dict: {0!r}".format(e))
+    for tokentype, class_name in TOKEN_CLASS_MANIFEST:
+        tokenclass = get_token_class(tokentype)
+        if tokenclass:
+            tokenclass_dict[class_name] = tokenclass
+            tokentype_dict[class_name] = tokentype
 
     return tokenclass_dict, tokentype_dict
 
@@ -354,32 +390,31 @@ def get_token_class(tokentype):
     :return: The tokenclass for the given type
     :rtype: tokenclass
     """
-    if tokentype.lower() == "hmac":
+    tokentype = tokentype.lower()
+    if tokentype == "hmac":
         tokentype = "hotp"
 
-    tokenclass = None
-    tokenclasses = get_token_classes()
-    for tclass in tokenclasses:
-        if tclass.get_class_type().lower() == tokentype.lower():
-            tokenclass = tclass
-            break
+    # The token classes are imported, when they are used for the first time
+    tokenclasses = this.config.setdefault("pi_token_class_by_type", {})
+    if tokentype not in tokenclasses:
+        class_name = TOKEN_TYPE_MANIFEST.get(tokentype)
+        if class_name is None:
+            return None
+        tokenclasses[tokentype] = _import_token_class(class_name)
 
-    return tokenclass
+    return tokenclasses[tokentype]
 
 
 #@cache.cached(key_prefix="types")
 def get_token_types():
     """
     Return a simple list of the type names of the tokens.
+    The token modules are not imported.
+
     :return: list of tokentypes like 'hotp', 'totp'...
     :rtype: list
     """
-    if "pi_token_types" not in this.config:
-        (t_classes, t_types) = get_token_class_dict()
-        this.config["pi_token_types"] = t_types
-        this.config["pi_token_classes"] = t_classes
-
-    return list(this.config["pi_token_types"].values())
+    return [tokentype for tokentype, _class_name in TOKEN_CLASS_MANIFEST]
 
 
 #@cache.cached(key_prefix="prefix")
@@ -395,14 +430,14 @@ def get_token_prefix(tokentype=None, default=None):
     :return: the prefix of the tokentype or the dict with all prefixes
     :rtype: string or dict
     """
-    prefix_dict = {}
-    for tokenclass in get_token_classes():
-        prefix_dict[tokenclass.get_class_type()] = tokenclass.get_class_prefix()
-
     if tokentype:
-        ret = prefix_dict.get(tokentype, default)
+        # Only import the token class of this type
+        tokenclass = get_token_class(tokentype) if tokentype in TOKEN_TYPE_MANIFEST else None
+        ret = tokenclass.get_class_prefix() if tokenclass else default
     else:
-        ret = prefix_dict
+        ret = {}
+        for tokenclass in get_token_classes():
+            ret[tokenclass.get_class_type()] = tokenclass.get_class_prefix()
     return ret
 
 
@@ -604,33 +639,8 @@ def get_token_list():
     get the list of the tokens
     :return: list of token names from the config file
     """
-    module_list = set()
-
-    # TODO: migrate the implementations and uncomment
-    module_list.add("privacyidea.lib.tokens.daplugtoken")
-    module_list.add("privacyidea.lib.tokens.hotptoken")
-    module_list.add("privacyidea.lib.tokens.motptoken")
-    module_list.add("privacyidea.lib.tokens.passwordtoken")
-    module_list.add("privacyidea.lib.tokens.remotetoken")
-    module_list.add("privacyidea.lib.tokens.spasstoken")
-    module_list.add("privacyidea.lib.tokens.sshkeytoken")
-    module_list.add("privacyidea.lib.tokens.totptoken")
-    module_list.add("privacyidea.lib.tokens.yubicotoken")
-    module_list.add("privacyidea.lib.tokens.yubikeytoken")
-    module_list.add("privacyidea.lib.tokens.radiustoken")
-    module_list.add("privacyidea.lib.tokens.smstoken")
-    module_list.add("privacyidea.lib.tokens.emailtoken")
-    module_list.add("privacyidea.lib.tokens.registrationtoken")
-    module_list.add("privacyidea.lib.tokens.certificatetoken")
-    module_list.add("privacyidea.lib.tokens.foureyestoken")
-    module_list.add("privacyidea.lib.tokens.tiqrtoken")
-    module_list.add("privacyidea.lib.tokens.ocratoken")
-    module_list.add("privacyidea.lib.tokens.u2ftoken")
-    module_list.add("privacyidea.lib.tokens.papertoken")
-    module_list.add("privacyidea.lib.tokens.questionnairetoken")
-    module_list.add("privacyidea.lib.tokens.vascotoken")
-    module_list.add("privacyidea.lib.tokens.tantoken")
-    module_list.add("privacyidea.lib.tokens.pushtoken")
+    module_list = set(class_name.rpartition(".")[0]
+                      for _tokentype, class_name in TOKEN_CLASS_MANIFEST)
 
     #module_list.add(".tokens.tagespassworttoken")
     #module_list.add(".tokens.vascotoken")
@@ -806,7 +816,7 @@ def set_privacyidea_config(key, value, typ="", desc=""):
         if desc:
             c1.Description = desc
         save_config_timestamp()
-        db.session.commit()
+        commit_session()
         ret = "update"
     else:
         #new_entry = Config(key, value, typ, desc)
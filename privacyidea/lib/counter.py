@@ -21,9 +21,215 @@
 # License along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 """
-This module is used to modify counters in the database
+This module is used to modify counters in the database.
+
+The counters are modified with atomic SQL updates like
+``counter_value = counter_value + 1``, so that concurrent requests do not
+lose increments.
+
+If ``PI_COUNTER_SHARDS`` is set to a number N greater than 1, each counter is
+stored in up to N rows (shards). Every modification updates a randomly chosen
+shard, so that concurrent requests do not have to wait for the lock on one
+single row. Reading a counter returns the sum of all shards.
+
+If ``PI_COUNTER_FLUSH_INTERVAL`` is set to a number of seconds, increments and
+decrements are accumulated in the process and written to the database
+at most once within this interval. A timer writes the accumulated changes
+after the interval, if no further change happens, and they are also written
+when the process exits.
 """
-from privacyidea.models import EventCounter
+import atexit
+import logging
+import random
+import time
+from collections import defaultdict
+from threading import Lock, Timer
+
+from flask import current_app
+from sqlalchemy import func
+from sqlalchemy.exc import IntegrityError
+
+from privacyidea.models import EventCounter, db, commit_session
+from privacyidea.lib.framework import get_app_local_store, get_app_config_value
+
+log = logging.getLogger(__name__)
+
+DEFAULT_SHARDS = 1
+DEFAULT_FLUSH_INTERVAL = 0
+
+
+class CounterAccumulator(object):
+    """
+    Holds the changes of the counters, that have not been written to the
+    database yet. The accumulator is shared among all threads of a process.
+    """
+
+    def __init__(self, interval):
+        """
+        :param interval: The number of seconds after which the accumulated
+            changes should be written to the database
+        """
+        self.interval = interval
+        self._lock = Lock()
+        self._deltas = defaultdict(int)
+        self._last_flush = time.time()
+        self._timer = None
+
+    def add(self, counter_name, delta):
+        """
+        Add the change to the counter.
+
+        :return: The accumulated change of the counter
+        """
+        with self._lock:
+            self._deltas[counter_name] += delta
+            return self._deltas[counter_name]
+
+    def is_due(self):
+        """
+        :return: True, if the accumulated changes should be written to the
+            database now
+        """
+        with self._lock:
+            return time.time() - self._last_flush >= self.interval
+
+    def start_timer(self, function, *args):
+        """
+        Start a timer, which calls the function after the flush interval, so
+        that the accumulated changes are written, even if the counters are not
+        changed again. Nothing is done, if a timer is already running.
+        """
+        with self._lock:
+            if self._timer is None:
+                self._timer = Timer(self.interval, function, args)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def get(self, counter_name):
+        with self._lock:
+            return self._deltas.get(counter_name, 0)
+
+    def pop(self, counter_name):
+        """
+        Remove the accumulated change of the counter and return it.
+        """
+        with self._lock:
+            return self._deltas.pop(counter_name, 0)
+
+    def pop_all(self):
+        """
+        Remove all accumulated changes and return them.
+
+        :return: dictionary of counter names and changes
+        """
+        with self._lock:
+            deltas, self._deltas = self._deltas, defaultdict(int)
+            self._last_flush = time.time()
+            self._timer = None
+        return deltas
+
+
+def _get_accumulator():
+    """
+    Return the ``CounterAccumulator`` of the current application or None, if
+    the counter changes should be written to the database immediately.
+    """
+    interval = int(get_app_config_value("PI_COUNTER_FLUSH_INTERVAL",
+                                        DEFAULT_FLUSH_INTERVAL))
+    if interval <= 0:
+        return None
+    store = get_app_local_store()
+    try:
+        return store["counter_accumulator"]
+    except KeyError:
+        accumulator = store.setdefault("counter_accumulator",
+                                       CounterAccumulator(interval))
+        # Other processes can not write the changes of this process
+        atexit.register(_flush_in_app, current_app._get_current_object())
+        return accumulator
+
+
+def _get_shard():
+    """
+    Return the shard, which should be modified.
+    """
+    shards = int(get_app_config_value("PI_COUNTER_SHARDS", DEFAULT_SHARDS))
+    if shards > 1:
+        return random.randrange(shards)
+    return 0
+
+
+def _insert(counter_name, value, shard=0):
+    """
+    Insert a shard of the counter in a savepoint. The savepoint is rolled
+    back, if a concurrent request created the shard in the meantime, so that
+    the other changes of the session are kept.
+
+    :return: True, if the shard was inserted
+    """
+    try:
+        with db.session.begin_nested():
+            db.session.execute(EventCounter.__table__.insert().values(
+                counter_name=counter_name, counter_value=value, shard=shard))
+        return True
+    except IntegrityError:
+        return False
+
+
+def _add(counter_name, delta):
+    """
+    Atomically add ``delta`` to one shard of the counter in the database.
+    If the shard does not exist yet, it is created.
+    """
+    shard = _get_shard()
+    for _i in range(2):
+        r = EventCounter.query.filter_by(counter_name=counter_name, shard=shard).update(
+            {EventCounter.counter_value: EventCounter.counter_value + delta},
+            synchronize_session=False)
+        if r or _insert(counter_name, delta, shard):
+            commit_session()
+            return
+    log.warning(u"Could not modify the counter {0!r}.".format(counter_name))
+
+
+def flush():
+    """
+    Write all counter changes, that were accumulated in this process, to
+    the database.
+    """
+    accumulator = _get_accumulator()
+    if accumulator:
+        for counter_name, delta in accumulator.pop_all().items():
+            if delta:
+                _add(counter_name, delta)
+
+
+def _flush_in_app(app):
+    """
+    Write the accumulated changes outside of a request, i.e. in the timer
+    thread or when the process exits.
+    """
+    try:
+        with app.app_context():
+            flush()
+    except Exception as exx:  # pragma: no cover
+        log.warning(u"Could not write the event counters: {0!r}".format(exx))
+
+
+def _accumulate(accumulator, counter_name, delta):
+    """
+    Add the change to the accumulator and write the accumulated changes, if
+    the flush interval has passed. Otherwise a timer writes them later.
+
+    :return: The change of the counter, that was accumulated in this process
+        and is not written to the database yet
+    """
+    accumulated = accumulator.add(counter_name, delta)
+    if accumulator.is_due():
+        flush()
+        return 0
+    accumulator.start_timer(_flush_in_app, current_app._get_current_object())
+    return accumulated
 
 
 def increase(counter_name):
@@ -32,14 +238,15 @@ def increase(counter_name):
     If the counter does not exist yet, create the counter.
 
     :param counter_name: The name/identifier of the counter
-    :return: the new integer value of the counter
+    :return: the new integer value of the counter. If the changes are
+        accumulated in the process, the database is not read and the change
+        of the counter, that is not written to the database yet, is returned.
     """
-    counter = EventCounter.query.filter_by(counter_name=counter_name).first()
-    if not counter:
-        counter = EventCounter(counter_name, 0)
-        counter.save()
-    counter.increase()
-    return counter.counter_value
+    accumulator = _get_accumulator()
+    if accumulator:
+        return _accumulate(accumulator, counter_name, 1)
+    _add(counter_name, 1)
+    return read(counter_name)
 
 
 def decrease(counter_name, allow_negative=False):
@@ -50,14 +257,56 @@ def decrease(counter_name, allow_negative=False):
 
     :param counter_name: The name/identifier of the counter
     :param allow_negative: Whether the counter can become negative
-    :return: the new integer value of the counter
+    :return: the new integer value of the counter. If the changes are
+        accumulated in the process and the counter can become negative, the
+        change of the counter, that is not written to the database yet, is
+        returned.
+    """
+    accumulator = _get_accumulator()
+    if allow_negative:
+        if accumulator:
+            return _accumulate(accumulator, counter_name, -1)
+        _add(counter_name, -1)
+        return read(counter_name)
+
+    # We need to know the current value to stop at zero
+    if accumulator:
+        delta = accumulator.pop(counter_name)
+        if delta:
+            _add(counter_name, delta)
+    # decrease one of the shards with a positive value
+    shards = db.session.query(EventCounter.shard).filter(
+        EventCounter.counter_name == counter_name,
+        EventCounter.counter_value > 0).all()
+    random.shuffle(shards)
+    for (shard,) in shards:
+        r = EventCounter.query.filter(
+            EventCounter.counter_name == counter_name,
+            EventCounter.shard == shard,
+            EventCounter.counter_value > 0).update(
+            {EventCounter.counter_value: EventCounter.counter_value - 1},
+            synchronize_session=False)
+        if r:
+            commit_session()
+            break
+    else:
+        # set counter to zero
+        _set_zero(counter_name, only_negative=True)
+    return read(counter_name)
+
+
+def _set_zero(counter_name, only_negative=False):
+    """
+    Set all shards of the counter to zero. If the counter does not exist yet,
+    create the counter.
     """
-    counter = EventCounter.query.filter_by(counter_name=counter_name).first()
-    if not counter:
-        counter = EventCounter(counter_name, 0)
-        counter.save()
-    counter.decrease(allow_negative)
-    return counter.counter_value
+    query = EventCounter.query.filter(EventCounter.counter_name == counter_name)
+    if only_negative:
+        query = query.filter(EventCounter.counter_value < 0)
+    query.update({EventCounter.counter_value: 0}, synchronize_session=False)
+    if not EventCounter.query.filter_by(counter_name=counter_name).first():
+        _insert(counter_name, 0)
+    commit_session()
 
 
 def reset(counter_name):
@@ -67,23 +316,54 @@ def reset(counter_name):
     :param counter_name: The name/identifier of the counter
     :return:
     """
-    counter = EventCounter.query.filter_by(counter_name=counter_name).first()
-    if not counter:
-        counter = EventCounter(counter_name, 0)
-        counter.save()
-    counter.reset()
+    accumulator = _get_accumulator()
+    if accumulator:
+        accumulator.pop(counter_name)
+    _set_zero(counter_name)
 
 
 def read(counter_name):
     """
     Read the counter value from the database.
+    The value is the sum of all shards and the changes, that were accumulated
+    in this process, but not written to the database yet.
     If the counter_name does not exist, 'None' is returned.
 
     :param counter_name: The name of the counter
     :return: The value of the counter
     """
-    counter = EventCounter.query.filter_by(counter_name=counter_name).first()
-    if not counter:
+    value, shards = db.session.query(func.sum(EventCounter.counter_value),
+                                     func.count(EventCounter.id)).filter(
+        EventCounter.counter_name == counter_name).one()
+    accumulator = _get_accumulator()
+    delta = accumulator.get(counter_name) if accumulator else 0
+    if not shards and not delta:
         return None
     else:
-        return counter.counter_value
\ No newline at end of file
+        return int(value or 0) + delta
+
+
+def read_and_reset(counter_name):
+    """
+    Read the counter value from the database and reset the counter.
+    Each shard is decreased by the value, that was read, so that concurrent
+    increments are not lost.
+    If the counter_name does not exist, 'None' is returned.
+
+    :param counter_name: The name of the counter
+    :return: The value of the counter before the reset
+    """
+    flush()
+    shards = db.session.query(EventCounter.id, EventCounter.counter_value).filter(
+        EventCounter.counter_name == counter_name).all()
+    if not shards:
+        return None
+    value = 0
+    for shard_id, shard_value in shards:
+        if shard_value:
+            EventCounter.query.filter(EventCounter.id == shard_id).update(
+                {EventCounter.counter_value: EventCounter.counter_value - shard_value},
+                synchronize_session=False)
+            value += shard_value
+    commit_session()
+    return value
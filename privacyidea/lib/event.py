@@ -26,6 +26,8 @@ from privacyidea.lib.utils import fetch_one_resource
 from privacyidea.models import EventHandler, EventHandlerOption, db
 from privacyidea.lib.error import ParameterError
 from privacyidea.lib.audit import getAudit
+from privacyidea.lib.eventhandler.base import (EventConditionContext,
+                                               compile_conditions)
 import functools
 import logging
 log = logging.getLogger(__name__)
@@ -61,6 +63,8 @@ class event(object):
             # DB table eventhandler and based on the self.eventname etc...
             # do Pre-Event Handling
             e_handles = self.g.event_config.get_handled_events(self.eventname, position="pre")
+            # The data for the evaluation of the conditions is shared by all handlers
+            context = EventConditionContext(self.request)
             for e_handler_def in e_handles:
                 log.debug(u"Pre-Handling event {eventname} with "
                           u"{eventDef}".format(eventname=self.eventname,
@@ -71,7 +75,8 @@ class event(object):
                 # In the options we can pass the mailserver configuration
                 options = {"request": self.request,
                            "g": self.g,
-                           "handler_def": e_handler_def}
+                           "handler_def": e_handler_def,
+                           "condition_context": context}
                 if event_handler.check_condition(options=options):
                     log.debug(u"Pre-Handling event {eventname} with options"
                               u"{options}".format(eventname=self.eventname,
@@ -92,6 +97,8 @@ class event(object):
 
                     event_handler.do(e_handler_def.get("action"),
                                      options=options)
+                    # The action may have changed the token
+                    context.invalidate()
                     # set audit object to success
                     event_audit.log({"success": True})
                     event_audit.finalize_log()
@@ -100,6 +107,8 @@ class event(object):
 
             # Post-Event Handling
             e_handles = self.g.event_config.get_handled_events(self.eventname)
+            # The request may have changed the token, so we need a new context
+            context = EventConditionContext(self.request)
             for e_handler_def in e_handles:
                 log.debug(u"Post-Handling event {eventname} with "
                           u"{eventDef}".format(eventname=self.eventname,
@@ -111,7 +120,8 @@ class event(object):
                 options = {"request": self.request,
                            "g": self.g,
                            "response": f_result,
-                           "handler_def": e_handler_def}
+                           "handler_def": e_handler_def,
+                           "condition_context": context}
                 if event_handler.check_condition(options=options):
                     log.debug(u"Post-Handling event {eventname} with options"
                               u"{options}".format(eventname=self.eventname,
@@ -132,6 +142,8 @@ class event(object):
 
                     event_handler.do(e_handler_def.get("action"),
                                      options=options)
+                    # The action may have changed the token
+                    context.invalidate()
                     # In case the handler has modified the response
                     f_result = options.get("response")
                     # set audit object to success
@@ -288,5 +300,8 @@ class EventConfiguration(object):
     def _read_events(self):
         q = EventHandler.query.order_by(EventHandler.ordering)
         for e in q:
-            self.eventlist.append(e.get())
+            event_def = e.get()
+            # precompile the regular expressions of the conditions
+            compile_conditions(event_def.get("conditions"))
+            self.eventlist.append(event_def)
 
@@ -37,7 +37,8 @@ from privacyidea.lib.realm import get_realms
 from privacyidea.lib.resolver import get_resolver_list
 from privacyidea.lib.auth import ROLE
 from privacyidea.lib.policy import ACTION
-from privacyidea.lib.token import get_token_owner, get_tokens
+from privacyidea.lib.token import (get_token_owner, get_tokens,
+                                   get_user_token_summary)
 from privacyidea.lib.user import User, UserError
 from privacyidea.lib.utils import (compare_condition, compare_value_value,
                                    parse_time_offset_from_now, is_true,
@@ -78,6 +79,143 @@ class CONDITION(object):
     CLIENT_IP = "client_ip"
 
 
+#: Conditions, whose values are regular expressions
+REGEX_CONDITIONS = ["serial", CONDITION.DETAIL_ERROR_MESSAGE,
+                    CONDITION.DETAIL_MESSAGE]
+
+# compiled regular expressions of the conditions
+_regex_cache = {}
+
+
+def get_condition_regex(pattern):
+    """
+    Return the compiled regular expression for the condition value
+    ``pattern``. The compiled expressions are kept for the lifetime of
+    the process, since the number of event handler conditions is limited.
+
+    :param pattern: The regular expression
+    :type pattern: basestring
+    :return: compiled regular expression
+    """
+    regex = _regex_cache.get(pattern)
+    if regex is None:
+        regex = _regex_cache.setdefault(pattern, re.compile(pattern))
+    return regex
+
+
+def compile_conditions(conditions):
+    """
+    Precompile the regular expressions in the given conditions of an
+    event handler definition. Invalid regular expressions are only logged,
+    so that they fail at evaluation time like before.
+
+    :param conditions: The conditions of the event handler definition
+    :type conditions: dict
+    """
+    for cond in REGEX_CONDITIONS:
+        if cond in conditions:
+            try:
+                get_condition_regex(conditions.get(cond))
+            except (re.error, TypeError) as exx:
+                log.warning(u"Invalid regular expression in condition {0!s}: "
+                            u"{1!s}".format(cond, exx))
+
+
+class EventConditionContext(object):
+    """
+    The data, which is needed to evaluate the conditions of all event handlers
+    of one request. The response is parsed only once and the token and the
+    token owner are only loaded once, no matter how many event handlers check
+    their conditions.
+
+    If an event handler performs its action, it may change the token. So
+    ``invalidate`` needs to be called to reload the token for the next
+    event handler.
+    """
+
+    def __init__(self, request):
+        self.request = request
+        self._response = None
+        self._response_data = None
+        self._content = None
+        self._user = None
+        self._token_data = None
+        self._maxfail_tokens = None
+
+    def invalidate(self):
+        """
+        Forget the token and user data, since an action may have changed it.
+        """
+        self._user = None
+        self._token_data = None
+        self._maxfail_tokens = None
+
+    def get_content(self, response):
+        """
+        Return the parsed JSON content of the response. The response is only
+        parsed again, if an event handler has modified the response.
+        """
+        if not response:
+            # In Pre-Handling we have no response and no content
+            return {}
+        data = response.data
+        if response is not self._response or data != self._response_data:
+            self._content = json.loads(data)
+            self._response = response
+            self._response_data = data
+        return self._content
+
+    def get_tokenowner(self):
+        if self._user is None:
+            self._user = BaseEventHandler._get_tokenowner(self.request)
+        return self._user
+
+    def get_token_data(self, serial):
+        """
+        Determine the token, that is involved in the request, and its realms,
+        resolvers and type.
+
+        :param serial: The serial number from the request or the response
+        :return: tuple of (token_obj, tokenrealms, tokenresolvers, tokentype)
+        """
+        if self._token_data is None or self._token_data[0] != serial:
+            tokenrealms = []
+            tokenresolvers = []
+            tokentype = None
+            token_obj = None
+            if serial:
+                # We have determined the serial number from the request.
+                token_obj_list = get_tokens(serial=serial)
+            else:
+                # We have to determine the token via the user object. But only if
+                #  the user has only one token
+                token_obj_list = get_tokens(user=self.get_tokenowner())
+            if len(token_obj_list) == 1:
+                # There is a token involved, so we determine it's resolvers and realms
+                token_obj = token_obj_list[0]
+                tokenrealms = token_obj.get_realms()
+                tokentype = token_obj.get_tokentype()
+
+                all_realms = get_realms()
+                for tokenrealm in tokenrealms:
+                    resolvers = all_realms.get(tokenrealm, {}).get("resolver", {})
+                    tokenresolvers.extend([r.get("name") for r in resolvers])
+                tokenresolvers = list(set(tokenresolvers))
+            self._token_data = (serial, (token_obj, tokenrealms,
+                                         tokenresolvers, tokentype))
+        return self._token_data[1]
+
+    def get_user_token_count(self):
+        # The token summary is kept per request, until a token is changed
+        return get_user_token_summary(self.get_tokenowner()).count()
+
+    def get_maxfail_tokens(self):
+        if self._maxfail_tokens is None:
+            self._maxfail_tokens = get_tokens(user=self.get_tokenowner(),
+                                              maxfail=True)
+        return self._maxfail_tokens
+
+
 class BaseEventHandler(object):
     """
     An Eventhandler needs to return a list of actions, which it can handle.
@@ -316,35 +454,18 @@ class BaseEventHandler(object):
         if not e_handler_def:
             # options is the handler definition
             return True
+        # The context is shared by all event handlers of the request
+        context = options.get("condition_context") or \
+                  EventConditionContext(request)
         # conditions can be corresponding to the property conditions
         conditions = e_handler_def.get("conditions")
-        content = self._get_response_content(response)
-        user = self._get_tokenowner(request)
+        content = context.get_content(response)
+        user = context.get_tokenowner()
 
         serial = request.all_data.get("serial") or \
                  content.get("detail", {}).get("serial")
-        tokenrealms = []
-        tokenresolvers = []
-        tokentype = None
-        token_obj = None
-        if serial:
-            # We have determined the serial number from the request.
-            token_obj_list = get_tokens(serial=serial)
-        else:
-            # We have to determine the token via the user object. But only if
-            #  the user has only one token
-            token_obj_list = get_tokens(user=user)
-        if len(token_obj_list) == 1:
-            # There is a token involved, so we determine it's resolvers and realms
-            token_obj = token_obj_list[0]
-            tokenrealms = token_obj.get_realms()
-            tokentype = token_obj.get_tokentype()
-
-            all_realms = get_realms()
-            for tokenrealm in tokenrealms:
-                resolvers = all_realms.get(tokenrealm, {}).get("resolver", {})
-                tokenresolvers.extend([r.get("name") for r in resolvers])
-            tokenresolvers = list(set(tokenresolvers))
+        token_obj, tokenrealms, tokenresolvers, tokentype = \
+            context.get_token_data(serial)
 
         if CONDITION.CLIENT_IP in conditions:
             if g and g.client_ip:
@@ -394,7 +515,7 @@ class BaseEventHandler(object):
                     return False
             else:
                 # check all tokens of the user, if any token is maxfail
-                token_objects = get_tokens(user=user, maxfail=True)
+                token_objects = context.get_maxfail_tokens()
                 if not ','.join([tok.get_serial() for tok in token_objects]):
                     return False
 
@@ -418,11 +539,11 @@ class BaseEventHandler(object):
 
         if "serial" in conditions and serial:
             serial_match = conditions.get("serial")
-            if not bool(re.match(serial_match, serial)):
+            if not bool(get_condition_regex(serial_match).match(serial)):
                 return False
 
         if CONDITION.USER_TOKEN_NUMBER in conditions and user:
-            num_tokens = get_tokens(user=user, count=True)
+            num_tokens = context.get_user_token_count()
             if num_tokens != int(conditions.get(
                     CONDITION.USER_TOKEN_NUMBER)):
                 return False
@@ -430,14 +551,14 @@ class BaseEventHandler(object):
         if CONDITION.DETAIL_ERROR_MESSAGE in conditions:
             message = content.get("detail", {}).get("error", {}).get("message")
             search_exp = conditions.get(CONDITION.DETAIL_ERROR_MESSAGE)
-            m = re.search(search_exp, message)
+            m = get_condition_regex(search_exp).search(message)
             if not bool(m):
                 return False
 
         if CONDITION.DETAIL_MESSAGE in conditions:
             message = content.get("detail", {}).get("message")
             search_exp = conditions.get(CONDITION.DETAIL_MESSAGE)
-            m = re.search(search_exp, message)
+            m = get_condition_regex(search_exp).search(message)
             if not bool(m):
                 return False
 
@@ -29,7 +29,6 @@ from privacyidea.lib.privacyideaserver import (get_privacyideaservers,
 from privacyidea.lib import _
 import json
 import logging
-import requests
 from flask import Response
 
 
@@ -124,11 +123,12 @@ class FederationEventHandler(BaseEventHandler):
             server_def = handler_options.get("privacyIDEA")
             pi_server = get_privacyideaserver(server_def)
 
-            # the new url is the configured server url and the original path
-            url = pi_server.config.url + request.path
+            # the new url is the configured server url and the original path.
+            # If several upstream servers are configured, the request fails
+            # over to the next one.
+            upstreams = pi_server.upstreams
             # We use the original method
             method = request.method
-            tls = pi_server.config.tls
             # We also transfer the original payload
             data = request.all_data
             if handler_options.get("forward_client_ip"):
@@ -138,8 +138,9 @@ class FederationEventHandler(BaseEventHandler):
             if handler_options.get("resolver"):
                 data["resolver"] = handler_options.get("resolver")
 
-            log.info(u"Sending {0} request to {1!r}".format(method, url))
-            requestor = None
+            log.info(u"Sending {0} request to {1!r}".format(method,
+                                                            pi_server.config.url))
+            http_method = None
             params = None
             headers = {}
 
@@ -153,15 +154,16 @@ class FederationEventHandler(BaseEventHandler):
             if method.upper() == "GET":
                 params = data
                 data = None
-                requestor = requests.get
+                http_method = "GET"
             elif method.upper() == "POST":
-                requestor = requests.post
+                http_method = "POST"
             elif method.upper() == "DELETE":
-                requestor = requests.delete
+                http_method = "DELETE"
 
-            if requestor:
-                r = requestor(url, params=params, data=data,
-                              headers=headers, verify=tls)
+            if http_method:
+                url, r = upstreams.request(http_method, request.path,
+                                           params=params, data=data,
+                                           headers=headers)
                 # convert requests Response to werkzeug Response
                 response_dict = json.loads(r.text)
                 if "detail" in response_dict:
@@ -0,0 +1,290 @@
+# -*- coding: utf-8 -*-
+#
+# This code is free software; you can redistribute it and/or
+# modify it under the terms of the GNU AFFERO GENERAL PUBLIC LICENSE
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or any later version.
+#
+# This code is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU AFFERO GENERAL PUBLIC LICENSE for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+__doc__ = """
+This module implements a registry of HTTP clients, which are used for
+outgoing HTTP requests like the requests of the remote token, the federation
+event handler or the HTTP SMS provider.
+
+Like the engine registry in ``lib/pooling.py``, there is one shared registry
+per application. It holds one ``requests.Session`` per target (scheme, host
+and port) and TLS settings, so that connections are kept alive and reused
+between requests. All clients share a common policy for the pool size,
+timeouts and retries and record the latency and the errors per target.
+
+This module is tested in tests/test_lib_httpclient.py.
+"""
+
+import logging
+import time
+from threading import Lock
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.cookies import RequestsCookieJar
+from six.moves.urllib.parse import urlparse
+from urllib3.util.retry import Retry
+
+from privacyidea.lib.framework import get_app_local_store, get_app_config_value
+
+log = logging.getLogger(__name__)
+
+DEFAULT_POOL_SIZE = 10
+DEFAULT_RETRIES = 0
+DEFAULT_BACKOFF = 0.1
+DEFAULT_TIMEOUT = 30
+
+
+class _NoCookieJar(RequestsCookieJar):
+    """
+    A cookie jar which never stores cookies. The sessions are shared between
+    all requests of a process, so cookies set by one remote server response
+    must not be sent with other requests.
+    """
+    def set_cookie(self, cookie, *args, **kwargs):
+        pass
+
+
+class HTTPClient(object):
+    """
+    A wrapper around a ``requests.Session`` for one target, which applies the
+    default timeout and records the number of requests, the number of errors
+    and the latency of the requests.
+    """
+
+    def __init__(self, target, verify=True, proxies=None,
+                 pool_size=DEFAULT_POOL_SIZE, retries=DEFAULT_RETRIES,
+                 backoff=DEFAULT_BACKOFF, timeout=DEFAULT_TIMEOUT):
+        """
+        :param target: The target like ``https://example.com:443``
+        :param verify: The TLS verification setting. See ``requests``.
+        :param proxies: dictionary of proxies
+        :param pool_size: The maximum number of connections to keep open
+        :param retries: The number of retries, if the connection can not be
+            established. Requests, which have been sent, are never repeated.
+        :param backoff: The backoff factor in seconds between the retries
+        :param timeout: The default timeout of a request in seconds
+        """
+        self.target = target
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.verify = verify
+        self.session.cookies = _NoCookieJar()
+        if proxies:
+            self.session.proxies.update(proxies)
+        retry = Retry(total=retries, connect=retries, read=0, status=0,
+                      backoff_factor=backoff, raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size,
+                              max_retries=retry)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self._lock = Lock()
+        self.requests = 0
+        self.errors = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+    def request(self, method, url, **kwargs):
+        """
+        Send a request. The parameters are the same as of ``requests.request``.
+        Errors are counted if the request fails or the server returns a
+        status code 5xx.
+
+        :return: a ``requests.Response`` object
+        """
+        kwargs.setdefault("timeout", self.timeout)
+        start = time.time()
+        error = True
+        try:
+            response = self.session.request(method, url, **kwargs)
+            error = response.status_code >= 500
+            return response
+        finally:
+            latency = time.time() - start
+            with self._lock:
+                self.requests += 1
+                self.errors += int(error)
+                self.latency_total += latency
+                self.latency_max = max(self.latency_max, latency)
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request("DELETE", url, **kwargs)
+
+    def close(self):
+        self.session.close()
+
+    def get_metrics(self):
+        """
+        :return: dictionary with the number of requests and errors and the
+            average and maximum latency in seconds
+        """
+        with self._lock:
+            return {"requests": self.requests,
+                    "errors": self.errors,
+                    "latency_avg": self.latency_total / self.requests if self.requests else 0.0,
+                    "latency_max": self.latency_max}
+
+
+def _get_target(url):
+    """
+    Return the scheme, host and port of the URL.
+    """
+    parsed = urlparse(url)
+    port = parsed.port or {"http": 80, "https": 443}.get(parsed.scheme)
+    return u"{0!s}://{1!s}:{2!s}".format(parsed.scheme, parsed.hostname, port)
+
+
+def _create_client(target, verify, proxies):
+    return HTTPClient(target, verify=verify, proxies=proxies,
+                      pool_size=int(get_app_config_value("PI_HTTP_POOL_SIZE", DEFAULT_POOL_SIZE)),
+                      retries=int(get_app_config_value("PI_HTTP_RETRIES", DEFAULT_RETRIES)),
+                      backoff=float(get_app_config_value("PI_HTTP_BACKOFF", DEFAULT_BACKOFF)),
+                      timeout=float(get_app_config_value("PI_HTTP_TIMEOUT", DEFAULT_TIMEOUT)))
+
+
+class BaseHTTPClientRegistry(object):
+    """
+    Abstract base class for HTTP client registries.
+    """
+    #: True, if the clients are kept after the request
+    shared = False
+
+    def get_client(self, url, verify=True, proxies=None):
+        """
+        Return the HTTP client for the target of the given URL.
+
+        :param url: The URL of the request
+        :param verify: The TLS verification setting
+        :param proxies: dictionary of proxies
+        :return: an ``HTTPClient`` object
+        """
+        raise NotImplementedError()
+
+    def get_metrics(self):
+        """
+        :return: dictionary of the metrics per target
+        """
+        return {}
+
+
+class NullHTTPClientRegistry(BaseHTTPClientRegistry):
+    """
+    A registry which creates a new client and thus new connections for
+    every request.
+
+    It can be activated by setting ``PI_HTTP_CLIENT_REGISTRY_CLASS`` to "null".
+    """
+    def get_client(self, url, verify=True, proxies=None):
+        return _create_client(_get_target(url), verify, proxies)
+
+
+class SharedHTTPClientRegistry(BaseHTTPClientRegistry):
+    """
+    A registry which holds a dictionary mapping a target and its TLS and
+    proxy settings to an HTTP client.
+
+    It can be activated by setting ``PI_HTTP_CLIENT_REGISTRY_CLASS`` to "shared".
+    """
+    shared = True
+
+    def __init__(self):
+        BaseHTTPClientRegistry.__init__(self)
+        self._client_lock = Lock()
+        self._clients = {}
+
+    def get_client(self, url, verify=True, proxies=None):
+        target = _get_target(url)
+        key = (target, verify, tuple(sorted((proxies or {}).items())))
+        # Like the engine registry, we need a lock to make sure that we
+        # do not create two clients for the same key
+        with self._client_lock:
+            if key not in self._clients:
+                log.info(u"Creating a new HTTP client for {0!s}".format(target))
+                self._clients[key] = _create_client(target, verify, proxies)
+            return self._clients[key]
+
+    def get_metrics(self):
+        with self._client_lock:
+            clients = list(self._clients.values())
+        metrics = {}
+        for client in clients:
+            client_metrics = client.get_metrics()
+            if client.target in metrics:
+                # The same target with different TLS settings
+                for key in ["requests", "errors"]:
+                    metrics[client.target][key] += client_metrics[key]
+                metrics[client.target]["latency_max"] = max(
+                    metrics[client.target]["latency_max"], client_metrics["latency_max"])
+            else:
+                metrics[client.target] = client_metrics
+        return metrics
+
+
+HTTP_CLIENT_REGISTRY_CLASSES = {
+    "null": NullHTTPClientRegistry,
+    "shared": SharedHTTPClientRegistry,
+}
+DEFAULT_REGISTRY_CLASS_NAME = "shared"
+
+
+def get_registry():
+    """
+    Return the ``HTTPClientRegistry`` object associated with the current application.
+    If there is no such object yet, create one and write it to the app-local store.
+    This respects the ``PI_HTTP_CLIENT_REGISTRY_CLASS`` config option.
+    :return: an ``HTTPClientRegistry`` object
+    """
+    app_store = get_app_local_store()
+    try:
+        return app_store["http_client_registry"]
+    except KeyError:
+        registry_class_name = get_app_config_value("PI_HTTP_CLIENT_REGISTRY_CLASS",
+                                                   DEFAULT_REGISTRY_CLASS_NAME)
+        if registry_class_name not in HTTP_CLIENT_REGISTRY_CLASSES:
+            log.warning(u"Unknown HTTP client registry class: {!r}".format(registry_class_name))
+            registry_class_name = DEFAULT_REGISTRY_CLASS_NAME
+        registry = HTTP_CLIENT_REGISTRY_CLASSES[registry_class_name]()
+        log.info(u"Created a new HTTP client registry: {!r}".format(registry))
+        return app_store.setdefault("http_client_registry", registry)
+
+
+def get_client(url, verify=True, proxies=None):
+    """
+    Shortcut to get an HTTP client from the application-global registry.
+    :return: an ``HTTPClient`` object
+    """
+    return get_registry().get_client(url, verify, proxies)
+
+
+def request(method, url, verify=True, proxies=None, **kwargs):
+    """
+    Send an HTTP request via the HTTP client for the target of the URL.
+    The parameters are the same as of ``requests.request``.
+
+    :return: a ``requests.Response`` object
+    """
+    registry = get_registry()
+    client = registry.get_client(url, verify, proxies)
+    try:
+        return client.request(method, url, **kwargs)
+    finally:
+        if not registry.shared:
+            client.close()
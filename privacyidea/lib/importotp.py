@@ -51,15 +51,18 @@ import re
 import binascii
 import base64
 import cgi
+from io import BytesIO
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
 
 from privacyidea.lib.utils import (modhex_decode, modhex_encode,
-                                   hexlify_and_unicode, to_unicode, to_utf8)
+                                   hexlify_and_unicode, to_unicode, to_utf8,
+                                   to_bytes)
 from privacyidea.lib.config import get_token_class
 from privacyidea.lib.log import log_with
 from privacyidea.lib.crypto import (aes_decrypt_b64, aes_encrypt_b64, geturandom)
 from bs4 import BeautifulSoup
+from lxml import etree as lxml_etree
 import traceback
 from passlib.crypto.digest import pbkdf2_hmac
 import gnupg
@@ -129,18 +132,26 @@ def parseOATHcsv(csv):
                         'ocrasuite' : xxx  }
         }
     '''
-    TOKENS = {}
-    version = 0
+    return dict(iter_oath_csv(csv.split('\n')))
+
 
-    csv_array = csv.split('\n')
+def iter_oath_csv(lines):
+    """
+    This function parses the lines of an OATH CSV file and yields the tokens
+    one after the other. See ``parseOATHcsv`` for the file format.
 
-    m = re.match(r"^#\s*version:\s*(\d+)", csv_array[0])
-    if m:
-        version = m.group(1)
-        log.debug("the file is version {0}.".format(version))
+    :param lines: An iterable of the lines of the CSV file, e.g. a file object
+    :return: generator of tuples (serial, token dictionary)
+    """
+    version = 0
+    for line_number, line in enumerate(lines):
+        line = to_unicode(line).rstrip("\r\n")
+        if line_number == 0:
+            m = re.match(r"^#\s*version:\s*(\d+)", line)
+            if m:
+                version = m.group(1)
+                log.debug("the file is version {0}.".format(version))
 
-    log.debug("the file contains {0:d} lines.".format(len(csv_array)))
-    for line in csv_array:
         # Do not parse comment lines
         if line.startswith("#"):
             continue
@@ -177,9 +188,7 @@ def parseOATHcsv(csv):
             log.debug("read the line {0!s}".format(params))
 
             params["user"] = user
-            TOKENS[serial] = params
-
-    return TOKENS
+            yield serial, params
 
 
 @log_with(log)
@@ -227,11 +236,19 @@ def parseYubicoCSV(csv):
                          }
         }
     '''
-    TOKENS = {}
-    csv_array = csv.split('\n')
+    return dict(iter_yubico_csv(csv.split('\n')))
+
 
-    log.debug("the file contains {0:d} tokens.".format(len(csv_array)))
-    for line in csv_array:
+def iter_yubico_csv(lines):
+    """
+    This function parses the lines of a Yubico CSV file and yields the tokens
+    one after the other. See ``parseYubicoCSV`` for the file format.
+
+    :param lines: An iterable of the lines of the CSV file, e.g. a file object
+    :return: generator of tuples (serial, token dictionary)
+    """
+    for line in lines:
+        line = to_unicode(line).rstrip("\r\n")
         l = line.split(',')
         serial = ""
         key = ""
@@ -262,11 +279,11 @@ def parseYubicoCSV(csv):
                     ttype = "yubikey"
                     otplen = 32 + len(public_id)
                     serial = "UBAM{0:08d}_{1!s}".format(serial_int, slot)
-                    TOKENS[serial] = {'type': ttype,
-                                      'otpkey': key,
-                                      'otplen': otplen,
-                                      'description': public_id
-                                      }
+                    yield serial, {'type': ttype,
+                                   'otpkey': key,
+                                   'otplen': otplen,
+                                   'description': public_id
+                                   }
                 elif typ.lower() == "oath-hotp":
                     '''
                     WARNING: this does not work out at the moment, since the
@@ -279,11 +296,11 @@ def parseYubicoCSV(csv):
                     ttype = "hotp"
                     otplen = 6
                     serial = "UBOM{0:08d}_{1!s}".format(serial_int, slot)
-                    TOKENS[serial] = {'type': ttype,
-                                      'otpkey': key,
-                                      'otplen': otplen,
-                                      'description': public_id
-                                      }
+                    yield serial, {'type': ttype,
+                                   'otpkey': key,
+                                   'otplen': otplen,
+                                   'description': public_id
+                                   }
                 else:
                     log.warning("at the moment we do only support Yubico OTP"
                                 " and HOTP: %r" % line)
@@ -316,17 +333,15 @@ def parseYubicoCSV(csv):
                     serial = "UBAM{0!s}_{1!s}".format(serial, slot)
                     public_id = l[1].strip()
                     otplen = 32 + len(public_id)
-                TOKENS[serial] = {'type': typ,
-                                  'otpkey': key,
-                                  'otplen': otplen,
-                                  'description': public_id
-                                  }
+                yield serial, {'type': typ,
+                               'otpkey': key,
+                               'otplen': otplen,
+                               'description': public_id
+                               }
         else:
             log.warning("the line {0!r} did not contain a enough values".format(line))
             continue
 
-    return TOKENS
-
 
 @log_with(log)
 def parseSafeNetXML(xml):
@@ -337,54 +352,66 @@ def parseSafeNetXML(xml):
     It returns a dictionary of
         serial : { otpkey , counter, type }
     """
+    return dict(iter_safenet_xml(BytesIO(to_bytes(xml))))
 
-    TOKENS = {}
-    elem_tokencontainer = etree.fromstring(xml)
 
-    if getTagName(elem_tokencontainer) != "Tokens":
-        raise ImportException("No toplevel element Tokens")
+def iter_safenet_xml(xml_file):
+    """
+    This function parses an Aladdin/SafeNet XML file incrementally and yields
+    the tokens one after the other. Only one token element is kept in memory.
+
+    :param xml_file: A binary file object of the XML file
+    :return: generator of tuples (serial, token dictionary)
+    """
+    elem_tokencontainer = None
+    for event, elem in etree.iterparse(xml_file, events=("start", "end")):
+        if elem_tokencontainer is None:
+            elem_tokencontainer = elem
+            if getTagName(elem_tokencontainer) != "Tokens":
+                raise ImportException("No toplevel element Tokens")
+            continue
+        if event != "end" or getTagName(elem) != "Token":
+            continue
 
-    for elem_token in list(elem_tokencontainer):
         SERIAL = None
         COUNTER = None
         HMAC = None
         DESCRIPTION = None
-        if getTagName(elem_token) == "Token":
-            SERIAL = elem_token.get("serial")
-            log.debug("Found token with serial {0!s}".format(SERIAL))
-            for elem_tdata in list(elem_token):
-                tag = getTagName(elem_tdata)
-                if "ProductName" == tag:
-                    DESCRIPTION = elem_tdata.text
-                    log.debug("The Token with the serial %s has the "
-                              "productname %s" % (SERIAL, DESCRIPTION))
-                if "Applications" == tag:
-                    for elem_apps in elem_tdata:
-                        if getTagName(elem_apps) == "Application":
-                            for elem_app in elem_apps:
-                                tag = getTagName(elem_app)
-                                if "Seed" == tag:
-                                    HMAC = elem_app.text
-                                if "MovingFactor" == tag:
-                                    COUNTER = elem_app.text
-            if not SERIAL:
-                log.error("Found token without a serial")
+        SERIAL = elem.get("serial")
+        log.debug("Found token with serial {0!s}".format(SERIAL))
+        for elem_tdata in list(elem):
+            tag = getTagName(elem_tdata)
+            if "ProductName" == tag:
+                DESCRIPTION = elem_tdata.text
+                log.debug("The Token with the serial %s has the "
+                          "productname %s" % (SERIAL, DESCRIPTION))
+            if "Applications" == tag:
+                for elem_apps in elem_tdata:
+                    if getTagName(elem_apps) == "Application":
+                        for elem_app in elem_apps:
+                            tag = getTagName(elem_app)
+                            if "Seed" == tag:
+                                HMAC = elem_app.text
+                            if "MovingFactor" == tag:
+                                COUNTER = elem_app.text
+        # free the memory of the parsed token elements
+        elem_tokencontainer.clear()
+        if not SERIAL:
+            log.error("Found token without a serial")
+        else:
+            if HMAC:
+                hashlib = "sha1"
+                if len(HMAC) == 64:
+                    hashlib = "sha256"
+
+                yield SERIAL, {'otpkey': HMAC,
+                               'counter': COUNTER,
+                               'type': 'hotp',
+                               'hashlib': hashlib
+                               }
             else:
-                if HMAC:
-                    hashlib = "sha1"
-                    if len(HMAC) == 64:
-                        hashlib = "sha256"
-
-                    TOKENS[SERIAL] = {'otpkey': HMAC,
-                                      'counter': COUNTER,
-                                      'type': 'hotp',
-                                      'hashlib': hashlib
-                                      }
-                else:
-                    log.error("Found token {0!s} without a element 'Seed'".format(
-                              SERIAL))
-
-    return TOKENS
+                log.error("Found token {0!s} without a element 'Seed'".format(
+                          SERIAL))
 
 
 def strip_prefix_from_soup(xml_soup):
@@ -470,61 +497,109 @@ def parsePSKCdata(xml_data,
 
     key_packages = xml.keycontainer.findAll("keypackage")
     for key_package in key_packages:
-        token = {}
-        key = key_package.key
-        try:
-            token["description"] = key_package.deviceinfo.manufacturer.string
-        except Exception as exx:
-            log.debug("Can not get manufacturer string {0!s}".format(exx))
-        serial = key["id"]
-        try:
-            serial = key_package.deviceinfo.serialno.string.strip()
-        except Exception as exx:
-            log.debug("Can not get serial string from device info {0!s}".format(exx))
-        algo = key["algorithm"]
-        token["type"] = algo.split(":")[-1].lower()
-        parameters = key.algorithmparameters
-        token["otplen"] = parameters.responseformat["length"] or 6
-        try:
-            token["hashlib"] = parameters.suite["hashalgo"] or "sha1"
-        except Exception as exx:
-            log.warning("No compatible suite contained.")
-        try:
-            if key.data.secret.plainvalue:
-                secret = key.data.secret.plainvalue.string
-                token["otpkey"] = hexlify_and_unicode(base64.b64decode(secret))
-            elif key.data.secret.encryptedvalue:
-                encryptionmethod = key.data.secret.encryptedvalue.encryptionmethod
-                enc_algorithm = encryptionmethod["algorithm"].split("#")[-1]
-                if enc_algorithm.lower() != "aes128-cbc":
-                    raise ImportException("We only import PSKC files with "
-                                          "AES128-CBC.")
-                enc_data = key.data.secret.encryptedvalue.ciphervalue.text
-                enc_data = enc_data.strip()
-                secret = aes_decrypt_b64(binascii.unhexlify(preshared_key_hex), enc_data)
-                if token["type"].lower() in ["hotp", "totp"]:
-                    token["otpkey"] = hexlify_and_unicode(secret)
-                elif token["type"].lower() in ["pw"]:
-                    token["otpkey"] = to_unicode(secret)
-                else:
-                    token["otpkey"] = to_unicode(secret)
-        except Exception as exx:
-            log.error("Failed to import tokendata: {0!s}".format(exx))
-            log.debug(traceback.format_exc())
-            raise ImportException("Failed to import tokendata. Wrong "
-                                  "encryption key? %s" % exx)
-        if token["type"] in ["hotp", "totp"] and key.data.counter:
-            token["counter"] = key.data.counter.text.strip()
-        if token["type"] == "totp":
-            if key.data.timeinterval:
-                token["timeStep"] = key.data.timeinterval.text.strip()
-            if key.data.timedrift:
-                token["timeShift"] = key.data.timedrift.text.strip()
-
+        serial, token = _parse_key_package(key_package, preshared_key_hex)
         tokens[serial] = token
     return tokens
 
 
+def _parse_key_package(key_package, preshared_key_hex=None):
+    """
+    Parse one KeyPackage of a PSKC file.
+
+    :param key_package: The KeyPackage as Beautiful Soup without prefixes
+    :param preshared_key_hex: The preshared key, hexlified
+    :return: tuple of the serial and the token dictionary
+    """
+    token = {}
+    key = key_package.key
+    try:
+        token["description"] = key_package.deviceinfo.manufacturer.string
+    except Exception as exx:
+        log.debug("Can not get manufacturer string {0!s}".format(exx))
+    serial = key["id"]
+    try:
+        serial = key_package.deviceinfo.serialno.string.strip()
+    except Exception as exx:
+        log.debug("Can not get serial string from device info {0!s}".format(exx))
+    algo = key["algorithm"]
+    token["type"] = algo.split(":")[-1].lower()
+    parameters = key.algorithmparameters
+    token["otplen"] = parameters.responseformat["length"] or 6
+    try:
+        token["hashlib"] = parameters.suite["hashalgo"] or "sha1"
+    except Exception as exx:
+        log.warning("No compatible suite contained.")
+    try:
+        if key.data.secret.plainvalue:
+            secret = key.data.secret.plainvalue.string
+            token["otpkey"] = hexlify_and_unicode(base64.b64decode(secret))
+        elif key.data.secret.encryptedvalue:
+            encryptionmethod = key.data.secret.encryptedvalue.encryptionmethod
+            enc_algorithm = encryptionmethod["algorithm"].split("#")[-1]
+            if enc_algorithm.lower() != "aes128-cbc":
+                raise ImportException("We only import PSKC files with "
+                                      "AES128-CBC.")
+            enc_data = key.data.secret.encryptedvalue.ciphervalue.text
+            enc_data = enc_data.strip()
+            secret = aes_decrypt_b64(binascii.unhexlify(preshared_key_hex), enc_data)
+            if token["type"].lower() in ["hotp", "totp"]:
+                token["otpkey"] = hexlify_and_unicode(secret)
+            elif token["type"].lower() in ["pw"]:
+                token["otpkey"] = to_unicode(secret)
+            else:
+                token["otpkey"] = to_unicode(secret)
+    except Exception as exx:
+        log.error("Failed to import tokendata: {0!s}".format(exx))
+        log.debug(traceback.format_exc())
+        raise ImportException("Failed to import tokendata. Wrong "
+                              "encryption key? %s" % exx)
+    if token["type"] in ["hotp", "totp"] and key.data.counter:
+        token["counter"] = key.data.counter.text.strip()
+    if token["type"] == "totp":
+        if key.data.timeinterval:
+            token["timeStep"] = key.data.timeinterval.text.strip()
+        if key.data.timedrift:
+            token["timeShift"] = key.data.timedrift.text.strip()
+
+    return serial, token
+
+
+def iter_pskc_data(xml_file, preshared_key_hex=None, password=None):
+    """
+    This function parses a PSKC file incrementally and yields the tokens one
+    after the other. Only one KeyPackage is kept in memory.
+    See ``parsePSKCdata`` for the supported encryptions.
+
+    Like ``parsePSKCdata``, which uses the lxml parser of Beautiful Soup, the
+    parser tolerates minor errors in the XML file. Entities are not resolved.
+
+    :param xml_file: A binary file object of the XML file
+    :param preshared_key_hex: The preshared key, hexlified
+    :param password: The password that encrypted the keys
+    :return: generator of tuples (serial, token dictionary)
+    """
+    for _event, elem in lxml_etree.iterparse(xml_file, events=("end",),
+                                             recover=True,
+                                             resolve_entities=False,
+                                             no_network=True):
+        # In recover mode, tags with undeclared prefixes keep the prefix
+        tag = to_unicode(elem.tag).rsplit("}", 1)[-1].rsplit(":", 1)[-1]
+        if tag == "EncryptionKey":
+            container_soup = strip_prefix_from_soup(BeautifulSoup(
+                u"<KeyContainer>{0!s}</KeyContainer>".format(
+                    to_unicode(lxml_etree.tostring(elem))), "lxml"))
+            if container_soup.keycontainer.encryptionkey.derivedkey:
+                preshared_key_hex = derive_key(container_soup, password)
+        elif tag == "KeyPackage":
+            key_package = strip_prefix_from_soup(BeautifulSoup(
+                to_unicode(lxml_etree.tostring(elem)), "lxml"))
+            # free the memory of the parsed key packages
+            elem.clear()
+            while elem.getprevious() is not None:
+                del elem.getparent()[0]
+            yield _parse_key_package(key_package.keypackage, preshared_key_hex)
+
+
 class GPGImport(object):
     """
     This class is used to decrypt GPG encrypted import files.
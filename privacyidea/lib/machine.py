@@ -33,15 +33,26 @@ from privacyidea.models import Token
 from privacyidea.models import (MachineToken, db, MachineTokenOptions,
                                 MachineResolver, get_token_id,
                                 get_machineresolver_id,
-                                get_machinetoken_id)
+                                get_machinetoken_id, commit_session)
 from privacyidea.lib.utils import fetch_one_resource
+from privacyidea.lib.framework import get_app_local_store, get_app_config_value
 from netaddr import IPAddress
 from sqlalchemy import and_
+from threading import Lock
+from collections import OrderedDict
+import copy
+import hashlib
+import json
 import logging
+import time
 
 log = logging.getLogger(__name__)
 from privacyidea.lib.log import log_with
-from privacyidea.lib.applications.base import get_auth_item
+from privacyidea.lib.applications.base import (get_auth_item,
+                                               get_machine_application_class_dict)
+
+#: The maximum number of entries in the cache of the authentication items
+AUTHITEM_CACHE_SIZE = 1000
 
 
 @log_with(log)
@@ -171,6 +182,7 @@ def attach_token(serial, application, hostname=None, machine_id=None,
     if options:
         add_option(machinetoken_id=machinetoken.id,
                    options=options)
+    invalidate_auth_item_cache()
 
     return machinetoken
 
@@ -213,7 +225,8 @@ def detach_token(serial, application, hostname=None, machine_id=None,
                                        MachineToken.machine_id == machine_id,
                                        MachineToken.machineresolver_id == machineresolver_id,
                                        MachineToken.application == application)).delete()
-    db.session.commit()
+    commit_session()
+    invalidate_auth_item_cache()
     return r
 
 
@@ -244,6 +257,7 @@ def add_option(machinetoken_id=None, machine_id=None, resolver_name=None,
 
     for option_name, option_value in options.items():
         MachineTokenOptions(machinetoken_id, option_name, option_value)
+    invalidate_auth_item_cache()
     return len(options)
 
 
@@ -273,7 +287,8 @@ def delete_option(machinetoken_id=None, machine_id=None, resolver_name=None,
     r = MachineTokenOptions.query.filter(and_(
         MachineTokenOptions.machinetoken_id == machinetoken_id,
         MachineTokenOptions.mt_key == key)).delete()
-    db.session.commit()
+    commit_session()
+    invalidate_auth_item_cache()
     return r
 
 
@@ -382,6 +397,117 @@ def _get_host_identifier(hostname, machine_id, resolver_name):
     return machine_id, resolver_name
 
 
+class AuthItemCache(object):
+    """
+    A cache of the authentication items of the machines. Each entry holds
+    the authentication items of one request for a hostname, an application
+    and the filter parameters together with their ETag and expires after
+    ``ttl`` seconds. The cache keeps the ``size`` recently used entries.
+
+    The cache is kept per process. It is cleared, if tokens are attached to
+    or detached from machines, if machine token options are changed and if
+    tokens are enabled, disabled, assigned, unassigned or deleted.
+    """
+
+    def __init__(self, ttl, size=AUTHITEM_CACHE_SIZE):
+        self.ttl = ttl
+        self.size = size
+        self._lock = Lock()
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        """
+        :return: tuple of the ETag and the authentication items or None
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return None
+            if entry[0] <= time.time():
+                # The expired entry stays removed
+                return None
+            # Move the entry to the end, since it was used recently
+            self._entries[key] = entry
+        return entry[1], copy.deepcopy(entry[2])
+
+    def set(self, key, etag, auth_items):
+        auth_items = copy.deepcopy(auth_items)
+        now = time.time()
+        with self._lock:
+            self._entries.pop(key, None)
+            for expired in [k for k, entry in self._entries.items()
+                            if entry[0] <= now]:
+                del self._entries[expired]
+            self._entries[key] = (now + self.ttl, etag, auth_items)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries = OrderedDict()
+
+
+def get_auth_item_cache():
+    """
+    Return the ``AuthItemCache`` of the current application or None, if the
+    cache is disabled. This respects the ``PI_AUTHITEM_CACHE_TTL`` config
+    option.
+    """
+    ttl = int(get_app_config_value("PI_AUTHITEM_CACHE_TTL", 0))
+    if ttl <= 0:
+        return None
+    store = get_app_local_store()
+    if "auth_item_cache" not in store:
+        store.setdefault("auth_item_cache", AuthItemCache(ttl))
+    return store["auth_item_cache"]
+
+
+def invalidate_auth_item_cache():
+    """
+    Remove all entries from the cache of the authentication items.
+    """
+    cache = get_app_local_store().get("auth_item_cache")
+    if cache:
+        cache.clear()
+
+
+def get_auth_items_etag(auth_items):
+    """
+    Return the ETag of the given authentication items.
+    """
+    return hashlib.sha256(json.dumps(auth_items, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def get_cached_auth_items(hostname, ip=None, application=None,
+                          serial=None, challenge=None, filter_param=None):
+    """
+    Return the authentication items like ``get_auth_items`` together with
+    their ETag. The authentication items of applications, which allow
+    caching (like SSH), are read from the ``AuthItemCache``, if it is enabled
+    and no challenge is given.
+
+    :return: tuple of the ETag and the dictionary of the authentication items
+    """
+    cache = None
+    app_class = get_machine_application_class_dict().get(application)
+    if app_class and app_class.allow_caching and not challenge:
+        cache = get_auth_item_cache()
+    if cache:
+        key = (hostname, application, serial,
+               json.dumps(filter_param or {}, sort_keys=True))
+        cached = cache.get(key)
+        if cached:
+            log.debug(u"Return the cached auth items of {0!s}".format(hostname))
+            return cached
+    auth_items = get_auth_items(hostname, ip=ip, application=application,
+                                serial=serial, challenge=challenge,
+                                filter_param=filter_param)
+    etag = get_auth_items_etag(auth_items)
+    if cache:
+        cache.set(key, etag, auth_items)
+    return etag, auth_items
+
+
 def get_auth_items(hostname, ip=None, application=None,
                    serial=None, challenge=None, filter_param=None):
     """
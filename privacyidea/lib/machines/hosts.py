@@ -23,6 +23,11 @@ __doc__ = """This contains the HostsMachineResolver which simply resolves
 the machines in a file like /etc/hosts.
 The machine id is the IP address in this case.
 
+The hosts file is parsed once and kept in memory as an index with maps of the
+machine ids, hostnames and IP addresses and a trigram index for substring
+searches. The index is read again, if the modification time or the size of
+the file changes.
+
 This file is tested in tests/test_lib_machines.py in the class
 HostsMachineTestCase
 """
@@ -31,13 +36,145 @@ from .base import Machine
 from .base import BaseMachineResolver
 from .base import MachineResolverError
 
+from threading import Lock
+import os
+
 import netaddr
 
+#: The separator of the fields in the search text of a line. It can not
+#: be part of a hostname, so a substring never matches across two fields.
+SEARCH_SEPARATOR = u"\x00"
+NGRAM_LENGTH = 3
+
+
+class HostsIndex(object):
+    """
+    The parsed content of a hosts file. Each entry is a tuple of the machine
+    id, the list of hostnames and the IP address of a line in the order of
+    the file.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        stat = os.stat(filename)
+        self.file_version = (stat.st_mtime, stat.st_size)
+        self.entries = []
+        self.ids = {}
+        self.hostnames = {}
+        self.ips = {}
+        self.search_texts = []
+        self.ngrams = {}
+        with open(filename, "r") as f:
+            for line in f:
+                split_line = line.split()
+                if len(split_line) < 2:
+                    # skip lines with less than 2 columns
+                    continue
+                if split_line[0][0] == "#":
+                    # skip comments
+                    continue
+                self._add_entry(split_line[0], netaddr.IPAddress(split_line[0]),
+                                split_line[1:])
+
+    def _add_entry(self, line_id, line_ip, line_hostname):
+        i = len(self.entries)
+        self.entries.append((line_id, line_hostname, line_ip))
+        self.ids.setdefault(line_id, []).append(i)
+        self.ips.setdefault(line_ip, []).append(i)
+        for hostname in set(line_hostname):
+            self.hostnames.setdefault(hostname, []).append(i)
+        search_text = SEARCH_SEPARATOR.join([line_id] + line_hostname +
+                                            [u"{0!s}".format(line_ip)])
+        self.search_texts.append(search_text)
+        for ngram in set(search_text[j:j + NGRAM_LENGTH]
+                         for j in range(len(search_text) - NGRAM_LENGTH + 1)):
+            self.ngrams.setdefault(ngram, []).append(i)
+
+    def search(self, needle):
+        """
+        Return the entries, whose machine id, hostnames or IP address contain
+        the given substring.
+
+        :param needle: The substring to search for
+        :return: list of the entry numbers in the order of the file
+        """
+        if SEARCH_SEPARATOR in needle:
+            return []
+        if len(needle) < NGRAM_LENGTH:
+            candidates = range(len(self.entries))
+        else:
+            # Only the entries, which contain all ngrams of the needle, can
+            # contain the needle.
+            postings = []
+            for j in range(len(needle) - NGRAM_LENGTH + 1):
+                posting = self.ngrams.get(needle[j:j + NGRAM_LENGTH])
+                if not posting:
+                    return []
+                postings.append(posting)
+            postings.sort(key=len)
+            candidates = postings[0]
+            for posting in postings[1:]:
+                posting = set(posting)
+                candidates = [i for i in candidates if i in posting]
+        return [i for i in candidates if needle in self.search_texts[i]]
+
+
+_hosts_indexes = {}
+_hosts_index_lock = Lock()
+
+
+def get_hosts_index(filename):
+    """
+    Return the index of the given hosts file. The file is only read again,
+    if its modification time or its size changed.
+
+    :param filename: The name of the hosts file
+    :return: a ``HostsIndex`` object
+    """
+    stat = os.stat(filename)
+    index = _hosts_indexes.get(filename)
+    if index is None or index.file_version != (stat.st_mtime, stat.st_size):
+        with _hosts_index_lock:
+            index = _hosts_indexes.get(filename)
+            if index is None or index.file_version != (stat.st_mtime, stat.st_size):
+                index = HostsIndex(filename)
+                _hosts_indexes[filename] = index
+    return index
+
+
+def _filter(candidates, entries):
+    """
+    Return the entries of ``candidates``, which are also contained in
+    ``entries``. If ``candidates`` is None, all entries are candidates.
+    """
+    if candidates is None:
+        return list(entries)
+    entries = set(entries)
+    return [i for i in candidates if i in entries]
+
+
+def _to_ip_address(ip):
+    """
+    Convert the IP address to a ``netaddr.IPAddress``, which is the key of
+    the IP addresses in the index.
+
+    :return: The IP address or None, if it is not a valid IP address
+    """
+    try:
+        return netaddr.IPAddress(ip)
+    except (netaddr.AddrFormatError, ValueError, TypeError):
+        return None
+
 
 class HostsMachineResolver(BaseMachineResolver):
 
     type = "hosts"
 
+    def _create_machine(self, entry):
+        line_id, line_hostname, line_ip = entry
+        return Machine(self.name, line_id, hostname=list(line_hostname),
+                       ip=line_ip)
+
     def get_machines(self, machine_id=None, hostname=None, ip=None, any=None,
                      substring=False):
         """
@@ -52,56 +189,33 @@ class HostsMachineResolver(BaseMachineResolver):
         :type any: basestring
         :return: list of Machine Objects
         """
-        machines = []
+        index = get_hosts_index(self.filename)
+        candidates = None
+        if any:
+            candidates = index.search(any)
 
-        f = open(self.filename, "r")
-        try:
-            for line in f:
-                split_line = line.split()
-                if len(split_line) < 2:
-                    # skip lines with less than 2 columns
-                    continue
-                if split_line[0][0] == "#":
-                    # skip comments
-                    continue
-                line_id = split_line[0]
-                line_ip = netaddr.IPAddress(split_line[0])
-                line_hostname = split_line[1:]
-                # check if machine_id, ip or hostname matches a substring
-                if (any and any not in line_id and
-                        len([x for x in line_hostname if any in x]) <= 0 and
-                        any not in "{0!s}".format(line_ip)):
-                    # "any" was provided but did not match either
-                    # hostname, ip or machine_id
-                    continue
+        if machine_id:
+            if not substring:
+                # return the first machine with this machine id
+                allowed = None if candidates is None else set(candidates)
+                for i in index.ids.get(machine_id, []):
+                    if allowed is None or i in allowed:
+                        return [self._create_machine(index.entries[i])]
+            else:
+                candidates = [i for i in _filter(candidates, index.search(machine_id))
+                              if machine_id in index.entries[i][0]]
+        if hostname:
+            if substring:
+                candidates = [i for i in _filter(candidates, index.search(hostname))
+                              if len([x for x in index.entries[i][1] if hostname in x])]
+            else:
+                candidates = _filter(candidates, index.hostnames.get(hostname, []))
+        if ip:
+            candidates = _filter(candidates, index.ips.get(_to_ip_address(ip), []))
 
-                else:
-                    if machine_id:
-                        if not substring and machine_id == line_id:
-                            return [Machine(self.name, line_id,
-                                            hostname=line_hostname, ip=line_ip)]
-                        if substring and machine_id not in line_id:
-                            # do not append this machine!
-                            continue
-                    if hostname:
-                        if substring:
-                            h_match = len([x for x in line_hostname if hostname in x])
-                        else:
-                            h_match = hostname in line_hostname
-                        if not h_match:
-                            # do not append this machine!
-                            continue
-
-                    if ip and ip != line_ip:
-                        # Do not append this machine!
-                        continue
-
-                machines.append(Machine(self.name, line_id,
-                                        hostname=line_hostname,
-                                        ip=line_ip))
-        finally:
-            f.close()
-        return machines
+        if candidates is None:
+            candidates = range(len(index.entries))
+        return [self._create_machine(index.entries[i]) for i in candidates]
 
     def get_machine_id(self, hostname=None, ip=None):
         """
@@ -118,11 +232,18 @@ class HostsMachineResolver(BaseMachineResolver):
         :return: The machine ID, which depends on the resolver
         :rtype: basestring
         """
-        machines = self.get_machines()
-        for machine in machines:
-            h_match = not hostname or machine.has_hostname(hostname)
-            i_match = not ip or machine.has_ip(ip)
-            if h_match and i_match:
+        index = get_hosts_index(self.filename)
+        if ip:
+            ip = netaddr.IPAddress(ip)
+        if hostname:
+            candidates = index.hostnames.get(hostname, [])
+        elif ip:
+            candidates = index.ips.get(ip, [])
+        else:
+            candidates = range(len(index.entries))
+        for i in candidates:
+            machine = self._create_machine(index.entries[i])
+            if not ip or machine.has_ip(ip):
                 return machine.id
 
         return
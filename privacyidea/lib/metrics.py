@@ -0,0 +1,432 @@
+# -*- coding: utf-8 -*-
+#
+# This code is free software; you can redistribute it and/or
+# modify it under the terms of the GNU AFFERO GENERAL PUBLIC LICENSE
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or any later version.
+#
+# This code is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU AFFERO GENERAL PUBLIC LICENSE for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+__doc__ = """
+This module implements an in-process registry of metrics like the request
+latency, the duration of the phases of an authentication request, the
+latency of the user resolvers and the number of SQL statements.
+
+Unlike the monitoring statistics in ``lib/monitoringstats.py`` the metrics
+are not written to the database. They are kept in memory and exported in the
+Prometheus text format by the endpoint ``/metrics``.
+
+Like the HTTP client registry in ``lib/httpclient.py``, there is one registry
+per application, which is chosen by ``PI_METRICS_REGISTRY_CLASS``. The
+default "null" registry does not record anything. The "multiprocess" registry
+writes the metrics of each process to a file in ``PI_METRICS_DIR``, so that
+the metrics of all processes of a prefork web server can be exported.
+
+This module is tested in tests/test_lib_metrics.py.
+"""
+
+import functools
+import json
+import logging
+import os
+import time
+from threading import Lock
+
+from flask import has_app_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from privacyidea.lib.framework import get_app_local_store, get_app_config_value
+
+log = logging.getLogger(__name__)
+
+COUNTER = "counter"
+HISTOGRAM = "histogram"
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+DEFAULT_FLUSH_INTERVAL = 5
+
+REQUEST_DURATION = "privacyidea_request_duration_seconds"
+PHASE_DURATION = "privacyidea_phase_duration_seconds"
+POLICY_DURATION = "privacyidea_policy_duration_seconds"
+RESOLVER_DURATION = "privacyidea_resolver_duration_seconds"
+DB_QUERIES = "privacyidea_db_queries_total"
+PERIODIC_TASK_DURATION = "privacyidea_periodictask_duration_seconds"
+
+#: The known metrics. Maps the name to the type and the help text.
+METRICS = {
+    REQUEST_DURATION: (HISTOGRAM, "Duration of the HTTP requests"),
+    PHASE_DURATION: (HISTOGRAM, "Duration of the phases of the authentication requests"),
+    POLICY_DURATION: (HISTOGRAM, "Duration of the pre and post policy functions"),
+    RESOLVER_DURATION: (HISTOGRAM, "Duration of the calls of the user resolvers"),
+    DB_QUERIES: (COUNTER, "Number of executed SQL statements"),
+    PERIODIC_TASK_DURATION: (HISTOGRAM, "Duration of the periodic tasks"),
+}
+
+METRICS_FILE_PREFIX = "metrics-"
+
+
+class _NullTimer(object):
+    """
+    A timer which does nothing
+    """
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+NULL_TIMER = _NullTimer()
+
+
+class _Timer(object):
+    """
+    A timer which observes its duration in a histogram
+    """
+    def __init__(self, registry, name, labels):
+        self.registry = registry
+        self.name = name
+        self.labels = labels
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.registry.observe(self.name, time.time() - self.start, **self.labels)
+        return False
+
+
+def _format_labels(labels):
+    return u",".join(u'{0!s}="{1!s}"'.format(key, u"{0!s}".format(value).replace(
+        '\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for key, value in labels)
+
+
+def _format_value(value):
+    if value == int(value):
+        return u"{0:d}".format(int(value))
+    return repr(float(value))
+
+
+def render_metrics(values, buckets=DEFAULT_BUCKETS):
+    """
+    Render the metrics in the Prometheus text format.
+
+    :param values: dictionary mapping tuples of the name and the labels to
+        the list of values. A counter has one value. A histogram has the
+        counts of the buckets, the count of the larger values, the sum and
+        the count.
+    :param buckets: The upper bounds of the histogram buckets
+    :return: The metrics as text
+    """
+    lines = []
+    names = sorted(set(name for name, _labels in values))
+    for name in names:
+        metric_type, help_text = METRICS.get(name, (COUNTER, ""))
+        lines.append(u"# HELP {0!s} {1!s}".format(name, help_text))
+        lines.append(u"# TYPE {0!s} {1!s}".format(name, metric_type))
+        for (value_name, labels), value in sorted(values.items()):
+            if value_name != name:
+                continue
+            if metric_type == HISTOGRAM:
+                cumulative = 0
+                for bound, count in zip(list(buckets) + ["+Inf"], value[:-2]):
+                    cumulative += count
+                    bucket_labels = labels + (("le", bound),)
+                    lines.append(u"{0!s}_bucket{{{1!s}}} {2!s}".format(
+                        name, _format_labels(bucket_labels), _format_value(cumulative)))
+                label_str = u"{{{0!s}}}".format(_format_labels(labels)) if labels else u""
+                lines.append(u"{0!s}_sum{1!s} {2!s}".format(name, label_str,
+                                                            _format_value(value[-2])))
+                lines.append(u"{0!s}_count{1!s} {2!s}".format(name, label_str,
+                                                              _format_value(value[-1])))
+            else:
+                label_str = u"{{{0!s}}}".format(_format_labels(labels)) if labels else u""
+                lines.append(u"{0!s}{1!s} {2!s}".format(name, label_str,
+                                                        _format_value(value[0])))
+    return u"\n".join(lines) + u"\n"
+
+
+def merge_values(target, values):
+    """
+    Add the metric values to the target dictionary.
+    """
+    for key, value in values.items():
+        if key in target:
+            target[key] = [a + b for a, b in zip(target[key], value)]
+        else:
+            target[key] = list(value)
+    return target
+
+
+class BaseMetricsRegistry(object):
+    """
+    Abstract base class for metrics registries.
+    """
+    #: True, if the registry records metrics
+    enabled = False
+
+    def inc(self, name, value=1, **labels):
+        """
+        Increase a counter.
+
+        :param name: The name of the counter
+        :param value: The value to add
+        :param labels: The labels of the counter
+        """
+        pass
+
+    def observe(self, name, value, **labels):
+        """
+        Observe a value in a histogram.
+
+        :param name: The name of the histogram
+        :param value: The value like a duration in seconds
+        :param labels: The labels of the histogram
+        """
+        pass
+
+    def timer(self, name, **labels):
+        """
+        Return a context manager, which observes its duration in a histogram.
+        """
+        return NULL_TIMER
+
+    def get_values(self):
+        """
+        :return: dictionary mapping tuples of the name and the labels to the
+            list of values
+        """
+        return {}
+
+    def render(self):
+        """
+        :return: The metrics in the Prometheus text format
+        """
+        return render_metrics(self.get_values())
+
+
+class NullMetricsRegistry(BaseMetricsRegistry):
+    """
+    A registry which does not record any metrics.
+
+    It is used, if ``PI_METRICS_REGISTRY_CLASS`` is "null", which is the
+    default.
+    """
+    pass
+
+
+class ProcessMetricsRegistry(BaseMetricsRegistry):
+    """
+    A registry which keeps the metrics of the current process in memory.
+
+    It can be activated by setting ``PI_METRICS_REGISTRY_CLASS`` to "process".
+    With a prefork web server, each scrape only returns the metrics of the
+    process, which handles the request.
+    """
+    enabled = True
+
+    def __init__(self):
+        BaseMetricsRegistry.__init__(self)
+        self._lock = Lock()
+        self._values = {}
+        self._pid = os.getpid()
+        self.buckets = DEFAULT_BUCKETS
+        _register_engine_listener()
+
+    def _check_pid(self):
+        # A forked process must not report the metrics of its parent
+        if os.getpid() != self._pid:
+            self._pid = os.getpid()
+            self._values = {}
+
+    def _updated(self):
+        """
+        Called with the lock held after the values have been updated
+        """
+        pass
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._check_pid()
+            values = self._values.get(key)
+            if values is None:
+                self._values[key] = [value]
+            else:
+                values[0] += value
+            self._updated()
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        index = len(self.buckets)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                index = i
+                break
+        with self._lock:
+            self._check_pid()
+            values = self._values.get(key)
+            if values is None:
+                values = self._values[key] = [0] * (len(self.buckets) + 3)
+            values[index] += 1
+            values[-2] += value
+            values[-1] += 1
+            self._updated()
+
+    def timer(self, name, **labels):
+        return _Timer(self, name, labels)
+
+    def get_values(self):
+        with self._lock:
+            self._check_pid()
+            return dict((key, list(value)) for key, value in self._values.items())
+
+
+class MultiprocessMetricsRegistry(ProcessMetricsRegistry):
+    """
+    A registry which keeps the metrics of the current process in memory and
+    writes them to a file in a directory shared by all processes at most
+    every ``flush_interval`` seconds. The exported metrics are the sum of
+    the metrics of all files. The files of terminated processes are kept, so
+    that the counters do not decrease.
+
+    It can be activated by setting ``PI_METRICS_REGISTRY_CLASS`` to
+    "multiprocess" and ``PI_METRICS_DIR`` to the directory.
+    """
+
+    def __init__(self, directory, flush_interval=DEFAULT_FLUSH_INTERVAL):
+        ProcessMetricsRegistry.__init__(self)
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self._next_flush = 0
+
+    def _get_filename(self, pid=None):
+        return os.path.join(self.directory, u"{0!s}{1!s}.json".format(
+            METRICS_FILE_PREFIX, pid or self._pid))
+
+    def _updated(self):
+        now = time.time()
+        if now >= self._next_flush:
+            self._next_flush = now + self.flush_interval
+            self._write()
+
+    def _write(self):
+        """
+        Write the metrics of this process to its file. This is called with
+        the lock held.
+        """
+        filename = self._get_filename()
+        tmp_filename = u"{0!s}.tmp".format(filename)
+        try:
+            with open(tmp_filename, "w") as f:
+                json.dump([[name, labels, value] for (name, labels), value
+                           in self._values.items()], f)
+            os.rename(tmp_filename, filename)
+        except (IOError, OSError) as exx:  # pragma: no cover
+            log.warning(u"Could not write the metrics file {0!s}: {1!r}".format(filename, exx))
+
+    def flush(self):
+        """
+        Write the metrics of this process to its file now.
+        """
+        with self._lock:
+            self._check_pid()
+            self._write()
+
+    def get_values(self):
+        self.flush()
+        values = {}
+        for filename in os.listdir(self.directory):
+            if not (filename.startswith(METRICS_FILE_PREFIX) and filename.endswith(".json")):
+                continue
+            try:
+                with open(os.path.join(self.directory, filename)) as f:
+                    file_values = json.load(f)
+            except (IOError, OSError, ValueError) as exx:  # pragma: no cover
+                log.warning(u"Could not read the metrics file {0!s}: {1!r}".format(filename, exx))
+                continue
+            merge_values(values, dict(((name, tuple(tuple(label) for label in labels)), value)
+                                      for name, labels, value in file_values))
+        return values
+
+
+def _count_query(conn, cursor, statement, parameters, context, executemany):
+    if has_app_context():
+        get_registry().inc(DB_QUERIES)
+
+
+def _register_engine_listener():
+    """
+    Count the SQL statements of all engines. The listener is only registered
+    once per process and only if metrics are recorded.
+    """
+    if not event.contains(Engine, "before_cursor_execute", _count_query):
+        event.listen(Engine, "before_cursor_execute", _count_query)
+
+
+def _create_registry():
+    registry_class_name = get_app_config_value("PI_METRICS_REGISTRY_CLASS", "null")
+    if registry_class_name == "multiprocess":
+        directory = get_app_config_value("PI_METRICS_DIR")
+        if directory and os.path.isdir(directory):
+            return MultiprocessMetricsRegistry(
+                directory,
+                float(get_app_config_value("PI_METRICS_FLUSH_INTERVAL",
+                                           DEFAULT_FLUSH_INTERVAL)))
+        log.warning(u"PI_METRICS_DIR {0!r} is not a directory. Only the metrics of "
+                    u"the current process are recorded.".format(directory))
+        return ProcessMetricsRegistry()
+    elif registry_class_name == "process":
+        return ProcessMetricsRegistry()
+    elif registry_class_name != "null":
+        log.warning(u"Unknown metrics registry class: {!r}".format(registry_class_name))
+    return NullMetricsRegistry()
+
+
+def get_registry():
+    """
+    Return the metrics registry associated with the current application.
+    If there is no such object yet, create one and write it to the app-local store.
+    This respects the ``PI_METRICS_REGISTRY_CLASS`` config option.
+    :return: a ``MetricsRegistry`` object
+    """
+    app_store = get_app_local_store()
+    try:
+        return app_store["metrics_registry"]
+    except KeyError:
+        registry = _create_registry()
+        log.info(u"Created a new metrics registry: {!r}".format(registry))
+        return app_store.setdefault("metrics_registry", registry)
+
+
+def timer(name, **labels):
+    """
+    Shortcut to get a timer from the application-global registry.
+
+        with timer(PHASE_DURATION, phase="user"):
+            ...
+    """
+    return get_registry().timer(name, **labels)
+
+
+def timed(name, **labels):
+    """
+    Decorator, which observes the duration of the decorated function in the
+    histogram ``name``.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def timed_wrapper(*args, **kwds):
+            with get_registry().timer(name, **labels):
+                return func(*args, **kwds)
+        return timed_wrapper
+    return decorator
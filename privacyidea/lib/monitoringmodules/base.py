@@ -26,11 +26,21 @@ tuples of (timestamp, status key, status value)
 
 A monitoring module needs to provide the possibility to write new data,
 return all available keys, return the last data. 
+
+It may also return the values in time buckets of a coarser resolution, which
+are aggregated by one of the functions in AGGREGATES.
 """
 import logging
 log = logging.getLogger(__name__)
 from privacyidea.lib.log import log_with
 
+#: The supported resolutions and the size of their time buckets in seconds
+RESOLUTIONS = {"5min": 300,
+               "hour": 3600,
+               "day": 86400}
+#: The aggregate functions of the values in a time bucket
+AGGREGATES = ["avg", "min", "max", "last", "sum", "count"]
+
 
 class Monitoring(object):
 
@@ -45,15 +55,22 @@ class Monitoring(object):
         """
         return []
 
-    def get_values(self, stats_key, start_timestamp=None, end_timestamp=None):
+    def get_values(self, stats_key, start_timestamp=None, end_timestamp=None,
+                   resolution=None, aggregate="avg"):
         """
         Return a list of tuples of (timestamp, value) for the requested stats_key.
 
+        If a resolution is given, one tuple is returned per time bucket. The
+        timestamp is the start of the bucket and the value is the aggregate
+        of the values in the bucket.
+
         :param stats_key: Identifier of the stats
         :param start_timestamp: start of the time frame
         :type start_timestamp: timezone aware datetime
         :param end_timestamp:  end of the time frame
         :type end_timestamp: timezone aware datetime
+        :param resolution: None for the raw values or a key of RESOLUTIONS
+        :param aggregate: One of AGGREGATES
         :return:
         """
         return []
@@ -80,6 +97,19 @@ class Monitoring(object):
         """
         return 0
 
+    def delete_old_values(self, timestamp, resolution=None):
+        """
+        Delete the entries of all stats keys, which are older than the
+        timestamp.
+
+        :param timestamp: The entries before this time are deleted
+        :type timestamp: timezone aware datetime
+        :param resolution: None to delete the raw values or a key of
+            RESOLUTIONS to delete the time buckets of this resolution
+        :return: number of deleted entries
+        """
+        return 0
+
     def add_value(self, stats_key, stats_value, timestamp, reset_values=False):
         """
         This method adds a measurement point to the statistics key "stats_key".
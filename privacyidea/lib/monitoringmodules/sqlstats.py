@@ -20,17 +20,25 @@
 # License along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 __doc__ = """This module writes statistics data to the SQL database table "monitoringstats".
+
+Each new value is also added to the time buckets of the table
+"monitoringstatsrollup" with an atomic SQL update. So the values of a key can
+be read in a coarser resolution without reading all raw values.
 """
+import calendar
+import datetime
 import logging
 from privacyidea.lib.monitoringmodules.base import Monitoring as MonitoringBase
+from privacyidea.lib.monitoringmodules.base import RESOLUTIONS
 from privacyidea.lib.pooling import get_engine
 from sqlalchemy.orm import sessionmaker, scoped_session
 from privacyidea.lib.utils import censor_connect_string, convert_timestamp_to_utc
 from privacyidea.lib.lifecycle import register_finalizer
 log = logging.getLogger(__name__)
-from sqlalchemy import MetaData, cast, String
+from sqlalchemy import MetaData, cast, String, Float, case, func
 from sqlalchemy import asc, desc, and_, or_
-from privacyidea.models import MonitoringStats
+from sqlalchemy.exc import IntegrityError
+from privacyidea.models import MonitoringStats, MonitoringStatsRollup
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker, scoped_session
 import traceback
@@ -40,6 +48,32 @@ from dateutil.tz import tzlocal, tzutc
 metadata = MetaData()
 
 
+def _get_bucket(timestamp, resolution):
+    """
+    Return the start of the time bucket, which contains the timestamp.
+
+    :param timestamp: naive datetime in UTC
+    :param resolution: The size of the time bucket in seconds
+    :return: naive datetime in UTC
+    """
+    seconds = calendar.timegm(timestamp.timetuple())
+    return datetime.datetime.utcfromtimestamp(seconds - seconds % resolution)
+
+
+def _get_aggregate_column(aggregate):
+    """
+    Return the column or SQL expression of the rollup table, which
+    contains the given aggregate of a time bucket.
+    """
+    if aggregate == "avg":
+        return cast(MonitoringStatsRollup.sum_value, Float) / MonitoringStatsRollup.count
+    return {"min": MonitoringStatsRollup.min_value,
+            "max": MonitoringStatsRollup.max_value,
+            "last": MonitoringStatsRollup.last_value,
+            "sum": MonitoringStatsRollup.sum_value,
+            "count": MonitoringStatsRollup.count}[aggregate]
+
+
 class Monitoring(MonitoringBase):
 
     def __init__(self, config=None):
@@ -78,6 +112,65 @@ class Monitoring(MonitoringBase):
             log.debug("Using no SQL pool_size.")
         return engine
 
+    def _add_to_rollups(self, stats_key, stats_value, utc_timestamp):
+        """
+        Add the value to the time buckets of all resolutions. The bucket is
+        updated with an atomic SQL update. Only if it does not exist yet, it
+        is created.
+        """
+        R = MonitoringStatsRollup
+        is_last = R.last_timestamp <= utc_timestamp
+        values = {R.count: R.count + 1,
+                  R.sum_value: R.sum_value + stats_value,
+                  R.min_value: case([(R.min_value > stats_value, stats_value)],
+                                    else_=R.min_value),
+                  R.max_value: case([(R.max_value < stats_value, stats_value)],
+                                    else_=R.max_value),
+                  R.last_value: case([(is_last, stats_value)], else_=R.last_value),
+                  R.last_timestamp: case([(is_last, utc_timestamp)],
+                                         else_=R.last_timestamp)}
+        for resolution in RESOLUTIONS.values():
+            bucket = _get_bucket(utc_timestamp, resolution)
+            for _i in range(2):
+                try:
+                    r = self.session.query(R).filter(R.stats_key == stats_key,
+                                                     R.resolution == resolution,
+                                                     R.timestamp == bucket).update(
+                        values, synchronize_session=False)
+                    if not r:
+                        self.session.add(R(stats_key, resolution, bucket,
+                                           stats_value, utc_timestamp))
+                    self.session.commit()
+                    break
+                except IntegrityError:
+                    # A concurrent request created the bucket in the meantime
+                    self.session.rollback()
+
+    def _rebuild_rollup(self, stats_key, resolution, bucket):
+        """
+        Recreate a time bucket from the raw values in the bucket.
+        The old time bucket must already be deleted.
+        """
+        conditions = [MonitoringStats.stats_key == stats_key,
+                      MonitoringStats.timestamp >= bucket,
+                      MonitoringStats.timestamp < bucket + datetime.timedelta(seconds=resolution)]
+        count, sum_value, min_value, max_value, last_timestamp = self.session.query(
+            func.count(MonitoringStats.id), func.sum(MonitoringStats.stats_value),
+            func.min(MonitoringStats.stats_value), func.max(MonitoringStats.stats_value),
+            func.max(MonitoringStats.timestamp)).filter(and_(*conditions)).one()
+        if count:
+            # Several values may have the same timestamp. The value, which
+            # was added last, wins like in _add_to_rollups.
+            last_value = self.session.query(MonitoringStats.stats_value).filter(
+                MonitoringStats.stats_key == stats_key,
+                MonitoringStats.timestamp == last_timestamp).order_by(
+                MonitoringStats.id.desc()).limit(1).first()[0]
+            self.session.add(MonitoringStatsRollup(stats_key, resolution, bucket,
+                                                   last_value, last_timestamp,
+                                                   count=count, sum_value=sum_value,
+                                                   min_value=min_value,
+                                                   max_value=max_value))
+
     def add_value(self, stats_key, stats_value, timestamp, reset_values=False):
         utc_timestamp = convert_timestamp_to_utc(timestamp)
         try:
@@ -88,7 +181,10 @@ class Monitoring(MonitoringBase):
                 # Successfully saved the new stats entry, so remove old entries
                 self.session.query(MonitoringStats).filter(and_(MonitoringStats.stats_key == stats_key,
                                                   MonitoringStats.timestamp < utc_timestamp)).delete()
+                self.session.query(MonitoringStatsRollup).filter(
+                    MonitoringStatsRollup.stats_key == stats_key).delete()
                 self.session.commit()
+            self._add_to_rollups(stats_key, stats_value, utc_timestamp)
         except Exception as exx:  # pragma: no cover
             log.error(u"exception {0!r}".format(exx))
             log.error(u"DATA: {0!s} -> {0!s}".format(stats_key, stats_value))
@@ -109,12 +205,65 @@ class Monitoring(MonitoringBase):
             conditions.append(MonitoringStats.timestamp <= utc_end_timestamp)
         try:
             r = self.session.query(MonitoringStats).filter(and_(*conditions)).delete()
+            self._delete_rollups(stats_key, start_timestamp, end_timestamp)
             self.session.commit()
         except Exception as exx:  # pragma: no cover
             log.error(u"exception {0!r}".format(exx))
             log.error(u"could not delete statskeys {0!s}".format(stats_key))
             log.debug(u"{0!s}".format(traceback.format_exc()))
             self.session.rollback()
+            # Nothing was deleted
+            r = None
+
+        finally:
+            self.session.close()
+
+        return r
+
+    def _delete_rollups(self, stats_key, start_timestamp, end_timestamp):
+        """
+        Delete the time buckets of the stats_key, which overlap the time
+        frame. The buckets at the borders of the time frame are recreated
+        from the remaining raw values.
+        """
+        utc_start_timestamp = utc_end_timestamp = None
+        if start_timestamp:
+            utc_start_timestamp = convert_timestamp_to_utc(start_timestamp)
+        if end_timestamp:
+            utc_end_timestamp = convert_timestamp_to_utc(end_timestamp)
+        for resolution in RESOLUTIONS.values():
+            conditions = [MonitoringStatsRollup.stats_key == stats_key,
+                          MonitoringStatsRollup.resolution == resolution]
+            borders = set()
+            if utc_start_timestamp:
+                start_bucket = _get_bucket(utc_start_timestamp, resolution)
+                conditions.append(MonitoringStatsRollup.timestamp >= start_bucket)
+                borders.add(start_bucket)
+            if utc_end_timestamp:
+                end_bucket = _get_bucket(utc_end_timestamp, resolution)
+                conditions.append(MonitoringStatsRollup.timestamp <= end_bucket)
+                borders.add(end_bucket)
+            self.session.query(MonitoringStatsRollup).filter(and_(*conditions)).delete()
+            for bucket in borders:
+                self._rebuild_rollup(stats_key, resolution, bucket)
+
+    def delete_old_values(self, timestamp, resolution=None):
+        r = None
+        utc_timestamp = convert_timestamp_to_utc(timestamp)
+        try:
+            if resolution:
+                r = self.session.query(MonitoringStatsRollup).filter(
+                    MonitoringStatsRollup.resolution == RESOLUTIONS[resolution],
+                    MonitoringStatsRollup.timestamp < utc_timestamp).delete()
+            else:
+                r = self.session.query(MonitoringStats).filter(
+                    MonitoringStats.timestamp < utc_timestamp).delete()
+            self.session.commit()
+        except Exception as exx:  # pragma: no cover
+            log.error(u"exception {0!r}".format(exx))
+            log.error(u"could not delete old values")
+            log.debug(u"{0!s}".format(traceback.format_exc()))
+            self.session.rollback()
 
         finally:
             self.session.close()
@@ -140,10 +289,37 @@ class Monitoring(MonitoringBase):
             self.session.close()
         return keys
 
-    def get_values(self, stats_key, start_timestamp=None, end_timestamp=None, date_strings=False):
+    def _get_rollup_values(self, stats_key, start_timestamp, end_timestamp,
+                           resolution, aggregate):
+        """
+        Return the aggregates of the time buckets, which overlap the time frame.
+        """
+        values = []
+        resolution = RESOLUTIONS[resolution]
+        conditions = [MonitoringStatsRollup.stats_key == stats_key,
+                      MonitoringStatsRollup.resolution == resolution]
+        if start_timestamp:
+            utc_start_timestamp = convert_timestamp_to_utc(start_timestamp)
+            conditions.append(MonitoringStatsRollup.timestamp >=
+                              _get_bucket(utc_start_timestamp, resolution))
+        if end_timestamp:
+            utc_end_timestamp = convert_timestamp_to_utc(end_timestamp)
+            conditions.append(MonitoringStatsRollup.timestamp <= utc_end_timestamp)
+        for timestamp, value in self.session.query(
+                MonitoringStatsRollup.timestamp,
+                _get_aggregate_column(aggregate)).filter(and_(*conditions)). \
+                order_by(MonitoringStatsRollup.timestamp.asc()):
+            values.append((timestamp.replace(tzinfo=tzutc()), value))
+        return values
+
+    def get_values(self, stats_key, start_timestamp=None, end_timestamp=None, date_strings=False,
+                   resolution=None, aggregate="avg"):
         values = []
 
         try:
+            if resolution:
+                return self._get_rollup_values(stats_key, start_timestamp, end_timestamp,
+                                               resolution, aggregate)
             conditions = [MonitoringStats.stats_key == stats_key]
             if start_timestamp:
                 utc_start_timestamp = convert_timestamp_to_utc(start_timestamp)
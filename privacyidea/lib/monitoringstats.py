@@ -24,11 +24,16 @@ database table "monitoringstats". This can be arbitrary data for time series of
   
    timestamp, key, value
 
+The values can also be read in the resolutions "5min", "hour" and "day". Then
+the monitoring module returns one aggregated value per time bucket.
+
 This module is tested in tests/test_lib_monitoringstats.py
 """
 import logging
 from dateutil.tz import tzlocal
+from privacyidea.lib.error import ParameterError
 from privacyidea.lib.log import log_with
+from privacyidea.lib.monitoringmodules.base import RESOLUTIONS, AGGREGATES
 from privacyidea.lib.utils import get_module_class
 from privacyidea.lib.framework import get_app_config, get_request_local_store
 import datetime
@@ -103,18 +108,48 @@ def get_stats_keys():
     return monitoring_obj.get_keys()
 
 
-def get_values(stats_key, start_timestamp=None, end_timestamp=None):
+def delete_old_stats(timestamp, resolution=None):
+    """
+    Delete the statistics of all keys, which are older than the timestamp.
+
+    :param timestamp: The statistics before this time are deleted
+    :type timestamp: timezone-aware datetime object
+    :param resolution: None to delete the raw values or one of "5min", "hour"
+        and "day" to delete the aggregated values of this resolution
+    :return: The number of deleted entries
+    """
+    if resolution and resolution not in RESOLUTIONS:
+        raise ParameterError(u"Unknown resolution {0!r}.".format(resolution))
+    monitoring_obj = _get_monitoring()
+    return monitoring_obj.delete_old_values(timestamp, resolution=resolution)
+
+
+def get_values(stats_key, start_timestamp=None, end_timestamp=None,
+               resolution=None, aggregate="avg"):
     """
     Return a list of sets of (timestamp, value), ordered by timestamps in ascending order
 
+    If a resolution is given, there is one set per time bucket, which contains
+    the start of the bucket and the aggregate of its values.
+
     :param stats_key: The stats key to query
     :param start_timestamp: the start of the timespan, inclusive
     :type start_timestamp: timezone-aware datetime object
     :param end_timestamp: the end of the timespan, inclusive
     :type end_timestamp: timezone-aware datetime object
+    :param resolution: None for the raw values or one of "5min", "hour" and "day"
+    :param aggregate: The aggregate of the time buckets: "avg", "min", "max",
+        "last", "sum" or "count"
     :return: list of tuples, with timestamps being timezone-aware UTC datetime objects
     """
+    if resolution and resolution not in RESOLUTIONS:
+        raise ParameterError(u"Unknown resolution {0!r}.".format(resolution))
+    if aggregate not in AGGREGATES:
+        raise ParameterError(u"Unknown aggregate {0!r}.".format(aggregate))
     monitoring_obj = _get_monitoring()
+    if resolution:
+        return monitoring_obj.get_values(stats_key, start_timestamp, end_timestamp,
+                                         resolution=resolution, aggregate=aggregate)
     return monitoring_obj.get_values(stats_key, start_timestamp, end_timestamp)
 
 
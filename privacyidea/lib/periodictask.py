@@ -21,24 +21,46 @@ __doc__ = """This module provides functions to manage periodic tasks in the data
 to determine their next scheduled running time and to run them."""
 
 import logging
-from datetime import datetime
+import time
+import traceback
+from datetime import datetime, timedelta
+from threading import Thread
 
 from croniter import croniter
 from dateutil.tz import tzutc, tzlocal
+from sqlalchemy import and_, or_
+from sqlalchemy.exc import IntegrityError
 
 from privacyidea.lib.error import ParameterError, ResourceNotFoundError
+from privacyidea.lib.metrics import get_registry, PERIODIC_TASK_DURATION
+from privacyidea.lib.monitoringstats import write_stats
 from privacyidea.lib.utils import fetch_one_resource
+from privacyidea.lib.task.authcachejanitor import AuthCacheJanitorTask
+from privacyidea.lib.task.challengejanitor import ChallengeJanitorTask
 from privacyidea.lib.task.eventcounter import EventCounterTask
+from privacyidea.lib.task.monitoringjanitor import MonitoringJanitorTask
 from privacyidea.lib.task.simplestats import SimpleStatsTask
-from privacyidea.models import PeriodicTask
+from privacyidea.lib.task.tokenimportjanitor import TokenImportJanitorTask
+from privacyidea.lib.task.tokenstats import TokenStatsTask
+from privacyidea.models import db, PeriodicTask, PeriodicTaskLease
 from privacyidea.lib.framework import get_app_config
 
 log = logging.getLogger(__name__)
 
-TASK_CLASSES = [EventCounterTask, SimpleStatsTask]
+TASK_CLASSES = [EventCounterTask, SimpleStatsTask, ChallengeJanitorTask,
+                AuthCacheJanitorTask, MonitoringJanitorTask, TokenStatsTask,
+                TokenImportJanitorTask]
 #: TASK_MODULES maps task module identifiers to subclasses of BaseTask
 TASK_MODULES = dict((cls.identifier, cls) for cls in TASK_CLASSES)
 
+#: The default number of periodic tasks, which the scheduler runs concurrently
+DEFAULT_SCHEDULER_WORKERS = 4
+#: The default duration of a lease in seconds. The scheduler renews the
+#: leases of the running tasks in each round.
+DEFAULT_LEASE_TIMEOUT = 600
+#: The monitoring stats key of the durations of a periodic task in milliseconds
+DURATION_STATS_KEY = u"periodictask_duration_{0!s}"
+
 
 def get_available_taskmodules():
     """
@@ -70,9 +92,11 @@ def calculate_next_timestamp(ptask, node, interval_tzinfo=None):
     The next timestamp is calculated based on the last time the task was run on the given node.
     If the task has never run on the node, the last update timestamp of the periodic tasks
     is used as a reference timestamp.
+    If ``node`` is None, the last run on any node is used, so that the task is
+    run once per interval on one of its nodes.
 
     :param ptask: Dictionary describing the periodic task, as from ``PeriodicTask.get()``
-    :param node: Node on which the periodic task is scheduled
+    :param node: Node on which the periodic task is scheduled or None
     :type node: unicode
     :param interval_tzinfo: Timezone in which the cron expression should be interpreted. Defaults to local time.
     :type interval_tzinfo: tzinfo
@@ -80,7 +104,10 @@ def calculate_next_timestamp(ptask, node, interval_tzinfo=None):
     """
     if interval_tzinfo is None:
         interval_tzinfo = tzlocal()
-    timestamp = ptask["last_runs"].get(node, ptask["last_update"])
+    if node is None:
+        timestamp = max(ptask["last_runs"].values()) if ptask["last_runs"] else ptask["last_update"]
+    else:
+        timestamp = ptask["last_runs"].get(node, ptask["last_update"])
     local_timestamp = timestamp.astimezone(interval_tzinfo)
     iterator = croniter(ptask["interval"], local_timestamp)
     next_timestamp = iterator.get_next(datetime)
@@ -272,3 +299,269 @@ def execute_task(taskmodule, params):
     module = get_taskmodule(taskmodule)
     log.info(u"Running taskmodule {!r} with parameters {!r}".format(module, params))
     return module.do(params)
+
+
+def get_due_periodic_tasks(node, current_timestamp=None, interval_tzinfo=None):
+    """
+    Collect all periodic tasks, which may be run on a specific node and whose
+    next scheduled run is due, ordered by their ordering.
+
+    Unlike ``get_scheduled_periodic_tasks`` the next run is calculated based
+    on the last run on any node. This function is used by the scheduler, which
+    runs each task once per interval on one of its nodes.
+
+    :param node: Node name
+    :type node: unicode
+    :param current_timestamp: The current timestamp, defaults to the current time
+    :type current_timestamp: timezone-aware datetime
+    :param interval_tzinfo: timezone in which the crontab expression should be interpreted
+    :type interval_tzinfo: tzinfo, defaults to local time
+    :return: List of tuples of the periodic task dictionary and the scheduled
+        timestamp of the run
+    """
+    active_ptasks = get_periodic_tasks(node=node, active=True)
+    if current_timestamp is None:
+        current_timestamp = datetime.now(tzutc())
+    if current_timestamp.tzinfo is None:
+        raise ParameterError(u"expected timezone-aware datetime, got {!r}".format(current_timestamp))
+    due_ptasks = []
+    for ptask in active_ptasks:
+        try:
+            next_timestamp = calculate_next_timestamp(ptask, None, interval_tzinfo)
+            if next_timestamp <= current_timestamp:
+                log.debug(u"Periodic task {!r} is due since {!s}".format(ptask["name"],
+                                                                        next_timestamp.isoformat()))
+                due_ptasks.append((ptask, next_timestamp))
+        except Exception as e:
+            log.warning(u"Ignoring periodic task {!r}: {!r}".format(ptask["name"], e))
+    return due_ptasks
+
+
+def _get_utc_timestamp(timestamp=None):
+    """
+    Return the given timezone-aware timestamp or the current time as naive datetime in UTC.
+    """
+    if timestamp is None:
+        return datetime.utcnow()
+    return timestamp.astimezone(tzutc()).replace(tzinfo=None)
+
+
+def acquire_periodic_task_lease(ptask_id, node, scheduled, lease_timeout=DEFAULT_LEASE_TIMEOUT,
+                                current_timestamp=None):
+    """
+    Try to acquire the lease of a periodic task for the run at the scheduled timestamp.
+    The lease is granted, if the lease of the task is held for an earlier run or
+    if the lease for this run has expired without the run being finished.
+    Thus, each scheduled run is only started once, even if several nodes try to
+    acquire the lease concurrently. The lease is committed immediately.
+
+    :param ptask_id: ID of the periodic task
+    :type ptask_id: int
+    :param node: Node name
+    :type node: unicode
+    :param scheduled: The scheduled timestamp of the run
+    :type scheduled: timezone-aware datetime
+    :param lease_timeout: The number of seconds, after which the lease expires
+    :param current_timestamp: The current timestamp, defaults to the current time
+    :type current_timestamp: timezone-aware datetime
+    :return: True, if the node holds the lease
+    """
+    now = _get_utc_timestamp(current_timestamp)
+    scheduled = _get_utc_timestamp(scheduled)
+    expires = now + timedelta(seconds=lease_timeout)
+    # The condition is evaluated by the database, so that only one of several
+    # concurrent updates succeeds.
+    acquired = PeriodicTaskLease.query.filter(
+        PeriodicTaskLease.periodictask_id == ptask_id,
+        or_(PeriodicTaskLease.scheduled < scheduled,
+            and_(PeriodicTaskLease.scheduled == scheduled,
+                 PeriodicTaskLease.finished == None,
+                 PeriodicTaskLease.expires <= now))).update(
+        {"node": node, "scheduled": scheduled, "expires": expires, "finished": None},
+        synchronize_session=False)
+    if not acquired and not PeriodicTaskLease.query.filter_by(periodictask_id=ptask_id).count():
+        # The task has never been run by the scheduler
+        db.session.add(PeriodicTaskLease(ptask_id, node, scheduled, expires))
+        acquired = 1
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # Another node created the lease in the meantime
+        db.session.rollback()
+        acquired = 0
+    if acquired:
+        log.debug(u"Node {!r} acquired the lease of periodic task {!r}".format(node, ptask_id))
+    return bool(acquired)
+
+
+def renew_periodic_task_lease(ptask_id, node, scheduled, lease_timeout=DEFAULT_LEASE_TIMEOUT,
+                              current_timestamp=None):
+    """
+    Extend the lease of a periodic task, which is running on the node.
+
+    :param ptask_id: ID of the periodic task
+    :param node: Node name
+    :param scheduled: The scheduled timestamp of the run
+    :type scheduled: timezone-aware datetime
+    :param lease_timeout: The number of seconds, after which the lease expires
+    :param current_timestamp: The current timestamp, defaults to the current time
+    :type current_timestamp: timezone-aware datetime
+    :return: True, if the node still holds the lease
+    """
+    expires = _get_utc_timestamp(current_timestamp) + timedelta(seconds=lease_timeout)
+    renewed = PeriodicTaskLease.query.filter_by(
+        periodictask_id=ptask_id, node=node, scheduled=_get_utc_timestamp(scheduled),
+        finished=None).update({"expires": expires}, synchronize_session=False)
+    db.session.commit()
+    return bool(renewed)
+
+
+def release_periodic_task_lease(ptask_id, node, scheduled, success, current_timestamp=None):
+    """
+    Release the lease of a periodic task after the run. If the run was
+    successful, the run is marked as finished. Otherwise the lease expires
+    immediately, so that the run is retried by any node.
+
+    :param ptask_id: ID of the periodic task
+    :param node: Node name
+    :param scheduled: The scheduled timestamp of the run
+    :type scheduled: timezone-aware datetime
+    :param success: Whether the run was successful
+    :type success: bool
+    :param current_timestamp: The current timestamp, defaults to the current time
+    :type current_timestamp: timezone-aware datetime
+    """
+    now = _get_utc_timestamp(current_timestamp)
+    values = {"finished": now} if success else {"expires": now}
+    PeriodicTaskLease.query.filter_by(
+        periodictask_id=ptask_id, node=node, scheduled=_get_utc_timestamp(scheduled),
+        finished=None).update(values, synchronize_session=False)
+    db.session.commit()
+
+
+def record_periodic_task_duration(name, duration):
+    """
+    Record the duration of a run of a periodic task in the monitoring stats
+    (in milliseconds) and in the metrics registry (in seconds).
+
+    :param name: Name of the periodic task
+    :param duration: The duration in seconds
+    :type duration: float
+    """
+    get_registry().observe(PERIODIC_TASK_DURATION, duration, task=name)
+    write_stats(DURATION_STATS_KEY.format(name), int(duration * 1000))
+
+
+class PeriodicTaskScheduler(object):
+    """
+    The scheduler runs the due periodic tasks of a node concurrently in
+    worker threads. Several nodes may run a scheduler at the same time: The
+    leases in the database ensure, that each scheduled run of a task is only
+    started by one node. The ``tick`` method needs to be called regularly
+    in an application context.
+    """
+
+    def __init__(self, app, node, workers=DEFAULT_SCHEDULER_WORKERS,
+                 lease_timeout=DEFAULT_LEASE_TIMEOUT, interval_tzinfo=None):
+        """
+        :param app: The privacyIDEA app, which provides the application context of the workers
+        :param node: Node name
+        :type node: unicode
+        :param workers: The maximum number of concurrently running tasks
+        :type workers: int
+        :param lease_timeout: The number of seconds, after which the lease of
+            a task expires, if it is not renewed
+        :type lease_timeout: int
+        :param interval_tzinfo: timezone in which the crontab expressions should be interpreted
+        :type interval_tzinfo: tzinfo, defaults to local time
+        """
+        if workers < 1:
+            raise ParameterError(u"Invalid number of workers: {!s}".format(workers))
+        self.app = app
+        self.node = node
+        self.workers = workers
+        self.lease_timeout = lease_timeout
+        self.interval_tzinfo = interval_tzinfo
+        #: maps the IDs of the running tasks to the thread and the scheduled timestamp
+        self.running = {}
+
+    def _reap(self):
+        """
+        Forget the finished threads.
+        """
+        for ptask_id, (thread, _scheduled) in list(self.running.items()):
+            if not thread.is_alive():
+                del self.running[ptask_id]
+
+    def tick(self, current_timestamp=None):
+        """
+        Renew the leases of the running tasks and start the due tasks as long
+        as there are free workers.
+
+        :param current_timestamp: The current timestamp, defaults to the current time
+        :type current_timestamp: timezone-aware datetime
+        :return: list of the names of the started tasks
+        """
+        self._reap()
+        for ptask_id, (_thread, scheduled) in self.running.items():
+            if not renew_periodic_task_lease(ptask_id, self.node, scheduled,
+                                             self.lease_timeout, current_timestamp):
+                log.warning(u"Node {!r} lost the lease of the running periodic task "
+                            u"{!r}.".format(self.node, ptask_id))
+        started = []
+        for ptask, scheduled in get_due_periodic_tasks(self.node, current_timestamp,
+                                                       self.interval_tzinfo):
+            if len(self.running) >= self.workers:
+                log.debug(u"All workers are busy.")
+                break
+            if ptask["id"] in self.running:
+                continue
+            if acquire_periodic_task_lease(ptask["id"], self.node, scheduled,
+                                           self.lease_timeout, current_timestamp):
+                thread = Thread(target=self._run_task, args=(ptask, scheduled))
+                thread.daemon = True
+                self.running[ptask["id"]] = (thread, scheduled)
+                thread.start()
+                started.append(ptask["name"])
+        return started
+
+    def join(self, timeout=None):
+        """
+        Wait for the running tasks to finish.
+
+        :param timeout: The number of seconds to wait for each task or None
+        :return: True, if no task is running anymore
+        """
+        for thread, _scheduled in list(self.running.values()):
+            thread.join(timeout)
+        self._reap()
+        return not self.running
+
+    def _run_task(self, ptask, scheduled):
+        """
+        Run a periodic task in a worker thread, record the duration and
+        release the lease.
+        """
+        with self.app.app_context():
+            start = time.time()
+            try:
+                log.info(u"Node {!r} runs the periodic task {!r} scheduled "
+                         u"at {!s}".format(self.node, ptask["name"], scheduled.isoformat()))
+                result = execute_task(ptask["taskmodule"], ptask["options"])
+            except Exception as e:
+                log.warning(u"Caught exception when running {!r}: {!r}".format(ptask["name"], e))
+                log.debug(u"{0!s}".format(traceback.format_exc()))
+                db.session.rollback()
+                result = False
+            duration = time.time() - start
+            try:
+                if result:
+                    set_periodic_task_last_run(ptask["id"], self.node, datetime.now(tzutc()))
+                else:
+                    log.warning(u"Periodic task {!r} on node {!r} did not run "
+                                u"successfully.".format(ptask["name"], self.node))
+                record_periodic_task_duration(ptask["name"], duration)
+                release_periodic_task_lease(ptask["id"], self.node, scheduled, bool(result))
+            except Exception as e:  # pragma: no cover
+                log.error(u"Could not finish the periodic task {!r}: {!r}".format(ptask["name"], e))
+                log.debug(u"{0!s}".format(traceback.format_exc()))
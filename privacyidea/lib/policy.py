@@ -159,7 +159,7 @@ from operator import itemgetter
 import six
 import logging
 from ..models import (Policy, Config, PRIVACYIDEA_TIMESTAMP, db,
-                      save_config_timestamp)
+                      save_config_timestamp, commit_session)
 from privacyidea.lib.config import (get_token_classes, get_token_types,
                                     Singleton)
 from privacyidea.lib.framework import get_app_config_value
@@ -175,13 +175,20 @@ from privacyidea.lib import _
 import datetime
 import re
 import ast
+from collections import OrderedDict
+from copy import deepcopy
+from threading import Lock
 from six import with_metaclass, string_types
+from flask import request, has_request_context
 
 log = logging.getLogger(__name__)
 
 optional = True
 required = False
 
+#: The maximum number of keys, for which the UI rights are cached
+UI_CACHE_SIZE = 1000
+
 
 class SCOPE(object):
     __doc__ = """This is the list of the allowed scopes that can be used in
@@ -380,6 +387,53 @@ class TIMEOUT_ACTION(object):
     LOCKSCREEN = 'lockscreen'
 
 
+class PolicyDecisionCache(object):
+    """
+    This cache holds the policies, which were found during one request, for
+    each combination of filter values. It also holds the ordered resolvers
+    of the users, which are needed for policies with ``check_all_resolvers``.
+
+    The cache is stored in the request object, since the ``PolicyClass`` is
+    shared between the requests and threads.
+    """
+
+    def __init__(self, policies):
+        """
+        :param policies: The list of policies of the PolicyClass. If the
+            policies are reloaded, the cache is not valid anymore.
+        """
+        self.policies = policies
+        self.decisions = {}
+        self.user_resolvers = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """
+        Return the cached list of policies for the filter values or None.
+        """
+        policies = self.decisions.get(key)
+        if policies is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            log.debug(u"Policy cache hit: {0:d} hits, {1:d} misses".format(
+                self.hits, self.misses))
+        return policies
+
+    def set(self, key, policies):
+        self.decisions[key] = policies
+
+    def get_user_resolvers(self, user, realm):
+        """
+        Return the ordered resolvers of the user in the realm. They are only
+        determined once per request.
+        """
+        if (user, realm) not in self.user_resolvers:
+            self.user_resolvers[(user, realm)] = User(user, realm=realm).get_ordererd_resolvers()
+        return self.user_resolvers[(user, realm)]
+
+
 class PolicyClass(with_metaclass(Singleton, object)):
 
     """
@@ -396,6 +450,12 @@ class PolicyClass(with_metaclass(Singleton, object)):
         """
         self.policies = []
         self.timestamp = None
+        # The UI rights are computed once for each logged in user and client
+        # and kept until the policies are reloaded. Only the rights of the
+        # UI_CACHE_SIZE recently used users and clients are kept.
+        self._ui_cache = OrderedDict()
+        self._ui_cache_policies = None
+        self._ui_cache_lock = Lock()
         # read the policies from the database and store it in the object
         self.reload_from_db()
 
@@ -454,6 +514,22 @@ class PolicyClass(with_metaclass(Singleton, object)):
 
         return value_found, value_excluded
 
+    def get_decision_cache(self):
+        """
+        Return the policy decision cache of the current request. Outside of
+        a request nothing is cached and None is returned.
+
+        :return: a PolicyDecisionCache object or None
+        """
+        if not has_request_context():
+            return None
+        cache = getattr(request, "policy_decision_cache", None)
+        if cache is None or cache.policies is not self.policies:
+            # The policies have been reloaded
+            cache = PolicyDecisionCache(self.policies)
+            request.policy_decision_cache = cache
+        return cache
+
     @log_with(log)
     def get_policies(self, name=None, scope=None, realm=None, active=None,
                      resolver=None, user=None, client=None, action=None,
@@ -461,6 +537,8 @@ class PolicyClass(with_metaclass(Singleton, object)):
                      sort_by_priority=True, audit_data=None):
         """
         Return the policies of the given filter values.
+        During a request the result for the same filter values is only
+        determined once.
 
         :param name: The name of the policy
         :param scope: The scope of the policy
@@ -487,6 +565,40 @@ class PolicyClass(with_metaclass(Singleton, object)):
         :return: list of policies
         :rtype: list of dicts
         """
+        cache = self.get_decision_cache()
+        key = (name, scope, realm, active, resolver, user, client, action,
+               adminrealm, time, all_times, sort_by_priority)
+        try:
+            hash(key)
+        except TypeError:
+            # e.g. a list of users can not be cached
+            cache = None
+        reduced_policies = cache.get(key) if cache else None
+        if reduced_policies is None:
+            reduced_policies = self._filter_policies(
+                name=name, scope=scope, realm=realm, active=active,
+                resolver=resolver, user=user, client=client, action=action,
+                adminrealm=adminrealm, time=time, all_times=all_times,
+                sort_by_priority=sort_by_priority, cache=cache)
+            if cache:
+                cache.set(key, reduced_policies)
+
+        if audit_data is not None:
+            for p in reduced_policies:
+                audit_data.setdefault("policies", []).append(p.get("name"))
+
+        return list(reduced_policies)
+
+    def _filter_policies(self, name, scope, realm, active, resolver, user,
+                         client, action, adminrealm, time, all_times,
+                         sort_by_priority, cache=None):
+        """
+        Filter the policies. See ``get_policies`` for the parameters.
+
+        :param cache: The PolicyDecisionCache of the request, which is used
+            for the resolvers of the user
+        :return: list of policies
+        """
         reduced_policies = self.policies
 
         # filter policy for time. If no time is set or is a time is set and
@@ -546,8 +658,11 @@ class PolicyClass(with_metaclass(Singleton, object)):
                         # We have a realm and a user and can get all resolvers
                         # of this user in the realm
                         if not user_resolvers:
-                            user_resolvers = User(user,
-                                                  realm=realm).get_ordererd_resolvers()
+                            if cache:
+                                user_resolvers = cache.get_user_resolvers(user, realm)
+                            else:
+                                user_resolvers = User(user,
+                                                      realm=realm).get_ordererd_resolvers()
                         for reso in user_resolvers:
                             value_found, _v_ex = self._search_value(
                                 policy.get("resolver"), reso)
@@ -599,10 +714,6 @@ class PolicyClass(with_metaclass(Singleton, object)):
         if sort_by_priority:
             reduced_policies = sorted(reduced_policies, key=itemgetter("priority"))
 
-        if audit_data is not None:
-            for p in reduced_policies:
-                audit_data.setdefault("policies", []).append(p.get("name"))
-
         return reduced_policies
 
     @staticmethod
@@ -701,6 +812,39 @@ class PolicyClass(with_metaclass(Singleton, object)):
 
         return policy_values
 
+    def _get_ui_cached(self, key, compute):
+        """
+        Return the UI rights for the given key from the cache. If they are not
+        cached yet, they are computed by calling ``compute``.
+        The cache is cleared, if the policies are reloaded. It keeps the
+        rights of the ``UI_CACHE_SIZE`` recently used keys. If a policy is
+        restricted to a time range, the UI rights are not cached, since they
+        depend on the current time.
+
+        :param key: A tuple of the kind of rights, the role, the realm, the
+            username and the client
+        :param compute: A function without arguments, which returns the rights
+        :return: a copy of the rights
+        """
+        policies = self.policies
+        with self._ui_cache_lock:
+            if self._ui_cache_policies is not policies:
+                self._ui_cache = OrderedDict()
+                self._ui_cache_policies = policies
+            if key in self._ui_cache:
+                # Move the entry to the end, since it was used recently
+                value = self._ui_cache.pop(key)
+                self._ui_cache[key] = value
+                return deepcopy(value)
+        value = compute()
+        if not [p for p in policies if p.get("time")]:
+            with self._ui_cache_lock:
+                if self._ui_cache_policies is policies:
+                    self._ui_cache[key] = value
+                    while len(self._ui_cache) > UI_CACHE_SIZE:
+                        self._ui_cache.popitem(last=False)
+        return deepcopy(value)
+
     @log_with(log)
     def ui_get_main_menus(self, logged_in_user, client=None):
         """
@@ -714,6 +858,12 @@ class PolicyClass(with_metaclass(Singleton, object)):
         :param client: The IP address of the client
         :return: A list of MENUs to be displayed
         """
+        key = ("menus", logged_in_user.get("role"), logged_in_user.get("realm"),
+               logged_in_user.get("username"), client)
+        return self._get_ui_cached(key, lambda: self._ui_get_main_menus(logged_in_user,
+                                                                        client))
+
+    def _ui_get_main_menus(self, logged_in_user, client=None):
         from privacyidea.lib.token import get_dynamic_policy_definitions
         role = logged_in_user.get("role")
         user_rights = self.ui_get_rights(role,
@@ -745,6 +895,11 @@ class PolicyClass(with_metaclass(Singleton, object)):
         :param client: The HTTP client IP
         :return: A list of actions
         """
+        key = ("rights", scope, realm, username, client)
+        return self._get_ui_cached(key, lambda: self._ui_get_rights(scope, realm,
+                                                                    username, client))
+
+    def _ui_get_rights(self, scope, realm, username, client=None):
         from privacyidea.lib.auth import ROLE
         from privacyidea.lib.token import get_dynamic_policy_definitions
         rights = set()
@@ -809,6 +964,12 @@ class PolicyClass(with_metaclass(Singleton, object)):
         :type logged_in_user: dict
         :return: list of token types, the user may enroll
         """
+        key = ("enroll", logged_in_user.get("role"), logged_in_user.get("realm"),
+               logged_in_user.get("username"), client)
+        return self._get_ui_cached(key, lambda: self._ui_get_enroll_tokentypes(
+            client, logged_in_user))
+
+    def _ui_get_enroll_tokentypes(self, client, logged_in_user):
         from privacyidea.lib.auth import ROLE
         enroll_types = {}
         role = logged_in_user.get("role")
@@ -933,7 +1094,7 @@ def set_policy(name=None, scope=None, action=None, realm=None, resolver=None,
         p1.active = active
         p1.check_all_resolvers = check_all_resolvers
         save_config_timestamp()
-        db.session.commit()
+        commit_session()
         ret = p1.id
     else:
         # Create a new policy
@@ -48,6 +48,7 @@ from privacyidea.lib.policy import ACTION, SCOPE, ACTIONVALUE, LOGINMODE
 from privacyidea.lib.user import User
 from privacyidea.lib.utils import parse_timelimit, parse_timedelta
 from privacyidea.lib.authcache import verify_in_cache, add_to_cache
+from privacyidea.lib.authcounter import get_auth_count, add_auth
 import datetime
 from dateutil.tz import tzlocal
 from privacyidea.lib.radiusserver import get_radius
@@ -216,7 +217,7 @@ def auth_user_has_no_token(wrapped_function, user_object, passw,
     :param options: Dict containing values for "g" and "clientip"
     :return: Tuple of True/False and reply-dictionary
     """
-    from privacyidea.lib.token import get_tokens
+    from privacyidea.lib.token import get_user_token_summary
     options = options or {}
     g = options.get("g")
     if g:
@@ -230,7 +231,7 @@ def auth_user_has_no_token(wrapped_function, user_object, passw,
                                                    client=clientip, active=True)
         if pass_no_token:
             # Now we need to check, if the user really has no token.
-            tokencount = get_tokens(user=user_object, count=True)
+            tokencount = get_user_token_summary(user_object).count()
             if tokencount == 0:
                 g.audit_object.add_policy([p.get("name") for p in pass_no_token])
                 return True, {"message": u"user has no token, accepted due to '{!s}'".format(
@@ -293,7 +294,7 @@ def auth_user_passthru(wrapped_function, user_object, passw, options=None):
     :param options: Dict containing values for "g" and "clientip"
     :return: Tuple of True/False and reply-dictionary
     """
-    from privacyidea.lib.token import get_tokens
+    from privacyidea.lib.token import get_user_token_summary
     options = options or {}
     g = options.get("g")
     if g:
@@ -308,7 +309,7 @@ def auth_user_passthru(wrapped_function, user_object, passw, options=None):
                                                active=True,
                                                sort_by_priority=True)
         # We only go to passthru, if the user has no tokens!
-        if pass_thru and get_tokens(user=user_object, count=True) == 0:
+        if pass_thru and get_user_token_summary(user_object).count() == 0:
             # Ensure that there are no conflicting action values within the same priority
             policy_object.check_for_conflicts(pass_thru, "passthru")
             pass_thru_action = pass_thru[0].get("action").get("passthru")
@@ -379,16 +380,14 @@ def auth_user_timelimit(wrapped_function, user_object, passw, options=None):
             user=user_object.login,
             client=clientip,
             unique=True)
+        max_ages = []
         # Check for maximum failed authentications
         # Always - also in case of unsuccessful authentication
         if len(max_fail_dict) == 1:
             policy_count, tdelta = parse_timelimit(list(max_fail_dict)[0])
-            fail_c = g.audit_object.get_count({"user": user_object.login,
-                                               "realm": user_object.realm,
-                                               "action":
-                                                   "%/validate/check"},
-                                              success=False,
-                                              timedelta=tdelta)
+            max_ages.append(tdelta)
+            fail_c = get_auth_count(user_object.login, user_object.realm,
+                                    False, tdelta)
             log.debug("Checking users timelimit %s: %s "
                       "failed authentications" %
                       (list(max_fail_dict)[0], fail_c))
@@ -398,18 +397,15 @@ def auth_user_timelimit(wrapped_function, user_object, passw, options=None):
                                          "per %s" % (policy_count, tdelta))
                 g.audit_object.add_policy(next(iter(max_fail_dict.values())))
 
-        if res:
-            # Check for maximum successful authentications
-            # Only in case of a successful authentication
-            if len(max_success_dict) == 1:
-                policy_count, tdelta = parse_timelimit(list(max_success_dict)[0])
+        if len(max_success_dict) == 1:
+            policy_count, tdelta = parse_timelimit(list(max_success_dict)[0])
+            max_ages.append(tdelta)
+            if res:
+                # Check for maximum successful authentications
+                # Only in case of a successful authentication
                 # check the successful authentications for this user
-                succ_c = g.audit_object.get_count({"user": user_object.login,
-                                                   "realm": user_object.realm,
-                                                   "action":
-                                                       "%/validate/check"},
-                                                  success=True,
-                                                  timedelta=tdelta)
+                succ_c = get_auth_count(user_object.login, user_object.realm,
+                                        True, tdelta)
                 log.debug("Checking users timelimit %s: %s "
                           "succesful authentications" %
                           (list(max_success_dict)[0], succ_c))
@@ -419,6 +415,11 @@ def auth_user_timelimit(wrapped_function, user_object, passw, options=None):
                                              "authentications per %s"
                                              % (policy_count, tdelta))
 
+        if max_ages:
+            # Count this authentication for the following requests
+            add_auth(user_object.login, user_object.realm, res,
+                     max_age=max(max_ages))
+
     return res, reply_dict
 
 
@@ -19,12 +19,21 @@
 #
 from privacyidea.models import PrivacyIDEAServer as PrivacyIDEAServerDB
 import logging
+import re
+import time
+from threading import Thread, Lock
+from six.moves.queue import Queue, Empty
+from requests.exceptions import (ConnectionError as RequestsConnectionError,
+                                 ConnectTimeout)
+from urllib3.exceptions import (MaxRetryError, NewConnectionError,
+                                ConnectTimeoutError)
 from privacyidea.lib.log import log_with
 from privacyidea.lib.utils import fetch_one_resource
 from privacyidea.lib.error import ConfigAdminError, privacyIDEAError
+from privacyidea.lib.framework import get_app_local_store, get_app_config_value
 import json
 from privacyidea.lib import _
-import requests
+from privacyidea.lib import httpclient
 
 __doc__ = """
 This is the library for creating, listing and deleting remote privacyIDEA 
@@ -33,10 +42,268 @@ server objects in the Database.
 It depends on the PrivacyIDEAServver in the database model models.py. This 
 module can be tested standalone without any webservices.
 This module is tested in tests/test_lib_privacyideaserver.py
+
+The URL of a privacyIDEA server definition may contain several URLs of
+upstream servers, separated by spaces or commas. Requests are then sent with
+an ``UpstreamGroup``, which fails over to the next upstream server, if an
+upstream server does not answer. Upstream servers, which failed several times
+in a row, are skipped for some time (circuit breaker). Optionally an
+idempotent request is sent to the next upstream server in parallel, if the
+first one has not answered within a given time (hedged request).
+
+Requests, which are not idempotent, like ``POST /validate/check``, must not be
+processed twice, since this would use the OTP value twice or increase the fail
+counter on several upstream servers. They are only sent to the next upstream
+server, if the connection could not be established, and they are never hedged.
+If the connection is closed after the request was sent, the upstream server
+may have processed the request, so it is not sent again.
 """
 
 log = logging.getLogger(__name__)
 
+#: Number of consecutive failures after which an upstream server is skipped
+DEFAULT_UPSTREAM_MAX_FAILURES = 3
+#: Number of seconds after which a skipped upstream server is tried again
+DEFAULT_UPSTREAM_RETRY_AFTER = 30
+#: Number of seconds after which a hedged request is sent. 0 disables hedging.
+DEFAULT_UPSTREAM_HEDGE_AFTER = 0
+#: HTTP methods, whose requests may be sent to several upstream servers
+IDEMPOTENT_METHODS = ["GET", "HEAD", "OPTIONS"]
+
+
+def connection_failed(exx):
+    """
+    Check whether the exception of a request means, that the connection to
+    the upstream server could not be established, i.e. that the request was
+    not sent. A ``ConnectionError`` is also raised, if the connection is
+    closed after the request was sent, in which case this returns False.
+
+    :param exx: The exception raised by the request
+    :return: True, if the request was not sent
+    """
+    if isinstance(exx, ConnectTimeout):
+        return True
+    if isinstance(exx, RequestsConnectionError) and exx.args:
+        reason = exx.args[0]
+        if isinstance(reason, MaxRetryError):
+            return isinstance(reason.reason, (NewConnectionError,
+                                              ConnectTimeoutError))
+    return False
+
+
+def split_urls(urls):
+    """
+    Split a string of URLs, which are separated by spaces or commas.
+
+    :param urls: The URLs
+    :type urls: basestring
+    :return: list of URLs
+    """
+    return [url for url in re.split(r"[\s,]+", urls or "") if url]
+
+
+class UpstreamHealth(object):
+    """
+    The health state of one upstream server. The state is shared by all
+    threads of a process.
+    """
+
+    def __init__(self, url):
+        self.url = url
+        self._lock = Lock()
+        self.failures = 0
+        self.open_until = 0
+        self.latency = None
+
+    def is_available(self):
+        """
+        :return: False, if the circuit breaker is open, i.e. the upstream
+            server failed too often and should not be used right now.
+        """
+        return time.time() >= self.open_until
+
+    def success(self, latency):
+        with self._lock:
+            self.failures = 0
+            self.open_until = 0
+            # exponentially weighted moving average of the latency
+            if self.latency is None:
+                self.latency = latency
+            else:
+                self.latency = 0.8 * self.latency + 0.2 * latency
+
+    def failure(self, max_failures, retry_after):
+        with self._lock:
+            self.failures += 1
+            if self.failures >= max_failures:
+                log.warning(u"The upstream server {0!s} failed {1!s} times. "
+                            u"Skipping it for {2!s} seconds.".format(self.url,
+                                                                     self.failures,
+                                                                     retry_after))
+                self.open_until = time.time() + retry_after
+
+
+def get_upstream_health(url):
+    """
+    Return the health state of the upstream server with the given URL.
+    The health states are kept in the app-local store.
+    """
+    store = get_app_local_store()
+    health = store.setdefault("upstream_health", {})
+    try:
+        return health[url]
+    except KeyError:
+        return health.setdefault(url, UpstreamHealth(url))
+
+
+class UpstreamGroup(object):
+    """
+    A group of upstream privacyIDEA servers, which can answer the same requests.
+    """
+
+    def __init__(self, upstreams, max_failures=None, retry_after=None,
+                 hedge_after=None):
+        """
+        :param upstreams: list of tuples (url, tls)
+        :param max_failures: The number of consecutive failures, after which
+            an upstream server is skipped
+        :param retry_after: The number of seconds, after which a skipped
+            upstream server is tried again
+        :param hedge_after: The number of seconds, after which the request is
+            also sent to the next upstream server. 0 disables hedging.
+        """
+        self.upstreams = upstreams
+        self.max_failures = int(max_failures if max_failures is not None else
+                                get_app_config_value("PI_UPSTREAM_MAX_FAILURES",
+                                                     DEFAULT_UPSTREAM_MAX_FAILURES))
+        self.retry_after = float(retry_after if retry_after is not None else
+                                 get_app_config_value("PI_UPSTREAM_RETRY_AFTER",
+                                                      DEFAULT_UPSTREAM_RETRY_AFTER))
+        self.hedge_after = float(hedge_after if hedge_after is not None else
+                                 get_app_config_value("PI_UPSTREAM_HEDGE_AFTER",
+                                                      DEFAULT_UPSTREAM_HEDGE_AFTER))
+
+    @classmethod
+    def from_urls(cls, urls, tls=True, **kwargs):
+        """
+        Create an upstream group from a string of URLs.
+
+        :param urls: URLs separated by spaces or commas
+        :param tls: whether the certificates of the servers should be checked
+        """
+        return cls([(url, tls) for url in split_urls(urls)], **kwargs)
+
+    def _ordered_upstreams(self):
+        """
+        Return the upstreams in the order, in which they should be tried.
+        Available upstreams are tried in the configured order, upstreams with
+        an open circuit breaker are only tried as a last resort.
+        """
+        available = []
+        unavailable = []
+        for url, tls in self.upstreams:
+            health = get_upstream_health(url)
+            if health.is_available():
+                available.append((url, tls, health))
+            else:
+                unavailable.append((url, tls, health))
+        return available + unavailable
+
+    def _send(self, client, health, method, url, kwargs, results):
+        """
+        Send the request and put a tuple (url, response, exception) to
+        the results queue. This may run in a separate thread.
+        """
+        start = time.time()
+        try:
+            response = client.request(method, url, **kwargs)
+            if response.status_code >= 500:
+                health.failure(self.max_failures, self.retry_after)
+            else:
+                health.success(time.time() - start)
+            results.put((url, response, None))
+        except Exception as exx:
+            health.failure(self.max_failures, self.retry_after)
+            results.put((url, None, exx))
+
+    def request(self, method, path="", idempotent=None, **kwargs):
+        """
+        Send a request to the upstream servers.
+        The request is sent to the first available upstream server. If it
+        fails with a connection error or a status code 5xx, it is sent to the
+        next one. If hedging is enabled and the upstream server has not
+        answered within ``hedge_after`` seconds, the request is also sent to
+        the next upstream server and the first answer is used.
+
+        A request, which is not idempotent, is only sent to the next upstream
+        server, if the connection could not be established. It is never hedged.
+
+        :param method: The HTTP method
+        :param path: The path, that is appended to the URL of the upstream server
+        :param idempotent: Whether the request may be processed by several
+            upstream servers. If None, only GET, HEAD and OPTIONS requests are
+            idempotent.
+        :param kwargs: The parameters of ``requests.request``
+        :return: tuple of the URL and the ``requests.Response`` object
+        """
+        if idempotent is None:
+            idempotent = method.upper() in IDEMPOTENT_METHODS
+        hedge_after = self.hedge_after if idempotent else 0
+        upstreams = self._ordered_upstreams()
+        if not upstreams:
+            raise ConfigAdminError("No upstream privacyIDEA server defined.")
+        results = Queue()
+        pending = 0
+        last_error = None
+        last_response = None
+        # The clients are fetched here, since the threads do not have an
+        # application context
+        registry = httpclient.get_registry()
+        clients = [registry.get_client(url, verify=tls) for url, tls, _h in upstreams]
+        upstreams = [(url + path, client, health)
+                     for (url, _tls, health), client in zip(upstreams, clients)]
+        try:
+            while upstreams or pending:
+                if upstreams and (not pending or hedge_after):
+                    url, client, health = upstreams.pop(0)
+                    log.debug(u"Sending {0!s} request to {1!r}".format(method, url))
+                    args = (client, health, method, url, kwargs, results)
+                    if hedge_after:
+                        thread = Thread(target=self._send, args=args)
+                        thread.daemon = True
+                        thread.start()
+                    else:
+                        self._send(*args)
+                    pending += 1
+                try:
+                    # wait for the hedge timeout, if there is another upstream server
+                    timeout = hedge_after if (upstreams and hedge_after) else None
+                    url, response, exx = results.get(timeout=timeout)
+                except Empty:
+                    log.info(u"No answer within {0!s} seconds. Sending a hedged "
+                             u"request.".format(hedge_after))
+                    continue
+                pending -= 1
+                if exx is None and response.status_code < 500:
+                    return url, response
+                log.warning(u"The upstream server {0!r} failed: {1!r}".format(
+                    url, exx or response.status_code))
+                last_error = exx
+                if response is not None:
+                    last_response = (url, response)
+                if not idempotent and not connection_failed(exx):
+                    # The upstream server may have processed the request
+                    break
+            if last_response:
+                return last_response
+            raise last_error
+        finally:
+            # hedged requests, which are still running, close their
+            # connections when they are garbage collected
+            if not registry.shared and not pending:
+                for client in clients:
+                    client.close()
+
 
 class PrivacyIDEAServer(object):
     """
@@ -53,11 +320,22 @@ class PrivacyIDEAServer(object):
         """
         self.config = db_privacyideaserver_object
 
+    @property
+    def upstreams(self):
+        """
+        The upstream servers of this privacyIDEA server definition.
+
+        :return: an ``UpstreamGroup`` object
+        """
+        return UpstreamGroup.from_urls(self.config.url, self.config.tls)
+
     @staticmethod
     def request(config, user, password):
         """
         Perform an HTTP test request to the privacyIDEA server.
         The privacyIDEA configuration contains the URL and the TLS verify.
+        If the URL contains several URLs, the request fails over to the
+        next upstream server.
 
         * config.url
         * config.tls
@@ -68,10 +346,8 @@ class PrivacyIDEAServer(object):
         :param password: the password/OTP to test
         :return: True or False. If any error occurs, an exception is raised.
         """
-        response = requests.post(config.url + "/validate/check",
-                          data={"user": user, "pass": password},
-                          verify=config.tls
-                          )
+        _url, response = UpstreamGroup.from_urls(config.url, config.tls).request(
+            "POST", "/validate/check", data={"user": user, "pass": password})
         log.debug("Sent request to privacyIDEA server. status code returned: "
                   "{0!s}".format(response.status_code))
         if response.status_code != 200:
@@ -38,7 +38,7 @@ in tests/test_lib_realm.py
 '''
 from ..models import (Realm,
                       ResolverRealm,
-                      Resolver, db, save_config_timestamp)
+                      Resolver, db, save_config_timestamp, commit_session)
 from .log import log_with
 from privacyidea.lib.config import update_config_object
 import logging
@@ -121,7 +121,7 @@ def set_default_realm(default_realm=None):
         r.default = True
     if db.session.dirty or db.session.new:
         save_config_timestamp()
-        db.session.commit()
+        commit_session()
     return r.id
 
 
@@ -232,6 +232,6 @@ def set_realm(realm, resolvers=None, priority=None):
         r = Realm.query.filter_by(name=realm).first()
         r.default = True
         save_config_timestamp()
-        db.session.commit()
+        commit_session()
 
     return (added, failed)
@@ -34,21 +34,96 @@
 #
 __doc__ = """This is the resolver to find users in a SCIM service.
 
+The access tokens are kept in a per process cache until they expire and are
+refreshed shortly before. The requests are sent via the shared HTTP clients
+of ``lib/httpclient.py``. User searches are passed to the SCIM service as
+``filter`` and the user list is read page by page.
+
 The file is tested in tests/test_lib_resolver.py
 """
 
 import logging
 import traceback
+import time
+import hashlib
+from threading import Lock
 
 from .UserIdResolver import UserIdResolver
 import yaml
-import requests
 import base64
 from six.moves.urllib.parse import urlencode
+from privacyidea.lib import httpclient
 from privacyidea.lib.utils import to_bytes, to_unicode
 
 log = logging.getLogger(__name__)
 
+#: The number of users, which are requested in one page of the user list
+PAGE_SIZE = 100
+#: The access token is refreshed this number of seconds before it expires
+ACCESS_TOKEN_REFRESH = 30
+#: The lifetime of an access token, if the auth server does not return
+#: ``expires_in``
+DEFAULT_ACCESS_TOKEN_LIFETIME = 300
+
+#: Maps the privacyIDEA user attributes to the SCIM attributes, which can be
+#: used in a search filter
+SEARCH_ATTRIBUTES = {"username": "userName",
+                     "givenname": "name.givenName",
+                     "surname": "name.familyName",
+                     "email": "emails"}
+
+#: The per process cache of the access tokens. It maps the auth server, the
+#: client and the hash of the secret to the access token.
+ACCESS_TOKENS = {}
+ACCESS_TOKENS_LOCK = Lock()
+
+
+class AccessTokenCacheEntry(object):
+    """
+    An access token and its expiration time
+    """
+    def __init__(self, access_token, expires_at):
+        self.access_token = access_token
+        self.expires_at = expires_at
+        self.refreshing = False
+
+
+class UnauthorizedError(Exception):
+    """
+    The SCIM service did not accept the access token
+    """
+    pass
+
+
+def _search_filter(searchDict):
+    """
+    Create a SCIM filter from the search dictionary. The wildcard "*" at the
+    beginning or the end of a value is translated to "sw", "ew" or "co".
+    Attributes, which can not be searched, are ignored.
+
+    :param searchDict: dictionary of privacyIDEA user attributes and values
+    :return: The SCIM filter string
+    """
+    conditions = []
+    for key, value in sorted(searchDict.items()):
+        attribute = SEARCH_ATTRIBUTES.get(key)
+        if not attribute:
+            log.debug(u"The attribute {0!s} can not be searched.".format(key))
+            continue
+        operator = "eq"
+        if value.startswith("*") and value.endswith("*"):
+            operator = "co"
+        elif value.endswith("*"):
+            operator = "sw"
+        elif value.startswith("*"):
+            operator = "ew"
+        value = value.strip("*")
+        if not value:
+            continue
+        value = value.replace('\\', '\\\\').replace('"', '\\"')
+        conditions.append(u'{0!s} {1!s} "{2!s}"'.format(attribute, operator, value))
+    return u" and ".join(conditions)
+
 
 class IdResolver (UserIdResolver):
 
@@ -58,6 +133,7 @@ class IdResolver (UserIdResolver):
         self.auth_client = 'localhost'
         self.auth_secret = ''
         self.access_token = None
+        self.mapping = {}
 
     def checkPass(self, uid, password):
         """
@@ -76,9 +152,7 @@ class IdResolver (UserIdResolver):
         ret = {}
         # The SCIM ID is always /Users/ID
         # Alas, we can not map the ID to any other attribute
-        res = self._get_user(self.resource_server,
-                             self.access_token,
-                             userid)
+        res = self._call(self._get_user, userid)
         user = res
         ret = self._fill_user_schema_1_0(user)
 
@@ -137,23 +211,33 @@ class IdResolver (UserIdResolver):
 
     def getUserList(self, searchDict=None):
         """
-        Return the list of users
+        Return the list of users. The search dictionary is passed to the SCIM
+        service as filter.
         """
-        ret = []
-
-        # TODO: search dict is not used at the moment
-        res = {}
-        if self.access_token:
-            res = self._search_users(self.resource_server,
-                                                 self.access_token,
-                                                 "")
+        return list(self.iter_users(searchDict))
 
-        for user in res.get("Resources"):
-            ret_user = self._fill_user_schema_1_0(user)
-
-            ret.append(ret_user)
+    def iter_users(self, searchDict=None):
+        """
+        Read the users matching the search dictionary page by page.
 
-        return ret
+        :param searchDict: A dictionary with search parameters
+        :type searchDict: dict
+        :return: generator of users, where each user is a dictionary
+        """
+        params = {"count": PAGE_SIZE}
+        search_filter = _search_filter(searchDict or {})
+        if search_filter:
+            params["filter"] = search_filter
+        start_index = 1
+        while True:
+            params["startIndex"] = start_index
+            res = self._call(self._search_users, params)
+            resources = res.get("Resources") or []
+            for user in resources:
+                yield self._fill_user_schema_1_0(user)
+            start_index += len(resources)
+            if not resources or start_index > int(res.get("totalResults", 0)):
+                break
 
     def getResolverId(self):
         """
@@ -212,7 +296,7 @@ class IdResolver (UserIdResolver):
         self.auth_client = config.get('Client')
         self.auth_secret = config.get('Secret')
         self.mapping = yaml.safe_load(config.get('Mapping'))
-        self.create_scim_object()
+        # The access token is fetched, when it is needed
         return self
 
     @classmethod
@@ -257,7 +341,9 @@ class IdResolver (UserIdResolver):
         headers = {'Authorization': "Bearer {0}".format(access_token),
                    'content-type': 'application/json'}
         url = '{0}/Users?{1}'.format(resource_server, urlencode(params))
-        resp = requests.get(url, headers=headers)
+        resp = httpclient.request("GET", url, headers=headers)
+        if resp.status_code == 401:
+            raise UnauthorizedError("Could not get user list: 401")
         if resp.status_code != 200:
             info = "Could not get user list: {0!s}".format(resp.status_code)
             log.error(info)
@@ -282,8 +368,10 @@ class IdResolver (UserIdResolver):
         headers = {'Authorization': "Bearer {0}".format(access_token),
                    'content-type': 'application/json'}
         url = '{0}/Users/{1}'.format(resource_server, userid)
-        resp = requests.get(url, headers=headers)
+        resp = httpclient.request("GET", url, headers=headers)
 
+        if resp.status_code == 401:
+            raise UnauthorizedError("Could not get user: 401")
         if resp.status_code != 200:
             info = "Could not get user: {0!s}".format(resp.status_code)
             log.error(info)
@@ -294,22 +382,78 @@ class IdResolver (UserIdResolver):
 
     @staticmethod
     def get_access_token(server=None, client=None, secret=None):
+        return IdResolver._request_access_token(server, client, secret)[0]
+
+    @staticmethod
+    def _request_access_token(server, client, secret):
+        """
+        Request a new access token from the auth server
 
+        :return: tuple of the access token and its lifetime in seconds
+        """
         auth = to_unicode(base64.b64encode(to_bytes(client + ':' + secret)))
 
         url = "{0!s}/oauth/token?grant_type=client_credentials".format(server)
-        resp = requests.get(url,
-                            headers={'Authorization': 'Basic ' + auth})
+        resp = httpclient.request("GET", url,
+                                  headers={'Authorization': 'Basic ' + auth})
 
         if resp.status_code != 200:
             info = "Could not get access token: {0!s}".format(resp.status_code)
             log.error(info)
             raise Exception(info)
 
-        access_token = yaml.safe_load(resp.content).get('access_token')
+        content = yaml.safe_load(resp.content)
+        expires_in = int(content.get('expires_in') or DEFAULT_ACCESS_TOKEN_LIFETIME)
+        return content.get('access_token'), expires_in
+
+    def _get_cache_key(self):
+        secret_hash = hashlib.sha256(to_bytes(self.auth_secret or "")).hexdigest()
+        return self.auth_server, self.auth_client, secret_hash
+
+    def _get_access_token(self):
+        """
+        Return the cached access token. A new access token is requested, if
+        there is no valid access token. If the access token expires within
+        ``ACCESS_TOKEN_REFRESH`` seconds, one caller refreshes it, while the
+        other callers still use the old access token.
+        """
+        key = self._get_cache_key()
+        now = time.time()
+        with ACCESS_TOKENS_LOCK:
+            entry = ACCESS_TOKENS.get(key)
+            if entry and now < entry.expires_at:
+                if entry.refreshing or now < entry.expires_at - ACCESS_TOKEN_REFRESH:
+                    return entry.access_token
+                entry.refreshing = True
+        try:
+            access_token, expires_in = self._request_access_token(self.auth_server,
+                                                                  self.auth_client,
+                                                                  self.auth_secret)
+        except Exception:
+            if entry:
+                entry.refreshing = False
+            raise
+        log.debug(u"Fetched a new access token from {0!s}".format(self.auth_server))
+        with ACCESS_TOKENS_LOCK:
+            ACCESS_TOKENS[key] = AccessTokenCacheEntry(access_token, now + expires_in)
         return access_token
 
+    def _call(self, func, *args):
+        """
+        Call ``_search_users`` or ``_get_user`` with the cached access token.
+        If the SCIM service does not accept the access token, a new access
+        token is requested and the call is repeated once.
+        """
+        self.create_scim_object()
+        try:
+            return func(self.resource_server, self.access_token, *args)
+        except UnauthorizedError:
+            log.info(u"The access token of {0!s} was not accepted. Requesting a "
+                     u"new one.".format(self.auth_server))
+            with ACCESS_TOKENS_LOCK:
+                ACCESS_TOKENS.pop(self._get_cache_key(), None)
+            self.create_scim_object()
+            return func(self.resource_server, self.access_token, *args)
+
     def create_scim_object(self):
-        self.access_token = self.get_access_token(self.auth_server,
-                                                  self.auth_client,
-                                                  self.auth_secret)
+        self.access_token = self._get_access_token()
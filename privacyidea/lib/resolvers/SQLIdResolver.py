@@ -27,6 +27,10 @@
 #
 __doc__ = """This is the resolver to find users in SQL databases.
 
+The login names and user IDs are looked up by exact match and only the mapped
+columns are read from the user table. The user information can be kept in a
+short living per process cache, which is configured with ``CACHE_TIMEOUT``.
+
 The file is tested in tests/test_lib_resolver.py
 """
 
@@ -34,12 +38,13 @@ import logging
 import yaml
 import binascii
 import re
+import time
+from threading import Lock
 
 from privacyidea.lib.resolvers.UserIdResolver import UserIdResolver
 
 from sqlalchemy import and_
 from sqlalchemy import create_engine
-from sqlalchemy import Integer
 from sqlalchemy.orm import sessionmaker, scoped_session
 
 import traceback
@@ -213,6 +218,98 @@ if SQLSOUP_LOADED is False:  # pragma: no cover
     except ImportError:
         log.error("SQLSoup could not be loaded from SQLAlchemy!")
 
+#: The number of user IDs, which are looked up in one query by ``getUserInfos``
+USERINFO_BATCH_SIZE = 500
+
+#: The per process cache of the SQL resolvers. It maps the cache key of a
+#: resolver to its ``UserCache``.
+CACHE = {}
+CACHE_LOCK = Lock()
+
+
+class UserCache(object):
+    """
+    A short living per process cache of the user IDs and the user information
+    of one SQL resolver. Expired entries are removed, when they are read and
+    when the whole cache is swept, which happens at most once per timeout.
+    """
+
+    def __init__(self, timeout):
+        """
+        :param timeout: The lifetime of the entries in seconds
+        """
+        self.timeout = timeout
+        self._lock = Lock()
+        # login name -> (user ID, timestamp)
+        self.user_ids = {}
+        # user ID as text -> (user info, timestamp)
+        self.user_infos = {}
+        self._next_sweep = time.time() + timeout
+
+    @staticmethod
+    def _uid_key(uid):
+        return u"{0!s}".format(uid)
+
+    def _get(self, entries, key):
+        now = time.time()
+        with self._lock:
+            entry = entries.get(key)
+            if entry is None:
+                return None
+            if now > entry[1] + self.timeout:
+                del entries[key]
+                return None
+            return entry[0]
+
+    def _set(self, entries, key, value):
+        now = time.time()
+        with self._lock:
+            entries[key] = (value, now)
+            if now > self._next_sweep:
+                for cached in (self.user_ids, self.user_infos):
+                    for cached_key, (_value, timestamp) in list(cached.items()):
+                        if now > timestamp + self.timeout:
+                            del cached[cached_key]
+                self._next_sweep = now + self.timeout
+
+    def get_user_id(self, login):
+        """
+        :return: the cached user ID of the login name or None
+        """
+        return self._get(self.user_ids, login)
+
+    def set_user_id(self, login, uid):
+        self._set(self.user_ids, login, uid)
+
+    def get_user_info(self, uid):
+        """
+        :return: a copy of the cached user information or None
+        """
+        userinfo = self._get(self.user_infos, self._uid_key(uid))
+        if userinfo is not None:
+            return dict(userinfo)
+
+    def set_user_info(self, uid, userinfo):
+        """
+        Cache the user information and the user ID of the login name of the
+        user.
+        """
+        self._set(self.user_infos, self._uid_key(uid), dict(userinfo))
+        if "username" in userinfo and "id" in userinfo:
+            self.set_user_id(userinfo["username"], userinfo["id"])
+
+    def invalidate(self, uid):
+        """
+        Remove the user information and the login names of a user, which has
+        been modified or deleted.
+        """
+        uid_key = self._uid_key(uid)
+        with self._lock:
+            self.user_infos.pop(uid_key, None)
+            for login, (cached_uid, _timestamp) in list(self.user_ids.items()):
+                if self._uid_key(cached_uid) == uid_key:
+                    del self.user_ids[login]
+
 
 class IdResolver (UserIdResolver):
 
@@ -262,6 +359,8 @@ class IdResolver (UserIdResolver):
         self.engine = None
         self._editable = False
         self.password_hash_type = None
+        self.cache_timeout = 0
+        self._cache_key = None
         return
 
     def getSearchFields(self):
@@ -305,7 +404,9 @@ class IdResolver (UserIdResolver):
         """
 
         res = False
-        userinfo = self.getUserInfo(uid)
+        # The password hash is always read from the database, so that a
+        # changed password can not be used from the cache.
+        userinfo = self._get_user_info(uid)
 
         database_pw = userinfo.get("password", "XXXXXXX")
 
@@ -334,31 +435,78 @@ class IdResolver (UserIdResolver):
         :return: A dictionary with the keys defined in self.map
         :rtype: dict
         """
+        cache = self._get_cache()
+        if cache:
+            userinfo = cache.get_user_info(userId)
+            if userinfo is not None:
+                log.debug(u"Reading {0!r} from cache for getUserInfo".format(userId))
+                return userinfo
+
+        userinfo = self._get_user_info(userId)
+        if cache and userinfo:
+            cache.set_user_info(userId, userinfo)
+        return userinfo
+
+    def _get_user_info(self, userId):
+        """
+        Read the user info of the given userid from the database.
+        """
         userinfo = {}
 
         try:
-            conditions = []
-            conditions.append(self._get_userid_filter(userId))
-            conditions = self._append_where_filter(conditions, self.TABLE,
-                                                   self.where)
-            filter_condition = and_(*conditions)
-            result = self.session.query(self.TABLE).filter(filter_condition)
-
-            for r in result:
-                if userinfo:  # pragma: no cover
-                    raise Exception("More than one user with userid {0!s} found!".format(userId))
-                userinfo = self._get_user_from_mapped_object(r)
+            users = self._query_users([self._get_userid_filter(userId)],
+                                      limit=2)
+            if users:
+                userinfo = users[0]
+            if len(users) > 1:  # pragma: no cover
+                raise Exception("More than one user with userid {0!s} found!".format(userId))
         except Exception as exx:  # pragma: no cover
             log.error("Could not get the userinformation: {0!r}".format(exx))
 
         return userinfo
-    
+
+    def getUserInfos(self, userIds):
+        """
+        This function returns the user info of several users. The users,
+        which are not cached, are read with one query per
+        ``USERINFO_BATCH_SIZE`` user IDs.
+
+        :param userIds: The userids of the objects
+        :type userIds: list
+        :return: A dictionary mapping each userid to the user info. The user
+            info of an unknown user is an empty dictionary.
+        :rtype: dict
+        """
+        userinfos = {}
+        cache = self._get_cache()
+        missing = []
+        for userId in userIds:
+            userinfo = cache.get_user_info(userId) if cache else None
+            if userinfo is None:
+                missing.append(userId)
+            else:
+                userinfos[userId] = userinfo
+
+        column = getattr(self.TABLE, self.map.get("userid"))
+        for i in range(0, len(missing), USERINFO_BATCH_SIZE):
+            batch = missing[i:i + USERINFO_BATCH_SIZE]
+            found = {}
+            try:
+                for user in self._query_users([column.in_(batch)]):
+                    found[u"{0!s}".format(user.get("id"))] = user
+            except Exception as exx:  # pragma: no cover
+                log.error("Could not get the userinformation: {0!r}".format(exx))
+            for userId in batch:
+                userinfo = found.get(u"{0!s}".format(userId), {})
+                userinfos[userId] = userinfo
+                if cache and userinfo:
+                    cache.set_user_info(userId, userinfo)
+
+        return userinfos
+
     def _get_userid_filter(self, userId):
         column = getattr(self.TABLE, self.map.get("userid"))
-        if isinstance(column.type, Integer):
-            return column == userId
-        else:
-            return column.like(userId)
+        return column == userId
 
     def getUsername(self, userId):
         """
@@ -379,28 +527,64 @@ class IdResolver (UserIdResolver):
         :type LoginName: string
         :return: UserId as found for the LoginName
         """
+        cache = self._get_cache()
+        if cache:
+            userid = cache.get_user_id(LoginName)
+            if userid is not None:
+                log.debug(u"Reading {0!r} from cache for getUserId".format(LoginName))
+                return userid
+
         userid = ""
 
         try:
-            conditions = []
             column = self.map.get("username")
-            conditions.append(getattr(self.TABLE, column).like(LoginName))
-            conditions = self._append_where_filter(conditions, self.TABLE,
-                                                   self.where)
-            filter_condition = and_(*conditions)
-            result = self.session.query(self.TABLE).filter(filter_condition)
-
-            for r in result:
-                if userid != "":    # pragma: no cover
-                    raise Exception("More than one user with loginname"
-                                    " %s found!" % LoginName)
-                user = self._get_user_from_mapped_object(r)
-                userid = user["id"]
+            users = self._query_users([getattr(self.TABLE, column) == LoginName],
+                                      columns=[self.map.get("userid")],
+                                      limit=2)
+            if users:
+                userid = users[0].get("id", "")
+            if len(users) > 1:    # pragma: no cover
+                raise Exception("More than one user with loginname"
+                                " %s found!" % LoginName)
         except Exception as exx:    # pragma: no cover
             log.error("Could not get the userinformation: {0!r}".format(exx))
 
+        if cache and userid != "":
+            cache.set_user_id(LoginName, userid)
         return userid
 
+    def _get_mapped_columns(self):
+        """
+        :return: the names of the table columns, which are mapped to user
+            attributes
+        """
+        columns = []
+        for column in self.map.values():
+            if column in self.TABLE._table.c and column not in columns:
+                columns.append(column)
+        return columns
+
+    def _query_users(self, conditions, columns=None, limit=None):
+        """
+        Read the users matching the conditions and the WHERE statement of
+        the resolver. Only the given columns are read from the table.
+
+        :param conditions: filter conditions
+        :type conditions: list
+        :param columns: The names of the columns to read. Defaults to all
+            mapped columns.
+        :param limit: The maximum number of users
+        :return: list of users, where each user is a dictionary
+        """
+        columns = columns or self._get_mapped_columns()
+        conditions = self._append_where_filter(list(conditions), self.TABLE,
+                                               self.where)
+        result = self.session.query(*[getattr(self.TABLE, column) for column in columns]).\
+            filter(and_(*conditions))
+        if limit:
+            result = result.limit(limit)
+        return [self._get_user_from_row(r._asdict()) for r in result]
+
     def _get_user_from_mapped_object(self, ro):
         """
         :param ro: row
@@ -408,7 +592,15 @@ class IdResolver (UserIdResolver):
         :return: User
         :rtype: dict
         """
-        r = ro.__dict__
+        return self._get_user_from_row(ro.__dict__)
+
+    def _get_user_from_row(self, r):
+        """
+        :param r: The columns of a row
+        :type r: dict
+        :return: User
+        :rtype: dict
+        """
         user = {}
         try:
             if self.map.get("userid") in r:
@@ -450,21 +642,26 @@ class IdResolver (UserIdResolver):
             value = value.replace("*", "%")
             conditions.append(getattr(self.TABLE, column).like(value))
 
-        conditions = self._append_where_filter(conditions, self.TABLE,
-                                               self.where)
-        filter_condition = and_(*conditions)
-
-        result = self.session.query(self.TABLE).\
-            filter(filter_condition).\
-            limit(self.limit)
-
-        for r in result:
-            user = self._get_user_from_mapped_object(r)
+        for user in self._query_users(conditions, limit=self.limit):
             if "id" in user:
                 users.append(user)
 
         return users
 
+    def _get_cache(self):
+        """
+        :return: the ``UserCache`` of this resolver or None, if the cache is
+            disabled
+        """
+        if self.cache_timeout <= 0:
+            return None
+        with CACHE_LOCK:
+            cache = CACHE.get(self._cache_key)
+            if cache is None:
+                cache = CACHE[self._cache_key] = UserCache(self.cache_timeout)
+        cache.timeout = self.cache_timeout
+        return cache
+
     def getResolverId(self):
         """
         Returns the resolver Id
@@ -521,6 +718,8 @@ class IdResolver (UserIdResolver):
         # recycle SQL connections after 2 hours by default
         # (necessary for MySQL servers, which terminate idle connections after some hours)
         self.pool_recycle = int(config.get('poolRecycle') or 7200)
+        # The user cache is disabled by default
+        self.cache_timeout = int(config.get('CACHE_TIMEOUT') or 0)
 
         # create the connectstring like
         params = {'Port': self.port,
@@ -545,6 +744,10 @@ class IdResolver (UserIdResolver):
         self.db = SQLSoup(self.engine, session=Session)
         self.db.session._model_changes = {}
         self.TABLE = self.db.entity(self.table)
+        # Several resolvers may use the same connection, so the table, the
+        # mapping and the WHERE statement are part of the cache key.
+        self._cache_key = (self.getResolverId(), self.table, self.where,
+                           tuple(sorted(self.map.items())))
 
         return self
 
@@ -588,6 +791,7 @@ class IdResolver (UserIdResolver):
                                 'poolTimeout': 'int',
                                 'poolSize': 'int',
                                 'poolRecycle': 'int',
+                                'CACHE_TIMEOUT': 'int',
                                 'Encoding': 'string',
                                 'conParams': 'string'}
         return {typ: descriptor}
@@ -739,6 +943,9 @@ class IdResolver (UserIdResolver):
         except Exception as exx:
             log.error("Error deleting user: {0!s}".format(exx))
             res = False
+        cache = self._get_cache()
+        if cache:
+            cache.invalidate(uid)
         return res
 
     def update_user(self, uid, attributes=None):
@@ -762,6 +969,9 @@ class IdResolver (UserIdResolver):
         kwargs = {self.map.get("userid"): uid}
         r = self.TABLE.filter_by(**kwargs).update(params)
         self.db.commit()
+        cache = self._get_cache()
+        if cache:
+            cache.invalidate(uid)
         return r
 
     @property
@@ -153,6 +153,17 @@ class UserIdResolver(object):
         """
         return {}
 
+    def getUserInfos(self, userids):
+        """
+        This function returns the user information of several users.
+        Resolvers, which can read several users at once, should overwrite it.
+        :param userids: IDs of the users in the resolver
+        :type userids: list
+        :return: dictionary mapping each user ID to the user information
+        :rtype: dict
+        """
+        return dict((userid, self.getUserInfo(userid)) for userid in userids)
+
     def getUserList(self, searchDict=None):
         """
         This function finds the user objects,
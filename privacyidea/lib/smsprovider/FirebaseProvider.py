@@ -27,7 +27,7 @@ from privacyidea.lib.smsprovider.SMSProvider import (ISMSProvider, SMSError)
 from privacyidea.lib import _
 import logging
 from oauth2client.service_account import ServiceAccountCredentials
-import requests
+from privacyidea.lib import httpclient
 import json
 
 FIREBASE_URL_SEND = 'https://fcm.googleapis.com/v1/projects/{0!s}/messages:send'
@@ -88,7 +88,8 @@ class FirebaseProvider(ISMSProvider):
             }
 
         url = FIREBASE_URL_SEND.format(self.smsgateway.option_dict.get(FIREBASE_CONFIG.PROJECT_ID))
-        resp = requests.post(url, data=json.dumps(fcm_message), headers=headers)
+        resp = httpclient.request("POST", url, data=json.dumps(fcm_message),
+                                  headers=headers)
 
         if resp.status_code == 200:
             log.debug("Message sent successfully to Firebase service.")
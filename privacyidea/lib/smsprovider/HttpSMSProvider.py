@@ -46,7 +46,7 @@ The code is tested in tests/test_lib_smsprovider
 
 from privacyidea.lib.smsprovider.SMSProvider import (ISMSProvider, SMSError)
 from privacyidea.lib import _
-import requests
+from privacyidea.lib import httpclient
 from six.moves.urllib.parse import urlparse
 import re
 import logging
@@ -137,23 +137,23 @@ class HttpSMSProvider(ISMSProvider):
             proxies = {protocol: proxy}
 
         # url, parameter, username, password, method
-        requestor = requests.get
+        http_method = "GET"
         params = parameter
         data = {}
         if method == "POST":
-            requestor = requests.post
+            http_method = "POST"
             params = {}
             data = parameter
 
         log.debug("issuing request with parameters %s and method %s and "
                   "authentication %s to url %s." % (parameter, method,
                                                     basic_auth, url))
-        r = requestor(url, params=params,
-                      data=data,
-                      verify=ssl_verify,
-                      auth=basic_auth,
-                      timeout=float(timeout),
-                      proxies=proxies)
+        r = httpclient.request(http_method, url, params=params,
+                               data=data,
+                               verify=ssl_verify,
+                               proxies=proxies,
+                               auth=basic_auth,
+                               timeout=float(timeout))
         log.debug("queued SMS on the HTTP gateway. status code returned: {0!s}".format(
                   r.status_code))
 
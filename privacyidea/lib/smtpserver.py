@@ -21,11 +21,16 @@ from privacyidea.lib.queue import job, wrap_job, has_job_queue
 from privacyidea.models import SMTPServer as SMTPServerDB
 from privacyidea.lib.crypto import (decryptPassword, encryptPassword,
                                     FAILED_TO_DECRYPT_PASSWORD)
-from privacyidea.lib.utils import fetch_one_resource
+from privacyidea.lib.utils import fetch_one_resource, to_bytes
+from privacyidea.lib.framework import get_app_local_store, get_app_config_value
 import logging
 from privacyidea.lib.log import log_with
 from time import gmtime, strftime
+from threading import Lock
+from contextlib import contextmanager
+import hashlib
 import smtplib
+import time
 from email.mime.text import MIMEText
 from privacyidea.lib.error import ConfigAdminError
 __doc__ = """
@@ -42,6 +47,269 @@ TIMEOUT = 10
 
 SEND_EMAIL_JOB_NAME = "smtpserver.send_email"
 
+#: Number of idle connections that are kept open per SMTP server. 0 disables pooling.
+DEFAULT_POOL_SIZE = 0
+#: Idle connections older than this number of seconds are not reused.
+DEFAULT_POOL_MAX_IDLE = 60
+
+
+def _connect(config):
+    """
+    Open a new SMTP connection according to the given configuration.
+    This does the complete handshake, i.e. EHLO, STARTTLS and login.
+
+    :param config: The email configuration
+    :type config: dict
+    :return: a connected ``smtplib.SMTP`` object
+    """
+    mail = smtplib.SMTP(config['server'], port=int(config['port']),
+                        timeout=config.get('timeout', TIMEOUT))
+    log.debug("Saying EHLO to mailserver {0!s}".format(config['server']))
+    r = mail.ehlo()
+    log.debug("mailserver responded with {0!s}".format(r))
+    # Start TLS if required
+    if config.get('tls', False):
+        log.debug("Trying to STARTTLS: {0!s}".format(config['tls']))
+        mail.starttls()
+    # Authenticate, if a username is given.
+    if config.get('username', ''):
+        log.debug("Doing authentication with {0!s}".format(config['username']))
+        password = decryptPassword(config['password'])
+        if password == FAILED_TO_DECRYPT_PASSWORD:
+            password = config['password']
+        mail.login(config['username'], password)
+    return mail
+
+
+def _close(mail):
+    """
+    Quit an SMTP connection and ignore any errors, since the connection may
+    already be dead.
+    """
+    try:
+        mail.quit()
+    except (smtplib.SMTPException, IOError) as exx:  # pragma: no cover
+        log.debug("Error while closing SMTP connection: {0!r}".format(exx))
+    finally:
+        # quit does not close the socket, if the server does not answer
+        mail.close()
+
+
+class SMTPConnectionPool(object):
+    """
+    A pool of open connections to one SMTP server.
+
+    Connections are checked out with ``acquire`` and returned with ``release``.
+    Before an idle connection is handed out again, its health is checked with
+    a NOOP command. Dead or stale connections are replaced by new ones.
+    The pool counts the performed handshakes and the reused connections.
+
+    The pool is shared between threads, but a checked out connection is only
+    used by one thread at a time.
+    """
+
+    def __init__(self, size=DEFAULT_POOL_SIZE, max_idle=DEFAULT_POOL_MAX_IDLE):
+        """
+        :param size: The maximum number of idle connections to keep
+        :param max_idle: The number of seconds after which an idle connection
+            is discarded
+        """
+        self.size = size
+        self.max_idle = max_idle
+        self._lock = Lock()
+        # list of tuples (connection, timestamp of release)
+        self._idle = []
+        self.handshakes = 0
+        self.reused = 0
+        self.reconnects = 0
+
+    def connect(self, config):
+        """
+        Open a new connection and count the handshake.
+        """
+        mail = _connect(config)
+        with self._lock:
+            self.handshakes += 1
+        return mail
+
+    def _pop_idle(self):
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+        return None, None
+
+    def acquire(self, config):
+        """
+        Return a healthy connection to the SMTP server. This is either an idle
+        connection from the pool, which answered a NOOP command, or a
+        new connection.
+
+        :param config: The email configuration
+        :type config: dict
+        :return: a tuple of a ``smtplib.SMTP`` object and a boolean, which
+            is True if the connection was reused.
+        """
+        mail, released = self._pop_idle()
+        while mail is not None:
+            if time.time() - released <= self.max_idle:
+                try:
+                    code, _msg = mail.noop()
+                    if code == 250:
+                        with self._lock:
+                            self.reused += 1
+                        return mail, True
+                except (smtplib.SMTPException, IOError) as exx:
+                    log.debug("Idle SMTP connection is dead: {0!r}".format(exx))
+            _close(mail)
+            mail, released = self._pop_idle()
+        return self.connect(config), False
+
+    def release(self, mail, broken=False):
+        """
+        Return a connection to the pool. If the pool is full or the connection
+        is broken, the connection is closed.
+        """
+        with self._lock:
+            if not broken and len(self._idle) < self.size:
+                self._idle.append((mail, time.time()))
+                return
+        _close(mail)
+
+    def clear(self):
+        """
+        Close all idle connections.
+        """
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for mail, _released in idle:
+            _close(mail)
+
+    def get_stats(self):
+        """
+        :return: a dictionary with the number of handshakes, reused connections,
+            reconnects and currently idle connections.
+        """
+        with self._lock:
+            return {"handshakes": self.handshakes,
+                    "handshakes_saved": self.reused,
+                    "reconnects": self.reconnects,
+                    "idle": len(self._idle)}
+
+    @contextmanager
+    def session(self, config):
+        """
+        Context manager which yields an object with a ``sendmail`` method.
+        If sending fails because a reused connection was closed by the
+        server, a new connection is opened and the message is sent again.
+        """
+        session = _SMTPSession(self, config)
+        try:
+            yield session
+        except Exception:
+            session.close(broken=True)
+            raise
+        session.close()
+
+
+class _SMTPSession(object):
+    """
+    A connection checked out from a ``SMTPConnectionPool``, which transparently
+    reconnects once if the server closed the connection.
+    """
+    def __init__(self, pool, config):
+        self.pool = pool
+        self.config = config
+        self.mail, self.reused = pool.acquire(config)
+
+    def sendmail(self, mail_from, recipient, msg):
+        try:
+            return self.mail.sendmail(mail_from, recipient, msg)
+        except smtplib.SMTPServerDisconnected as exx:
+            if not self.reused:
+                raise
+            log.info("SMTP server closed the connection, reconnecting: {0!r}".format(exx))
+            with self.pool._lock:
+                self.pool.reconnects += 1
+            mail, self.mail = self.mail, None
+            _close(mail)
+            self.mail = self.pool.connect(self.config)
+            self.reused = False
+            return self.mail.sendmail(mail_from, recipient, msg)
+
+    def close(self, broken=False):
+        if self.mail is not None:
+            self.pool.release(self.mail, broken)
+            self.mail = None
+
+
+def _pool_key(config):
+    # The connections are logged in, so a changed password needs a new pool.
+    # Only a hash of the password is kept in the key.
+    password_hash = hashlib.sha256(to_bytes(config.get('password') or '')).hexdigest()
+    return (config['server'], int(config['port']), bool(config.get('tls', False)),
+            config.get('username', '') or '', password_hash,
+            config.get('timeout', TIMEOUT))
+
+
+def get_smtp_pool(config):
+    """
+    Return the connection pool of the SMTP server given by the configuration.
+    The pools are stored in the app-local store, so they are shared among all
+    threads of a process. The pool size and the maximum idle time are read from
+    ``PI_SMTP_POOL_SIZE`` and ``PI_SMTP_POOL_MAX_IDLE``.
+
+    :param config: The email configuration
+    :type config: dict
+    :return: a ``SMTPConnectionPool`` object
+    """
+    store = get_app_local_store()
+    pools = store.setdefault("smtp_pools", {})
+    key = _pool_key(config)
+    try:
+        return pools[key]
+    except KeyError:
+        pool = SMTPConnectionPool(
+            size=int(get_app_config_value("PI_SMTP_POOL_SIZE", DEFAULT_POOL_SIZE)),
+            max_idle=int(get_app_config_value("PI_SMTP_POOL_MAX_IDLE", DEFAULT_POOL_MAX_IDLE)))
+        log.info(u"Creating a new SMTP connection pool for {0!s}:{1!s}".format(key[0], key[1]))
+        return pools.setdefault(key, pool)
+
+
+def _build_message(config, recipient, subject, body, sender=None,
+                   reply_to=None, mimetype="plain"):
+    """
+    Create the MIME message.
+
+    :return: tuple of the sender address, the list of recipients and the message
+    """
+    if type(recipient) != list:
+        recipient = [recipient]
+    mail_from = sender or config['sender']
+    reply_to = reply_to or mail_from
+    msg = MIMEText(body.encode('utf-8'), mimetype, 'utf-8')
+    msg['Subject'] = subject
+    msg['From'] = mail_from
+    msg['To'] = ",".join(recipient)
+    msg['Date'] = strftime("%a, %d %b %Y %H:%M:%S +0000", gmtime())
+    msg['Reply-To'] = reply_to
+    return mail_from, recipient, msg
+
+
+def _check_result(recipient, r):
+    """
+    r is a dictionary like {"recp@destination.com": (200, 'OK')}
+    we change this to True or False
+    """
+    success = True
+    for one_recipient in recipient:
+        res_id, res_text = r.get(one_recipient, (200, "OK"))
+        if res_id != 200 and res_text != "OK":
+            success = False
+            log.error("Failed to send email to {0!r}: {1!r}, {2!r}".format(one_recipient,
+                                                              res_id,
+                                                              res_text))
+    return success
+
 
 class SMTPServer(object):
     """
@@ -86,50 +354,58 @@ class SMTPServer(object):
         :param mimetype: The type of the email to send. Can by plain or html
         :return: True or False
         """
-        if type(recipient) != list:
-            recipient = [recipient]
-        mail_from = sender or config['sender']
-        reply_to = reply_to or mail_from
-        msg = MIMEText(body.encode('utf-8'), mimetype, 'utf-8')
-        msg['Subject'] = subject
-        msg['From'] = mail_from
-        msg['To'] = ",".join(recipient)
-        msg['Date'] = strftime("%a, %d %b %Y %H:%M:%S +0000", gmtime())
-        msg['Reply-To'] = reply_to
-
-        mail = smtplib.SMTP(config['server'], port=int(config['port']),
-                            timeout=config.get('timeout', TIMEOUT))
+        mail_from, recipient, msg = _build_message(config, recipient, subject, body,
+                                                   sender, reply_to, mimetype)
         log.debug(u"submitting message to {0!s}".format(msg["To"]))
-        log.debug("Saying EHLO to mailserver {0!s}".format(config['server']))
-        r = mail.ehlo()
-        log.debug("mailserver responded with {0!s}".format(r))
-        # Start TLS if required
-        if config.get('tls', False):
-            log.debug("Trying to STARTTLS: {0!s}".format(config['tls']))
-            mail.starttls()
-        # Authenticate, if a username is given.
-        if config.get('username', ''):
-            log.debug("Doing authentication with {0!s}".format(config['username']))
-            password = decryptPassword(config['password'])
-            if password == FAILED_TO_DECRYPT_PASSWORD:
-                password = config['password']
-            mail.login(config['username'], password)
-        r = mail.sendmail(mail_from, recipient, msg.as_string())
+        with get_smtp_pool(config).session(config) as mail:
+            r = mail.sendmail(mail_from, recipient, msg.as_string())
         log.info("Mail sent: {0!s}".format(r))
-        # r is a dictionary like {"recp@destination.com": (200, 'OK')}
-        # we change this to True or False
-        success = True
-        for one_recipient in recipient:
-            res_id, res_text = r.get(one_recipient, (200, "OK"))
-            if res_id != 200 and res_text != "OK":
-                success = False
-                log.error("Failed to send email to {0!r}: {1!r}, {2!r}".format(one_recipient,
-                                                                  res_id,
-                                                                  res_text))
-        mail.quit()
+        success = _check_result(recipient, r)
         log.debug("I am done sending your email.")
         return success
 
+    def send_emails(self, messages):
+        """
+        Send many emails over one SMTP session. The emails are always sent
+        directly, even if the server is configured to enqueue jobs.
+
+        :param messages: list of dictionaries with the keys ``recipient``,
+            ``subject``, ``body`` and optionally ``sender``, ``reply_to`` and
+            ``mimetype``
+        :return: list of True or False, one entry per message
+        """
+        return send_emails_batch(self.config.get(), messages)
+
+
+def send_emails_batch(config, messages):
+    """
+    Send many emails via the configuration over a single SMTP session.
+    The handshake (EHLO, STARTTLS and login) is done at most once. If the
+    connection breaks while sending, it is reopened.
+
+    :param config: The email configuration
+    :type config: dict
+    :param messages: list of dictionaries with the keys ``recipient``,
+        ``subject``, ``body`` and optionally ``sender``, ``reply_to`` and
+        ``mimetype``
+    :return: list of True or False, one entry per message
+    """
+    results = []
+    pool = get_smtp_pool(config)
+    handshakes = pool.handshakes
+    with pool.session(config) as mail:
+        for message in messages:
+            mail_from, recipient, msg = _build_message(config, **message)
+            try:
+                r = mail.sendmail(mail_from, recipient, msg.as_string())
+                results.append(_check_result(recipient, r))
+            except smtplib.SMTPRecipientsRefused as exx:
+                log.error("Failed to send email to {0!r}: {1!r}".format(recipient, exx))
+                results.append(False)
+    log.info(u"Sent {0!s} emails with {1!s} handshakes via {2!s}.".format(
+        len(results), pool.handshakes - handshakes, config['server']))
+    return results
+
 
 def send_or_enqueue_email(config, recipient, subject, body, sender=None, reply_to=None, mimetype="plain"):
     """
@@ -166,6 +442,20 @@ def send_email_identifier(identifier, recipient, subject, body, sender=None,
                                   mimetype)
 
 
+@log_with(log)
+def send_emails_identifier(identifier, messages):
+    """
+    Send many emails via the specified SMTP server configuration using a
+    single SMTP session.
+
+    :param identifier: The identifier of the SMTP server configuration
+    :param messages: list of dictionaries, see ``send_emails_batch``
+    :return: list of True or False, one entry per message
+    """
+    smtp_server = get_smtpserver(identifier)
+    return smtp_server.send_emails(messages)
+
+
 @log_with(log)
 def send_email_data(mailserver, subject, message, mail_from,
                     recipient, username=None,
@@ -21,6 +21,9 @@ from sqlalchemy import select, text
 from sqlalchemy.ext.compiler import compiles
 from sqlalchemy.sql import ClauseElement, Delete
 
+#: The key in ``session.info``, which marks an active unit of work
+UNIT_OF_WORK = "unit_of_work"
+
 
 class DeleteLimit(Delete, ClauseElement):
     """
@@ -82,6 +85,8 @@ def delete_chunked(session, table, filter, limit=1000):
     """
     Delete all rows matching a given filter criterion from a table,
     but only delete *limit* rows at a time. Commit after each DELETE.
+    If a unit of work is active, the chunks are not committed, but become
+    part of the transaction of the unit of work.
 
     :param session: SQLAlchemy session object
     :param table: SQLAlchemy table object (e.g. ``LogEntry.__table__``)
@@ -94,7 +99,8 @@ def delete_chunked(session, table, filter, limit=1000):
     while True:
         result = session.execute(statement)
         deleted += result.rowcount
-        session.commit()
+        if not session.info.get(UNIT_OF_WORK):
+            session.commit()
         if result.rowcount < limit:
             return deleted
 
@@ -112,7 +118,8 @@ def delete_matching_rows(session, table, filter, chunksize=None):
     """
     if chunksize is None:
         result = session.execute(table.delete().where(filter))
-        session.commit()
+        if not session.info.get(UNIT_OF_WORK):
+            session.commit()
         return result.rowcount
     else:
         return delete_chunked(session, table, filter, chunksize)
@@ -31,7 +31,7 @@ import random
 from .log import log_with
 from ..models import Subscription
 from privacyidea.lib.error import SubscriptionError
-from privacyidea.lib.token import get_tokens
+from privacyidea.lib.tokenstats import get_token_stats
 from privacyidea.lib.crypto import Sign
 import functools
 from privacyidea.lib.framework import get_app_config_value
@@ -99,7 +99,7 @@ def subscription_status():
 
     :return: subscription state
     """
-    token_count = get_tokens(assigned=True, active=True, count=True)
+    token_count = get_token_stats(assigned=True, active=True)
     if token_count <= APPLICATIONS.get("privacyidea", 50):
         return 0
 
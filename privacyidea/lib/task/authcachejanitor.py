@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+#
+# This code is free software; you can redistribute it and/or
+# modify it under the terms of the GNU AFFERO GENERAL PUBLIC LICENSE
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or any later version.
+#
+# This code is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU AFFERO GENERAL PUBLIC LICENSE for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#
+import logging
+from privacyidea.lib.task.base import BaseTask
+from privacyidea.lib.authcache import cleanup
+from privacyidea.lib import _
+
+
+__doc__ = """This task module deletes old entries from the authcache
+database table."""
+
+log = logging.getLogger(__name__)
+
+DEFAULT_MINUTES = 480
+
+
+class AuthCacheJanitorTask(BaseTask):
+    identifier = "AuthCacheJanitor"
+    description = "Delete old entries from the authentication cache."
+
+    @property
+    def options(self):
+        return {
+            "minutes": {
+                "type": "str",
+                "description": _("Delete the entries, which were not used "
+                                 "for this number of minutes.")
+            }
+        }
+
+    def do(self, params):
+        minutes = int(params.get("minutes") or DEFAULT_MINUTES)
+        deleted = cleanup(minutes)
+        log.info(u"Deleted {0!s} entries from the authentication cache.".format(deleted))
+        return True
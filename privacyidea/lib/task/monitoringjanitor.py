@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+#
+# This code is free software; you can redistribute it and/or
+# modify it under the terms of the GNU AFFERO GENERAL PUBLIC LICENSE
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or any later version.
+#
+# This code is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU AFFERO GENERAL PUBLIC LICENSE for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+import datetime
+import logging
+
+from dateutil.tz import tzlocal
+
+from privacyidea.lib.task.base import BaseTask
+from privacyidea.lib.monitoringstats import delete_old_stats
+from privacyidea.lib import _
+
+
+__doc__ = """This task module deletes old statistics values and old
+aggregated time buckets from the monitoring database."""
+
+log = logging.getLogger(__name__)
+
+#: The default number of days to keep the raw values and the time buckets
+#: of each resolution. 0 keeps the entries forever.
+DEFAULT_DAYS = {"raw": 7,
+                "5min": 31,
+                "hour": 366,
+                "day": 0}
+
+
+class MonitoringJanitorTask(BaseTask):
+    identifier = "MonitoringJanitor"
+    description = "Delete old statistics values from the monitoring database."
+
+    @property
+    def options(self):
+        return {
+            "raw_days": {
+                "type": "str",
+                "description": _("Delete the raw values, which are older than this "
+                                 "number of days. 0 keeps them forever.")
+            },
+            "5min_days": {
+                "type": "str",
+                "description": _("Delete the 5 minute values, which are older than "
+                                 "this number of days. 0 keeps them forever.")
+            },
+            "hour_days": {
+                "type": "str",
+                "description": _("Delete the hourly values, which are older than "
+                                 "this number of days. 0 keeps them forever.")
+            },
+            "day_days": {
+                "type": "str",
+                "description": _("Delete the daily values, which are older than "
+                                 "this number of days. 0 keeps them forever.")
+            }
+        }
+
+    def do(self, params):
+        now = datetime.datetime.now(tzlocal())
+        for resolution, default_days in DEFAULT_DAYS.items():
+            days = params.get("{0!s}_days".format(resolution))
+            days = int(default_days if days in (None, "") else days)
+            if days > 0:
+                deleted = delete_old_stats(now - datetime.timedelta(days=days),
+                                           resolution=None if resolution == "raw" else resolution)
+                log.info(u"Deleted {0!s} {1!s} statistics values.".format(deleted, resolution))
+        return True
@@ -21,7 +21,7 @@ import logging
 
 from privacyidea.lib.utils import is_true
 from privacyidea.lib.tokenclass import TOKENKIND
-from privacyidea.lib.token import get_tokens
+from privacyidea.lib.tokenstats import get_token_stats
 from privacyidea.lib.monitoringstats import write_stats
 from privacyidea.lib.subscriptions import get_users_with_active_tokens
 from privacyidea.lib.task.base import BaseTask
@@ -31,7 +31,10 @@ from privacyidea.lib import _
 __doc__ = """This is a statistics task which collects simple statistics from the database.
 If You want to add more statistic points, simply add them to the options method and add a
 corresponding property function (beginning with a '_').
-The entry in the monitoringstats table will have the same key as the property name."""
+The entry in the monitoringstats table will have the same key as the property name.
+
+The numbers of tokens are read from the token counters of lib/tokenstats.py and
+not counted in the token table."""
 
 log = logging.getLogger(__name__)
 
@@ -69,23 +72,23 @@ class SimpleStatsTask(BaseTask):
 
     @property
     def _total_tokens(self):
-        return get_tokens(count=True)
+        return get_token_stats()
 
     @property
     def _hardware_tokens(self):
-        return get_tokens(count=True, tokeninfo={'tokenkind': TOKENKIND.HARDWARE})
+        return get_token_stats(tokenkind=TOKENKIND.HARDWARE)
 
     @property
     def _software_tokens(self):
-        return get_tokens(count=True, tokeninfo={'tokenkind': TOKENKIND.SOFTWARE})
+        return get_token_stats(tokenkind=TOKENKIND.SOFTWARE)
 
     @property
     def _unassigned_hardware_tokens(self):
-        return get_tokens(count=True, tokeninfo={'tokenkind': 'hardware'}, assigned=False)
+        return get_token_stats(tokenkind=TOKENKIND.HARDWARE, assigned=False)
 
     @property
     def _assigned_tokens(self):
-        return get_tokens(count=True, assigned=True)
+        return get_token_stats(assigned=True)
 
     def do(self, params):
         for opt in self.options.keys():
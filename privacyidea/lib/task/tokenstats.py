@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+#
+# This code is free software; you can redistribute it and/or
+# modify it under the terms of the GNU AFFERO GENERAL PUBLIC LICENSE
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or any later version.
+#
+# This code is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU AFFERO GENERAL PUBLIC LICENSE for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+import logging
+from privacyidea.lib.task.base import BaseTask
+from privacyidea.lib.tokenstats import reconcile_token_stats
+
+
+__doc__ = """This task module counts the tokens in the token table and
+corrects the token counters, which are used by the statistics."""
+
+log = logging.getLogger(__name__)
+
+
+class TokenStatsTask(BaseTask):
+    identifier = "TokenStats"
+    description = "Reconcile the token counters with the token table."
+
+    def do(self, params):
+        wrong = reconcile_token_stats()
+        log.info(u"Reconciled the token counters, {0!s} were wrong.".format(wrong))
+        return True
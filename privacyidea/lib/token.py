@@ -67,7 +67,9 @@ import os
 import logging
 from six import string_types
 
-from sqlalchemy import (and_, func)
+from flask import has_app_context
+from sqlalchemy import func, event
+from sqlalchemy.orm import Session
 
 from privacyidea.lib.error import (TokenAdminError,
                                    ParameterError,
@@ -75,18 +77,23 @@ from privacyidea.lib.error import (TokenAdminError,
 from privacyidea.lib.decorators import (check_user_or_serial,
                                         check_copy_serials)
 from privacyidea.lib.tokenclass import TokenClass
+from privacyidea.lib.challenge import throttled_challenge_janitor
 from privacyidea.lib.utils import is_true, BASE58, hexlify_and_unicode
 from privacyidea.lib.crypto import generate_password
 from privacyidea.lib.log import log_with
+from privacyidea.lib.framework import get_request_local_store
 from privacyidea.models import (Token, Realm, TokenRealm, Challenge,
-                                MachineToken, TokenInfo, TokenOwner)
+                                MachineToken, TokenInfo, TokenOwner, db)
 from privacyidea.lib.config import (get_token_class, get_token_prefix,
                                     get_token_types, get_from_config,
                                     get_inc_fail_count_on_false_pin)
-from privacyidea.lib.user import User
+from privacyidea.lib.user import User, get_username
 from privacyidea.lib import _
 from privacyidea.lib.realm import realm_is_defined
 from privacyidea.lib.resolver import get_resolver_object
+from privacyidea.lib.machine import invalidate_auth_item_cache
+from privacyidea.lib.tokenstats import get_token_stats_key, update_token_stats
+from privacyidea.lib import metrics
 from privacyidea.lib.policydecorators import (libpolicy,
                                               auth_user_does_not_exist,
                                               auth_user_has_no_token,
@@ -158,9 +165,9 @@ def _create_token_query(tokentype=None, realm=None, assigned=None, user=None,
             sql_query = sql_query.filter(Token.tokentype.like(
                 tokentype.lower().replace("*", "%")))
         else:
-            # exact match
-            sql_query = sql_query.filter(func.lower(Token.tokentype) ==
-                                         tokentype.lower())
+            # exact match. The token types are stored in lower case, so
+            # that the index on the token type can be used.
+            sql_query = sql_query.filter(Token.tokentype == tokentype.lower())
 
     if description is not None and description.strip("*"):
         # filter for Description
@@ -183,36 +190,37 @@ def _create_token_query(tokentype=None, realm=None, assigned=None, user=None,
             log.warning("assigned value not in [True, False] {0!r}".format(assigned))
 
     if realm is not None:
-        # filter for the realm
-        sql_query = sql_query.filter(and_(func.lower(Realm.name) ==
-                                          realm.lower(),
-                                          TokenRealm.realm_id == Realm.id,
-                                          TokenRealm.token_id ==
-                                          Token.id)).distinct()
-
+        # filter for the realm. The semi-join uses the index on the realm_id
+        # of the tokenrealm table and does not return duplicate tokens.
+        realm_ids = db.session.query(Realm.id).filter(func.lower(Realm.name) ==
+                                                      realm.lower())
+        sql_query = sql_query.filter(Token.id.in_(
+            db.session.query(TokenRealm.token_id).filter(
+                TokenRealm.realm_id.in_(realm_ids))))
+
+    # The conditions on the token owner are collected and applied as one
+    # semi-join
+    owner_filters = []
     stripped_resolver = None if resolver is None else resolver.strip("*")
     stripped_userid = None if userid is None else userid.strip("*")
-    if stripped_userid or stripped_resolver:
-        # Join the search with the token owner
-        sql_query = sql_query.filter(TokenOwner.token_id == Token.id)
 
     if stripped_resolver:
         # filter for given resolver
         if "*" in resolver:
             # match with "like"
-            sql_query = sql_query.filter(TokenOwner.resolver.like(resolver.replace(
+            owner_filters.append(TokenOwner.resolver.like(resolver.replace(
                 "*", "%")))
         else:
-            sql_query = sql_query.filter(TokenOwner.resolver == resolver)
+            owner_filters.append(TokenOwner.resolver == resolver)
 
     if stripped_userid:
         # filter for given userid
         if "*" in userid:
             # match with "like"
-            sql_query = sql_query.filter(TokenOwner.user_id.like(userid.replace(
+            owner_filters.append(TokenOwner.user_id.like(userid.replace(
                 "*", "%")))
         else:
-            sql_query = sql_query.filter(TokenOwner.user_id == userid)
+            owner_filters.append(TokenOwner.user_id == userid)
 
     if serial_wildcard is not None and serial_wildcard.strip("*"):
         # filter for serial
@@ -227,14 +235,16 @@ def _create_token_query(tokentype=None, realm=None, assigned=None, user=None,
     if user is not None and not user.is_empty():
         # filter for the rest of the user.
         if user.resolver:
-            sql_query = sql_query.filter(TokenOwner.token_id == Token.id)
-            sql_query = sql_query.filter(TokenOwner.resolver == user.resolver)
+            owner_filters.append(TokenOwner.resolver == user.resolver)
         (uid, _rtype, _resolver) = user.get_user_identifiers()
         if uid:
             if type(uid) == int:
                 uid = str(uid)
-            sql_query = sql_query.filter(TokenOwner.token_id == Token.id)
-            sql_query = sql_query.filter(TokenOwner.user_id == uid)
+            owner_filters.append(TokenOwner.user_id == uid)
+
+    if owner_filters:
+        sql_query = sql_query.filter(Token.id.in_(
+            db.session.query(TokenOwner.token_id).filter(*owner_filters)))
 
     if active is not None:
         # Filter active or inactive tokens
@@ -282,7 +292,8 @@ def _create_token_query(tokentype=None, realm=None, assigned=None, user=None,
 
 def get_tokens_paginated_generator(tokentype=None, realm=None, assigned=None, user=None,
                                    serial_wildcard=None, active=None, resolver=None, rollout_state=None,
-                                   revoked=None, locked=None, tokeninfo=None, maxfail=None, psize=1000):
+                                   revoked=None, locked=None, tokeninfo=None, maxfail=None, psize=1000,
+                                   description=None, userid=None):
     """
     Fetch chunks of ``psize`` tokens that match the filter criteria from the database and generate
     lists of token objects.
@@ -300,7 +311,9 @@ def get_tokens_paginated_generator(tokentype=None, realm=None, assigned=None, us
                                          active=active, resolver=resolver,
                                          rollout_state=rollout_state,
                                          revoked=revoked, locked=locked,
-                                         tokeninfo=tokeninfo, maxfail=maxfail).order_by(Token.id)
+                                         tokeninfo=tokeninfo, maxfail=maxfail,
+                                         description=description,
+                                         userid=userid).order_by(Token.id)
     # Fetch the first ``psize`` tokens
     sql_query = main_sql_query.limit(psize)
     while True:
@@ -320,6 +333,74 @@ def get_tokens_paginated_generator(tokentype=None, realm=None, assigned=None, us
         else:
             break
 
+
+def get_token_dicts_generator(tokentype=None, realm=None, assigned=None, user=None,
+                              serial_wildcard=None, resolver=None, description=None,
+                              userid=None, psize=1000):
+    """
+    Generate the dictionaries of all tokens, that match the filter criteria,
+    including the user information like in ``get_tokens_paginate``.
+    The tokens are fetched from the database in chunks of ``psize`` tokens
+    ordered by their database ID, so that only one chunk is kept in memory.
+    See ``get_tokens_paginate`` for information on the arguments.
+
+    :param psize: Maximum size of chunks that are fetched from the database
+    :return: This is a generator that generates token dictionaries.
+    """
+    for token_objects in get_tokens_paginated_generator(tokentype=tokentype, realm=realm,
+                                                        assigned=assigned, user=user,
+                                                        serial_wildcard=serial_wildcard,
+                                                        resolver=resolver,
+                                                        description=description,
+                                                        userid=userid, psize=psize):
+        for token_dict in _get_token_dicts(token_objects):
+            yield token_dict
+
+
+def _get_token_dicts(token_objects):
+    """
+    Return the dictionaries of the given token objects with the user
+    information of the owners. The owners of all tokens are read with one
+    SQL query and every user is only looked up once in the user store.
+
+    :param token_objects: list of token objects
+    :return: list of token dictionaries
+    """
+    owners = {}
+    token_ids = [tokenobject.token.id for tokenobject in token_objects]
+    if token_ids:
+        for owner in TokenOwner.query.filter(TokenOwner.token_id.in_(token_ids))\
+                                     .order_by(TokenOwner.id):
+            # Like ``Token.first_owner`` we use the first owner of a token
+            owners.setdefault(owner.token_id, owner)
+
+    users = {}
+    token_list = []
+    for tokenobject in token_objects:
+        token_dict = tokenobject.get_as_dict()
+        # add user information
+        # In certain cases the LDAP or SQL server might not be reachable.
+        # Then an exception is raised
+        token_dict["username"] = ""
+        token_dict["user_realm"] = ""
+        owner = owners.get(tokenobject.token.id)
+        if owner:
+            user_key = (owner.resolver, owner.user_id)
+            try:
+                if user_key not in users:
+                    users[user_key] = (get_username(owner.user_id, owner.resolver),
+                                       get_resolver_object(owner.resolver).editable)
+                token_dict["username"], token_dict["user_editable"] = users[user_key]
+                token_dict["user_realm"] = owner.realm.name.lower()
+            except Exception as exx:
+                log.error("User information can not be retrieved: {0!s}".format(exx))
+                log.debug(traceback.format_exc())
+                token_dict["username"] = "**resolver error**"
+
+        token_list.append(token_dict)
+    return token_list
+
+
 @log_with(log)
 #@cache.memoize(10)
 def get_tokens(tokentype=None, realm=None, assigned=None, user=None,
@@ -409,6 +490,122 @@ def get_tokens(tokentype=None, realm=None, assigned=None, user=None,
     return ret
 
 
+class TokenSummary(object):
+    """
+    The number of tokens of a user or of a realm by token type, active state,
+    revoked state and realm. It is returned by ``get_user_token_summary`` and
+    ``get_realm_token_summary``.
+    """
+
+    def __init__(self):
+        # list of (tokentype, active, revoked, realms, number of tokens)
+        self._entries = []
+
+    def add(self, tokentype, active, revoked, realms, number=1):
+        self._entries.append((tokentype.lower(), bool(active), bool(revoked),
+                              set(r.lower() for r in realms), number))
+
+    def count(self, tokentype=None, active=None, revoked=None, realm=None):
+        """
+        Return the number of tokens, which match all given conditions.
+
+        :param tokentype: Only count the tokens of this type
+        :param active: Only count active (True) or inactive (False) tokens
+        :param revoked: Only count revoked (True) or not revoked (False) tokens
+        :param realm: Only count the tokens in this realm
+        :return: The number of tokens
+        :rtype: int
+        """
+        return sum(number for ttype, tactive, trevoked, trealms, number in self._entries
+                   if (tokentype is None or ttype == tokentype.lower()) and
+                   (active is None or tactive == active) and
+                   (revoked is None or trevoked == revoked) and
+                   (realm is None or realm.lower() in trealms))
+
+
+def _get_token_summaries():
+    return get_request_local_store().setdefault("token_summaries", {})
+
+
+def _forget_token_summaries(session, flush_context=None):
+    """
+    Remove the token summaries of the request, if a token, a token owner or
+    a token realm is changed.
+    """
+    if has_app_context():
+        changed = session.new | session.dirty | session.deleted
+        if any(isinstance(obj, (Token, TokenOwner, TokenRealm)) for obj in changed):
+            _get_token_summaries().clear()
+
+
+def _forget_token_summaries_on_bulk(context):
+    if has_app_context() and context.mapper.class_ in (Token, TokenOwner, TokenRealm):
+        _get_token_summaries().clear()
+
+
+event.listen(Session, "after_flush", _forget_token_summaries)
+event.listen(Session, "after_bulk_update", _forget_token_summaries_on_bulk)
+event.listen(Session, "after_bulk_delete", _forget_token_summaries_on_bulk)
+
+
+def get_user_token_summary(user):
+    """
+    Return the number of tokens of the user by token type, active state,
+    revoked state and realm. Like in ``get_tokens(user=user)`` only the tokens
+    in the realm of the user are taken into account.
+
+    The tokens are read with one query. The summary is kept for the rest of
+    the request, until a token is changed.
+
+    :param user: The owner of the tokens
+    :type user: User object
+    :return: TokenSummary object
+    """
+    if user is None or user.is_empty():
+        raise ParameterError("A user is required to summarize the tokens.")
+    (uid, _rtype, resolver) = user.get_user_identifiers()
+    summaries = _get_token_summaries()
+    key = ("user", resolver, str(uid), user.realm)
+    if key not in summaries:
+        tokens = {}
+        sql_query = _create_token_query(user=user).with_entities(
+            Token.id, Token.tokentype, Token.active, Token.revoked, Realm.name).outerjoin(
+            TokenRealm, TokenRealm.token_id == Token.id).outerjoin(
+            Realm, Realm.id == TokenRealm.realm_id)
+        for token_id, tokentype, active, revoked, realm in sql_query:
+            token = tokens.setdefault(token_id, (tokentype, active, revoked, []))
+            if realm:
+                token[3].append(realm)
+        summary = TokenSummary()
+        for tokentype, active, revoked, realms in tokens.values():
+            summary.add(tokentype, active, revoked, realms)
+        summaries[key] = summary
+    return summaries[key]
+
+
+def get_realm_token_summary(realm):
+    """
+    Return the number of tokens in the realm by token type, active state and
+    revoked state. The tokens are counted with one query. The summary is kept
+    for the rest of the request, until a token is changed.
+
+    :param realm: The name of the realm
+    :type realm: basestring
+    :return: TokenSummary object
+    """
+    summaries = _get_token_summaries()
+    key = ("realm", realm.lower())
+    if key not in summaries:
+        sql_query = _create_token_query(realm=realm).with_entities(
+            Token.tokentype, Token.active, Token.revoked, func.count(Token.id)).group_by(
+            Token.tokentype, Token.active, Token.revoked)
+        summary = TokenSummary()
+        for tokentype, active, revoked, number in sql_query:
+            summary.add(tokentype, active, revoked, [realm], number)
+        summaries[key] = summary
+    return summaries[key]
+
+
 @log_with(log)
 def get_tokens_paginate(tokentype=None, realm=None, assigned=None, user=None,
                 serial=None, active=None, resolver=None, rollout_state=None,
@@ -472,29 +669,12 @@ def get_tokens_paginate(tokentype=None, realm=None, assigned=None, user=None,
     next = None
     if pagination.has_next:
         next = page + 1
-    token_list = []
+    token_objects = []
     for token in tokens:
         tokenobject = create_tokenclass_object(token)
         if isinstance(tokenobject, TokenClass):
-            token_dict = tokenobject.get_as_dict()
-            # add user information
-            # In certain cases the LDAP or SQL server might not be reachable.
-            # Then an exception is raised
-            token_dict["username"] = ""
-            token_dict["user_realm"] = ""
-            try:
-                userobject = tokenobject.user
-                if userobject:
-                    token_dict["username"] = userobject.login
-                    token_dict["user_realm"] = userobject.realm
-                    token_dict["user_editable"] = get_resolver_object(
-                        userobject.resolver).editable
-            except Exception as exx:
-                log.error("User information can not be retrieved: {0!s}".format(exx))
-                log.debug(traceback.format_exc())
-                token_dict["username"] = "**resolver error**"
-
-            token_list.append(token_dict)
+            token_objects.append(tokenobject)
+    token_list = _get_token_dicts(token_objects)
 
     ret = {"tokens": token_list,
            "prev": prev,
@@ -595,7 +775,7 @@ def get_num_tokens_in_realm(realm, active=True):
     :return: The number of tokens in the realm
     :rtype: int
     """
-    return get_tokens(realm=realm, active=active, count=True)
+    return get_realm_token_summary(realm).count(active=active)
 
 
 @log_with(log)
@@ -963,6 +1143,7 @@ def init_token(param, user=None, tokenrealms=None,
     """
     db_token = None
     tokenobject = None
+    old_stats_key = None
 
     tokentype = param.get("type") or "hotp"
     serial = param.get("serial") or gen_serial(tokentype, param.get("prefix"))
@@ -994,6 +1175,7 @@ def init_token(param, user=None, tokenrealms=None,
                                                                   tokentype))
             log.error(msg)
             raise TokenAdminError("initToken failed: {0!s}".format(msg))
+        old_stats_key = get_token_stats_key(db_token)
 
     # if there is a realm as parameter (and the realm is not empty), but no
     # user, we assign the token to this realm.
@@ -1027,7 +1209,11 @@ def init_token(param, user=None, tokenrealms=None,
     tokenobject.update(upd_params)
 
     try:
-        # Save the token to the database
+        # Count the token and save it to the database
+        new_stats_key = get_token_stats_key(db_token)
+        if tokenkind:
+            new_stats_key = new_stats_key._replace(tokenkind=tokenkind)
+        update_token_stats(old_stats_key, new_stats_key)
         db_token.save()
 
     except Exception as e:  # pragma: no cover
@@ -1048,6 +1234,7 @@ def init_token(param, user=None, tokenrealms=None,
         set_validity_period_end(serial, user, validity_period_end)
     if validity_period_start:
         set_validity_period_start(serial, user, validity_period_start)
+    invalidate_auth_item_cache()
 
     return tokenobject
 
@@ -1072,6 +1259,7 @@ def remove_token(serial=None, user=None):
 
     # Delete challenges of such a token
     for tokenobject in tokenobject_list:
+        stats_key = get_token_stats_key(tokenobject.token)
         # delete the challenge
         Challenge.query.filter(Challenge.serial == tokenobject.get_serial(
 
@@ -1089,7 +1277,9 @@ def remove_token(serial=None, user=None):
         TokenOwner.query.filter(TokenOwner.token_id ==
                                 tokenobject.token.id).delete()
 
+        update_token_stats(stats_key, None)
         tokenobject.token.delete()
+    invalidate_auth_item_cache()
 
     return token_count
 
@@ -1168,12 +1358,14 @@ def assign_token(serial, user, pin=None, encrypt_pin=False, err_message=None):
         err_message = err_message or "Token already assigned to user {0!r}".format(old_user)
         raise TokenAdminError(err_message, id=1103)
 
+    stats_key = get_token_stats_key(tokenobject.token)
     tokenobject.add_user(user)
     if pin is not None:
         tokenobject.set_pin(pin, encrypt=encrypt_pin)
 
     # reset the OtpFailCounter
     tokenobject.set_failcount(0)
+    update_token_stats(stats_key, stats_key._replace(assigned=True))
 
     try:
         tokenobject.save()
@@ -1183,6 +1375,7 @@ def assign_token(serial, user, pin=None, encrypt_pin=False, err_message=None):
 
     log.debug("successfully assigned token with serial "
               "{0!r} to user {1!r}".format(serial, user))
+    invalidate_auth_item_cache()
     return True
 
 
@@ -1198,18 +1391,21 @@ def unassign_token(serial, user=None):
     """
     tokenobject_list = get_tokens_from_serial_or_user(serial=serial, user=user)
     for tokenobject in tokenobject_list:
+        stats_key = get_token_stats_key(tokenobject.token)
         tokenobject.set_pin("")
         tokenobject.set_failcount(0)
 
         try:
             # Delete the tokenowner entry
             TokenOwner.query.filter(TokenOwner.token_id == tokenobject.token.id).delete()
+            update_token_stats(stats_key, stats_key._replace(assigned=False))
             tokenobject.save()
         except Exception as e:  # pragma: no cover
             log.error('update token DB failed')
             raise TokenAdminError("Token unassign failed for {0!r}/{1!r}: {2!r}".format(serial, user, e), id=1105)
 
         log.debug("successfully unassigned token with serial {0!r}".format(tokenobject))
+    invalidate_auth_item_cache()
     # TODO: test with more than 1 token
     return len(tokenobject_list)
 
@@ -1355,8 +1551,11 @@ def revoke_token(serial, user=None):
     tokenobject_list = get_tokens_from_serial_or_user(user=user, serial=serial)
 
     for tokenobject in tokenobject_list:
+        stats_key = get_token_stats_key(tokenobject.token)
         tokenobject.revoke()
+        update_token_stats(stats_key, stats_key._replace(active=bool(tokenobject.token.active)))
         tokenobject.save()
+    invalidate_auth_item_cache()
 
     return len(tokenobject_list)
 
@@ -1386,9 +1585,13 @@ def enable_token(serial, enable=True, user=None):
 
     for tokenobject in tokenobject_list:
         if tokenobject.is_active() == (not enable):
+            stats_key = get_token_stats_key(tokenobject.token)
             tokenobject.enable(enable)
+            update_token_stats(stats_key, stats_key._replace(active=bool(tokenobject.token.active)))
             tokenobject.save()
             count += 1
+    if count:
+        invalidate_auth_item_cache()
 
     return count
 
@@ -1757,6 +1960,8 @@ def copy_token_user(serial_from, serial_to):
     # For backward compatibility we remove the potentially old users from the token.
     # TODO: Later we probably want to be able to "add" new users to a token.
     unassign_token(serial_to)
+    stats_key = get_token_stats_key(tokenobject_to.token)
+    update_token_stats(stats_key, stats_key._replace(assigned=True))
     TokenOwner(token_id=tokenobject_to.token.id,
                user_id=tokenobject_from.token.first_owner.user_id,
                realm_id=tokenobject_from.token.first_owner.realm_id,
@@ -2040,6 +2245,7 @@ def create_challenges_from_tokens(token_list, reply_dict, options=None):
 
 
 @log_with(log)
+@metrics.timed(metrics.PHASE_DURATION, phase="check_token_list")
 @libpolicy(reset_all_user_tokens)
 def check_token_list(tokenobject_list, passw, user=None, options=None, allow_reset_all_tokens=False):
     """
@@ -2212,7 +2418,7 @@ def check_token_list(tokenobject_list, passw, user=None, options=None, allow_res
                     if increase_auth_counters:
                         tokenobject.inc_count_auth_success()
                     reply_dict["message"] = "Found matching challenge"
-                    tokenobject.challenge_janitor()
+                    throttled_challenge_janitor()
                     # clean up all other challenges from other tokens. I.e.
                     # all challenges with this very transaction_id!
                     transaction_id = options.get("transaction_id") or \
@@ -88,8 +88,10 @@ from .log import log_with
 from .config import (get_from_config, get_prepend_pin)
 from .user import (User,
                    get_username)
-from ..models import (TokenOwner, Challenge, cleanup_challenges)
-from .challenge import get_challenges
+from ..models import (TokenOwner, Challenge, keep_failcount)
+from .tokenstats import get_token_stats_key, update_token_stats
+from .challenge import (get_challenges, cleanup_expired_challenges,
+                        throttled_challenge_janitor)
 from privacyidea.lib.crypto import (encryptPassword, decryptPassword,
                                     generate_otpkey)
 from .policydecorators import libpolicy, auth_otppin, challenge_response_allowed
@@ -161,7 +163,7 @@ class TokenClass(object):
         """
         tokentype = u'' + tokentype
         self.type = tokentype
-        self.token.tokentype = tokentype
+        self.token.tokentype = tokentype.lower()
 
     @staticmethod
     def get_class_type():
@@ -605,6 +607,7 @@ class TokenClass(object):
         """
         delete the database token
         """
+        update_token_stats(get_token_stats_key(self.token), None)
         self.token.delete()
 
     def save(self):
@@ -770,6 +773,7 @@ class TokenClass(object):
         except:  # pragma: no cover
             log.error('update failed')
             raise TokenAdminError("Token Fail Counter update failed", id=1106)
+        keep_failcount(self.token)
         return self.token.failcount
 
     @check_token_locked
@@ -1416,17 +1420,19 @@ class TokenClass(object):
                         # increase the received_count
                         challengeobject.set_otp_status()
 
-        self.challenge_janitor()
+        throttled_challenge_janitor()
         return otp_counter
 
     @staticmethod
     def challenge_janitor():
         """
         Just clean up all challenges, for which the expiration has expired.
+        During authentication requests ``throttled_challenge_janitor`` is
+        used instead, which only cleans up once per interval.
 
         :return: None
         """
-        cleanup_challenges()
+        cleanup_expired_challenges()
 
     def create_challenge(self, transactionid=None, options=None):
         """
@@ -1469,7 +1475,6 @@ class TokenClass(object):
                                  session=options.get("session"),
                                  validitytime=validity)
         db_challenge.save()
-        self.challenge_janitor()
         return True, message, db_challenge.transaction_id, attributes
 
     def get_as_dict(self):
@@ -0,0 +1,309 @@
+# -*- coding: utf-8 -*-
+#
+# This code is free software; you can redistribute it and/or
+# modify it under the terms of the GNU AFFERO GENERAL PUBLIC LICENSE
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or any later version.
+#
+# This code is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU AFFERO GENERAL PUBLIC LICENSE for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+__doc__ = """
+This module imports token files as a stream. The token files are parsed
+incrementally with the iterators of ``lib/importotp.py``, so that only a
+small part of the file is kept in memory. The tokens are written to the
+database in batches. Each batch is committed in one transaction.
+
+The import can be run as a job of the job queue and with
+``pi-manage token import_tokens``. For the job queue the token file and its
+secrets are stored encrypted in the database, so that only the ID of the
+stored file is passed to the job queue and the job can run on any node.
+
+This module is tested in tests/test_lib_tokenimport.py.
+"""
+
+import binascii
+import datetime
+import io
+import json
+import logging
+import uuid
+from io import BytesIO
+from itertools import islice
+
+from flask import current_app
+
+from privacyidea.lib.crypto import (encryptPassword, decryptPassword,
+                                    FAILED_TO_DECRYPT_PASSWORD)
+from privacyidea.lib.error import ParameterError, TokenAdminError
+from privacyidea.lib.framework import get_app_config_value
+from privacyidea.lib.importotp import (iter_oath_csv, iter_yubico_csv,
+                                       iter_safenet_xml, iter_pskc_data,
+                                       GPGImport)
+from privacyidea.lib.monitoringstats import write_stats
+from privacyidea.lib.queue import job
+from privacyidea.lib.token import import_token
+from privacyidea.lib.utils import to_bytes, hexlify_and_unicode
+from privacyidea.models import (TokenImportChunk, db, unit_of_work,
+                                commit_session)
+
+log = logging.getLogger(__name__)
+
+IMPORT_TOKENS_JOB_NAME = "tokenimport.import_stored_token_file"
+DEFAULT_IMPORT_BATCH_SIZE = 1000
+#: The number of bytes of the token file, which are stored in one row.
+#: The encrypted and hexlified part fits into a TEXT column of MySQL.
+STORED_CHUNK_SIZE = 8192
+#: The position of the row, which contains the secrets of a stored token file
+SECRETS_POSITION = -1
+
+#: Maps the known file types to the parsers
+FILE_TYPES = {"aladdin-xml": "aladdin-xml",
+              "oathcsv": "oathcsv",
+              "OATH CSV": "oathcsv",
+              "yubikeycsv": "yubikeycsv",
+              "Yubikey CSV": "yubikeycsv",
+              "pskc": "pskc"}
+
+GPG_MESSAGE_HEADER = b"-----BEGIN PGP MESSAGE-----"
+
+
+def iter_token_file(token_file, file_type, psk=None, password=None):
+    """
+    Parse a token file incrementally. GPG encrypted files are decrypted
+    in memory first.
+
+    :param token_file: A seekable binary file object
+    :param file_type: The file type. One of ``FILE_TYPES``.
+    :param psk: The pre shared key of a PSKC file, hexlified
+    :param password: The password of a PSKC file
+    :return: generator of tuples (serial, token dictionary)
+    """
+    if file_type not in FILE_TYPES:
+        log.error(u"Unknown file type: >>{0!s}<<. We only know the types: "
+                  u"{1!s}".format(file_type, ', '.join(FILE_TYPES)))
+        raise TokenAdminError("Unknown file type: >>%s<<. We only know the "
+                              "types: %s" % (file_type, ', '.join(FILE_TYPES)))
+    if psk and len(psk) != 32:
+        raise TokenAdminError("The Pre Shared Key must be 128 Bit hex "
+                              "encoded. It must be 32 characters long!")
+
+    head = token_file.read(len(GPG_MESSAGE_HEADER))
+    token_file.seek(0)
+    if not head:
+        log.error("Error loading/importing token file. File empty!")
+        raise ParameterError("Error loading token file. File empty!")
+    if head == GPG_MESSAGE_HEADER:
+        gpg = GPGImport(current_app.config)
+        token_file = BytesIO(to_bytes(gpg.decrypt(token_file.read())))
+
+    parser = FILE_TYPES[file_type]
+    if parser == "aladdin-xml":
+        return iter_safenet_xml(token_file)
+    elif parser == "oathcsv":
+        return iter_oath_csv(token_file)
+    elif parser == "yubikeycsv":
+        return iter_yubico_csv(token_file)
+    return iter_pskc_data(token_file, preshared_key_hex=psk, password=password)
+
+
+def import_tokens(tokens, tokenrealms=None, default_hashlib=None,
+                  batch_size=None, progress=None):
+    """
+    Import the tokens in batches. All tokens of one batch are written to the
+    database in one transaction. If the import of a token fails, the current
+    batch is rolled back and the exception is raised. The tokens of the
+    previous batches stay imported.
+
+    :param tokens: An iterable of tuples (serial, token dictionary)
+    :param tokenrealms: list of realms, to which the tokens are added
+    :param default_hashlib: The hash algorithm, if it is not specified in the file
+    :param batch_size: The number of tokens, which are committed together.
+        Defaults to ``PI_TOKEN_IMPORT_BATCH_SIZE``.
+    :param progress: A function, which is called with the number of the
+        imported tokens after each batch
+    :return: list of the serial numbers of the imported tokens
+    """
+    batch_size = int(batch_size or get_app_config_value("PI_TOKEN_IMPORT_BATCH_SIZE",
+                                                        DEFAULT_IMPORT_BATCH_SIZE))
+    serials = []
+    imported = set()
+    tokens = iter(tokens)
+    while True:
+        batch = list(islice(tokens, batch_size))
+        if not batch:
+            break
+        with unit_of_work():
+            for serial, token_dict in batch:
+                log.debug(u"importing token {0!s}".format(serial))
+                import_token(serial, token_dict, tokenrealms=tokenrealms,
+                             default_hashlib=default_hashlib)
+                if serial not in imported:
+                    imported.add(serial)
+                    serials.append(serial)
+        log.info(u"Imported {0:d} tokens.".format(len(serials)))
+        if progress:
+            progress(len(serials))
+    return serials
+
+
+def _decrypt_chunk(data):
+    value = decryptPassword(data)
+    if value == FAILED_TO_DECRYPT_PASSWORD:
+        raise TokenAdminError("Could not decrypt the stored token file.")
+    return value
+
+
+def store_token_file(token_file, psk=None, password=None):
+    """
+    Store a token file and its secrets encrypted in the database, so that
+    it can be imported by a job on any node.
+
+    :param token_file: A binary file object
+    :param psk: The pre shared key of a PSKC file, hexlified
+    :param password: The password of a PSKC file
+    :return: The ID of the stored file
+    """
+    import_id = uuid.uuid4().hex
+    try:
+        with unit_of_work():
+            secrets = json.dumps({"psk": psk, "password": password})
+            db.session.add(TokenImportChunk(import_id, SECRETS_POSITION,
+                                            encryptPassword(secrets)))
+            position = 0
+            while True:
+                data = token_file.read(STORED_CHUNK_SIZE)
+                if not data:
+                    break
+                # The data is hexlified, since the decryption removes the
+                # padding at the last occurrence of the padding bytes
+                db.session.add(TokenImportChunk(import_id, position,
+                                                encryptPassword(hexlify_and_unicode(data))))
+                commit_session()
+                position += 1
+    except Exception:
+        # Do not keep the parts, which were already committed
+        delete_stored_token_file(import_id)
+        raise
+    return import_id
+
+
+def delete_stored_token_file(import_id):
+    """
+    Delete a stored token file.
+
+    :param import_id: The ID of the stored file
+    :return: The number of deleted rows
+    """
+    r = TokenImportChunk.query.filter_by(import_id=import_id).delete()
+    commit_session()
+    return r
+
+
+def delete_old_token_files(minutes):
+    """
+    Delete the stored token files, which were stored more than the given
+    number of minutes ago. These are left over, if the import job was not
+    run or if it was not able to delete the file.
+
+    :param minutes: The age of the stored files in minutes
+    :type minutes: int
+    :return: The number of deleted files
+    """
+    cleanuptime = datetime.datetime.utcnow() - datetime.timedelta(minutes=minutes)
+    import_ids = [row.import_id for row in
+                  db.session.query(TokenImportChunk.import_id).filter(
+                      TokenImportChunk.created < cleanuptime).distinct()]
+    for import_id in import_ids:
+        log.warning(u"Deleting the stored token file {0!s}, which was not "
+                    u"imported.".format(import_id))
+        delete_stored_token_file(import_id)
+    return len(import_ids)
+
+
+class StoredTokenFile(io.RawIOBase):
+    """
+    A binary file object, which reads and decrypts a stored token file part
+    by part. It can only be rewound to the start.
+    """
+
+    def __init__(self, import_id):
+        io.RawIOBase.__init__(self)
+        self.import_id = import_id
+        self._position = 0
+        self._offset = 0
+        self._buffer = b""
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._offset
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if (offset, whence) != (0, io.SEEK_SET):
+            raise io.UnsupportedOperation("A stored token file can only be "
+                                          "rewound to the start.")
+        self._position = 0
+        self._offset = 0
+        self._buffer = b""
+        return 0
+
+    def readinto(self, b):
+        while not self._buffer:
+            chunk = TokenImportChunk.query.filter_by(import_id=self.import_id,
+                                                     position=self._position).first()
+            if chunk is None:
+                return 0
+            self._buffer = binascii.unhexlify(_decrypt_chunk(chunk.data))
+            self._position += 1
+        length = min(len(b), len(self._buffer))
+        b[:length] = self._buffer[:length]
+        self._buffer = self._buffer[length:]
+        self._offset += length
+        return length
+
+
+@job(IMPORT_TOKENS_JOB_NAME)
+def import_stored_token_file(import_id, file_type, tokenrealms=None,
+                             default_hashlib=None, stats_key=None):
+    """
+    Import a token file, which was stored with ``store_token_file``. This is
+    run as a job of the job queue. The progress, i.e. the number of imported
+    tokens, is written to the monitoring statistics with the key
+    ``stats_key``. The stored file is deleted afterwards.
+
+    :param import_id: The ID of the stored file
+    :param file_type: The file type. One of ``FILE_TYPES``.
+    :param tokenrealms: list of realms, to which the tokens are added
+    :param default_hashlib: The hash algorithm, if it is not specified in the file
+    :param stats_key: The monitoring statistics key for the progress
+    :return: list of the serial numbers of the imported tokens
+    """
+    progress = None
+    if stats_key:
+        def progress(count):
+            write_stats(stats_key, count)
+
+    try:
+        secrets = TokenImportChunk.query.filter_by(import_id=import_id,
+                                                   position=SECRETS_POSITION).first()
+        if secrets is None:
+            raise ParameterError(u"The token file {0!s} does not exist.".format(import_id))
+        secrets = json.loads(_decrypt_chunk(secrets.data))
+        token_file = io.BufferedReader(StoredTokenFile(import_id))
+        tokens = iter_token_file(token_file, file_type, psk=secrets.get("psk"),
+                                 password=secrets.get("password"))
+        return import_tokens(tokens, tokenrealms=tokenrealms,
+                             default_hashlib=default_hashlib,
+                             progress=progress)
+    finally:
+        delete_stored_token_file(import_id)
@@ -0,0 +1,397 @@
+# -*- coding: utf-8 -*-
+#
+# This code is free software; you can redistribute it and/or
+# modify it under the terms of the GNU AFFERO GENERAL PUBLIC LICENSE
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or any later version.
+#
+# This code is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU AFFERO GENERAL PUBLIC LICENSE for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+__doc__ = """
+This module finds and processes the tokens for ``privacyidea-token-janitor``.
+
+The tokens are read from the database in chunks of consecutive token IDs.
+The conditions on the token type, the state, the tokeninfo key and the last
+authentication are evaluated by the database. The other conditions like
+regular expressions are evaluated for each token. The tokeninfo of all tokens
+of a chunk is read with one query.
+
+The chunks can be processed in several worker threads. A checkpoint file
+records the processed chunks, so that an interrupted run can be resumed.
+
+This module is tested in tests/test_lib_tokenjanitor.py.
+"""
+
+import io
+import json
+import logging
+import os
+import re
+import traceback
+from collections import namedtuple
+from datetime import datetime, timedelta
+from threading import Thread, Event, Lock
+
+from flask import current_app
+from six.moves.queue import Queue, Empty
+from sqlalchemy import func
+from sqlalchemy.orm import selectinload
+
+from privacyidea.lib.error import ParameterError
+from privacyidea.lib.policy import ACTION
+from privacyidea.lib.token import (_create_token_query, create_tokenclass_object,
+                                   remove_token, enable_token, unassign_token)
+from privacyidea.lib.tokenclass import TokenClass
+from privacyidea.lib.utils import parse_timedelta
+from privacyidea.models import db, Token, TokenInfo, unit_of_work
+
+log = logging.getLogger(__name__)
+
+DEFAULT_CHUNK_SIZE = 1000
+#: The actions, which modify the tokens
+TOKEN_ACTIONS = ["disable", "delete", "unassign", "mark"]
+
+#: The result of a processed chunk of token IDs
+ChunkResult = namedtuple("ChunkResult", ["first_id", "last_id", "processed",
+                                         "found", "result"])
+
+
+class TokenFilter(object):
+    """
+    The conditions, which the tokens of the token janitor need to match.
+    """
+
+    def __init__(self, tokentype=None, assigned=None, active=None, serial=None,
+                 description=None, last_auth=None, orphaned=False,
+                 tokeninfo_key=None, tokeninfo_filter=None):
+        """
+        :param tokentype: The token type, which may contain wildcards
+        :param assigned: Only find assigned (True) or unassigned (False) tokens
+        :param active: Only find active (True) or inactive (False) tokens
+        :param serial: A regular expression on the serial
+        :param description: A regular expression on the description
+        :param last_auth: Only find tokens, whose last authentication is older
+            than this time delta like 10h, 7d or 2y
+        :param orphaned: Only find orphaned tokens
+        :param tokeninfo_key: The tokeninfo key, whose value is checked
+        :param tokeninfo_filter: list of functions, which take the tokeninfo
+            value and return True, if it matches
+        """
+        self.tokentype = tokentype
+        self.assigned = assigned
+        self.active = active
+        self.serial = serial
+        self.description = description
+        self.last_auth = last_auth
+        self.orphaned = orphaned
+        self.tokeninfo_key = tokeninfo_key
+        self.tokeninfo_filter = tokeninfo_filter or []
+
+    def get_query(self):
+        """
+        Return the SQL query of the tokens, which contains all conditions that
+        can be evaluated by the database.
+        """
+        query = _create_token_query(tokentype=self.tokentype, assigned=self.assigned,
+                                    active=self.active)
+        if self.tokeninfo_key and self.tokeninfo_filter:
+            # Tokens without the tokeninfo key never match
+            query = query.filter(Token.id.in_(
+                db.session.query(TokenInfo.token_id).filter(
+                    TokenInfo.Key == self.tokeninfo_key)))
+        if self.last_auth:
+            # The last authentication is stored as a string starting with the
+            # date in local time. The tokens, whose date is later than the
+            # threshold plus two days, are newer even in any time zone, so that
+            # the database can sort them out. The exact comparison is done
+            # for the remaining tokens by ``matches``.
+            threshold = datetime.utcnow() - parse_timedelta(self.last_auth) + timedelta(days=2)
+            query = query.filter(Token.id.in_(
+                db.session.query(TokenInfo.token_id).filter(
+                    TokenInfo.Key == ACTION.LASTAUTH,
+                    TokenInfo.Value < threshold.strftime("%Y-%m-%d"))))
+        return query
+
+    def matches(self, token_obj):
+        """
+        Check the conditions, which can not be evaluated by the database.
+
+        :param token_obj: The token object
+        :return: True, if the token matches
+        """
+        if self.last_auth and token_obj.check_last_auth_newer(self.last_auth):
+            return False
+        if self.serial and not re.search(self.serial, token_obj.token.serial):
+            return False
+        if self.description and not re.search(self.description,
+                                              token_obj.token.description):
+            return False
+        if self.tokeninfo_key and self.tokeninfo_filter:
+            value = token_obj.get_tokeninfo(self.tokeninfo_key)
+            # if the tokeninfo key is not even set, it does not match the filter
+            if value is None:
+                return False
+            if not all(comparator(value) for comparator in self.tokeninfo_filter):
+                return False
+        if self.orphaned and not token_obj.is_orphaned():
+            return False
+        return True
+
+
+def get_token_id_chunks(token_filter, chunksize=DEFAULT_CHUNK_SIZE):
+    """
+    Split the IDs of the matching tokens into ranges of ``chunksize`` IDs.
+    The ranges start at multiples of ``chunksize``, so that they do not depend
+    on the tokens, which are deleted or no longer match during a run. So they
+    can be used to resume a run.
+
+    :param token_filter: The conditions of the tokens
+    :type token_filter: TokenFilter
+    :param chunksize: The number of token IDs of each chunk
+    :return: list of tuples of the first and the last token ID of a chunk
+    """
+    first_id, last_id = token_filter.get_query().with_entities(
+        func.min(Token.id), func.max(Token.id)).one()
+    if first_id is None:
+        return []
+    return [(start, start + chunksize - 1)
+            for start in range(first_id - first_id % chunksize, last_id + 1, chunksize)]
+
+
+def find_tokens_in_chunk(token_filter, chunk):
+    """
+    Read the tokens of a chunk of token IDs and return the matching tokens.
+
+    :param token_filter: The conditions of the tokens
+    :type token_filter: TokenFilter
+    :param chunk: tuple of the first and the last token ID
+    :return: tuple of the number of tokens read from the database and the
+        list of the matching token objects
+    """
+    query = token_filter.get_query().filter(Token.id.between(*chunk)).order_by(
+        Token.id).options(selectinload(Token.info_list))
+    processed = 0
+    token_objects = []
+    for db_token in query:
+        processed += 1
+        token_obj = create_tokenclass_object(db_token)
+        if isinstance(token_obj, TokenClass) and token_filter.matches(token_obj):
+            token_objects.append(token_obj)
+    return processed, token_objects
+
+
+class Checkpoint(object):
+    """
+    A checkpoint file records the processed chunks of a run of the token
+    janitor. The file contains one JSON object per line. The first line
+    contains the chunk size and the description of the run, i.e. the filter
+    and the action. Each other line contains a processed chunk.
+    """
+
+    def __init__(self, filename, chunksize, run=None):
+        """
+        Read an existing checkpoint file or create a new one.
+
+        :param filename: The name of the checkpoint file
+        :param chunksize: The chunk size of the run. It must match the chunk
+            size of an existing checkpoint file.
+        :param run: A dictionary, which describes the filter and the action of
+            the run. It must match the description in an existing checkpoint
+            file, so that a file is not used to resume another run.
+        """
+        self.filename = filename
+        self.done = set()
+        self._lock = Lock()
+        # Compare the description like it is read from the file
+        run = json.loads(json.dumps(run))
+        if os.path.exists(filename):
+            with io.open(filename, "r", encoding="utf8") as f:
+                lines = [json.loads(line) for line in f if line.strip()]
+            if not lines or lines[0].get("chunksize") != chunksize:
+                raise ParameterError(u"The checkpoint file {0!s} was written with "
+                                     u"another chunk size.".format(filename))
+            if lines[0].get("run") != run:
+                raise ParameterError(u"The checkpoint file {0!s} was written for "
+                                     u"another filter or action.".format(filename))
+            self.done = set(line["first_id"] for line in lines[1:])
+            log.info(u"Resuming from checkpoint {0!s} with {1:d} processed "
+                     u"chunks.".format(filename, len(self.done)))
+        else:
+            self._write({"chunksize": chunksize, "run": run})
+
+    def _write(self, entry):
+        with io.open(self.filename, "a", encoding="utf8") as f:
+            f.write(u"{0!s}\n".format(json.dumps(entry)))
+            f.flush()
+            os.fsync(f.fileno())
+
+    def add(self, chunk_result):
+        """
+        Record a processed chunk.
+
+        :param chunk_result: The result of the chunk
+        :type chunk_result: ChunkResult
+        """
+        with self._lock:
+            self._write({"first_id": chunk_result.first_id,
+                         "last_id": chunk_result.last_id,
+                         "processed": chunk_result.processed,
+                         "found": chunk_result.found})
+            self.done.add(chunk_result.first_id)
+
+
+def _process_chunk(token_filter, chunk, process):
+    processed, token_objects = find_tokens_in_chunk(token_filter, chunk)
+    return ChunkResult(chunk[0], chunk[1], processed, len(token_objects),
+                       process(token_objects))
+
+
+def process_tokens(token_filter, process, chunksize=DEFAULT_CHUNK_SIZE,
+                   workers=1, checkpoint=None):
+    """
+    Find the matching tokens chunk by chunk and call ``process`` with the
+    list of the token objects of each chunk.
+
+    With one worker, the chunks are processed in order in the current thread.
+    Otherwise, they are processed by worker threads with their own application
+    context and database session. In this case ``process`` must not return
+    token objects and the results are generated in the order, in which the
+    chunks are finished.
+
+    :param token_filter: The conditions of the tokens
+    :type token_filter: TokenFilter
+    :param process: function, which takes a list of token objects
+    :param chunksize: The number of token IDs of each chunk
+    :param workers: The number of worker threads
+    :param checkpoint: The chunks of the checkpoint are skipped and the
+        processed chunks are added to it. A chunk is only added, after the
+        caller has handled its result and asks for the next one. So the chunk,
+        whose result is handled when the run is interrupted, is processed
+        again, if the run is resumed.
+    :type checkpoint: Checkpoint
+    :return: generator of a ChunkResult for each chunk
+    """
+    chunks = [chunk for chunk in get_token_id_chunks(token_filter, chunksize)
+              if checkpoint is None or chunk[0] not in checkpoint.done]
+    log.info(u"Processing {0:d} chunks of tokens.".format(len(chunks)))
+    if workers <= 1:
+        for chunk in chunks:
+            result = _process_chunk(token_filter, chunk, process)
+            yield result
+            if checkpoint:
+                checkpoint.add(result)
+        return
+
+    app = current_app._get_current_object()
+    pending = Queue()
+    for chunk in chunks:
+        pending.put(chunk)
+    results = Queue()
+    stop = Event()
+
+    def worker():
+        with app.app_context():
+            while not stop.is_set():
+                try:
+                    chunk = pending.get_nowait()
+                except Empty:
+                    break
+                try:
+                    results.put(_process_chunk(token_filter, chunk, process))
+                except Exception as exx:
+                    log.error(u"Failed to process the tokens {0!s} to "
+                              u"{1!s}: {2!r}".format(chunk[0], chunk[1], exx))
+                    log.debug(u"{0!s}".format(traceback.format_exc()))
+                    db.session.rollback()
+                    results.put(exx)
+
+    threads = [Thread(target=worker) for _i in range(min(workers, len(chunks)))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    try:
+        for _i in range(len(chunks)):
+            result = results.get()
+            if isinstance(result, Exception):
+                raise result
+            yield result
+            if checkpoint:
+                checkpoint.add(result)
+    finally:
+        # The workers finish their current chunk. The chunks, whose results
+        # were not handled by the caller, are not recorded in the checkpoint.
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+
+def _apply_action(token_obj, action, set_description=None,
+                  set_tokeninfo_key=None, set_tokeninfo_value=None):
+    serial = token_obj.token.serial
+    messages = []
+    if action == "disable":
+        enable_token(serial=serial, enable=False)
+        messages.append(u"Disabling token {0!s}".format(serial))
+    elif action == "delete":
+        remove_token(serial=serial)
+        messages.append(u"Deleting token {0!s}".format(serial))
+    elif action == "unassign":
+        unassign_token(serial=serial)
+        messages.append(u"Unassigning token {0!s}".format(serial))
+    elif action == "mark":
+        if set_description:
+            messages.append(u"Setting description for token {0!s}: {1!s}".format(
+                serial, set_description))
+            token_obj.set_description(set_description)
+            token_obj.save()
+        if set_tokeninfo_value and set_tokeninfo_key:
+            messages.append(u"Setting tokeninfo for token {0!s}: {1!s}={2!s}".format(
+                serial, set_tokeninfo_key, set_tokeninfo_value))
+            token_obj.add_tokeninfo(set_tokeninfo_key, set_tokeninfo_value)
+            token_obj.save()
+    return messages
+
+
+def apply_token_action(token_objects, action, set_description=None,
+                       set_tokeninfo_key=None, set_tokeninfo_value=None):
+    """
+    Disable, delete, unassign or mark the tokens. The changes of all tokens
+    are committed in one transaction. If the action fails for a token, the
+    transaction is rolled back and the tokens are processed one by one, so
+    that only the failed tokens are skipped.
+
+    :param token_objects: list of token objects
+    :param action: One of ``TOKEN_ACTIONS``
+    :param set_description: The new description of the action "mark"
+    :param set_tokeninfo_key: The tokeninfo key of the action "mark"
+    :param set_tokeninfo_value: The tokeninfo value of the action "mark"
+    :return: list of messages, which describe the changes
+    """
+    if action not in TOKEN_ACTIONS:
+        raise ParameterError(u"Unknown action: {0!s}".format(action))
+    serials = [token_obj.token.serial for token_obj in token_objects]
+    try:
+        messages = []
+        with unit_of_work():
+            for token_obj in token_objects:
+                messages.extend(_apply_action(token_obj, action, set_description,
+                                              set_tokeninfo_key, set_tokeninfo_value))
+        return messages
+    except Exception as exx:
+        log.warning(u"Failed to process the tokens in one transaction: {0!r}".format(exx))
+    messages = []
+    for serial, token_obj in zip(serials, token_objects):
+        try:
+            with unit_of_work():
+                messages.extend(_apply_action(token_obj, action, set_description,
+                                              set_tokeninfo_key, set_tokeninfo_value))
+        except Exception as exx:
+            messages.append(u"Failed to process token {0!s}.".format(serial))
+            messages.append(u"{0!s}".format(exx))
+    return messages
@@ -41,6 +41,7 @@ from privacyidea.lib.log import log_with
 from privacyidea.lib import _
 
 from privacyidea.lib.tokenclass import TokenClass
+from privacyidea.lib.tokenstats import get_token_stats_key, update_token_stats
 from privacyidea.models import Challenge
 from privacyidea.lib.decorators import check_token_locked
 import logging
@@ -406,7 +407,11 @@ class PushTokenClass(TokenClass):
                 token_obj = get_one_token(serial=serial,
                                           tokentype="push",
                                           rollout_state="clientwait")
+                stats_key = get_token_stats_key(token_obj.token)
                 token_obj.update(request.all_data)
+                # The token is activated in the second step
+                update_token_stats(stats_key, get_token_stats_key(token_obj.token))
+                token_obj.save()
             except ResourceNotFoundError:
                 raise ResourceNotFoundError("No token with this serial number in the rollout state 'clientwait'.")
             init_detail_dict = request.all_data
@@ -553,7 +558,6 @@ class PushTokenClass(TokenClass):
                                  session=options.get("session"),
                                  validitytime=validity)
         db_challenge.save()
-        self.challenge_janitor()
         return True, message, db_challenge.transaction_id, attributes
 
     @check_token_locked
@@ -31,7 +31,7 @@ from privacyidea.lib.log import log_with
 from privacyidea.lib.error import TokenAdminError
 import logging
 from privacyidea.models import Challenge
-from privacyidea.lib.challenge import get_challenges
+from privacyidea.lib.challenge import get_challenges, throttled_challenge_janitor
 from privacyidea.lib import _
 from privacyidea.lib.decorators import check_token_locked
 import random
@@ -209,7 +209,6 @@ class QuestionnaireTokenClass(TokenClass):
                                  challenge=message,
                                  validitytime=validity)
         db_challenge.save()
-        self.challenge_janitor()
         return True, message, db_challenge.transaction_id, attributes
 
     def check_answer(self, given_answer, challenge_object):
@@ -278,7 +277,7 @@ class QuestionnaireTokenClass(TokenClass):
                         # increase the received_count
                         challengeobject.set_otp_status()
 
-        self.challenge_janitor()
+        throttled_challenge_janitor()
         return otp_counter
 
     @staticmethod
@@ -54,7 +54,7 @@ from privacyidea.lib.decorators import check_token_locked
 from privacyidea.lib.policydecorators import challenge_response_allowed
 from privacyidea.lib.radiusserver import get_radius
 from privacyidea.models import Challenge
-from privacyidea.lib.challenge import get_challenges
+from privacyidea.lib.challenge import get_challenges, throttled_challenge_janitor
 
 import pyrad.packet
 from pyrad.client import Client
@@ -206,7 +206,6 @@ class RadiusTokenClass(TokenClass):
                                  challenge=message,
                                  validitytime=validity)
         db_challenge.save()
-        self.challenge_janitor()
         return True, message, db_challenge.transaction_id, attributes
 
     @log_with(log)
@@ -258,7 +257,7 @@ class RadiusTokenClass(TokenClass):
                         challenge_response = True
                     else:
                         challengeobject.delete()
-                        self.challenge_janitor()
+                        throttled_challenge_janitor()
 
         return challenge_response
 
@@ -310,7 +309,7 @@ class RadiusTokenClass(TokenClass):
                         # increase the received_count
                         challengeobject.set_otp_status()
 
-        self.challenge_janitor()
+        throttled_challenge_janitor()
         return otp_counter
 
     @property
@@ -52,6 +52,7 @@ from privacyidea.lib.log import log_with
 from privacyidea.lib.policydecorators import challenge_response_allowed
 from privacyidea.lib.tokenclass import TokenClass, TOKENKIND
 from privacyidea.lib import _
+from privacyidea.lib.privacyideaserver import UpstreamGroup
 
 optional = True
 required = False
@@ -257,10 +258,11 @@ class RemoteTokenClass(TokenClass):
             return otp_count
 
         params['pass'] = otpval
-        request_url = "{0!s}{1!s}".format(remoteServer, remotePath)
+        # remote.server may contain several upstream servers
+        upstreams = UpstreamGroup.from_urls(remoteServer, ssl_verify)
 
         try:
-            r = requests.post(request_url, data=params, verify=ssl_verify)
+            request_url, r = upstreams.request("POST", remotePath, data=params)
 
             if r.status_code == requests.codes.ok:
                 response = r.json()
@@ -270,7 +272,7 @@ class RemoteTokenClass(TokenClass):
 
         except Exception as exx:  # pragma: no cover
             log.error("Error getting response from "
-                      "remote Server (%r): %r" % (request_url, exx))
+                      "remote Server (%r): %r" % (remoteServer, exx))
             log.debug("{0!s}".format(traceback.format_exc()))
 
         return otp_count
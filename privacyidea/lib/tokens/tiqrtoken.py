@@ -90,8 +90,7 @@ from privacyidea.lib.error import ParameterError
 from privacyidea.models import Challenge
 from privacyidea.lib.user import get_user_from_param
 from privacyidea.lib.tokens.ocra import OCRASuite, OCRA
-from privacyidea.lib.challenge import get_challenges
-from privacyidea.models import cleanup_challenges
+from privacyidea.lib.challenge import get_challenges, throttled_challenge_janitor
 from privacyidea.lib import _
 from privacyidea.lib.decorators import check_token_locked
 from privacyidea.lib.tokens.ocratoken import OcraTokenClass
@@ -336,7 +335,7 @@ class TiqrTokenClass(OcraTokenClass):
                         # Mark the challenge as answered successfully.
                         challenges[0].set_otp_status(True)
 
-            cleanup_challenges()
+            throttled_challenge_janitor()
 
             return "plain", res
 
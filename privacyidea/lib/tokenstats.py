@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+#
+# This code is free software; you can redistribute it and/or
+# modify it under the terms of the GNU AFFERO GENERAL PUBLIC LICENSE
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or any later version.
+#
+# This code is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU AFFERO GENERAL PUBLIC LICENSE for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+__doc__ = """
+This module counts the tokens by token kind, assignment and active state in
+the table "tokenstats". The functions in lib/token.py, which create, delete,
+assign, unassign, enable or disable tokens, update the counters with an atomic
+SQL update before they commit their changes. So the statistics and the
+subscription check do not need to count the token table.
+
+There are only a few counters, which are updated by all requests. To avoid
+deadlocks, the counters are always updated in the same order. Within a unit
+of work, the changes are collected and written just before the commit.
+
+Tokens, which are changed directly in the database, are not counted. The
+periodic task "TokenStats" reconciles the counters with the token table.
+
+This module is tested in tests/test_lib_tokenstats.py.
+"""
+
+import logging
+from collections import namedtuple, defaultdict
+
+from sqlalchemy import func, and_
+from sqlalchemy.exc import IntegrityError
+
+from privacyidea.models import (TokenStats, Token, TokenInfo, TokenOwner, db,
+                                commit_session, before_unit_of_work_commit)
+
+log = logging.getLogger(__name__)
+
+#: The counter, which contains a token
+TokenStatsKey = namedtuple("TokenStatsKey", ["tokenkind", "assigned", "active"])
+
+
+def get_token_stats_key(db_token):
+    """
+    Return the counter, which contains the token in its current state.
+
+    :param db_token: The database object of the token
+    :type db_token: Token
+    :return: TokenStatsKey
+    """
+    tokenkind = db.session.query(TokenInfo.Value).filter(
+        TokenInfo.token_id == db_token.id,
+        TokenInfo.Key == u"tokenkind").scalar()
+    return TokenStatsKey(tokenkind or u"", db_token.first_owner is not None,
+                         bool(db_token.active))
+
+
+def _add_to_counter(key, number):
+    # The counters of the usual token kinds are created with the table. Other
+    # counters are created in a savepoint, which is rolled back, if a
+    # concurrent request created the counter in the meantime.
+    query = TokenStats.query.filter_by(tokenkind=key.tokenkind,
+                                       assigned=key.assigned,
+                                       active=key.active)
+    values = {TokenStats.count: TokenStats.count + number}
+    if not query.update(values, synchronize_session=False):
+        try:
+            with db.session.begin_nested():
+                db.session.add(TokenStats(key.tokenkind, key.assigned,
+                                          key.active, number))
+        except IntegrityError:
+            query.update(values, synchronize_session=False)
+
+
+def _write_token_stats(changes):
+    # The counters are locked in a fixed order, so that concurrent transactions,
+    # which move tokens in opposite directions, do not deadlock.
+    for key in sorted(changes):
+        if changes[key]:
+            _add_to_counter(key, changes[key])
+
+
+def update_token_stats(old_key=None, new_key=None):
+    """
+    Move a token from one counter to another. The changes are not committed,
+    so that they are committed together with the changes of the token.
+    Within a unit of work, the changes are written before the unit of work
+    is committed.
+
+    :param old_key: The counter of the token before the change or None, if
+        the token was created
+    :type old_key: TokenStatsKey
+    :param new_key: The counter of the token after the change or None, if
+        the token was deleted
+    :type new_key: TokenStatsKey
+    """
+    if old_key == new_key:
+        return
+    pending = before_unit_of_work_commit("token_stats", _write_token_stats,
+                                         lambda: defaultdict(int))
+    changes = defaultdict(int) if pending is None else pending
+    if old_key is not None:
+        changes[old_key] -= 1
+    if new_key is not None:
+        changes[new_key] += 1
+    if pending is None:
+        _write_token_stats(changes)
+
+
+def get_token_stats(tokenkind=None, assigned=None, active=None):
+    """
+    Return the number of tokens, which match all given conditions.
+
+    :param tokenkind: Only count the tokens of this kind
+    :param assigned: Only count assigned (True) or unassigned (False) tokens
+    :param active: Only count active (True) or inactive (False) tokens
+    :return: The number of tokens
+    :rtype: int
+    """
+    query = db.session.query(func.sum(TokenStats.count))
+    if tokenkind is not None:
+        query = query.filter(TokenStats.tokenkind == tokenkind)
+    if assigned is not None:
+        query = query.filter(TokenStats.assigned == bool(assigned))
+    if active is not None:
+        query = query.filter(TokenStats.active == bool(active))
+    return int(query.scalar() or 0)
+
+
+def reconcile_token_stats():
+    """
+    Count the tokens in the token table and replace the counters.
+
+    :return: The number of counters, which were wrong
+    :rtype: int
+    """
+    owned = db.session.query(TokenOwner.token_id).distinct().subquery()
+    tokenkind = func.coalesce(TokenInfo.Value, u"")
+    assigned = owned.c.token_id != None
+    counts = {}
+    for kind, is_assigned, active, number in db.session.query(
+            tokenkind, assigned, Token.active, func.count(Token.id)).select_from(
+            Token).outerjoin(
+            TokenInfo, and_(TokenInfo.token_id == Token.id,
+                            TokenInfo.Key == u"tokenkind")).outerjoin(
+            owned, owned.c.token_id == Token.id).group_by(
+            tokenkind, assigned, Token.active):
+        counts[TokenStatsKey(kind, bool(is_assigned), bool(active))] = number
+    wrong = 0
+    for counter in TokenStats.query.all():
+        number = counts.pop(TokenStatsKey(counter.tokenkind, counter.assigned,
+                                          counter.active), 0)
+        if counter.count != number:
+            counter.count = number
+            wrong += 1
+    for key, number in counts.items():
+        db.session.add(TokenStats(key.tokenkind, key.assigned, key.active, number))
+        wrong += 1
+    commit_session()
+    if wrong:
+        log.info(u"Corrected {0!s} token counters.".format(wrong))
+    return wrong
@@ -61,6 +61,7 @@ from .realm import (get_realms,
                     get_realm)
 from .config import get_from_config
 from .usercache import (user_cache, cache_username, user_init, delete_user_cache)
+from . import metrics
 
 log = logging.getLogger(__name__)
 
@@ -111,7 +112,9 @@ class User(object):
             if y is None:
                 raise UserError("The resolver '{0!s}' does not exist!".format(
                     self.resolver))
-            self.uid = y.getUserId(self.login)
+            with metrics.timer(metrics.RESOLVER_DURATION,
+                               type=y.getResolverType(), method="getUserId"):
+                self.uid = y.getUserId(self.login)
             if y.has_multiple_loginnames:
                 # In this case the primary login might be another value!
                 self.login = y.getUsername(self.uid)
@@ -224,7 +227,9 @@ class User(object):
             log.info("Resolver {0!r} not found!".format(resolvername))
             return False
         else:
-            uid = y.getUserId(self.login)
+            with metrics.timer(metrics.RESOLVER_DURATION,
+                               type=y.getResolverType(), method="getUserId"):
+                uid = y.getUserId(self.login)
             if uid not in ["", None]:
                 log.info("user {0!r} found in resolver {1!r}".format(self.login,
                                                                      resolvername))
@@ -273,7 +278,9 @@ class User(object):
             return {}
         (uid, _rtype, _resolver) = self.get_user_identifiers()
         y = get_resolver_object(self.resolver)
-        userInfo = y.getUserInfo(uid)
+        with metrics.timer(metrics.RESOLVER_DURATION,
+                           type=y.getResolverType(), method="getUserInfo"):
+            userInfo = y.getUserInfo(uid)
         return userInfo
     
     @log_with(log)
@@ -361,7 +368,10 @@ class User(object):
             if len(res) == 1:
                 y = get_resolver_object(self.resolver)
                 uid, _rtype, _rname = self.get_user_identifiers()
-                if y.checkPass(uid, password):
+                with metrics.timer(metrics.RESOLVER_DURATION,
+                                   type=y.getResolverType(), method="checkPass"):
+                    password_ok = y.checkPass(uid, password)
+                if password_ok:
                     success = u"{0!s}@{1!s}".format(self.login, self.realm)
                     log.debug("Successfully authenticated user {0!r}.".format(self))
                 else:
@@ -642,7 +652,9 @@ def get_user_list(param=None, user=None):
             log.debug("Check for resolver class: {0!r}".format(resolver_name))
             y = get_resolver_object(resolver_name)
             log.debug("with this search dictionary: {0!r} ".format(searchDict))
-            ulist = y.getUserList(searchDict)
+            with metrics.timer(metrics.RESOLVER_DURATION,
+                               type=y.getResolverType(), method="getUserList"):
+                ulist = y.getUserList(searchDict)
             # Add resolvername to the list
             for ue in ulist:
                 ue["resolver"] = resolver_name
@@ -23,7 +23,7 @@ import logging
 import datetime
 
 from privacyidea.lib.config import get_from_config
-from privacyidea.models import UserCache, db
+from privacyidea.models import UserCache, db, commit_session
 from sqlalchemy import and_
 
 log = logging.getLogger(__name__)
@@ -97,7 +97,7 @@ def delete_user_cache(resolver=None, username=None, expired=None):
     filter_condition = create_filter(username=username, resolver=resolver,
                                      expired=expired)
     rowcount = db.session.query(UserCache).filter(filter_condition).delete()
-    db.session.commit()
+    commit_session()
     log.info(u'Deleted {} entries from the user cache (resolver={!r}, username={!r}, expired={!r})'.format(
         rowcount, resolver, username, expired
     ))
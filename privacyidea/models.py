@@ -38,6 +38,8 @@
 import binascii
 import six
 import logging
+from collections import OrderedDict
+from contextlib import contextmanager
 from datetime import datetime, timedelta
 
 from dateutil.tz import tzutc
@@ -50,9 +52,10 @@ from privacyidea.lib.crypto import (encrypt,
                                     hash,
                                     SecretObj,
                                     get_rand_digit_str)
-from sqlalchemy import and_
+from sqlalchemy import and_, event, DDL
 from sqlalchemy.schema import Sequence
 from .lib.log import log_with
+from privacyidea.lib.sqlutils import delete_chunked, UNIT_OF_WORK
 from privacyidea.lib.utils import (is_true, convert_column_to_unicode,
                                    hexlify_and_unicode)
 
@@ -69,6 +72,111 @@ PRIVACYIDEA_TIMESTAMP = "__timestamp__"
 
 db = SQLAlchemy()
 
+#: The key in ``db.session.info``, which holds the fail counters, that were
+#: increased during the unit of work
+UNIT_OF_WORK_FAILCOUNTERS = "unit_of_work_failcounters"
+#: The key in ``db.session.info``, which holds the functions, that are called
+#: before the unit of work is committed
+UNIT_OF_WORK_BEFORE_COMMIT = "unit_of_work_before_commit"
+
+
+def commit_session():
+    """
+    Commit the database session. If a unit of work is active, the changes
+    are only flushed to the database and committed at the end of the unit of
+    work.
+    """
+    if db.session.info.get(UNIT_OF_WORK):
+        db.session.flush()
+    else:
+        db.session.commit()
+
+
+def before_unit_of_work_commit(key, function, factory=dict):
+    """
+    Register a function, which is called before the active unit of work is
+    committed. The function is registered only once for each key and it is
+    called with the data, which was collected for this key during the unit
+    of work. If the unit of work is rolled back, the data is dropped.
+
+    :param key: The key of the function
+    :param function: The function, which takes the collected data
+    :param factory: The function, which creates the empty data
+    :return: The data, to which the changes should be added, or None, if no
+        unit of work is active
+    """
+    if not db.session.info.get(UNIT_OF_WORK):
+        return None
+    hooks = db.session.info.setdefault(UNIT_OF_WORK_BEFORE_COMMIT, OrderedDict())
+    if key not in hooks:
+        hooks[key] = (function, factory())
+    return hooks[key][1]
+
+
+def keep_failcount(token):
+    """
+    Remember the increased fail counter of the token, so that it is written
+    to the database, even if the unit of work is rolled back. Otherwise an
+    error during the request would reset the fail counter and weaken the
+    lockout of the token.
+
+    :param token: The database object of the token
+    :type token: Token
+    """
+    if db.session.info.get(UNIT_OF_WORK):
+        db.session.info.setdefault(UNIT_OF_WORK_FAILCOUNTERS, {})[token.id] = token.failcount
+
+
+def _restore_failcounters(failcounters):
+    """
+    Write the fail counters, which were increased during a unit of work,
+    that was rolled back. A fail counter is never decreased.
+
+    :param failcounters: dictionary of token IDs and fail counters
+    """
+    try:
+        for token_id, failcount in failcounters.items():
+            Token.query.filter(Token.id == token_id,
+                               Token.failcount < failcount).update(
+                {Token.failcount: failcount}, synchronize_session=False)
+        db.session.commit()
+    except Exception as exx:  # pragma: no cover
+        log.error(u"Could not restore the fail counters {0!r}: {1!r}".format(
+            failcounters, exx))
+        db.session.rollback()
+
+
+@contextmanager
+def unit_of_work():
+    """
+    Context manager, which defers the commits of ``commit_session`` and
+    thus of the ``save`` and ``delete`` methods of the database objects.
+    All changes are committed in one transaction at the end. If an exception
+    is raised, all changes are rolled back. Only the fail counters, which
+    were increased, are committed afterwards (see ``keep_failcount``).
+    Nested units of work are part of the outer unit of work.
+    """
+    if db.session.info.get(UNIT_OF_WORK):
+        yield
+        return
+    db.session.info[UNIT_OF_WORK] = True
+    try:
+        yield
+        hooks = db.session.info.pop(UNIT_OF_WORK_BEFORE_COMMIT, {})
+        for function, data in hooks.values():
+            function(data)
+    except Exception:
+        db.session.info.pop(UNIT_OF_WORK, None)
+        db.session.info.pop(UNIT_OF_WORK_BEFORE_COMMIT, None)
+        failcounters = db.session.info.pop(UNIT_OF_WORK_FAILCOUNTERS, None)
+        db.session.rollback()
+        if failcounters:
+            _restore_failcounters(failcounters)
+        raise
+    db.session.info.pop(UNIT_OF_WORK, None)
+    db.session.info.pop(UNIT_OF_WORK_FAILCOUNTERS, None)
+    db.session.commit()
+
 
 class MethodsMixin(object):
     """
@@ -78,13 +186,13 @@ class MethodsMixin(object):
     
     def save(self):
         db.session.add(self)
-        db.session.commit()
+        commit_session()
         return self.id
     
     def delete(self):
         ret = self.id
         db.session.delete(self)
-        db.session.commit()
+        commit_session()
         return ret
 
 
@@ -107,14 +215,14 @@ class TimestampMethodsMixin(object):
     def save(self):
         db.session.add(self)
         save_config_timestamp()
-        db.session.commit()
+        commit_session()
         return self.id
 
     def delete(self):
         ret = self.id
         db.session.delete(self)
         save_config_timestamp()
-        db.session.commit()
+        commit_session()
         return ret
 
 
@@ -137,8 +245,9 @@ class Token(MethodsMixin, db.Model):
                        unique=True,
                        nullable=False,
                        index=True)
+    # The token type is stored in lower case, so that the index can be used
     tokentype = db.Column(db.Unicode(30),
-                          default=u'HOTP',
+                          default=u'hotp',
                           index=True)
     user_pin = db.Column(db.Unicode(512),
                          default=u'')  # encrypt
@@ -190,7 +299,7 @@ class Token(MethodsMixin, db.Model):
                  **kwargs):
         super(Token, self).__init__(**kwargs)
         self.serial = u'' + serial
-        self.tokentype = tokentype
+        self.tokentype = tokentype.lower()
         self.count = 0
         self.failcount = 0
         self.maxfail = 10
@@ -217,7 +326,7 @@ class Token(MethodsMixin, db.Model):
                 db.session.add(to)
 
             if tr or to:
-                db.session.commit()
+                commit_session()
 
     @property
     def first_owner(self):
@@ -236,7 +345,7 @@ class Token(MethodsMixin, db.Model):
                   .filter(TokenInfo.token_id == self.id)\
                   .delete()
         db.session.delete(self)
-        db.session.commit()
+        commit_session()
         return ret
 
     @staticmethod
@@ -299,7 +408,7 @@ class Token(MethodsMixin, db.Model):
                     # If the realm is not yet attached to the token
                     Tr = TokenRealm(token_id=self.id, realm_id=r.id)
                     db.session.add(Tr)
-        db.session.commit()
+        commit_session()
         
     def get_realms(self):
         """
@@ -556,7 +665,7 @@ class Token(MethodsMixin, db.Model):
             if not k.endswith(".type"):
                 TokenInfo(self.id, k, v,
                           Type=types.get(k)).save(persistent=False)
-        db.session.commit()
+        commit_session()
 
     def del_info(self, key=None):
         """
@@ -595,7 +704,7 @@ class Token(MethodsMixin, db.Model):
             self.count = 0
             self.failcount = 0
 
-        self.tokentype = typ
+        self.tokentype = typ.lower()
         return
 
     def update_otpkey(self, otpkey):
@@ -617,6 +726,15 @@ class Token(MethodsMixin, db.Model):
             self.update_otpkey(otpkey)
 
 
+# The descriptions are searched case insensitive. Dialects which support
+# indexes on expressions get an index on the lower case description.
+TOKEN_DESCRIPTION_INDEX_DIALECTS = ("postgresql", "sqlite")
+event.listen(Token.__table__, "after_create",
+             DDL("CREATE INDEX ix_token_description_lower ON token "
+                 "(lower(description))").execute_if(
+                 dialect=TOKEN_DESCRIPTION_INDEX_DIALECTS))
+
+
 class TokenInfo(MethodsMixin, db.Model):
     """
     The table "tokeninfo" is used to store additional, long information that
@@ -663,7 +781,7 @@ class TokenInfo(MethodsMixin, db.Model):
         if ti is None:
             # create a new one
             db.session.add(self)
-            db.session.commit()
+            commit_session()
             ret = self.id
         else:
             # update
@@ -675,7 +793,7 @@ class TokenInfo(MethodsMixin, db.Model):
                                                      'Type': self.Type})
             ret = ti.id
         if persistent:
-            db.session.commit()
+            commit_session()
         return ret
 
 
@@ -707,7 +825,7 @@ class Admin(db.Model):
         if c is None:
             # create a new one
             db.session.add(self)
-            db.session.commit()
+            commit_session()
             ret = self.username
         else:
             # update
@@ -719,12 +837,12 @@ class Admin(db.Model):
             Admin.query.filter_by(username=self.username)\
                 .update(update_dict)
             ret = c.username
-        db.session.commit()
+        commit_session()
         return ret
 
     def delete(self):
         db.session.delete(self)
-        db.session.commit()
+        commit_session()
 
 
 @six.python_2_unicode_compatible
@@ -757,14 +875,14 @@ class Config(TimestampMethodsMixin, db.Model):
     def save(self):
         db.session.add(self)
         save_config_timestamp()
-        db.session.commit()
+        commit_session()
         return self.Key
 
     def delete(self):
         ret = self.Key
         db.session.delete(self)
         save_config_timestamp()
-        db.session.commit()
+        commit_session()
         return ret
 
 
@@ -800,7 +918,7 @@ class Realm(TimestampMethodsMixin, db.Model):
         # delete the realm
         db.session.delete(self)
         save_config_timestamp()
-        db.session.commit()
+        commit_session()
         return ret
 
 
@@ -834,7 +952,7 @@ class CAConnector(MethodsMixin, db.Model):
         db.session.query(CAConnectorConfig)\
                   .filter(CAConnectorConfig.caconnector_id == ret)\
                   .delete()
-        db.session.commit()
+        commit_session()
         return ret
 
 
@@ -886,7 +1004,7 @@ class CAConnectorConfig(db.Model):
         if c is None:
             # create a new one
             db.session.add(self)
-            db.session.commit()
+            commit_session()
             ret = self.id
         else:
             # update
@@ -897,7 +1015,7 @@ class CAConnectorConfig(db.Model):
                                                      'Descrip'
                                                      'tion': self.Description})
             ret = c.id
-        db.session.commit()
+        commit_session()
         return ret
 
 
@@ -932,7 +1050,7 @@ class Resolver(TimestampMethodsMixin, db.Model):
                   .filter(ResolverConfig.resolver_id == ret)\
                   .delete()
         save_config_timestamp()
-        db.session.commit()
+        commit_session()
         return ret
 
 
@@ -985,7 +1103,7 @@ class ResolverConfig(TimestampMethodsMixin, db.Model):
         if c is None:
             # create a new one
             db.session.add(self)
-            db.session.commit()
+            commit_session()
             ret = self.id
         else:
             # update
@@ -997,7 +1115,7 @@ class ResolverConfig(TimestampMethodsMixin, db.Model):
                                                      'tion': self.Description})
             ret = c.id
         save_config_timestamp()
-        db.session.commit()
+        commit_session()
         return ret
 
 
@@ -1056,10 +1174,13 @@ class TokenOwner(MethodsMixin, db.Model):
     A token can be assigned to several users.
     """
     __tablename__ = 'tokenowner'
-    __table_args__ = {'mysql_row_format': 'DYNAMIC'}
+    __table_args__ = (db.Index('ix_tokenowner_resolver_user_id',
+                               'resolver', 'user_id'),
+                      {'mysql_row_format': 'DYNAMIC'})
     id = db.Column(db.Integer(), Sequence("tokenowner_seq"), primary_key=True)
     token_id = db.Column(db.Integer(), db.ForeignKey('token.id'))
-    resolver = db.Column(db.Unicode(120), default=u'', index=True)
+    # The resolver is indexed by ix_tokenowner_resolver_user_id
+    resolver = db.Column(db.Unicode(120), default=u'')
     user_id = db.Column(db.Unicode(320), default=u'', index=True)
     realm_id = db.Column(db.Integer(), db.ForeignKey('realm.id'))
     # This creates an attribute "tokenowners" in the realm objects
@@ -1096,14 +1217,14 @@ class TokenOwner(MethodsMixin, db.Model):
         if to is None:
             # This very assignment does not exist, yet:
             db.session.add(self)
-            db.session.commit()
+            commit_session()
             ret = self.id
         else:
             ret = to.id
             # There is nothing to update
 
         if persistent:
-            db.session.commit()
+            commit_session()
         return ret
 
 
@@ -1118,6 +1239,7 @@ class TokenRealm(MethodsMixin, db.Model):
                    nullable=True)
     token_id = db.Column(db.Integer(),
                          db.ForeignKey('token.id'))
+    # The realm_id is indexed by ix_tokenrealm_realm_id_token_id
     realm_id = db.Column(db.Integer(),
                          db.ForeignKey('realm.id'))
     # This creates an attribute "realm_list" in the Token object
@@ -1131,6 +1253,8 @@ class TokenRealm(MethodsMixin, db.Model):
     __table_args__ = (db.UniqueConstraint('token_id',
                                           'realm_id',
                                           name='trix_2'),
+                      db.Index('ix_tokenrealm_realm_id_token_id',
+                               'realm_id', 'token_id'),
                       {'mysql_row_format': 'DYNAMIC'})
 
     def __init__(self, realm_id=0, token_id=0, realmname=None):
@@ -1156,7 +1280,7 @@ class TokenRealm(MethodsMixin, db.Model):
         if tr is None:
             # create a new one
             db.session.add(self)
-            db.session.commit()
+            commit_session()
 
         ret = self.id
         return ret
@@ -1219,7 +1343,7 @@ class Challenge(MethodsMixin, db.Model):
     # The token serial number
     serial = db.Column(db.Unicode(40), default=u'', index=True)
     timestamp = db.Column(db.DateTime, default=datetime.now())
-    expiration = db.Column(db.DateTime)
+    expiration = db.Column(db.DateTime, index=True)
     received_count = db.Column(db.Integer(), default=0)
     otp_valid = db.Column(db.Boolean, default=False)
 
@@ -1332,15 +1456,18 @@ class Challenge(MethodsMixin, db.Model):
         return u"{0!s}".format(descr)
 
 
-def cleanup_challenges():
+def cleanup_challenges(chunksize=1000):
     """
     Delete all challenges, that have expired.
+    The challenges are deleted in chunks, so that the challenge table is not
+    locked for a long time.
 
-    :return: None
+    :param chunksize: The number of challenges to delete in one statement
+    :return: The number of deleted challenges
     """
     c_now = datetime.now()
-    Challenge.query.filter(Challenge.expiration < c_now).delete()
-    db.session.commit()
+    return delete_chunked(db.session, Challenge.__table__,
+                          Challenge.expiration < c_now, chunksize)
 
 # -----------------------------------------------------------------------------
 #
@@ -1537,7 +1664,7 @@ class MachineUser(db.Model):
     @log_with(log)
     def store(self):
         db.session.add(self)
-        db.session.commit()
+        commit_session()
         return True
     
     def to_json(self):
@@ -1599,7 +1726,7 @@ class MachineTokenOptions(db.Model):
             MachineTokenOptions.query.filter_by(
                 machinetoken_id=self.machinetoken_id,
                 mt_key=self.mt_key).update({'mt_value': self.mt_value})
-        db.session.commit()
+        commit_session()
 
 
 """
@@ -1624,7 +1751,7 @@ class MachineUserOptions(db.Model):
         self.mu_key = key
         self.mu_value = value
         db.session.add(self)
-        db.session.commit()
+        commit_session()
 
 """
 
@@ -1688,13 +1815,13 @@ class EventHandler(MethodsMixin, db.Model):
             if cond.Key not in conditions:
                 EventHandlerCondition.query.filter_by(
                     eventhandler_id=self.id, Key=cond.Key).delete()
-                db.session.commit()
+                commit_session()
 
     def save(self):
         if self.id is None:
             # create a new one
             db.session.add(self)
-            db.session.commit()
+            commit_session()
         else:
             # update
             EventHandler.query.filter_by(id=self.id).update({
@@ -1707,7 +1834,7 @@ class EventHandler(MethodsMixin, db.Model):
                 "condition": self.condition,
                 "action": self.action
             })
-            db.session.commit()
+            commit_session()
         return self.id
 
     def delete(self):
@@ -1721,7 +1848,7 @@ class EventHandler(MethodsMixin, db.Model):
         db.session.query(EventHandlerCondition) \
             .filter(EventHandlerCondition.eventhandler_id == ret) \
             .delete()
-        db.session.commit()
+        commit_session()
         return ret
 
     def get(self):
@@ -1786,7 +1913,7 @@ class EventHandlerCondition(db.Model):
         if ehc is None:
             # create a new one
             db.session.add(self)
-            db.session.commit()
+            commit_session()
             ret = self.id
         else:
             # update
@@ -1795,7 +1922,7 @@ class EventHandlerCondition(db.Model):
                 .update({'Value': self.Value,
                          'comparator': self.comparator})
             ret = ehc.id
-        db.session.commit()
+        commit_session()
         return ret
 
 
@@ -1835,7 +1962,7 @@ class EventHandlerOption(db.Model):
         if eho is None:
             # create a new one
             db.session.add(self)
-            db.session.commit()
+            commit_session()
             ret = self.id
         else:
             # update
@@ -1845,7 +1972,7 @@ class EventHandlerOption(db.Model):
                          'Type': self.Type,
                          'Description': self.Description})
             ret = eho.id
-        db.session.commit()
+        commit_session()
         return ret
 
 
@@ -1881,7 +2008,7 @@ class MachineResolver(MethodsMixin, db.Model):
         db.session.query(MachineResolverConfig)\
                   .filter(MachineResolverConfig.resolver_id == ret)\
                   .delete()
-        db.session.commit()
+        commit_session()
         return ret
 
 
@@ -1927,7 +2054,7 @@ class MachineResolverConfig(db.Model):
         if c is None:
             # create a new one
             db.session.add(self)
-            db.session.commit()
+            commit_session()
             ret = self.id
         else:
             # update
@@ -1937,7 +2064,7 @@ class MachineResolverConfig(db.Model):
                          'Type': self.Type,
                          'Description': self.Description})
             ret = c.id
-        db.session.commit()
+        commit_session()
         return ret
 
 
@@ -2044,7 +2171,7 @@ class SMSGateway(MethodsMixin, db.Model):
         if self.id is None:
             # create a new one
             db.session.add(self)
-            db.session.commit()
+            commit_session()
         else:
             # update
             SMSGateway.query.filter_by(id=self.id).update({
@@ -2052,7 +2179,7 @@ class SMSGateway(MethodsMixin, db.Model):
                 "providermodule": self.providermodule,
                 "description": self.description
             })
-            db.session.commit()
+            commit_session()
         return self.id
 
     def delete(self):
@@ -2066,7 +2193,7 @@ class SMSGateway(MethodsMixin, db.Model):
         db.session.query(SMSGatewayOption)\
                   .filter(SMSGatewayOption.gateway_id == ret)\
                   .delete()
-        db.session.commit()
+        commit_session()
         return ret
 
     @property
@@ -2134,7 +2261,7 @@ class SMSGatewayOption(MethodsMixin, db.Model):
         if go is None:
             # create a new one
             db.session.add(self)
-            db.session.commit()
+            commit_session()
             ret = self.id
         else:
             # update
@@ -2143,7 +2270,7 @@ class SMSGatewayOption(MethodsMixin, db.Model):
                                               ).update({'Value': self.Value,
                                                         'Type': self.Type})
             ret = go.id
-        db.session.commit()
+        commit_session()
         return ret
 
 
@@ -2168,7 +2295,7 @@ class PrivacyIDEAServer(MethodsMixin, db.Model):
         if pi is None:
             # create a new one
             db.session.add(self)
-            db.session.commit()
+            commit_session()
             ret = self.id
         else:
             # update
@@ -2180,7 +2307,7 @@ class PrivacyIDEAServer(MethodsMixin, db.Model):
             PrivacyIDEAServer.query.filter(PrivacyIDEAServer.identifier ==
                                            self.identifier).update(values)
             ret = pi.id
-        db.session.commit()
+        commit_session()
         return ret
 
 
@@ -2226,7 +2353,7 @@ class RADIUSServer(MethodsMixin, db.Model):
         if radius is None:
             # create a new one
             db.session.add(self)
-            db.session.commit()
+            commit_session()
             ret = self.id
         else:
             # update
@@ -2246,7 +2373,7 @@ class RADIUSServer(MethodsMixin, db.Model):
             RADIUSServer.query.filter(RADIUSServer.identifier ==
                                       self.identifier).update(values)
             ret = radius.id
-        db.session.commit()
+        commit_session()
         return ret
 
 
@@ -2299,7 +2426,7 @@ class SMTPServer(MethodsMixin, db.Model):
         if smtp is None:
             # create a new one
             db.session.add(self)
-            db.session.commit()
+            commit_session()
             ret = self.id
         else:
             # update
@@ -2323,7 +2450,7 @@ class SMTPServer(MethodsMixin, db.Model):
             SMTPServer.query.filter(SMTPServer.identifier ==
                                     self.identifier).update(values)
             ret = smtp.id
-        db.session.commit()
+        commit_session()
         return ret
 
 
@@ -2352,7 +2479,7 @@ class ClientApplication(MethodsMixin, db.Model):
         if clientapp is None:
             # create a new one
             db.session.add(self)
-            db.session.commit()
+            commit_session()
             ret = self.id
         else:
             # update
@@ -2362,7 +2489,7 @@ class ClientApplication(MethodsMixin, db.Model):
             ClientApplication.query.filter(
                 ClientApplication.id == clientapp.id).update(values)
             ret = clientapp.id
-        db.session.commit()
+        commit_session()
         return ret
 
     def __repr__(self):
@@ -2403,7 +2530,7 @@ class Subscription(MethodsMixin, db.Model):
         if subscription is None:
             # create a new one
             db.session.add(self)
-            db.session.commit()
+            commit_session()
             ret = self.id
         else:
             # update
@@ -2411,7 +2538,7 @@ class Subscription(MethodsMixin, db.Model):
             Subscription.query.filter(
                 Subscription.id == subscription.id).update(values)
             ret = subscription.id
-        db.session.commit()
+        commit_session()
         return ret
 
     def __repr__(self):
@@ -2433,57 +2560,38 @@ class Subscription(MethodsMixin, db.Model):
 class EventCounter(db.Model):
     """
     This table stores counters of the event handler "Counter".
+
+    A counter can be split into several rows (shards), so that concurrent
+    requests do not all have to update the same row. The value of the counter
+    is the sum of the values of all its shards.
     """
     __tablename__ = 'eventcounter'
-    __table_args__ = {'mysql_row_format': 'DYNAMIC'}
-    counter_name = db.Column(db.Unicode(80), nullable=False, primary_key=True)
+    id = db.Column(db.Integer, Sequence("eventcounter_seq"), primary_key=True)
+    counter_name = db.Column(db.Unicode(80), nullable=False)
     counter_value = db.Column(db.Integer, default=0)
+    shard = db.Column(db.Integer, nullable=False, default=0)
+    __table_args__ = (db.UniqueConstraint('counter_name',
+                                          'shard',
+                                          name='evctr_1'),
+                      {'mysql_row_format': 'DYNAMIC'})
 
-    def __init__(self, name, value=0):
+    def __init__(self, name, value=0, shard=0):
         self.counter_value = value
         self.counter_name = name
+        self.shard = shard
         self.save()
 
     def save(self):
         db.session.add(self)
-        db.session.commit()
+        commit_session()
         return self.counter_name
 
     def delete(self):
         ret = self.counter_name
         db.session.delete(self)
-        db.session.commit()
+        commit_session()
         return ret
 
-    def increase(self):
-        """
-        Increase the value of a counter
-        :return:
-        """
-        self.counter_value = self.counter_value + 1
-        self.save()
-
-    def decrease(self, allow_negative=False):
-        """
-        Decrease the value of a counter, stop at zero if allow_negative not given
-        :param allow_negative:
-        :return:
-        """
-        if self.counter_value <= 0 and not allow_negative:
-            # set counter to zero
-            self.counter_value = 0
-        else:
-            self.counter_value = self.counter_value - 1
-        self.save()
-
-    def reset(self):
-        """
-        Reset the value of a counter
-        :return:
-        """
-        self.counter_value = 0
-        self.save()
-
 
 ### Audit
 
@@ -2615,6 +2723,110 @@ class AuthCache(MethodsMixin, db.Model):
         self.last_auth = last_auth
 
 
+class AuthCounter(db.Model):
+    """
+    This table stores the number of successful and failed authentications
+    of a user in time buckets. It is used to check the policies
+    ``auth_max_success`` and ``auth_max_fail``.
+
+    The column ``bucket`` contains the start of the time bucket in seconds
+    since the epoch.
+    """
+    __tablename__ = 'authcounter'
+    id = db.Column(db.Integer, Sequence("authcounter_seq"), primary_key=True)
+    username = db.Column(db.Unicode(64), nullable=False)
+    realm = db.Column(db.Unicode(120), nullable=False)
+    success = db.Column(db.Boolean, nullable=False)
+    bucket = db.Column(db.Integer, nullable=False)
+    count = db.Column(db.Integer, default=0)
+    __table_args__ = (db.UniqueConstraint('username',
+                                          'realm',
+                                          'success',
+                                          'bucket',
+                                          name='authctr_1'),
+                      {'mysql_row_format': 'DYNAMIC'})
+
+    def __init__(self, username, realm, success, bucket, count=0):
+        self.username = username
+        self.realm = realm
+        self.success = success
+        self.bucket = bucket
+        self.count = count
+
+
+class TokenStats(db.Model):
+    """
+    This table stores the number of tokens by token kind, assignment and
+    active state. It is updated, when a token is created, deleted, assigned,
+    unassigned, enabled or disabled, so that the statistics do not need to
+    count the token table.
+
+    Tokens without a token kind are counted with the empty token kind.
+    """
+    __tablename__ = 'tokenstats'
+    id = db.Column(db.Integer, Sequence("tokenstats_seq"), primary_key=True)
+    tokenkind = db.Column(db.Unicode(30), nullable=False, default=u'')
+    assigned = db.Column(db.Boolean, nullable=False)
+    active = db.Column(db.Boolean, nullable=False)
+    count = db.Column(db.Integer, default=0)
+    __table_args__ = (db.UniqueConstraint('tokenkind',
+                                          'assigned',
+                                          'active',
+                                          name='tsix_1'),
+                      {'mysql_row_format': 'DYNAMIC'})
+
+    def __init__(self, tokenkind, assigned, active, count=0):
+        self.tokenkind = tokenkind
+        self.assigned = assigned
+        self.active = active
+        self.count = count
+
+
+def _create_token_counters(target, connection, **kw):
+    """
+    Create the counters of the usual token kinds, so that the token functions
+    only need to update them.
+    """
+    connection.execute(target.insert(),
+                       [{"tokenkind": tokenkind, "assigned": assigned,
+                         "active": active, "count": 0}
+                        for tokenkind in TOKEN_STATS_KINDS
+                        for assigned in (False, True)
+                        for active in (False, True)])
+
+
+TOKEN_STATS_KINDS = (u"software", u"hardware", u"virtual", u"")
+event.listen(TokenStats.__table__, "after_create", _create_token_counters)
+
+
+class TokenImportChunk(db.Model):
+    """
+    This table stores the token files, which are imported by the job queue,
+    until the import is finished. So the job can run on any node.
+
+    A file is split into parts, which are encrypted like passwords. The part
+    at position -1 contains the encrypted secrets of the file like the pre
+    shared key of a PSKC file.
+    """
+    __tablename__ = 'tokenimportchunk'
+    id = db.Column(db.Integer, Sequence("tokenimportchunk_seq"), primary_key=True)
+    import_id = db.Column(db.Unicode(40), nullable=False)
+    position = db.Column(db.Integer, nullable=False)
+    data = db.Column(db.UnicodeText, nullable=False)
+    # We store this as a naive datetime in UTC
+    created = db.Column(db.DateTime(False), nullable=False)
+    __table_args__ = (db.UniqueConstraint('import_id',
+                                          'position',
+                                          name='tichix_1'),
+                      {'mysql_row_format': 'DYNAMIC'})
+
+    def __init__(self, import_id, position, data):
+        self.import_id = import_id
+        self.position = position
+        self.data = data
+        self.created = datetime.utcnow()
+
+
 ### Periodic Tasks
 
 class PeriodicTask(MethodsMixin, db.Model):
@@ -2675,7 +2887,7 @@ class PeriodicTask(MethodsMixin, db.Model):
         for last_run in all_last_runs:
             if last_run.node not in node_list:
                 PeriodicTaskLastRun.query.filter_by(id=last_run.id).delete()
-        db.session.commit()
+        commit_session()
 
     @property
     def aware_last_update(self):
@@ -2723,16 +2935,18 @@ class PeriodicTask(MethodsMixin, db.Model):
                 "ordering": self.ordering,
                 "last_update": self.last_update,
             })
-        db.session.commit()
+        commit_session()
         return self.id
 
     def delete(self):
         ret = self.id
-        # delete all PeriodicTaskOptions and PeriodicTaskLastRuns before deleting myself
+        # delete all PeriodicTaskOptions, PeriodicTaskLastRuns and
+        # PeriodicTaskLeases before deleting myself
         db.session.query(PeriodicTaskOption).filter_by(periodictask_id=ret).delete()
         db.session.query(PeriodicTaskLastRun).filter_by(periodictask_id=ret).delete()
+        db.session.query(PeriodicTaskLease).filter_by(periodictask_id=ret).delete()
         db.session.delete(self)
-        db.session.commit()
+        commit_session()
         return ret
 
     def set_last_run(self, node, timestamp):
@@ -2786,7 +3000,7 @@ class PeriodicTaskOption(db.Model):
                 'value': self.value,
             })
             ret = option.id
-        db.session.commit()
+        commit_session()
         return ret
 
 
@@ -2843,10 +3057,48 @@ class PeriodicTaskLastRun(db.Model):
                 'timestamp': self.timestamp,
             })
             ret = last_run.id
-        db.session.commit()
+        commit_session()
         return ret
 
 
+class PeriodicTaskLease(db.Model):
+    """
+    A node, which runs a periodic task in the scheduler mode of
+    ``privacyidea-cron``, holds the lease of the task. This way the task is
+    only run once for each scheduled timestamp, even if several nodes run a
+    scheduler.
+
+    ``scheduled`` is the scheduled timestamp of the run, ``expires`` the time
+    until which the node holds the lease and ``finished`` the time at which
+    the run finished successfully. All timestamps are naive datetimes in UTC.
+    """
+    __tablename__ = 'periodictasklease'
+    id = db.Column(db.Integer, Sequence("periodictasklease_seq"),
+                   primary_key=True)
+    periodictask_id = db.Column(db.Integer, db.ForeignKey('periodictask.id'),
+                                nullable=False)
+    node = db.Column(db.Unicode(255), nullable=False)
+    scheduled = db.Column(db.DateTime(False), nullable=False)
+    expires = db.Column(db.DateTime(False), nullable=False)
+    finished = db.Column(db.DateTime(False))
+
+    __table_args__ = (db.UniqueConstraint('periodictask_id',
+                                          name='ptlsix_1'),
+                      {'mysql_row_format': 'DYNAMIC'})
+
+    def __init__(self, periodictask_id, node, scheduled, expires):
+        """
+        :param periodictask_id: ID of the periodic task we are referring to
+        :param node: Node name as unicode
+        :param scheduled: The scheduled timestamp of the run as naive datetime in UTC
+        :param expires: The expiry of the lease as naive datetime in UTC
+        """
+        self.periodictask_id = periodictask_id
+        self.node = node
+        self.scheduled = scheduled
+        self.expires = expires
+
+
 class MonitoringStats(MethodsMixin, db.Model):
     """
     This is the table that stores measured, arbitrary statistic points in time.
@@ -2880,4 +3132,60 @@ class MonitoringStats(MethodsMixin, db.Model):
         self.timestamp = timestamp
         self.stats_key = key
         self.stats_value = value
-        #self.save()
\ No newline at end of file
+        #self.save()
+
+
+class MonitoringStatsRollup(MethodsMixin, db.Model):
+    """
+    This table stores the aggregated values of the table "monitoringstats"
+    in time buckets of 5 minutes, one hour and one day.
+
+    The column ``resolution`` contains the size of the bucket in seconds, the
+    column ``timestamp`` the start of the bucket as naive datetime in UTC.
+    """
+    __tablename__ = 'monitoringstatsrollup'
+    id = db.Column(db.Integer, Sequence("monitoringstatsrollup_seq"),
+                   primary_key=True)
+    stats_key = db.Column(db.Unicode(128), nullable=False)
+    resolution = db.Column(db.Integer, nullable=False)
+    timestamp = db.Column(db.DateTime(False), nullable=False)
+    count = db.Column(db.Integer, nullable=False, default=0)
+    sum_value = db.Column(db.BigInteger, nullable=False, default=0)
+    min_value = db.Column(db.Integer, nullable=False, default=0)
+    max_value = db.Column(db.Integer, nullable=False, default=0)
+    # last_value needs to be defined before last_timestamp, since MySQL
+    # evaluates the assignments of an UPDATE from left to right.
+    last_value = db.Column(db.Integer, nullable=False, default=0)
+    last_timestamp = db.Column(db.DateTime(False), nullable=False)
+
+    __table_args__ = (db.UniqueConstraint('stats_key',
+                                          'resolution',
+                                          'timestamp',
+                                          name='msrix_1'),
+                      {'mysql_row_format': 'DYNAMIC'})
+
+    def __init__(self, key, resolution, timestamp, value, value_timestamp,
+                 count=1, sum_value=None, min_value=None, max_value=None):
+        """
+        Create a new time bucket in the rollup table
+
+        :param key: The key of the measurement
+        :type key: basestring
+        :param resolution: The size of the time bucket in seconds
+        :type resolution: int
+        :param timestamp: The start of the time bucket
+        :type timestamp: timezone-naive datetime
+        :param value: The last value in the time bucket
+        :type value: Int
+        :param value_timestamp: The time of the last value
+        :type value_timestamp: timezone-naive datetime
+        """
+        self.stats_key = key
+        self.resolution = resolution
+        self.timestamp = timestamp
+        self.count = count
+        self.sum_value = value if sum_value is None else sum_value
+        self.min_value = value if min_value is None else min_value
+        self.max_value = value if max_value is None else max_value
+        self.last_value = value
+        self.last_timestamp = value_timestamp
@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 
+import os
 import unittest
 import json
 import mock
@@ -17,6 +18,11 @@ from privacyidea.lib.auditmodules.base import Audit
 PWFILE = "tests/testdata/passwords"
 PWFILE2 = "tests/testdata/passwd"
 
+#: The benchmarks with large amounts of data only run, if the environment
+#: variable PI_BENCHMARK is set.
+benchmark = unittest.skipUnless(os.environ.get("PI_BENCHMARK"),
+                                "Set PI_BENCHMARK to run the benchmarks")
+
 
 class FakeFlaskG(object):
     policy_object = None
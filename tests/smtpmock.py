@@ -142,6 +142,8 @@ class SmtpMock(object):
         if not self._request_data.get("authenticated"):
             response = {self._request_data.get("recipient"):
                             (530, "Authorization required (#5.7.1)")}
+        self._calls.setdata({"sender": sender, "recipient": recipient,
+                             "msg": msg}, response)
         return response
 
     def _on_login(self, SMTP_instance, username, password):
@@ -166,6 +168,10 @@ class SmtpMock(object):
     def _on_quit(SMTP_instance):
         return None
 
+    @staticmethod
+    def _on_noop(SMTP_instance):
+        return 250, b"OK"
+
     def _on_starttls(self, SMTP_instance):
         if self.exception:
             raise SMTPException("MOCK TLS ERROR")
@@ -227,6 +233,13 @@ class SmtpMock(object):
                                     unbound_on_starttls)
         self._patcher8.start()
 
+        def unbound_on_noop(SMTP, *a, **kwargs):
+            return self._on_noop(SMTP, *a, **kwargs)
+
+        self._patcher9 = mock.patch('smtplib.SMTP.noop',
+                                    unbound_on_noop)
+        self._patcher9.start()
+
     def stop(self):
         self._patcher.stop()
         self._patcher2.stop()
@@ -236,6 +249,7 @@ class SmtpMock(object):
         self._patcher6.stop()
         self._patcher7.stop()
         self._patcher8.stop()
+        self._patcher9.stop()
 
 
 # expose default mock namespace
@@ -4,7 +4,7 @@ This tests the file api.lib.utils
 """
 from .base import MyApiTestCase
 
-from privacyidea.api.lib.utils import (getParam)
+from privacyidea.api.lib.utils import (getParam, iter_csv, send_csv_result)
 from privacyidea.lib.error import ParameterError
 
 
@@ -25,3 +25,20 @@ class UtilsTestCase(MyApiTestCase):
 
         v = getParam({}, "sslverify", allowed_values=["0", "1"], default="1")
         self.assertEqual("1", v)
+
+    def test_02_iter_csv(self):
+        rows = [{"serial": "S1", "description": u'a "quoted", \ntext', "count": 3},
+                {"serial": "S2", "count": 4}]
+        lines = list(iter_csv(iter(rows)))
+        self.assertEqual(lines, [u'"serial","description","count"\n',
+                                 u'"S1","a ""quoted"",  text","3"\n',
+                                 u'"S2","","4"\n'])
+        self.assertEqual(list(iter_csv([])), [])
+
+    def test_03_send_csv_result(self):
+        with self.app.test_request_context('/token/', method='GET'):
+            res = send_csv_result({"tokens": [{"serial": "S1"}], "count": 1})
+            self.assertTrue(res.is_streamed)
+            self.assertEqual(res.get_data(), b'"serial"\n"S1"\n')
+            self.assertEqual(res.headers["Content-disposition"],
+                             "attachment; filename=privacyidea-tokendata.csv")
@@ -7,7 +7,8 @@ import passlib
 from privacyidea.lib.user import User
 from .base import MyApiTestCase
 import json
-from privacyidea.lib.token import init_token, get_tokens
+from privacyidea.lib.token import init_token, get_tokens, enable_token
+from privacyidea.lib.framework import get_app_local_store
 from privacyidea.lib.machine import attach_token
 from privacyidea.lib.policy import (set_policy, delete_policy, ACTION, SCOPE)
 
@@ -291,6 +292,45 @@ class APIMachinesTestCase(MyApiTestCase):
             sshkey = result["value"].get("ssh")[0].get("sshkey")
             self.assertTrue(sshkey.startswith("ssh-rsa"), sshkey)
 
+    def test_10_auth_items_ssh_etag(self):
+        # The auth items are cached in memory
+        self.app.config["PI_AUTHITEM_CACHE_TTL"] = 60
+        with self.app.test_request_context(
+                '/machine/authitem/ssh?hostname=gandalf',
+                method='GET',
+                headers={'Authorization': self.at}):
+            res = self.app.full_dispatch_request()
+            self.assertEqual(res.status_code, 200, res)
+            etag = res.headers.get("ETag")
+            self.assertTrue(etag.startswith('W/"'), etag)
+
+        # The auth items did not change
+        with self.app.test_request_context(
+                '/machine/authitem/ssh?hostname=gandalf',
+                method='GET',
+                headers={'Authorization': self.at,
+                         'If-None-Match': etag}):
+            res = self.app.full_dispatch_request()
+            self.assertEqual(res.status_code, 304, res)
+            self.assertEqual(res.data, b"")
+            self.assertEqual(res.headers.get("ETag"), etag)
+
+        # After disabling the token, the auth items are returned again
+        enable_token(self.serial2, False)
+        with self.app.test_request_context(
+                '/machine/authitem/ssh?hostname=gandalf',
+                method='GET',
+                headers={'Authorization': self.at,
+                         'If-None-Match': etag}):
+            res = self.app.full_dispatch_request()
+            self.assertEqual(res.status_code, 200, res)
+            self.assertNotEqual(res.headers.get("ETag"), etag)
+            result = res.json.get("result")
+            self.assertFalse(result["value"].get("ssh"))
+        enable_token(self.serial2)
+        self.app.config.pop("PI_AUTHITEM_CACHE_TTL")
+        get_app_local_store().pop("auth_item_cache", None)
+
     def test_11_auth_items_luks(self):
         # create TOTP/Yubikey token
         token_obj = init_token({"serial": self.serial3, "type": "totp",
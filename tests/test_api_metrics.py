@@ -0,0 +1,86 @@
+"""
+This file contains the tests for the metrics endpoint.
+
+In particular, this tests
+api/metrics.py
+"""
+from privacyidea.lib.config import (set_privacyidea_config,
+                                    delete_privacyidea_config, SYSCONF)
+from privacyidea.lib.framework import get_app_local_store
+from privacyidea.lib.token import init_token, remove_token
+from privacyidea.lib.user import User
+from .base import MyApiTestCase
+
+
+class APIMetricsTestCase(MyApiTestCase):
+
+    def tearDown(self):
+        get_app_local_store().pop("metrics_registry", None)
+        for key in ["PI_METRICS_REGISTRY_CLASS", "PI_METRICS_ALLOWED_CLIENTS"]:
+            self.app.config.pop(key, None)
+
+    def _get_metrics(self, remote_addr="127.0.0.1", forwarded_for=None):
+        headers = {"X-Forwarded-For": forwarded_for} if forwarded_for else {}
+        with self.app.test_request_context('/metrics/', method='GET',
+                                           environ_base={"REMOTE_ADDR": remote_addr},
+                                           headers=headers):
+            return self.app.full_dispatch_request()
+
+    def test_01_disabled(self):
+        res = self._get_metrics()
+        self.assertEqual(res.status_code, 404)
+
+    def test_02_validate_check(self):
+        self.app.config["PI_METRICS_REGISTRY_CLASS"] = "process"
+        self.setUp_user_realms()
+        init_token({"serial": "SPASS_METRICS", "type": "spass", "pin": "test"},
+                   user=User("cornelius", self.realm1))
+        with self.app.test_request_context('/validate/check', method='POST',
+                                           data={"user": "cornelius",
+                                                 "pass": "test"}):
+            res = self.app.full_dispatch_request()
+            self.assertEqual(res.status_code, 200)
+            self.assertTrue(res.json["result"]["value"])
+
+        res = self._get_metrics()
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(res.content_type.startswith("text/plain; version=0.0.4"))
+        text = res.data.decode("utf8")
+        for phase in ["user", "check_token_list", "audit", "signing"]:
+            self.assertIn('privacyidea_phase_duration_seconds_count{{phase="{0!s}"}} 1'.format(phase),
+                          text)
+        self.assertIn('privacyidea_policy_duration_seconds_count{function="set_realm",'
+                      'phase="prepolicy"} 1', text)
+        self.assertIn('privacyidea_policy_duration_seconds_count{function="no_detail_on_fail",'
+                      'phase="postpolicy"} 1', text)
+        self.assertIn('privacyidea_resolver_duration_seconds_count{method="getUserId",'
+                      'type="passwdresolver"}', text)
+        self.assertIn('privacyidea_request_duration_seconds_count{endpoint="/validate/check",'
+                      'method="POST",status="200"} 1', text)
+        self.assertIn('privacyidea_db_queries_total ', text)
+
+        # Other clients may not read the metrics
+        res = self._get_metrics("10.0.0.1")
+        self.assertEqual(res.status_code, 401)
+        self.app.config["PI_METRICS_ALLOWED_CLIENTS"] = "10.0.0.0/8, !10.0.0.2"
+        self.assertEqual(self._get_metrics("10.0.0.1").status_code, 200)
+        self.assertEqual(self._get_metrics("10.0.0.2").status_code, 401)
+        self.assertEqual(self._get_metrics().status_code, 401)
+        remove_token("SPASS_METRICS")
+
+    def test_03_reverse_proxy(self):
+        self.app.config["PI_METRICS_REGISTRY_CLASS"] = "process"
+        self.assertEqual(self._get_metrics().status_code, 200)
+        # Requests via a reverse proxy on localhost are refused by default
+        self.assertEqual(self._get_metrics(forwarded_for="10.0.0.1").status_code, 401)
+
+        # The allowed clients need to be set explicitly
+        self.app.config["PI_METRICS_ALLOWED_CLIENTS"] = "10.0.0.0/8"
+        # The proxy is not allowed to map the client IP
+        self.assertEqual(self._get_metrics(forwarded_for="10.0.0.1").status_code, 401)
+        set_privacyidea_config(SYSCONF.OVERRIDECLIENT, "127.0.0.1")
+        try:
+            self.assertEqual(self._get_metrics(forwarded_for="10.0.0.1").status_code, 200)
+            self.assertEqual(self._get_metrics(forwarded_for="192.168.0.1").status_code, 401)
+        finally:
+            delete_privacyidea_config(SYSCONF.OVERRIDECLIENT)
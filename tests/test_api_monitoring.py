@@ -3,6 +3,7 @@ from .base import MyApiTestCase
 from privacyidea.lib.monitoringstats import write_stats
 from privacyidea.lib.tokenclass import AUTH_DATE_FORMAT
 import datetime
+from dateutil.tz import tzutc
 from flask import current_app
 
 
@@ -119,3 +120,35 @@ class APIMonitoringTestCase(MyApiTestCase):
             result = json.loads(res.data.decode('utf8')).get("result")
             # Number of remaining values
             self.assertEqual(len(result.get("value")), 1)
+
+    def test_03_get_stats_in_resolution(self):
+        ts = datetime.datetime(2019, 5, 1, 10, 0, tzinfo=tzutc())
+        write_stats("key3", 4, timestamp=ts)
+        write_stats("key3", 8, timestamp=ts + datetime.timedelta(minutes=10))
+        write_stats("key3", 5, timestamp=ts + datetime.timedelta(hours=1))
+
+        with self.app.test_request_context('/monitoring/key3',
+                                           data={"resolution": "hour"},
+                                           method='GET',
+                                           headers={'Authorization': self.at}):
+            res = self.app.full_dispatch_request()
+            self.assertTrue(res.status_code == 200, res)
+            value = res.json.get("result").get("value")
+            self.assertEqual([v for _t, v in value], [6.0, 5.0])
+            self.assertEqual(value[0][0], ts.strftime(AUTH_DATE_FORMAT))
+
+        with self.app.test_request_context('/monitoring/key3',
+                                           data={"resolution": "day",
+                                                 "aggregate": "max"},
+                                           method='GET',
+                                           headers={'Authorization': self.at}):
+            res = self.app.full_dispatch_request()
+            self.assertTrue(res.status_code == 200, res)
+            self.assertEqual([v for _t, v in res.json.get("result").get("value")], [8])
+
+        with self.app.test_request_context('/monitoring/key3',
+                                           data={"resolution": "week"},
+                                           method='GET',
+                                           headers={'Authorization': self.at}):
+            res = self.app.full_dispatch_request()
+            self.assertEqual(res.status_code, 400, res)
@@ -3,6 +3,7 @@ import json
 import os
 import datetime
 import codecs
+import csv
 from privacyidea.lib.policy import (set_policy, delete_policy, SCOPE, ACTION,
                                     PolicyClass)
 from privacyidea.lib.token import get_tokens, init_token, remove_token, get_tokens_from_serial_or_user
@@ -232,6 +233,26 @@ class APITokenTestCase(MyApiTestCase):
             self.assertTrue(b"username" in res.data, res.data)
             self.assertTrue(b"user_realm" in res.data, res.data)
 
+        # All tokens are streamed, even if there are more than one page
+        for i in range(20):
+            init_token({"serial": "CSV{0!s}".format(i), "type": "hotp",
+                        "otpkey": self.otpkey})
+        with self.app.test_request_context('/token/',
+                                           method='GET',
+                                           query_string=urlencode({"outform": "csv",
+                                                                   "serial": "CSV*"}),
+                                           headers={'Authorization': self.at}):
+            res = self.app.full_dispatch_request()
+            self.assertEqual(res.status_code, 200, res)
+            self.assertTrue(res.is_streamed)
+            rows = list(csv.DictReader(res.get_data(as_text=True).splitlines()))
+            self.assertEqual(len(rows), 20)
+            self.assertEqual(set(row["serial"] for row in rows),
+                             set("CSV{0!s}".format(i) for i in range(20)))
+            self.assertEqual(rows[0]["tokentype"], "hotp")
+        for i in range(20):
+            remove_token("CSV{0!s}".format(i))
+
     def test_03_list_tokens_in_one_realm(self):
         for serial in ["S1", "S2", "S3", "S4"]:
              with self.app.test_request_context('/token/init',
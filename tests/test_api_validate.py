@@ -1,10 +1,12 @@
 # -*- coding: utf-8 -*-
 from six.moves.urllib.parse import urlencode
 import json
+import mock
 from .base import MyApiTestCase
 from privacyidea.lib.user import (User)
 from privacyidea.lib.tokens.totptoken import HotpTokenClass
-from privacyidea.models import (Token, Challenge, AuthCache)
+from privacyidea.models import (Token, Challenge, AuthCache, db)
+from sqlalchemy import event as sa_event
 from privacyidea.lib.authcache import _hash_password
 from privacyidea.lib.config import (set_privacyidea_config, get_token_types,
                                     get_inc_fail_count_on_false_pin,
@@ -3079,3 +3081,90 @@ class TriggeredPoliciesTestCase(MyApiTestCase):
         remove_token("triggtoken")
         delete_policy("otppin")
         delete_policy("lastauth")
+
+
+class UnitOfWorkTestCase(MyApiTestCase):
+    """
+    Test /validate/check with PI_UNIT_OF_WORK
+    """
+
+    def _authenticate(self, otp):
+        with self.app.test_request_context('/validate/check',
+                                           method='POST',
+                                           data={"user": "cornelius",
+                                                 "pass": "pin" + otp}):
+            res = self.app.full_dispatch_request()
+            self.assertEqual(res.status_code, 200, res)
+            return res.json["result"]
+
+    def _count_commits(self, otps):
+        commits = []
+
+        def _after_commit(session):
+            commits.append(session)
+
+        sa_event.listen(db.session(), "after_commit", _after_commit)
+        try:
+            for otp in otps:
+                self.assertTrue(self._authenticate(otp).get("value"))
+        finally:
+            sa_event.remove(db.session(), "after_commit", _after_commit)
+        return float(len(commits)) / len(otps)
+
+    def test_01_commits_per_authentication(self):
+        self.setUp_user_realms()
+        init_token({"serial": "UOW1", "type": "hotp", "otpkey": self.otpkey,
+                    "pin": "pin"}, user=User("cornelius", self.realm1))
+        # Count the commits per successful authentication
+        commits = self._count_commits(self.valid_otp_values[0:3])
+        self.assertGreater(commits, 1)
+
+        self.app.config["PI_UNIT_OF_WORK"] = True
+        try:
+            uow_commits = self._count_commits(self.valid_otp_values[3:6])
+        finally:
+            self.app.config.pop("PI_UNIT_OF_WORK")
+        self.assertEqual(uow_commits, 1)
+        token = get_one_token(serial="UOW1")
+        self.assertEqual(token.token.count, 6)
+        self.assertEqual(token.token.failcount, 0)
+
+    def test_02_rollback_on_error(self):
+        self.setUp_user_realms()
+        init_token({"serial": "UOW2", "type": "hotp", "otpkey": self.otpkey,
+                    "pin": "pin"})
+        commits = []
+
+        def _after_commit(session):
+            commits.append(session)
+
+        self.app.config["PI_UNIT_OF_WORK"] = True
+        sa_event.listen(db.session(), "after_commit", _after_commit)
+        try:
+            with mock.patch("privacyidea.api.validate.send_result",
+                            side_effect=ValueError("failed")):
+                # The token is checked successfully, but the request fails
+                # afterwards
+                with self.app.test_request_context(
+                        '/validate/check', method='POST',
+                        data={"serial": "UOW2",
+                              "pass": "pin" + self.valid_otp_values[0]}):
+                    self.assertRaises(ValueError, self.app.full_dispatch_request)
+                self.assertEqual(len(commits), 0)
+                token = get_one_token(serial="UOW2")
+                self.assertEqual(token.token.count, 0)
+                self.assertEqual(token.token.failcount, 0)
+
+                # A failed authentication, which fails afterwards, still
+                # increases the fail counter
+                with self.app.test_request_context(
+                        '/validate/check', method='POST',
+                        data={"serial": "UOW2", "pass": "pinabcdef"}):
+                    self.assertRaises(ValueError, self.app.full_dispatch_request)
+                token = get_one_token(serial="UOW2")
+                self.assertEqual(token.token.count, 0)
+                self.assertEqual(token.token.failcount, 1)
+        finally:
+            sa_event.remove(db.session(), "after_commit", _after_commit)
+            self.app.config.pop("PI_UNIT_OF_WORK")
+        remove_token("UOW2")
@@ -1,6 +1,7 @@
 # coding: utf-8
 from mock import mock
 import os
+from sqlalchemy import event
 
 from privacyidea.models import (Token,
                                 Resolver,
@@ -18,7 +19,8 @@ from privacyidea.models import (Token,
                                 EventHandlerCondition, PrivacyIDEAServer,
                                 ClientApplication, Subscription, UserCache,
                                 EventCounter, PeriodicTask, PeriodicTaskLastRun,
-                                PeriodicTaskOption, MonitoringStats)
+                                PeriodicTaskOption, MonitoringStats,
+                                db, unit_of_work, keep_failcount)
 from .base import MyTestCase
 from dateutil.tz import tzutc
 from datetime import datetime
@@ -751,39 +753,16 @@ class TokenModelTestCase(MyTestCase):
         counter2 = EventCounter.query.filter_by(counter_name="test_counter").first()
         self.assertEqual(counter2.counter_value, 10)
 
-        counter2.increase()
-        counter2.increase()
+        # The counter shards are modified with SQL updates in lib/counter.py
+        counter2.counter_value = 12
+        counter2.shard = 1
+        counter2.save()
 
         counter3 = EventCounter.query.filter_by(counter_name="test_counter").first()
         self.assertEqual(counter3.counter_value, 12)
+        self.assertEqual(counter3.shard, 1)
 
-        counter3.decrease()
-
-        counter4 = EventCounter.query.filter_by(counter_name="test_counter").first()
-        self.assertEqual(counter4.counter_value, 11)
-
-        counter4.decrease(allow_negative=True)
-
-        counter5 = EventCounter.query.filter_by(counter_name="test_counter").first()
-        self.assertEqual(counter5.counter_value, 10)
-
-        counter5.reset()
-
-        counter6 = EventCounter.query.filter_by(counter_name="test_counter").first()
-        self.assertEqual(counter6.counter_value, 0)
-
-        counter6.decrease(allow_negative=True)
-        counter6.decrease(allow_negative=True)
-
-        counter7 = EventCounter.query.filter_by(counter_name="test_counter").first()
-        self.assertEqual(counter7.counter_value, -2)
-
-        counter7.decrease(allow_negative=False)
-
-        counter8 = EventCounter.query.filter_by(counter_name="test_counter").first()
-        self.assertEqual(counter8.counter_value, 0)
-
-        counter8.delete()
+        counter3.delete()
         counter9 = EventCounter.query.filter_by(counter_name="test_counter").first()
         self.assertEqual(counter9, None)
 
@@ -910,3 +889,77 @@ class TokenModelTestCase(MyTestCase):
         MonitoringStats.query.delete()
         self.assertEqual(MonitoringStats.query.filter_by(stats_key=key1).count(), 0)
         self.assertEqual(MonitoringStats.query.filter_by(stats_key=key2).count(), 0)
+
+
+class UnitOfWorkTestCase(MyTestCase):
+    """
+    Test the deferred commits of a unit of work
+    """
+
+    def _count_commits(self):
+        commits = []
+
+        def _after_commit(session):
+            commits.append(session)
+
+        event.listen(db.session(), "after_commit", _after_commit)
+        self.addCleanup(event.remove, db.session(), "after_commit", _after_commit)
+        return commits
+
+    def test_01_deferred_commit(self):
+        commits = self._count_commits()
+        with unit_of_work():
+            token = Token("UOW1", tokentype="hotp")
+            token_id = token.save()
+            # The ID is available, since the session is flushed
+            self.assertTrue(token_id > 0)
+            token.set_info({"key1": "value1", "key2": "value2"})
+            token.count = 3
+            token.save()
+            # nested units of work do not commit
+            with unit_of_work():
+                Challenge("UOW1", transaction_id="uow").save()
+            self.assertEqual(len(commits), 0)
+        self.assertEqual(len(commits), 1)
+        token = Token.query.filter_by(serial="UOW1").first()
+        self.assertEqual(token.count, 3)
+        self.assertEqual(token.get_info().get("key2"), "value2")
+        # Without a unit of work, every save commits
+        token.count = 4
+        token.save()
+        self.assertEqual(len(commits), 2)
+        token.delete()
+        Challenge.query.filter_by(transaction_id="uow").delete()
+
+    def test_02_rollback(self):
+        commits = self._count_commits()
+
+        def _save_and_fail():
+            with unit_of_work():
+                Token("UOW2", tokentype="hotp").save()
+                raise ValueError("failed")
+
+        self.assertRaises(ValueError, _save_and_fail)
+        self.assertEqual(len(commits), 0)
+        self.assertEqual(Token.query.filter_by(serial="UOW2").count(), 0)
+        self.assertNotIn("unit_of_work", db.session.info)
+
+    def test_03_keep_failcount(self):
+        Token("UOW3", tokentype="hotp").save()
+
+        def _fail():
+            with unit_of_work():
+                token = Token.query.filter_by(serial="UOW3").first()
+                token.failcount = 2
+                token.count = 5
+                token.save()
+                keep_failcount(token)
+                raise ValueError("failed")
+
+        self.assertRaises(ValueError, _fail)
+        # Only the fail counter is written
+        token = Token.query.filter_by(serial="UOW3").first()
+        self.assertEqual(token.failcount, 2)
+        self.assertEqual(token.count, 0)
+        self.assertNotIn("unit_of_work_failcounters", db.session.info)
+        token.delete()
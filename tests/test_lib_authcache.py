@@ -8,8 +8,11 @@ from .base import MyTestCase
 from privacyidea.lib.authcache import (add_to_cache, delete_from_cache,
                                        update_cache_last_auth, verify_in_cache,
                                        _hash_password,
-                                       cleanup)
-from privacyidea.models import AuthCache
+                                       cleanup, get_memory_cache,
+                                       flush_last_auth)
+from privacyidea.lib.framework import get_app_local_store
+from privacyidea.models import AuthCache, db
+from sqlalchemy import event
 import datetime
 
 
@@ -113,3 +116,105 @@ class AuthCacheTestCase(MyTestCase):
         r = cleanup(10)
         self.assertEqual(1, r)
 
+
+    def test_05_memory_cache(self):
+        self.app.config["PI_AUTHCACHE_MEMORY_SIZE"] = 2
+        self.app.config["PI_AUTHCACHE_FLUSH_INTERVAL"] = 3600
+        first_auth = datetime.datetime.utcnow() - datetime.timedelta(hours=4)
+        statements = []
+
+        def count_statement(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        try:
+            cache_id = add_to_cache(self.username, self.realm, self.resolver,
+                                    self.password)
+            memory = get_memory_cache()
+            self.assertIsNotNone(memory.get((self.username, self.realm, self.resolver,
+                                             _hash_password(self.password))))
+            db_last_auth = AuthCache.query.filter_by(id=cache_id).first().last_auth
+
+            # A VPN re-authentication storm does not query the database
+            event.listen(db.engine, "before_cursor_execute", count_statement)
+            try:
+                for i in range(10):
+                    self.assertTrue(verify_in_cache(self.username, self.realm,
+                                                    self.resolver, self.password,
+                                                    first_auth=first_auth))
+            finally:
+                event.remove(db.engine, "before_cursor_execute", count_statement)
+            self.assertEqual(statements, [])
+            # The last_auth is written to the database later
+            self.assertEqual(AuthCache.query.filter_by(id=cache_id).first().last_auth,
+                             db_last_auth)
+            self.assertEqual(flush_last_auth(), 1)
+            self.assertGreater(AuthCache.query.filter_by(id=cache_id).first().last_auth,
+                               db_last_auth)
+            self.assertEqual(flush_last_auth(), 0)
+
+            # The entry in memory is not used, if it is too old for the policy
+            self.assertFalse(verify_in_cache(self.username, self.realm,
+                                             self.resolver, self.password,
+                                             first_auth=datetime.datetime.utcnow()))
+            self.assertIsNone(memory.get((self.username, self.realm, self.resolver,
+                                          _hash_password(self.password))))
+            self.assertEqual(AuthCache.query.filter_by(id=cache_id).count(), 0)
+
+            # The entries are read from the database, if they are not in memory
+            cache_id = add_to_cache(self.username, self.realm, self.resolver,
+                                    self.password)
+            add_to_cache("user2", self.realm, self.resolver, self.password)
+            add_to_cache("user3", self.realm, self.resolver, self.password)
+            # Only two entries are kept in memory
+            self.assertIsNone(memory.get((self.username, self.realm, self.resolver,
+                                          _hash_password(self.password))))
+            self.assertTrue(verify_in_cache(self.username, self.realm,
+                                            self.resolver, self.password,
+                                            first_auth=first_auth))
+            self.assertIsNotNone(memory.get((self.username, self.realm, self.resolver,
+                                             _hash_password(self.password))))
+
+            # The entries expire in memory
+            memory.ttl = 0
+            self.assertIsNone(memory.get((self.username, self.realm, self.resolver,
+                                          _hash_password(self.password))))
+
+            # The deleted entries are removed from memory
+            memory.ttl = 60
+            self.assertTrue(verify_in_cache(self.username, self.realm,
+                                            self.resolver, self.password))
+            delete_from_cache(self.username, self.realm, self.resolver, self.password)
+            self.assertFalse(verify_in_cache(self.username, self.realm,
+                                             self.resolver, self.password))
+            cleanup(0)
+            self.assertFalse(verify_in_cache("user2", self.realm,
+                                             self.resolver, self.password))
+        finally:
+            get_app_local_store().pop("authcache_memory", None)
+            self.app.config.pop("PI_AUTHCACHE_MEMORY_SIZE")
+            self.app.config.pop("PI_AUTHCACHE_FLUSH_INTERVAL")
+
+    def test_06_flush_timer(self):
+        self.app.config["PI_AUTHCACHE_MEMORY_SIZE"] = 2
+        self.app.config["PI_AUTHCACHE_FLUSH_INTERVAL"] = 0.5
+        try:
+            cache_id = add_to_cache(self.username, self.realm, self.resolver,
+                                    self.password)
+            db_last_auth = AuthCache.query.filter_by(id=cache_id).first().last_auth
+            memory = get_memory_cache()
+            self.assertTrue(verify_in_cache(self.username, self.realm,
+                                            self.resolver, self.password))
+            # The timestamp is written by a timer, although no further
+            # authentication happens
+            timer = memory._timer
+            self.assertIsNotNone(timer)
+            timer.join(5)
+            self.assertIsNone(memory._timer)
+            db.session.expire_all()
+            self.assertGreater(AuthCache.query.filter_by(id=cache_id).first().last_auth,
+                               db_last_auth)
+            delete_from_cache(self.username, self.realm, self.resolver, self.password)
+        finally:
+            get_app_local_store().pop("authcache_memory", None)
+            self.app.config.pop("PI_AUTHCACHE_MEMORY_SIZE")
+            self.app.config.pop("PI_AUTHCACHE_FLUSH_INTERVAL")
@@ -0,0 +1,99 @@
+"""
+This file contains the tests for the authentication counter.
+
+In particular, this tests
+lib/authcounter.py
+"""
+from datetime import timedelta
+
+import mock
+from sqlalchemy.orm import Query
+
+from privacyidea.lib.authcounter import (get_auth_count, add_auth,
+                                         delete_auth_counts)
+from privacyidea.models import AuthCounter, Token, unit_of_work
+from .base import MyTestCase
+
+NOW = 1600000005.5
+
+
+class AuthCounterTestCase(MyTestCase):
+
+    def tearDown(self):
+        delete_auth_counts()
+        self.app.config.pop("PI_AUTH_COUNTER_BUCKET", None)
+
+    def test_01_count(self):
+        with mock.patch("privacyidea.lib.authcounter.time.time", return_value=NOW):
+            for i in range(3):
+                add_auth("cornelius", "realm1", True)
+            add_auth("cornelius", "realm1", False)
+            add_auth("cornelius", "realm2", True)
+            # The authentications of one bucket are stored in one row
+            self.assertEqual(AuthCounter.query.count(), 3)
+            self.assertEqual(get_auth_count("cornelius", "realm1", True,
+                                            timedelta(minutes=1)), 3)
+            self.assertEqual(get_auth_count("cornelius", "realm1", False,
+                                            timedelta(minutes=1)), 1)
+            self.assertEqual(get_auth_count("cornelius", "realm2", True,
+                                            timedelta(minutes=1)), 1)
+            self.assertEqual(get_auth_count("hans", "realm1", True,
+                                            timedelta(minutes=1)), 0)
+
+    def test_02_sliding_window(self):
+        self.app.config["PI_AUTH_COUNTER_BUCKET"] = 10
+        for offset in [0, 12, 25, 61]:
+            with mock.patch("privacyidea.lib.authcounter.time.time",
+                            return_value=NOW + offset):
+                add_auth("cornelius", "realm1", False)
+        self.assertEqual(AuthCounter.query.count(), 4)
+        with mock.patch("privacyidea.lib.authcounter.time.time",
+                        return_value=NOW + 65):
+            # The window of 20 seconds starts in the bucket of NOW + 45
+            self.assertEqual(get_auth_count("cornelius", "realm1", False,
+                                             timedelta(seconds=20)), 1)
+            # The window of 52 seconds starts at NOW + 13. It is extended to
+            # the start of its bucket, which also contains NOW + 12
+            self.assertEqual(get_auth_count("cornelius", "realm1", False,
+                                             timedelta(seconds=52)), 3)
+            self.assertEqual(get_auth_count("cornelius", "realm1", False,
+                                             timedelta(hours=1)), 4)
+
+            # The buckets older than max_age are deleted
+            add_auth("cornelius", "realm1", False, max_age=timedelta(seconds=52))
+            self.assertEqual(sorted(c.bucket - 1600000000 for c in AuthCounter.query.all()),
+                             [10, 30, 60, 70])
+            self.assertEqual(get_auth_count("cornelius", "realm1", False,
+                                             timedelta(hours=1)), 4)
+
+    def test_03_delete(self):
+        add_auth("cornelius", "realm1", True)
+        add_auth("cornelius", "realm2", True)
+        add_auth("hans", "realm1", True)
+        self.assertEqual(delete_auth_counts("cornelius", "realm1"), 1)
+        self.assertEqual(delete_auth_counts(realm="realm2"), 1)
+        self.assertEqual(delete_auth_counts(), 1)
+
+    def test_04_concurrent_bucket(self):
+        original_update = Query.update
+        updates = []
+
+        def _update(query, *args, **kwargs):
+            updates.append(query)
+            if len(updates) == 1:
+                # The bucket seems to be missing, as if a concurrent request
+                # created it after the update
+                return 0
+            return original_update(query, *args, **kwargs)
+
+        with mock.patch("privacyidea.lib.authcounter.time.time", return_value=NOW):
+            add_auth("cornelius", "realm1", True)
+            with unit_of_work():
+                Token("AUTHCOUNTER1").save()
+                with mock.patch.object(Query, "update", _update):
+                    add_auth("cornelius", "realm1", True)
+            # The failed insert does not roll back the other changes
+            self.assertEqual(Token.query.filter_by(serial="AUTHCOUNTER1").count(), 1)
+            self.assertEqual(get_auth_count("cornelius", "realm1", True,
+                                            timedelta(minutes=1)), 2)
+        Token.query.filter_by(serial="AUTHCOUNTER1").first().delete()
@@ -5,7 +5,11 @@ This tests the token functions on an interface level
 """
 from .base import MyTestCase
 from privacyidea.lib.error import (TokenAdminError, ParameterError)
-from privacyidea.lib.challenge import get_challenges
+from privacyidea.lib.challenge import (get_challenges,
+                                       cleanup_expired_challenges,
+                                       throttled_challenge_janitor)
+from privacyidea.lib.framework import get_app_local_store
+from privacyidea.models import Challenge
 from privacyidea.lib.policy import (set_policy, delete_policy, SCOPE,
                                     ACTION)
 from privacyidea.lib.token import init_token
@@ -44,3 +48,36 @@ class ChallengeTestCase(MyTestCase):
         delete_policy("chalresp")
 
 
+
+    def test_02_cleanup_expired_challenges(self):
+        for i in range(5):
+            Challenge("CHAL2", transaction_id="exp{0!s}".format(i),
+                      validitytime=-10).save()
+        Challenge("CHAL2", transaction_id="valid", validitytime=100).save()
+        # The challenges are deleted in chunks
+        self.assertEqual(cleanup_expired_challenges(chunksize=2), 5)
+        self.assertEqual(len(get_challenges(serial="CHAL2")), 1)
+        self.assertEqual(cleanup_expired_challenges(), 0)
+
+    def test_03_throttled_challenge_janitor(self):
+        get_app_local_store().pop("challenge_cleanup_due", None)
+        Challenge("CHAL3", transaction_id="exp1", validitytime=-10).save()
+        # The first call cleans up
+        self.assertEqual(throttled_challenge_janitor(), 1)
+        # Within the interval, the expired challenges are not deleted
+        Challenge("CHAL3", transaction_id="exp2", validitytime=-10).save()
+        self.assertEqual(throttled_challenge_janitor(), 0)
+        self.assertEqual(len(get_challenges(serial="CHAL3")), 1)
+        # ...but after the interval
+        get_app_local_store()["challenge_cleanup_due"] = 0
+        self.assertEqual(throttled_challenge_janitor(), 1)
+        self.assertEqual(len(get_challenges(serial="CHAL3")), 0)
+
+        # The cleanup during requests can be disabled
+        Challenge("CHAL3", transaction_id="exp3", validitytime=-10).save()
+        get_app_local_store()["challenge_cleanup_due"] = 0
+        self.app.config["PI_CHALLENGE_CLEANUP_INTERVAL"] = -1
+        self.assertEqual(throttled_challenge_janitor(), 0)
+        self.assertEqual(len(get_challenges(serial="CHAL3")), 1)
+        self.app.config.pop("PI_CHALLENGE_CLEANUP_INTERVAL")
+        cleanup_expired_challenges()
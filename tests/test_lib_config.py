@@ -15,7 +15,7 @@ from privacyidea.lib.config import (get_resolver_list,
                                     delete_privacyidea_config,
                                     get_token_list,
                                     get_token_module_list,
-                                    get_token_class_dict,
+                                    get_token_class_dict, get_token_class,
                                     get_token_types,
                                     get_token_classes, get_token_prefix,
                                     get_machine_resolver_class_dict,
@@ -24,8 +24,15 @@ from privacyidea.lib.config import (get_resolver_list,
 from privacyidea.lib.resolvers.PasswdIdResolver import IdResolver as PWResolver
 from privacyidea.lib.tokens.hotptoken import HotpTokenClass
 from privacyidea.lib.tokens.totptoken import TotpTokenClass
+from privacyidea.lib.utils import to_unicode
 from flask import current_app
 import importlib
+import json
+import logging
+import subprocess
+import sys
+
+log = logging.getLogger(__name__)
 
 
 class ConfigTestCase(MyTestCase):
@@ -143,13 +150,48 @@ class ConfigTestCase(MyTestCase):
         types = get_token_types()
         self.assertTrue("totp" in types, types)
         self.assertTrue("hotp" in types, types)
+        self.assertEqual(len(types), len(classes))
 
-        # token classes are cached with calling 'get_token_types()'
-        self.assertTrue("pi_token_classes" in this.config, this.config)
-        self.assertTrue("pi_token_types" in this.config, this.config)
         r = get_token_classes()
         self.assertTrue(TotpTokenClass in r, r)
         self.assertTrue(HotpTokenClass in r, r)
+        # token classes are cached with calling 'get_token_classes()'
+        self.assertTrue("pi_token_classes" in this.config, this.config)
+        self.assertTrue("pi_token_types" in this.config, this.config)
+
+        self.assertEqual(get_token_class("HOTP"), HotpTokenClass)
+        self.assertEqual(get_token_class("hmac"), HotpTokenClass)
+        self.assertEqual(get_token_class("unknown"), None)
+
+    def test_02_lazy_token_classes(self):
+        # Creating the app does not import the token modules. They are only
+        # imported, when the token type is used.
+        code = (
+            "import sys, time\n"
+            "start = time.time()\n"
+            "from privacyidea.app import create_app\n"
+            "app = create_app('testing', '', silent=True)\n"
+            "duration = time.time() - start\n"
+            "modules = [m for m in sys.modules if m.startswith('privacyidea.lib.tokens.')]\n"
+            "with app.app_context():\n"
+            "    from privacyidea.lib.config import get_token_class, get_token_types\n"
+            "    types = get_token_types()\n"
+            "    get_token_class('hotp')\n"
+            "lazy = [m for m in sys.modules if m.startswith('privacyidea.lib.tokens.')\n"
+            "        and m not in modules]\n"
+            "print(json.dumps({'duration': duration, 'modules': modules,\n"
+            "                  'lazy': lazy, 'types': len(types)}))\n")
+        output = subprocess.check_output([sys.executable, "-c", "import json\n" + code],
+                                         stderr=subprocess.STDOUT)
+        result = json.loads(to_unicode(output).strip().splitlines()[-1])
+        log.info(u"create_app took {0:.3f}s".format(result["duration"]))
+        token_modules = get_token_list()
+        # Only the token modules used by the API code are imported
+        imported = [m for m in result["modules"] if m in token_modules]
+        self.assertLess(len(imported), len(token_modules) // 2, imported)
+        self.assertEqual([m for m in result["lazy"] if m in token_modules],
+                         ["privacyidea.lib.tokens.hotptoken"])
+        self.assertEqual(result["types"], len(get_token_list()))
 
     def test_03_token_prefix(self):
         prefix = get_token_prefix("totp")
@@ -3,8 +3,13 @@ This tests the files
   lib/counter.py
 """
 
+import mock
+from flask import current_app
+
 from .base import MyTestCase
-from privacyidea.lib.counter import increase, decrease, reset, read
+from privacyidea.lib.counter import (increase, decrease, reset, read,
+                                     read_and_reset, flush)
+from privacyidea.lib.framework import get_app_local_store
 from privacyidea.models import EventCounter
 
 
@@ -81,3 +86,91 @@ class CounterTestCase(MyTestCase):
 
         counter = EventCounter.query.filter_by(counter_name="hallo_counter4").first()
         self.assertEqual(counter.counter_value, 0)
+
+    def test_05_sharded_counter(self):
+        current_app.config["PI_COUNTER_SHARDS"] = 4
+        try:
+            for x in range(40):
+                increase("sharded_counter")
+            shards = EventCounter.query.filter_by(counter_name="sharded_counter").all()
+            self.assertTrue(1 < len(shards) <= 4)
+            self.assertEqual(sum(s.counter_value for s in shards), 40)
+            self.assertEqual(read("sharded_counter"), 40)
+
+            # decrease stops at zero, although the values are spread over the shards
+            for x in range(45):
+                decrease("sharded_counter")
+            self.assertEqual(read("sharded_counter"), 0)
+            for shard in EventCounter.query.filter_by(counter_name="sharded_counter"):
+                self.assertEqual(shard.counter_value, 0)
+
+            for x in range(10):
+                increase("sharded_counter")
+            decrease("sharded_counter", allow_negative=True)
+            self.assertEqual(read_and_reset("sharded_counter"), 9)
+            self.assertEqual(read("sharded_counter"), 0)
+            self.assertEqual(read_and_reset("unknown counter"), None)
+
+            increase("sharded_counter")
+            reset("sharded_counter")
+            self.assertEqual(read("sharded_counter"), 0)
+        finally:
+            current_app.config.pop("PI_COUNTER_SHARDS")
+
+    def test_06_accumulated_counter(self):
+        current_app.config["PI_COUNTER_FLUSH_INTERVAL"] = 3600
+        try:
+            for x in range(5):
+                r = increase("acc_counter")
+                # The change, that is not written yet, is returned
+                self.assertEqual(r, x + 1)
+            r = decrease("acc_counter", allow_negative=True)
+            self.assertEqual(r, 4)
+            # Nothing is written to the database yet
+            self.assertEqual(EventCounter.query.filter_by(counter_name="acc_counter").count(), 0)
+            # but the value in this process is known
+            self.assertEqual(read("acc_counter"), 4)
+            flush()
+            self.assertEqual(EventCounter.query.filter_by(counter_name="acc_counter").first().counter_value, 4)
+            self.assertEqual(read("acc_counter"), 4)
+
+            # a decrease, which stops at zero, writes the accumulated value first
+            increase("acc_counter")
+            r = decrease("acc_counter")
+            self.assertEqual(r, 4)
+
+            # reset also drops the accumulated changes
+            increase("acc_counter")
+            reset("acc_counter")
+            self.assertEqual(read("acc_counter"), 0)
+
+            # The changes are written, if the interval has passed
+            get_app_local_store()["counter_accumulator"].interval = 0
+            r = increase("acc_counter")
+            self.assertEqual(r, 0)
+            self.assertEqual(EventCounter.query.filter_by(counter_name="acc_counter").first().counter_value, 1)
+        finally:
+            current_app.config.pop("PI_COUNTER_FLUSH_INTERVAL")
+            get_app_local_store().pop("counter_accumulator")
+
+    def test_07_flush_timer(self):
+        current_app.config["PI_COUNTER_FLUSH_INTERVAL"] = 3600
+        try:
+            with mock.patch("privacyidea.lib.counter.Timer") as mock_timer, \
+                    mock.patch("privacyidea.lib.counter.atexit") as mock_atexit:
+                increase("timer_counter")
+                increase("timer_counter")
+                # The changes are written at exit
+                self.assertEqual(mock_atexit.register.call_count, 1)
+                # Only one timer is started
+                self.assertEqual(mock_timer.call_count, 1)
+                interval, function, args = mock_timer.call_args[0]
+                self.assertEqual(interval, 3600)
+            self.assertEqual(EventCounter.query.filter_by(counter_name="timer_counter").count(), 0)
+            # The timer writes the accumulated changes
+            function(*args)
+            self.assertEqual(EventCounter.query.filter_by(counter_name="timer_counter").first().counter_value, 2)
+            self.assertEqual(get_app_local_store()["counter_accumulator"]._timer, None)
+        finally:
+            current_app.config.pop("PI_COUNTER_FLUSH_INTERVAL")
+            get_app_local_store().pop("counter_accumulator")
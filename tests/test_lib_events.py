@@ -17,7 +17,9 @@ from privacyidea.lib.eventhandler.scripthandler import ScriptEventHandler, SCRIP
 from privacyidea.lib.eventhandler.counterhandler import CounterEventHandler
 from privacyidea.models import EventCounter, TokenOwner
 from privacyidea.lib.eventhandler.federationhandler import FederationEventHandler
-from privacyidea.lib.eventhandler.base import BaseEventHandler, CONDITION
+from privacyidea.lib.eventhandler.base import (BaseEventHandler, CONDITION,
+                                               EventConditionContext,
+                                               compile_conditions, _regex_cache)
 from privacyidea.lib.smtpserver import add_smtpserver
 from privacyidea.lib.smsprovider.SMSProvider import set_smsgateway
 from flask import Request, Response
@@ -39,6 +41,7 @@ from datetime import datetime, timedelta
 from dateutil.parser import parse as parse_date_string
 from dateutil.tz import tzlocal
 import json
+import mock
 
 
 class EventHandlerLibTestCase(MyTestCase):
@@ -466,6 +469,66 @@ class BaseEventHandlerTestCase(MyTestCase):
         )
         self.assertFalse(r)
 
+    def test_07_shared_condition_context(self):
+        self.setUp_user_realms()
+        serial = "pw01"
+        user = User("cornelius", "realm1")
+        remove_token(user=user)
+        init_token({"serial": serial, "type": "pw", "otppin": "test",
+                    "otpkey": "secret"}, user=user)
+
+        builder = EnvironBuilder(method='POST',
+                                 data={'user': "cornelius@realm1",
+                                       "pass": "wrongvalue"},
+                                 headers={})
+        env = builder.get_environ()
+        req = Request(env)
+        req.all_data = {"user": "cornelius@realm1",
+                        "pass": "wrongvalue"}
+        req.User = User("cornelius", "realm1")
+        resp = Response()
+        resp.data = """{"result": {"value": false},
+                        "detail": {"message": "wrong otp pin"}}"""
+        conditions = {CONDITION.TOKENTYPE: "pw",
+                      CONDITION.TOKENREALM: "realm1",
+                      CONDITION.USER_TOKEN_NUMBER: "1",
+                      CONDITION.DETAIL_MESSAGE: "wrong otp.*",
+                      "token_locked": "False"}
+        # The regular expressions are compiled when the configuration is read
+        compile_conditions(conditions)
+        self.assertIn("wrong otp.*", _regex_cache)
+
+        # The number of database lookups does not depend on the number of
+        # event handlers.
+        calls = {}
+        for num_handlers in [1, 20]:
+            context = EventConditionContext(req)
+            with mock.patch("privacyidea.lib.eventhandler.base.get_tokens",
+                            side_effect=get_tokens) as mock_get_tokens:
+                with mock.patch("json.loads",
+                                side_effect=json.loads) as mock_loads:
+                    for _i in range(num_handlers):
+                        r = BaseEventHandler().check_condition(
+                            {"g": {},
+                             "handler_def": {"conditions": conditions},
+                             "request": req,
+                             "response": resp,
+                             "condition_context": context})
+                        self.assertTrue(r)
+                    self.assertEqual(mock_loads.call_count, 1)
+                calls[num_handlers] = mock_get_tokens.call_count
+        self.assertEqual(calls[1], calls[20])
+
+        # If the response is modified, it is parsed again
+        resp.data = """{"result": {"value": true}}"""
+        self.assertTrue(context.get_content(resp).get("result").get("value"))
+        # After an action the token is loaded again
+        self.assertIsNotNone(context._token_data)
+        context.invalidate()
+        self.assertIsNone(context._token_data)
+
+        remove_token(serial)
+
 
 class CounterEventTestCase(MyTestCase):
 
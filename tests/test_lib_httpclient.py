@@ -0,0 +1,94 @@
+"""
+This file contains the tests for the HTTP client registry.
+
+In particular, this tests
+lib/httpclient.py
+"""
+import socket
+
+import requests
+import responses
+
+from privacyidea.lib.framework import get_app_local_store
+from privacyidea.lib.httpclient import (get_client, get_registry, request,
+                                        SharedHTTPClientRegistry,
+                                        NullHTTPClientRegistry, HTTPClient)
+from .base import MyTestCase
+
+
+class SharedHTTPClientTestCase(MyTestCase):
+
+    def tearDown(self):
+        get_app_local_store().pop("http_client_registry", None)
+        self.app.config.pop("PI_HTTP_CLIENT_REGISTRY_CLASS", None)
+
+    def test_01_registry(self):
+        # The shared registry is the default
+        registry1 = get_registry()
+        registry2 = get_registry()
+        self.assertIs(registry1, registry2)
+        self.assertIsInstance(registry1, SharedHTTPClientRegistry)
+
+    def test_02_client(self):
+        # The same target and TLS settings use the same client
+        client1 = get_client("https://pi.example.com/validate/check")
+        client2 = get_client("https://pi.example.com:443/auth")
+        self.assertIs(client1, client2)
+        self.assertEqual(client1.target, "https://pi.example.com:443")
+        # Other TLS settings, proxies or targets use other clients
+        self.assertIsNot(client1, get_client("https://pi.example.com/", verify=False))
+        self.assertIsNot(client1, get_client("https://pi.example.com/",
+                                             proxies={"https": "http://proxy:3128"}))
+        self.assertIsNot(client1, get_client("http://pi.example.com/"))
+        self.assertIsNot(client1, get_client("https://pi2.example.com/"))
+
+    @responses.activate
+    def test_03_request_metrics(self):
+        responses.add(responses.POST, "https://pi.example.com/validate/check",
+                      body='{"result": {"status": true, "value": true}}',
+                      headers={"Set-Cookie": "session=secret"},
+                      content_type="application/json")
+        responses.add(responses.GET, "https://pi.example.com/error",
+                      status=503)
+        for i in range(3):
+            r = request("POST", "https://pi.example.com/validate/check",
+                        data={"user": "cornelius", "pass": "test"})
+            self.assertEqual(r.status_code, 200)
+        r = request("GET", "https://pi.example.com/error")
+        self.assertEqual(r.status_code, 503)
+
+        # The shared session does not store the cookie
+        client = get_client("https://pi.example.com/")
+        self.assertEqual(len(client.session.cookies), 0)
+        metrics = get_registry().get_metrics()
+        self.assertEqual(metrics["https://pi.example.com:443"]["requests"], 4)
+        self.assertEqual(metrics["https://pi.example.com:443"]["errors"], 1)
+        self.assertGreaterEqual(metrics["https://pi.example.com:443"]["latency_max"],
+                                metrics["https://pi.example.com:443"]["latency_avg"])
+
+    def test_04_connection_errors(self):
+        # find a free port, where nobody listens
+        s = socket.socket()
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+        s.close()
+        client = HTTPClient("http://127.0.0.1:{0!s}".format(port),
+                            retries=2, backoff=0, timeout=1)
+        self.assertRaises(requests.exceptions.ConnectionError, client.get,
+                          "http://127.0.0.1:{0!s}/".format(port))
+        metrics = client.get_metrics()
+        self.assertEqual(metrics["requests"], 1)
+        self.assertEqual(metrics["errors"], 1)
+
+    @responses.activate
+    def test_05_null_registry(self):
+        self.app.config["PI_HTTP_CLIENT_REGISTRY_CLASS"] = "null"
+        registry = get_registry()
+        self.assertIsInstance(registry, NullHTTPClientRegistry)
+        client1 = get_client("https://pi.example.com/")
+        client2 = get_client("https://pi.example.com/")
+        self.assertIsNot(client1, client2)
+        responses.add(responses.GET, "https://pi.example.com/", body="OK")
+        r = request("GET", "https://pi.example.com/")
+        self.assertEqual(r.text, "OK")
+        self.assertEqual(registry.get_metrics(), {})
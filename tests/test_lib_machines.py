@@ -11,14 +11,21 @@ lib.machines.hosts
 HOSTSFILE = "tests/testdata/hosts"
 from .base import MyTestCase
 from privacyidea.lib.machines import BaseMachineResolver
-from privacyidea.lib.machines.hosts import HostsMachineResolver
+from privacyidea.lib.machines.hosts import HostsMachineResolver, get_hosts_index
 from privacyidea.lib.machines.base import Machine, MachineResolverError
+import logging
 import netaddr
+import os
+import shutil
+import tempfile
+import time
 from privacyidea.lib.machineresolver import (get_resolver_list, save_resolver,
                                      delete_resolver, get_resolver_config,
                                      get_resolver_object, pretestresolver)
 from privacyidea.lib.machine import get_machines
 
+log = logging.getLogger(__name__)
+
 
 class MachineObjectTestCase(MyTestCase):
 
@@ -177,6 +184,11 @@ class HostsMachineTestCase(MyTestCase):
                                            ip=netaddr.IPAddress("192.168.0.1"))
         self.assertEqual(len(machines), 1)
 
+        # The IP address can also be given as a string
+        machines = self.mreso.get_machines(ip="192.168.0.1")
+        self.assertEqual([m.id for m in machines], ["192.168.0.1"])
+        self.assertEqual(self.mreso.get_machines(ip="no ip"), [])
+
         # THere are 3 machines, whose name contains an "n"
         machines = self.mreso.get_machines(hostname="n",
                                            substring=True)
@@ -220,9 +232,85 @@ class HostsMachineTestCase(MyTestCase):
 
         id = self.mreso.get_machine_id(ip="192.168.0.2")
         self.assertEqual(id, "192.168.0.2")
+        id = self.mreso.get_machine_id(ip=netaddr.IPAddress("192.168.0.2"))
+        self.assertEqual(id, "192.168.0.2")
 
     def test_05_failing_load_config(self):
         # missing filename
         self.assertRaises(MachineResolverError,
                           self.mreso.load_config,
                           {"name": "nothing"})
+
+    def test_06_reload_changed_file(self):
+        tmpdir = tempfile.mkdtemp()
+        filename = os.path.join(tmpdir, "hosts")
+        shutil.copy(HOSTSFILE, filename)
+        mreso = HostsMachineResolver("tmpResolver", config={"filename": filename})
+        self.assertEqual(len(mreso.get_machines()), 5)
+        # The file is only parsed once
+        index = get_hosts_index(filename)
+        mreso.get_machines(hostname="gandalf")
+        self.assertIs(get_hosts_index(filename), index)
+
+        with open(filename, "a") as f:
+            f.write("10.0.0.1 frodo\n")
+        mtime = os.stat(filename).st_mtime + 10
+        os.utime(filename, (mtime, mtime))
+        self.assertEqual(len(mreso.get_machines()), 6)
+        self.assertEqual(mreso.get_machine_id(hostname="frodo"), "10.0.0.1")
+        self.assertIsNot(get_hosts_index(filename), index)
+        shutil.rmtree(tmpdir)
+
+    def test_07_large_hosts_file(self):
+        # Compare the index with a scan of a hosts file with 50000 lines
+        def scan(filename, hostname=None, any=None, substring=False):
+            machine_ids = []
+            with open(filename) as f:
+                for line in f:
+                    split_line = line.split()
+                    if len(split_line) < 2 or split_line[0][0] == "#":
+                        continue
+                    if any and any not in line:
+                        continue
+                    if hostname:
+                        if substring:
+                            if not [x for x in split_line[1:] if hostname in x]:
+                                continue
+                        elif hostname not in split_line[1:]:
+                            continue
+                    machine_ids.append(split_line[0])
+            return machine_ids
+
+        tmpdir = tempfile.mkdtemp()
+        filename = os.path.join(tmpdir, "hosts")
+        with open(filename, "w") as f:
+            f.write("# a large hosts file\n")
+            for i in range(50000):
+                f.write("10.{0:d}.{1:d}.{2:d}\thost{3:d}.example.com "
+                        "h{3:d}\n".format(i // 65536, (i // 256) % 256, i % 256, i))
+        mreso = HostsMachineResolver("largeResolver", config={"filename": filename})
+        start = time.time()
+        for query in [{"hostname": "host4711.example.com"},
+                      {"hostname": "h49999"},
+                      {"hostname": "st1234", "substring": True},
+                      {"hostname": "x", "substring": True},
+                      {"any": "10.0.18"},
+                      {"any": "h123"},
+                      {"any": "nothere"}]:
+            self.assertEqual([m.id for m in mreso.get_machines(**query)],
+                             scan(filename, **query), query)
+        self.assertEqual(mreso.get_machine_id(hostname="h12345"), "10.0.48.57")
+        self.assertEqual(mreso.get_machine_id(ip="10.0.48.57"), "10.0.48.57")
+        self.assertEqual(mreso.get_machines(machine_id="10.0.48.57")[0].hostname,
+                         ["host12345.example.com", "h12345"])
+        # The lookups after the first one use the index in memory
+        index = get_hosts_index(filename)
+        lookup_start = time.time()
+        for i in range(1000):
+            mreso.get_machine_id(hostname="h{0:d}".format(i))
+        lookup_time = time.time() - lookup_start
+        self.assertIs(get_hosts_index(filename), index)
+        log.info(u"50000 lines hosts file: {0:.3f}s for the searches and "
+                 u"{1:.3f}s for 1000 lookups".format(lookup_start - start,
+                                                     lookup_time))
+        shutil.rmtree(tmpdir)
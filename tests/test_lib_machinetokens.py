@@ -7,8 +7,12 @@ HOSTSFILE = "tests/testdata/hosts"
 from .base import MyTestCase
 from privacyidea.lib.machine import (attach_token, detach_token, add_option,
                                      delete_option, list_machine_tokens,
-                                     list_token_machines, get_auth_items)
-from privacyidea.lib.token import init_token, get_tokens
+                                     list_token_machines, get_auth_items,
+                                     get_cached_auth_items, AuthItemCache)
+from privacyidea.lib.framework import get_app_local_store
+from privacyidea.lib.token import init_token, get_tokens, enable_token
+import mock
+import time
 from privacyidea.lib.machineresolver import save_resolver
 
 
@@ -148,3 +152,80 @@ class MachineTokenTestCase(MyTestCase):
         sshkey_auth_items = ai.get("ssh")
         # None or an empty list
         self.assertFalse(sshkey_auth_items)
+
+    def test_11_cached_auth_items(self):
+        # Without the cache the auth items are read on every call
+        etag1, ai = get_cached_auth_items("gandalf", application="ssh")
+        self.assertEqual(len(ai.get("ssh")), 1)
+        etag2, _ai = get_cached_auth_items("gandalf", application="ssh")
+        self.assertEqual(etag1, etag2)
+        self.assertEqual(get_app_local_store().get("auth_item_cache"), None)
+
+        self.app.config["PI_AUTHITEM_CACHE_TTL"] = 60
+        try:
+            with mock.patch("privacyidea.lib.machine.get_auth_items",
+                            wraps=get_auth_items) as mock_get_auth_items:
+                etag3, ai = get_cached_auth_items("gandalf", application="ssh")
+                self.assertEqual(etag3, etag1)
+                etag3, ai = get_cached_auth_items("gandalf", application="ssh")
+                self.assertEqual(etag3, etag1)
+                self.assertEqual(len(ai.get("ssh")), 1)
+                self.assertEqual(mock_get_auth_items.call_count, 1)
+                # other filter parameters are cached separately
+                get_cached_auth_items("gandalf", application="ssh",
+                                      filter_param={"user": "testuser"})
+                self.assertEqual(mock_get_auth_items.call_count, 2)
+                # applications with a challenge are not cached
+                get_cached_auth_items("gandalf", application="luks",
+                                      challenge="abcdef")
+                get_cached_auth_items("gandalf", application="luks",
+                                      challenge="abcdef")
+                self.assertEqual(mock_get_auth_items.call_count, 4)
+
+                # Disabling the token invalidates the cache
+                enable_token(self.serial2, False)
+                etag4, ai = get_cached_auth_items("gandalf", application="ssh")
+                self.assertNotEqual(etag4, etag1)
+                self.assertFalse(ai.get("ssh"))
+                enable_token(self.serial2)
+                etag5, ai = get_cached_auth_items("gandalf", application="ssh")
+                self.assertEqual(etag5, etag1)
+
+                # Changing the options invalidates the cache
+                add_option(serial=self.serial2, application="ssh",
+                           hostname="gandalf", options={"user": "root"})
+                etag6, ai = get_cached_auth_items("gandalf", application="ssh")
+                self.assertNotEqual(etag6, etag1)
+                self.assertEqual(ai["ssh"][0]["user"], "root")
+                delete_option(serial=self.serial2, application="ssh",
+                              hostname="gandalf", key="user")
+                _etag, ai = get_cached_auth_items("gandalf", application="ssh")
+                self.assertNotIn("user", ai["ssh"][0])
+
+                # Detaching the token invalidates the cache
+                detach_token(self.serial2, "ssh", hostname="gandalf")
+                _etag, ai = get_cached_auth_items("gandalf", application="ssh")
+                self.assertFalse(ai.get("ssh"))
+                self.assertEqual(mock_get_auth_items.call_count, 9)
+        finally:
+            self.app.config.pop("PI_AUTHITEM_CACHE_TTL")
+            get_app_local_store().pop("auth_item_cache", None)
+
+    def test_12_auth_item_cache_size(self):
+        cache = AuthItemCache(60, size=2)
+        cache.set("host1", "etag1", {"ssh": []})
+        cache.set("host2", "etag2", {"ssh": []})
+        # host1 is used recently, so host2 is removed
+        self.assertEqual(cache.get("host1"), ("etag1", {"ssh": []}))
+        cache.set("host3", "etag3", {"ssh": []})
+        self.assertEqual(cache.get("host2"), None)
+        self.assertEqual(list(cache._entries), ["host1", "host3"])
+
+        # Expired entries are removed
+        with mock.patch("privacyidea.lib.machine.time.time",
+                        return_value=time.time() + 61):
+            self.assertEqual(cache.get("host1"), None)
+            self.assertEqual(list(cache._entries), ["host3"])
+            cache.set("host4", "etag4", {"ssh": []})
+            self.assertEqual(list(cache._entries), ["host4"])
+            self.assertEqual(cache.get("host4"), ("etag4", {"ssh": []}))
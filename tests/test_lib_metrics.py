@@ -0,0 +1,134 @@
+"""
+This file contains the tests for the metrics registry.
+
+In particular, this tests
+lib/metrics.py
+"""
+import os
+import shutil
+import tempfile
+
+import mock
+
+from privacyidea.lib import metrics
+from privacyidea.lib.framework import get_app_local_store
+from privacyidea.lib.metrics import (get_registry, timer, timed, render_metrics,
+                                     NullMetricsRegistry, ProcessMetricsRegistry,
+                                     MultiprocessMetricsRegistry, NULL_TIMER,
+                                     PHASE_DURATION, DB_QUERIES)
+from privacyidea.models import Config
+from .base import MyTestCase
+
+
+class MetricsTestCase(MyTestCase):
+
+    def tearDown(self):
+        get_app_local_store().pop("metrics_registry", None)
+        for key in ["PI_METRICS_REGISTRY_CLASS", "PI_METRICS_DIR"]:
+            self.app.config.pop(key, None)
+
+    def test_01_null_registry(self):
+        # No metrics are recorded by default
+        registry = get_registry()
+        self.assertIsInstance(registry, NullMetricsRegistry)
+        self.assertFalse(registry.enabled)
+        self.assertIs(timer(PHASE_DURATION, phase="user"), NULL_TIMER)
+        with timer(PHASE_DURATION, phase="user"):
+            pass
+        registry.inc(DB_QUERIES)
+        self.assertEqual(registry.get_values(), {})
+        self.assertEqual(registry.render(), "\n")
+
+    def test_02_process_registry(self):
+        self.app.config["PI_METRICS_REGISTRY_CLASS"] = "process"
+        registry = get_registry()
+        self.assertIsInstance(registry, ProcessMetricsRegistry)
+        self.assertIs(registry, get_registry())
+        registry.observe(PHASE_DURATION, 0.003, phase="user")
+        registry.observe(PHASE_DURATION, 0.2, phase="user")
+        registry.observe(PHASE_DURATION, 20, phase="user")
+        with timer(PHASE_DURATION, phase="audit"):
+            pass
+
+        @timed(PHASE_DURATION, phase="signing")
+        def sign(value):
+            return value + 1
+        self.assertEqual(sign(1), 2)
+
+        values = registry.get_values()
+        user_values = values[(PHASE_DURATION, (("phase", "user"),))]
+        self.assertEqual(user_values[0], 1)
+        self.assertEqual(user_values[5], 1)
+        self.assertEqual(user_values[11], 1)
+        self.assertAlmostEqual(user_values[-2], 20.203)
+        self.assertEqual(user_values[-1], 3)
+        self.assertEqual(values[(PHASE_DURATION, (("phase", "signing"),))][-1], 1)
+
+        # The SQL statements are counted
+        queries = values.get((DB_QUERIES, ()), [0])[0]
+        Config.query.filter_by(Key="metrics").first()
+        self.assertEqual(registry.get_values()[(DB_QUERIES, ())][0], queries + 1)
+
+        text = registry.render()
+        self.assertIn('# TYPE privacyidea_phase_duration_seconds histogram', text)
+        self.assertIn('privacyidea_phase_duration_seconds_bucket{phase="user",le="0.005"} 1', text)
+        self.assertIn('privacyidea_phase_duration_seconds_bucket{phase="user",le="0.25"} 2', text)
+        self.assertIn('privacyidea_phase_duration_seconds_bucket{phase="user",le="+Inf"} 3', text)
+        self.assertIn('privacyidea_phase_duration_seconds_count{phase="user"} 3', text)
+        self.assertIn('# TYPE privacyidea_db_queries_total counter', text)
+
+        # A forked process starts without the metrics of its parent
+        with mock.patch("privacyidea.lib.metrics.os.getpid", return_value=os.getpid() + 1):
+            self.assertEqual(registry.get_values(), {})
+
+    def test_03_multiprocess_registry(self):
+        directory = tempfile.mkdtemp()
+        try:
+            self.app.config["PI_METRICS_REGISTRY_CLASS"] = "multiprocess"
+            self.app.config["PI_METRICS_DIR"] = directory
+            registry = get_registry()
+            self.assertIsInstance(registry, MultiprocessMetricsRegistry)
+            registry.inc("privacyidea_test_total", 2, result="ok")
+            # The first update is written immediately, the next ones after
+            # the flush interval
+            self.assertEqual(os.listdir(directory),
+                             ["metrics-{0!s}.json".format(os.getpid())])
+
+            # Another process has written its metrics
+            other = MultiprocessMetricsRegistry(directory)
+            with mock.patch("privacyidea.lib.metrics.os.getpid", return_value=1):
+                other.inc("privacyidea_test_total", 3, result="ok")
+                other.inc("privacyidea_test_total", result="fail")
+                with open(os.path.join(directory, "metrics-1.json")) as f:
+                    self.assertNotIn("fail", f.read())
+                other.flush()
+            self.assertEqual(len(os.listdir(directory)), 2)
+
+            registry.inc("privacyidea_test_total", result="ok")
+            values = registry.get_values()
+            self.assertEqual(values[("privacyidea_test_total", (("result", "ok"),))], [6])
+            self.assertEqual(values[("privacyidea_test_total", (("result", "fail"),))], [1])
+            text = registry.render()
+            self.assertIn('privacyidea_test_total{result="ok"} 6', text)
+            self.assertIn('privacyidea_test_total{result="fail"} 1', text)
+        finally:
+            shutil.rmtree(directory)
+
+        # Without a directory only the metrics of the process are recorded
+        get_app_local_store().pop("metrics_registry", None)
+        self.app.config["PI_METRICS_DIR"] = "/does/not/exist"
+        self.assertIs(type(get_registry()), ProcessMetricsRegistry)
+
+    def test_04_render(self):
+        self.assertEqual(render_metrics({("privacyidea_test_total", (("name", 'a"b\\c'),)): [1.5]}),
+                         '# HELP privacyidea_test_total \n'
+                         '# TYPE privacyidea_test_total counter\n'
+                         'privacyidea_test_total{name="a\\"b\\\\c"} 1.5\n')
+        text = render_metrics({(PHASE_DURATION, ()): [1, 0, 0, 2, 0.5, 3]}, buckets=(0.1, 1, 10))
+        self.assertEqual(text.splitlines()[2:],
+                         ['privacyidea_phase_duration_seconds_bucket{le="0.1"} 1',
+                          'privacyidea_phase_duration_seconds_bucket{le="1"} 1',
+                          'privacyidea_phase_duration_seconds_bucket{le="10"} 1',
+                          'privacyidea_phase_duration_seconds_bucket{le="+Inf"} 3',
+                          'privacyidea_phase_duration_seconds_sum 0.5',
+                          'privacyidea_phase_duration_seconds_count 3'])
@@ -1,8 +1,9 @@
 # coding: utf-8
-from privacyidea.models import MonitoringStats
+from privacyidea.lib.error import ParameterError
+from privacyidea.models import MonitoringStats, MonitoringStatsRollup
 from privacyidea.lib.monitoringstats import (write_stats, delete_stats,
                                              get_stats_keys, get_values,
-                                             get_last_value)
+                                             get_last_value, delete_old_stats)
 
 from .base import MyTestCase
 import datetime
@@ -114,4 +115,102 @@ class TokenModelTestCase(MyTestCase):
 
         # Get the last value of key1
         r = get_last_value("key1")
-        self.assertEqual(r, 10)
\ No newline at end of file
+        self.assertEqual(r, 10)
+
+    def test_05_get_values_in_resolution(self):
+        for k in get_stats_keys():
+            delete_stats(k)
+
+        ts = datetime.datetime(2019, 5, 1, 10, 0, tzinfo=tzutc())
+        write_stats("key1", 4, timestamp=ts + timedelta(minutes=1))
+        write_stats("key1", 2, timestamp=ts + timedelta(minutes=3))
+        write_stats("key1", 9, timestamp=ts + timedelta(minutes=2))
+        write_stats("key1", 7, timestamp=ts + timedelta(minutes=6))
+        write_stats("key1", 1, timestamp=ts + timedelta(hours=1))
+        # Three time buckets of 5 minutes
+        self.assertEqual(MonitoringStatsRollup.query.filter_by(stats_key="key1",
+                                                               resolution=300).count(), 3)
+
+        r = get_values("key1", resolution="5min")
+        self.assertEqual(r, [(ts, 5.0),
+                             (ts + timedelta(minutes=5), 7.0),
+                             (ts + timedelta(hours=1), 1.0)])
+        self.assertEqual(r[0][0].tzinfo, tzutc())
+        self.assertEqual([v for _t, v in get_values("key1", resolution="5min",
+                                                    aggregate="last")], [2, 7, 1])
+        self.assertEqual([v for _t, v in get_values("key1", resolution="hour",
+                                                    aggregate="min")], [2, 1])
+        self.assertEqual([v for _t, v in get_values("key1", resolution="hour",
+                                                    aggregate="max")], [9, 1])
+        self.assertEqual(get_values("key1", resolution="day", aggregate="count"),
+                         [(datetime.datetime(2019, 5, 1, tzinfo=tzutc()), 5)])
+        self.assertEqual(get_values("key1", resolution="day", aggregate="sum")[0][1], 23)
+
+        # The buckets, which overlap the time frame, are returned
+        r = get_values("key1", start_timestamp=ts + timedelta(minutes=7),
+                       end_timestamp=ts + timedelta(minutes=30), resolution="5min")
+        self.assertEqual(r, [(ts + timedelta(minutes=5), 7.0)])
+
+        self.assertRaises(ParameterError, get_values, "key1", resolution="week")
+        self.assertRaises(ParameterError, get_values, "key1", resolution="hour",
+                          aggregate="median")
+
+        # Resetting the values also resets the buckets
+        write_stats("key1", 3, timestamp=ts + timedelta(hours=2), reset_values=True)
+        self.assertEqual(get_values("key1", resolution="day", aggregate="count")[0][1], 1)
+        self.assertEqual(get_values("key1", resolution="hour"),
+                         [(ts + timedelta(hours=2), 3.0)])
+
+    def test_06_delete_values_in_resolution(self):
+        for k in get_stats_keys():
+            delete_stats(k)
+
+        ts = datetime.datetime(2019, 5, 1, 10, 0, tzinfo=tzutc())
+        for minute, value in [(1, 1), (2, 2), (6, 3), (12, 4), (13, 5)]:
+            write_stats("key1", value, timestamp=ts + timedelta(minutes=minute))
+
+        # The buckets at the borders are recomputed from the remaining values
+        r = delete_stats("key1", start_timestamp=ts + timedelta(minutes=2),
+                         end_timestamp=ts + timedelta(minutes=12))
+        self.assertEqual(r, 3)
+        self.assertEqual(get_values("key1", resolution="5min", aggregate="last"),
+                         [(ts, 1), (ts + timedelta(minutes=10), 5)])
+        self.assertEqual(get_values("key1", resolution="hour", aggregate="sum"),
+                         [(ts, 6)])
+
+        delete_stats("key1")
+        self.assertEqual(MonitoringStatsRollup.query.filter_by(stats_key="key1").count(), 0)
+
+        # Delete old raw values and old buckets
+        write_stats("key1", 1, timestamp=ts)
+        write_stats("key1", 2, timestamp=ts + timedelta(days=1))
+        self.assertEqual(delete_old_stats(ts + timedelta(hours=1)), 1)
+        self.assertEqual([v for _t, v in get_values("key1")], [2])
+        self.assertEqual(len(get_values("key1", resolution="day")), 2)
+        self.assertEqual(delete_old_stats(ts + timedelta(hours=1), resolution="day"), 1)
+        self.assertEqual(delete_old_stats(ts + timedelta(hours=1), resolution="hour"), 1)
+        self.assertEqual(len(get_values("key1", resolution="day")), 1)
+        self.assertEqual(len(get_values("key1", resolution="5min")), 2)
+        self.assertRaises(ParameterError, delete_old_stats, ts, resolution="week")
+        delete_stats("key1")
+
+    def test_07_delete_values_with_same_timestamp(self):
+        for k in get_stats_keys():
+            delete_stats(k)
+
+        ts = datetime.datetime(2019, 5, 1, 10, 0, tzinfo=tzutc())
+        for minute, value in [(1, 1), (3, 2), (3, 6), (4, 8)]:
+            write_stats("key1", value, timestamp=ts + timedelta(minutes=minute))
+
+        # The bucket is recomputed from values with the same last timestamp.
+        # The value, which was written last, is the last value.
+        r = delete_stats("key1", start_timestamp=ts + timedelta(minutes=4))
+        self.assertEqual(r, 1)
+        self.assertEqual(get_values("key1", resolution="5min", aggregate="last"),
+                         [(ts, 6)])
+        self.assertEqual(get_values("key1", resolution="5min", aggregate="count"),
+                         [(ts, 3)])
+        self.assertEqual(get_values("key1", resolution="hour", aggregate="sum"),
+                         [(ts, 9)])
+        self.assertEqual(MonitoringStats.query.filter_by(stats_key="key1").count(), 3)
+        delete_stats("key1")
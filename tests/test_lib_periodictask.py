@@ -5,17 +5,21 @@ In particular, this tests
 lib/periodictask.py
 """
 from datetime import datetime, timedelta
+from threading import Event
 
 from dateutil.parser import parse as parse_timestamp
 from dateutil.tz import gettz, tzutc
 from mock import mock
 
 from privacyidea.lib.error import ServerError, ParameterError, ResourceNotFoundError
+from privacyidea.lib.monitoringstats import get_values, delete_stats
 from privacyidea.lib.periodictask import calculate_next_timestamp, set_periodic_task, get_periodic_tasks, \
     enable_periodic_task, delete_periodic_task, set_periodic_task_last_run, get_scheduled_periodic_tasks, \
-    get_periodic_task_by_name, TASK_MODULES, execute_task, get_periodic_task_by_id
+    get_periodic_task_by_name, TASK_MODULES, execute_task, get_periodic_task_by_id, get_due_periodic_tasks, \
+    acquire_periodic_task_lease, renew_periodic_task_lease, release_periodic_task_lease, \
+    PeriodicTaskScheduler, DURATION_STATS_KEY
 from privacyidea.lib.task.base import BaseTask
-from privacyidea.models import PeriodicTask
+from privacyidea.models import PeriodicTask, PeriodicTaskLease
 from .base import MyTestCase
 
 
@@ -477,3 +481,123 @@ class BasePeriodicTaskTestCase(MyTestCase):
         with mock.patch.dict(TASK_MODULES, values={"Test": _TestTask}):
             ret = execute_task("Test", {"key": "value"})
             self.assertTrue(ret)
+
+    def test_07_leases(self):
+        task = set_periodic_task("task lease", "*/5 * * * *", ["pinode1", "pinode2"], "some.task.module")
+        scheduled = parse_timestamp("2018-06-26 08:00:00 UTC")
+        now = scheduled + timedelta(seconds=5)
+
+        # only one node gets the lease for a scheduled run
+        self.assertTrue(acquire_periodic_task_lease(task, "pinode1", scheduled, 60, now))
+        self.assertFalse(acquire_periodic_task_lease(task, "pinode2", scheduled, 60, now))
+        self.assertFalse(acquire_periodic_task_lease(task, "pinode1", scheduled, 60, now))
+
+        # only the holder can renew the lease
+        self.assertFalse(renew_periodic_task_lease(task, "pinode2", scheduled, 60, now))
+        self.assertTrue(renew_periodic_task_lease(task, "pinode1", scheduled, 60,
+                                                  now + timedelta(seconds=30)))
+
+        # pinode1 does not renew the lease anymore, so pinode2 takes over after it expired
+        self.assertFalse(acquire_periodic_task_lease(task, "pinode2", scheduled, 60,
+                                                     now + timedelta(seconds=80)))
+        self.assertTrue(acquire_periodic_task_lease(task, "pinode2", scheduled, 60,
+                                                    now + timedelta(seconds=100)))
+        self.assertFalse(renew_periodic_task_lease(task, "pinode1", scheduled, 60,
+                                                   now + timedelta(seconds=100)))
+
+        # a finished run is not started again
+        release_periodic_task_lease(task, "pinode2", scheduled, True, now + timedelta(seconds=110))
+        self.assertFalse(acquire_periodic_task_lease(task, "pinode1", scheduled, 60,
+                                                     now + timedelta(days=1)))
+
+        # a failed run can be retried immediately
+        next_scheduled = scheduled + timedelta(minutes=5)
+        self.assertTrue(acquire_periodic_task_lease(task, "pinode1", next_scheduled, 60, next_scheduled))
+        release_periodic_task_lease(task, "pinode1", next_scheduled, False,
+                                    next_scheduled + timedelta(seconds=1))
+        self.assertTrue(acquire_periodic_task_lease(task, "pinode2", next_scheduled, 60,
+                                                    next_scheduled + timedelta(seconds=2)))
+
+        # the lease is deleted with the task
+        delete_periodic_task(task)
+        self.assertEqual(PeriodicTaskLease.query.filter_by(periodictask_id=task).count(), 0)
+
+    def test_08_due_periodic_tasks(self):
+        tzinfo = tzutc()
+        with mock.patch('privacyidea.models.datetime') as mock_dt:
+            mock_dt.utcnow.return_value = parse_timestamp("2018-06-20 07:00:00")
+            task = set_periodic_task("task due", "0 8 * * *", ["pinode1", "pinode2", "pinode3"],
+                                     "some.task.module")
+        # without last runs, the task is due since the first scheduled time after the last update
+        current_timestamp = parse_timestamp("2018-06-26 08:30:00 UTC")
+        due = get_due_periodic_tasks("pinode1", current_timestamp, tzinfo)
+        self.assertEqual([(ptask["name"], scheduled) for ptask, scheduled in due],
+                         [("task due", parse_timestamp("2018-06-20 08:00:00 UTC"))])
+        self.assertEqual(get_due_periodic_tasks("pinode4", current_timestamp, tzinfo), [])
+
+        # the last run on any node counts
+        set_periodic_task_last_run(task, "pinode1", parse_timestamp("2018-06-25 08:00:05 UTC"))
+        set_periodic_task_last_run(task, "pinode2", parse_timestamp("2018-06-26 08:00:10 UTC"))
+        self.assertEqual(len(get_scheduled_periodic_tasks("pinode1", current_timestamp, tzinfo)), 1)
+        self.assertEqual(get_due_periodic_tasks("pinode1", current_timestamp, tzinfo), [])
+        self.assertEqual(get_due_periodic_tasks("pinode3", current_timestamp, tzinfo), [])
+        due = get_due_periodic_tasks("pinode3", current_timestamp + timedelta(days=1), tzinfo)
+        self.assertEqual([scheduled for _ptask, scheduled in due],
+                         [parse_timestamp("2018-06-27 08:00:00 UTC")])
+
+        delete_periodic_task(task)
+
+    def test_09_scheduler(self):
+        release = Event()
+        runs = []
+
+        class _SlowTask(BaseTask):
+            identifier = "Slow"
+            description = "A task, which waits until it is released"
+
+            def do(self, params):
+                runs.append(params["name"])
+                release.wait(10)
+                if params.get("fail"):
+                    raise Exception("The task failed")
+                return True
+
+        # on each 1st of January at 08:00
+        with mock.patch('privacyidea.models.datetime') as mock_dt:
+            mock_dt.utcnow.return_value = parse_timestamp("2018-01-01 07:00:00")
+            tasks = [set_periodic_task(u"task {0!s}".format(name), "0 8 1 1 *",
+                                       ["pinode1", "pinode2"], "Slow", ordering, options)
+                     for ordering, (name, options) in enumerate([("a", {"name": "a"}),
+                                                                 ("b", {"name": "b"}),
+                                                                 ("c", {"name": "c", "fail": "1"})])]
+        current_timestamp = parse_timestamp("2018-01-01 08:01:00 UTC")
+        # two simulated nodes, which run two tasks at a time
+        scheduler1 = PeriodicTaskScheduler(self.app, "pinode1", workers=2, interval_tzinfo=tzutc())
+        scheduler2 = PeriodicTaskScheduler(self.app, "pinode2", workers=2, interval_tzinfo=tzutc())
+        with mock.patch.dict(TASK_MODULES, values={"Slow": _SlowTask}):
+            self.assertEqual(scheduler1.tick(current_timestamp), ["task a", "task b"])
+            self.assertEqual(scheduler2.tick(current_timestamp), ["task c"])
+            # the running tasks are not started again
+            self.assertEqual(scheduler1.tick(current_timestamp), [])
+            self.assertEqual(scheduler2.tick(current_timestamp), [])
+            release.set()
+            self.assertTrue(scheduler1.join(10))
+            self.assertTrue(scheduler2.join(10))
+            self.assertEqual(sorted(runs), ["a", "b", "c"])
+
+            # successful runs are recorded for the node, which ran the task
+            self.assertEqual(list(get_periodic_task_by_id(tasks[0])["last_runs"]), ["pinode1"])
+            self.assertEqual(list(get_periodic_task_by_id(tasks[1])["last_runs"]), ["pinode1"])
+            self.assertEqual(get_periodic_task_by_id(tasks[2])["last_runs"], {})
+            for name in ["task a", "task b", "task c"]:
+                self.assertEqual(len(get_values(DURATION_STATS_KEY.format(name))), 1)
+                delete_stats(DURATION_STATS_KEY.format(name))
+
+            # the failed task is retried by any node
+            self.assertEqual(scheduler1.tick(), ["task c"])
+            self.assertTrue(scheduler1.join(10))
+            self.assertEqual(sorted(runs), ["a", "b", "c", "c"])
+            delete_stats(DURATION_STATS_KEY.format("task c"))
+
+        for task in tasks:
+            delete_periodic_task(task)
@@ -19,8 +19,13 @@ from privacyidea.lib.resolver import (save_resolver, get_resolver_list,
 from privacyidea.lib.error import ParameterError
 from privacyidea.lib.user import User
 import datetime
+import logging
+import mock
+import time
 PWFILE = "tests/testdata/passwords"
 
+log = logging.getLogger(__name__)
+
 
 def _check_policy_name(polname, policies):
     """
@@ -867,4 +872,140 @@ class PolicyTestCase(MyTestCase):
         # The audit_data contains act1 and act2
         self.assertTrue("act1" in audit_data.get("policies"))
         self.assertTrue("act2" in audit_data.get("policies"))
-        self.assertTrue("act3" not in audit_data.get("policies"))
\ No newline at end of file
+        self.assertTrue("act3" not in audit_data.get("policies"))
+        delete_policy("act1")
+        delete_policy("act2")
+        delete_policy("act3")
+
+    def test_26_decision_cache(self):
+        save_resolver({"resolver": "reso1",
+                       "type": "passwdresolver",
+                       "fileName": PWFILE})
+        set_realm("realm1", ["reso1"])
+        set_policy("cache1", scope=SCOPE.AUTH, realm="realm1",
+                   action="{0!s}=userstore".format(ACTION.OTPPIN))
+        set_policy("cache2", scope=SCOPE.AUTH, resolver="resoX",
+                   check_all_resolvers=True,
+                   action="{0!s}=none".format(ACTION.OTPPIN))
+        P = PolicyClass()
+        # Outside of a request nothing is cached
+        self.assertIsNone(P.get_decision_cache())
+
+        with self.app.test_request_context('/validate/check', method='POST'):
+            with mock.patch("privacyidea.lib.policy.User", wraps=User) as mock_user:
+                audit_data = {}
+                for i in range(3):
+                    r = P.get_action_values(action=ACTION.OTPPIN, scope=SCOPE.AUTH,
+                                            realm="realm1", resolver="reso1",
+                                            user="cornelius", client="10.0.0.1",
+                                            audit_data=audit_data)
+                    self.assertEqual(r, {"userstore": ["cache1"]})
+                    P.get_policies(scope=SCOPE.AUTH, realm="realm1",
+                                   resolver="reso1", user="cornelius")
+                # The resolvers of the user are only determined once
+                self.assertEqual(mock_user.call_count, 1)
+            cache = P.get_decision_cache()
+            self.assertEqual(cache.misses, 2)
+            self.assertEqual(cache.hits, 4)
+            # The policies are still added to the audit data
+            self.assertEqual(audit_data.get("policies"), ["cache1"] * 3)
+            # Other filter values are not cached yet
+            r = P.get_action_values(action=ACTION.OTPPIN, scope=SCOPE.AUTH,
+                                    realm="realm1", resolver="reso1",
+                                    user="selfservice", client="10.0.0.1")
+            self.assertEqual(r, {"userstore": ["cache1"]})
+            self.assertEqual(cache.misses, 3)
+            # The returned list can be modified without changing the cache
+            P.get_policies(scope=SCOPE.AUTH).pop()
+            self.assertEqual(len(P.get_policies(scope=SCOPE.AUTH)), 2)
+
+            # If the policies are reloaded, a new cache is used
+            delete_policy("cache1")
+            P = PolicyClass()
+            self.assertIsNot(P.get_decision_cache(), cache)
+            r = P.get_action_values(action=ACTION.OTPPIN, scope=SCOPE.AUTH,
+                                    realm="realm1", resolver="reso1",
+                                    user="cornelius", client="10.0.0.1")
+            self.assertEqual(r, {})
+
+        # A new request uses a new cache
+        with self.app.test_request_context('/validate/check', method='POST'):
+            self.assertEqual(P.get_decision_cache().hits, 0)
+
+        delete_policy("cache2")
+        delete_realm("realm1")
+        delete_resolver("reso1")
+
+    def test_27_ui_rights_cache(self):
+        # Many admin realms with their own policies
+        for i in range(100):
+            set_policy(name="adminpol{0:d}".format(i), scope=SCOPE.ADMIN,
+                       adminrealm="adminrealm{0:d}".format(i),
+                       action="enable, disable, enrollHOTP, enrollTOTP, "
+                              "{0!s}=hotp".format(ACTION.TOKENTYPE))
+            set_policy(name="userpol{0:d}".format(i), scope=SCOPE.USER,
+                       realm="realm{0:d}".format(i),
+                       action="enrollHOTP, enable")
+        P = PolicyClass()
+        admins = [{"username": "admin", "realm": "adminrealm{0:d}".format(i),
+                   "role": "admin"} for i in range(0, 100, 2)]
+
+        def get_all_rights():
+            return [(sorted(P.ui_get_rights(SCOPE.ADMIN, admin.get("realm"),
+                                            admin.get("username"), "10.0.0.1")),
+                     sorted(P.ui_get_main_menus(admin, "10.0.0.1")),
+                     P.ui_get_enroll_tokentypes("10.0.0.1", admin))
+                    for admin in admins]
+
+        start = time.time()
+        rights = get_all_rights()
+        first_time = time.time() - start
+        self.assertIn("enrollHOTP", rights[0][0])
+        self.assertIn("tokentype=hotp", rights[0][0])
+        self.assertEqual(set(rights[0][2]), {"hotp", "totp"})
+
+        with mock.patch.object(P, "get_policies", wraps=P.get_policies) as mock_get:
+            start = time.time()
+            self.assertEqual(get_all_rights(), rights)
+            cached_time = time.time() - start
+            # The policies are not matched again
+            self.assertEqual(mock_get.call_count, 0)
+        log.info(u"UI rights of 50 admins with 200 policies: {0:.3f}s, "
+                 u"cached {1:.3f}s".format(first_time, cached_time))
+
+        # Only the rights of the recently used keys are kept
+        with mock.patch("privacyidea.lib.policy.UI_CACHE_SIZE", 10):
+            P.ui_get_rights(SCOPE.ADMIN, "adminrealm0", "admin", "10.0.0.1")
+            for i in range(20):
+                P.ui_get_rights(SCOPE.ADMIN, "adminrealm0", "admin",
+                                "10.0.1.{0:d}".format(i))
+            self.assertEqual(len(P._ui_cache), 10)
+            self.assertEqual(list(P._ui_cache)[-1][-1], "10.0.1.19")
+            with mock.patch.object(P, "get_policies", wraps=P.get_policies) as mock_get:
+                P.ui_get_rights(SCOPE.ADMIN, "adminrealm0", "admin", "10.0.0.1")
+                self.assertTrue(mock_get.called)
+
+        # The returned rights can be modified without changing the cache
+        P.ui_get_rights(SCOPE.ADMIN, "adminrealm0", "admin", "10.0.0.1").append("delete")
+        self.assertNotIn("delete", P.ui_get_rights(SCOPE.ADMIN, "adminrealm0",
+                                                   "admin", "10.0.0.1"))
+
+        # The cache is cleared, if the policies are reloaded
+        set_policy(name="adminpol0", scope=SCOPE.ADMIN, adminrealm="adminrealm0",
+                   action="enable")
+        P = PolicyClass()
+        self.assertEqual(P.ui_get_rights(SCOPE.ADMIN, "adminrealm0", "admin",
+                                         "10.0.0.1"), ["enable"])
+        self.assertEqual(P.ui_get_enroll_tokentypes("10.0.0.1", admins[0]), {})
+
+        # The rights are not cached, if a policy is restricted to a time range
+        set_policy(name="adminpol0", scope=SCOPE.ADMIN, adminrealm="adminrealm0",
+                   action="enable", time="Mon-Sun: 0-23:59")
+        P = PolicyClass()
+        self.assertEqual(P.ui_get_rights(SCOPE.ADMIN, "adminrealm0", "admin",
+                                         "10.0.0.1"), ["enable"])
+        self.assertEqual(P._ui_cache, {})
+
+        for i in range(100):
+            delete_policy("adminpol{0:d}".format(i))
+            delete_policy("userpol{0:d}".format(i))
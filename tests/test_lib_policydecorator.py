@@ -32,8 +32,10 @@ import datetime
 from . import radiusmock
 import binascii
 import hashlib
-from privacyidea.models import AuthCache
+import mock
+from privacyidea.models import AuthCache, AuthCounter
 from privacyidea.lib.authcache import delete_from_cache, _hash_password
+from privacyidea.lib.authcounter import get_auth_count, delete_auth_counts
 from datetime import timedelta
 
 
@@ -823,3 +825,48 @@ class LibPolicyTestCase(MyTestCase):
         # Clean up
         remove_token(pin1)
         remove_token(pin2)
+
+    def test_16_auth_user_timelimit(self):
+        my_user = User("cornelius", realm="r1")
+        set_policy(name="pol_time", scope=SCOPE.AUTHZ,
+                   action="{0!s}=2/1m, {1!s}=3/1h".format(ACTION.AUTHMAXFAIL,
+                                                          ACTION.AUTHMAXSUCCESS))
+        g = FakeFlaskG()
+        g.policy_object = PolicyClass()
+        g.audit_object = FakeAudit()
+        options = {"g": g}
+
+        def check(user, passw, options=None):
+            return passw == "good", {}
+
+        # The audit log is not used to count the authentications
+        with mock.patch.object(FakeAudit, "get_count") as mock_count:
+            for i in range(3):
+                r, _reply = auth_user_timelimit(check, my_user, "good", options=options)
+                self.assertTrue(r)
+            r, reply = auth_user_timelimit(check, my_user, "good", options=options)
+            self.assertFalse(r)
+            self.assertEqual(reply.get("message"),
+                             "Only 3 successfull authentications per 1:00:00")
+            mock_count.assert_not_called()
+        self.assertEqual(get_auth_count("cornelius", "r1", True, timedelta(hours=1)), 3)
+        # The denied authentication is counted as failed
+        self.assertEqual(get_auth_count("cornelius", "r1", False, timedelta(hours=1)), 1)
+
+        r, _reply = auth_user_timelimit(check, my_user, "bad", options=options)
+        self.assertFalse(r)
+        r, reply = auth_user_timelimit(check, my_user, "good", options=options)
+        self.assertFalse(r)
+        self.assertEqual(reply.get("message"), "Only 2 failed authentications per 0:01:00")
+        # Other users are not affected
+        r, _reply = auth_user_timelimit(check, User("selfservice", realm="r1"),
+                                        "good", options=options)
+        self.assertTrue(r)
+
+        # Without the policies, the authentications are not counted
+        delete_policy("pol_time")
+        g.policy_object = PolicyClass()
+        delete_auth_counts()
+        r, _reply = auth_user_timelimit(check, my_user, "good", options=options)
+        self.assertTrue(r)
+        self.assertEqual(AuthCounter.query.count(), 0)
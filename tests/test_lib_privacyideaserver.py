@@ -3,12 +3,68 @@ This test file tests the lib/privacyideaserver.py
 """
 from .base import MyTestCase
 from privacyidea.lib.error import ConfigAdminError
+from privacyidea.lib.framework import get_app_local_store
 from privacyidea.lib.privacyideaserver import (add_privacyideaserver,
                                                delete_privacyideaserver,
                                                get_privacyideaserver,
                                                get_privacyideaservers,
+                                               get_upstream_health,
+                                               split_urls, UpstreamGroup,
                                                PrivacyIDEAServer)
+from requests.exceptions import ConnectionError
+from urllib3.exceptions import MaxRetryError, NewConnectionError
+from threading import Thread
+import mock
 import responses
+import socket
+import struct
+import time
+
+
+def refused_error(url):
+    return ConnectionError(MaxRetryError(None, url, NewConnectionError(
+        None, "Connection refused")))
+
+
+class ResettingServer(object):
+    """
+    Local HTTP server, which reads the request and resets the connection
+    without sending a response
+    """
+
+    def __init__(self):
+        self.requests = 0
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.bind(("127.0.0.1", 0))
+        self.sock.listen(5)
+        self.url = "http://127.0.0.1:{0!s}/pi".format(self.sock.getsockname()[1])
+        thread = Thread(target=self._serve)
+        thread.daemon = True
+        thread.start()
+
+    def _serve(self):
+        while True:
+            try:
+                conn, _addr = self.sock.accept()
+            except socket.error:
+                return
+            data = b""
+            while b"\r\n\r\n" not in data:
+                chunk = conn.recv(1024)
+                if not chunk:
+                    break
+                data += chunk
+            self.requests += 1
+            conn.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER,
+                            struct.pack("ii", 1, 0))
+            conn.close()
+
+    def close(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.sock.close()
 
 
 class PrivacyIDEAServerTestCase(MyTestCase):
@@ -132,3 +188,164 @@ class PrivacyIDEAServerTestCase(MyTestCase):
         r = PrivacyIDEAServer.request(pi.config, "user", "password")
         self.assertFalse(r)
 
+
+
+class UpstreamGroupTestCase(MyTestCase):
+
+    success_body = '{"result": {"status": true, "value": true}, "detail": null}'
+
+    def tearDown(self):
+        get_app_local_store().pop("upstream_health", None)
+
+    def test_01_split_urls(self):
+        self.assertEqual(split_urls("https://pi1/pi, https://pi2/pi\nhttps://pi3"),
+                         ["https://pi1/pi", "https://pi2/pi", "https://pi3"])
+        self.assertEqual(split_urls("https://pi1"), ["https://pi1"])
+        self.assertEqual(split_urls(""), [])
+        self.assertRaises(ConfigAdminError, UpstreamGroup.from_urls("").request,
+                          "GET")
+
+    @responses.activate
+    def test_02_failover(self):
+        responses.add(responses.POST, "https://pi1/pi/validate/check",
+                      body=refused_error("https://pi1/pi/validate/check"))
+        responses.add(responses.POST, "https://pi2/pi/validate/check",
+                      status=503)
+        responses.add(responses.POST, "https://pi3/pi/validate/check",
+                      body=self.success_body, content_type="application/json")
+        add_privacyideaserver(identifier="pifailover",
+                              url="https://pi1/pi, https://pi2/pi https://pi3/pi",
+                              tls=False)
+        pi = get_privacyideaserver("pifailover")
+        self.assertEqual(len(pi.upstreams.upstreams), 3)
+        # The validate request is not idempotent. It fails over, if the
+        # connection fails, but not on the error response of pi2, since pi2
+        # may have processed the OTP value
+        self.assertFalse(PrivacyIDEAServer.request(pi.config, "user", "password"))
+        self.assertEqual(len(responses.calls), 2)
+        self.assertEqual(get_upstream_health("https://pi1/pi").failures, 1)
+        self.assertEqual(get_upstream_health("https://pi2/pi").failures, 1)
+        # An idempotent request also fails over on an error response
+        url, r = pi.upstreams.request("POST", "/validate/check", idempotent=True)
+        self.assertEqual(url, "https://pi3/pi/validate/check")
+        self.assertEqual(len(responses.calls), 5)
+        self.assertEqual(get_upstream_health("https://pi1/pi").failures, 2)
+        self.assertEqual(get_upstream_health("https://pi2/pi").failures, 2)
+        self.assertEqual(get_upstream_health("https://pi3/pi").failures, 0)
+        self.assertIsNotNone(get_upstream_health("https://pi3/pi").latency)
+        get_app_local_store().pop("upstream_health", None)
+
+        # If all upstream servers fail, the last error response is returned
+        group = UpstreamGroup.from_urls("https://pi1/pi https://pi2/pi")
+        url, r = group.request("POST", "/validate/check")
+        self.assertEqual(url, "https://pi2/pi/validate/check")
+        self.assertEqual(r.status_code, 503)
+        # ...or the exception is raised, if no upstream server answered
+        group = UpstreamGroup.from_urls("https://pi1/pi")
+        self.assertRaises(ConnectionError, group.request, "POST", "/validate/check")
+        delete_privacyideaserver("pifailover")
+
+    @responses.activate
+    def test_03_circuit_breaker(self):
+        responses.add(responses.GET, "https://pi1/pi/auth",
+                      body=ConnectionError("connection refused"))
+        responses.add(responses.GET, "https://pi2/pi/auth",
+                      body=self.success_body, content_type="application/json")
+        group = UpstreamGroup.from_urls("https://pi1/pi,https://pi2/pi",
+                                        max_failures=2, retry_after=60)
+        for _i in range(2):
+            url, r = group.request("GET", "/auth")
+            self.assertEqual(url, "https://pi2/pi/auth")
+        self.assertEqual(len(responses.calls), 4)
+        self.assertFalse(get_upstream_health("https://pi1/pi").is_available())
+
+        # The failed upstream server is skipped now
+        url, r = group.request("GET", "/auth")
+        self.assertEqual(url, "https://pi2/pi/auth")
+        self.assertEqual(len(responses.calls), 5)
+
+        # After the retry time the upstream server is tried again
+        get_upstream_health("https://pi1/pi").open_until = time.time() - 1
+        group.request("GET", "/auth")
+        self.assertEqual(len(responses.calls), 7)
+
+    @responses.activate
+    def test_04_hedged_request(self):
+        def slow_callback(request):
+            time.sleep(1)
+            return 200, {}, self.success_body
+
+        responses.add_callback(responses.GET, "https://pi1/pi/auth",
+                               callback=slow_callback,
+                               content_type="application/json")
+        responses.add(responses.GET, "https://pi2/pi/auth",
+                      body=self.success_body, content_type="application/json")
+        group = UpstreamGroup.from_urls("https://pi1/pi https://pi2/pi",
+                                        hedge_after=0.1)
+        start = time.time()
+        url, r = group.request("GET", "/auth")
+        self.assertLess(time.time() - start, 1)
+        self.assertEqual(url, "https://pi2/pi/auth")
+        self.assertTrue(r.json()["result"]["value"])
+
+        # Without hedging we wait for the slow upstream server
+        group = UpstreamGroup.from_urls("https://pi1/pi https://pi2/pi",
+                                        hedge_after=0)
+        url, r = group.request("GET", "/auth")
+        self.assertEqual(url, "https://pi1/pi/auth")
+
+    @responses.activate
+    def test_05_no_hedging_of_validate_requests(self):
+        def slow_callback(request):
+            time.sleep(0.5)
+            return 200, {}, self.success_body
+
+        responses.add_callback(responses.POST, "https://pi1/pi/validate/check",
+                               callback=slow_callback,
+                               content_type="application/json")
+        responses.add(responses.POST, "https://pi2/pi/validate/check",
+                      body=self.success_body, content_type="application/json")
+        group = UpstreamGroup.from_urls("https://pi1/pi https://pi2/pi",
+                                        hedge_after=0.1)
+        # The OTP value is only sent to one upstream server
+        with mock.patch("privacyidea.lib.privacyideaserver.Thread") as mock_thread:
+            url, r = group.request("POST", "/validate/check",
+                                   data={"user": "user", "pass": "123456"})
+            # Without hedging the request is sent synchronously
+            mock_thread.assert_not_called()
+        self.assertEqual(url, "https://pi1/pi/validate/check")
+        self.assertEqual(len(responses.calls), 1)
+
+    def test_06_no_failover_after_sending_the_request(self):
+        first = ResettingServer()
+        second = ResettingServer()
+        try:
+            group = UpstreamGroup.from_urls(" ".join([first.url, second.url]))
+            # The connection is reset after the validate request was sent.
+            # The first upstream server may have processed the OTP value, so
+            # the request is not sent to the second upstream server.
+            self.assertRaises(ConnectionError, group.request, "POST",
+                              "/validate/check",
+                              data={"user": "user", "pass": "123456"})
+            self.assertEqual(first.requests, 1)
+            self.assertEqual(second.requests, 0)
+
+            # An idempotent request fails over
+            self.assertRaises(ConnectionError, group.request, "GET", "/auth")
+            self.assertEqual(first.requests, 2)
+            self.assertEqual(second.requests, 1)
+
+            # If the connection is refused, the validate request fails over
+            unused = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            unused.bind(("127.0.0.1", 0))
+            refused_url = "http://127.0.0.1:{0!s}/pi".format(
+                unused.getsockname()[1])
+            unused.close()
+            group = UpstreamGroup.from_urls(" ".join([refused_url, second.url]))
+            self.assertRaises(ConnectionError, group.request, "POST",
+                              "/validate/check",
+                              data={"user": "user", "pass": "123456"})
+            self.assertEqual(second.requests, 2)
+        finally:
+            first.close()
+            second.close()
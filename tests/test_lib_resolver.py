@@ -9,15 +9,23 @@ lib.resolvers.ldapresolver
 The lib.resolver.py only depends on the database model.
 """
 PWFILE = "tests/testdata/passwords"
-from .base import MyTestCase
+from .base import MyTestCase, benchmark
 from . import ldap3mock
 from ldap3.core.exceptions import LDAPOperationResult
 from ldap3.core.results import RESULT_SIZE_LIMIT_EXCEEDED
 import mock
 import responses
 import datetime
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
 import uuid
 import pytest
+from sqlalchemy import create_engine, event
+from six.moves.urllib.parse import urlparse, parse_qsl
 from privacyidea.lib.resolvers.LDAPIdResolver import IdResolver as LDAPResolver
 from privacyidea.lib.resolvers.SQLIdResolver import IdResolver as SQLResolver
 from privacyidea.lib.resolvers.SCIMIdResolver import IdResolver as SCIMResolver
@@ -34,6 +42,7 @@ from privacyidea.lib.realm import (set_realm, delete_realm)
 from privacyidea.models import ResolverConfig
 from privacyidea.lib.utils import to_bytes, to_unicode
 
+log = logging.getLogger(__name__)
 
 objectGUIDs = [
     '039b36ef-e7c0-42f3-9bf9-ca6a6c0d4d31',
@@ -523,6 +532,228 @@ class SQLResolverTestCase(MyTestCase):
         user_info = y.getUserInfo(user)
         self.assertEqual(user_info.get("id"), "cornelius")      
 
+    def test_09_exact_match_and_projection(self):
+        y = SQLResolver()
+        y.loadConfig(self.parameters)
+        # The login name is not used as a pattern anymore
+        self.assertEqual(y.getUserId("corneliu%"), "")
+        self.assertEqual(y.getUserId("cornelius"), 3)
+        # Only the mapped columns are read
+        statements = []
+        with mock.patch.object(y.session, "query", wraps=y.session.query) as mock_query:
+            y.getUserId("cornelius")
+            statements.append(str(mock_query.return_value))
+            self.assertEqual(mock_query.call_count, 1)
+            columns = [c.key for c in mock_query.call_args[0]]
+            self.assertEqual(columns, ["id"])
+            y.getUserInfo(3)
+            columns = set(c.key for c in mock_query.call_args[0])
+            self.assertEqual(columns, {"username", "id", "email", "name",
+                                       "givenname", "password", "phone",
+                                       "mobile"})
+
+        # A mapped column, which does not exist, is ignored
+        d = self.parameters.copy()
+        d["Map"] = '{ "username": "username", "userid" : "id", "title": "title"}'
+        y = SQLResolver()
+        y.loadConfig(d)
+        self.assertEqual(y.getUserInfo(3), {"id": 3, "userid": 3,
+                                            "username": "cornelius"})
+
+    def test_10_user_cache(self):
+        y = SQLResolver()
+        d = self.parameters.copy()
+        d["CACHE_TIMEOUT"] = 120
+        y.loadConfig(d)
+        from privacyidea.lib.resolvers.SQLIdResolver import CACHE
+        CACHE.clear()
+        self.assertEqual(y.getUserId("cornelius"), 3)
+        self.assertEqual(y.getUserInfo(3).get("username"), "cornelius")
+        # A second resolver object with the same configuration uses the cache
+        y2 = SQLResolver()
+        y2.loadConfig(d)
+        with mock.patch.object(y2.session, "query") as mock_query:
+            self.assertEqual(y2.getUserId("cornelius"), 3)
+            self.assertEqual(y2.getUsername(3), "cornelius")
+            self.assertEqual(y2.getUserInfo("3").get("email"), "cornelius@privacyidea.org")
+            mock_query.assert_not_called()
+        # The login name of a user, whose info was read, is also cached
+        y2.getUserInfo(4)
+        with mock.patch.object(y2.session, "query") as mock_query:
+            self.assertEqual(y2.getUserId(y2.getUsername(4)), 4)
+            mock_query.assert_not_called()
+        # Unknown users are not cached
+        self.assertEqual(y2.getUserId("unknown"), "")
+        self.assertNotIn("unknown", CACHE[y2._cache_key].user_ids)
+        # The cached user info can not be modified by the caller
+        y2.getUserInfo(3)["username"] = "hacked"
+        self.assertEqual(y2.getUsername(3), "cornelius")
+
+        # The entries expire
+        now = time.time()
+        with mock.patch("privacyidea.lib.resolvers.SQLIdResolver.time") as mock_time:
+            mock_time.time.return_value = now + 122
+            with mock.patch.object(y2.session, "query", wraps=y2.session.query) as mock_query:
+                self.assertEqual(y2.getUserId("cornelius"), 3)
+                mock_query.assert_called_once()
+
+        # Another table or mapping uses another cache
+        d2 = d.copy()
+        d2["Where"] = "id > 3"
+        y3 = SQLResolver()
+        y3.loadConfig(d2)
+        self.assertEqual(y3.getUserId("cornelius"), "")
+
+        # Modified and deleted users are removed from the cache
+        uid = y.add_user({"username": "achmed", "password": "passw0rd"})
+        self.assertEqual(y.getUserId("achmed"), uid)
+        self.assertEqual(y.getUsername(uid), "achmed")
+        y.update_user(uid, {"username": "achmed2", "password": "test"})
+        self.assertEqual(y.getUserId("achmed"), "")
+        self.assertEqual(y.getUsername(uid), "achmed2")
+        # The password is always checked against the database
+        self.assertTrue(y.checkPass(uid, "test"))
+        y.delete_user(uid)
+        self.assertEqual(y.getUserId("achmed2"), "")
+        self.assertEqual(y.getUserInfo(uid), {})
+
+        # The cache is disabled by default
+        CACHE.clear()
+        y = SQLResolver()
+        y.loadConfig(self.parameters)
+        self.assertEqual(y.getUserId("cornelius"), 3)
+        self.assertEqual(CACHE, {})
+
+    def test_11_get_user_infos(self):
+        y = SQLResolver()
+        y.loadConfig(self.parameters)
+        with mock.patch("privacyidea.lib.resolvers.SQLIdResolver.USERINFO_BATCH_SIZE", 2):
+            with mock.patch.object(y.session, "query", wraps=y.session.query) as mock_query:
+                infos = y.getUserInfos([3, "4", 5, 1000])
+                self.assertEqual(mock_query.call_count, 2)
+        self.assertEqual(set(infos.keys()), {3, "4", 5, 1000})
+        self.assertEqual(infos[3], y.getUserInfo(3))
+        self.assertEqual(infos["4"], y.getUserInfo(4))
+        self.assertEqual(infos[5].get("id"), 5)
+        self.assertEqual(infos[1000], {})
+
+        # The cached users are not read again
+        d = self.parameters.copy()
+        d["CACHE_TIMEOUT"] = 120
+        y.loadConfig(d)
+        y.getUserInfo(3)
+        with mock.patch.object(y.session, "query", wraps=y.session.query) as mock_query:
+            infos = y.getUserInfos([3, 4])
+            mock_query.assert_called_once()
+        self.assertEqual(infos[3].get("username"), "cornelius")
+        from privacyidea.lib.resolvers.SQLIdResolver import CACHE
+        CACHE.clear()
+
+        # The default implementation reads the users one by one
+        self.assertEqual(UserIdResolver().getUserInfos(["1", "2"]),
+                         {"1": {}, "2": {}})
+
+    def _create_user_table(self, tmpdir, num_users):
+        engine = create_engine("sqlite:///" + os.path.join(tmpdir, "bench.sqlite"))
+        engine.execute("CREATE TABLE users (id INTEGER PRIMARY KEY, "
+                       "username VARCHAR(40) UNIQUE, email VARCHAR(80), "
+                       "description TEXT)")
+        engine.execute("INSERT INTO users (id, username, email, description) "
+                       "VALUES (?, ?, ?, ?)",
+                       [(i, u"user{0:d}".format(i), u"user{0:d}@example.com".format(i),
+                         u"x" * 200) for i in range(1, num_users + 1)])
+        engine.dispose()
+        y = SQLResolver()
+        y.loadConfig({'Driver': 'sqlite',
+                      'Server': '/' + tmpdir,
+                      'Database': "bench.sqlite",
+                      'Table': 'users',
+                      'Map': '{"username": "username", "userid": "id", '
+                             '"email": "email"}'})
+        return y
+
+    def test_12_lookup_queries(self):
+        # The users are looked up by an exact match on an indexed column and
+        # read in batches
+        tmpdir = tempfile.mkdtemp()
+        try:
+            y = self._create_user_table(tmpdir, 1200)
+            # connect to the database
+            self.assertTrue(y.getUserId(u"user1"))
+            statements = []
+            parameters = []
+
+            def count_statement(conn, cursor, statement, params, context, executemany):
+                statements.append(statement)
+                parameters.append(params)
+
+            event.listen(y.engine, "before_cursor_execute", count_statement)
+            try:
+                self.assertEqual(u"{0!s}".format(y.getUserId(u"user42")), u"42")
+                self.assertEqual(len(statements), 1)
+                statement = statements[0]
+                self.assertIn("users.username = ", statement)
+                self.assertNotIn(" LIKE ", statement.upper())
+                # Only the user ID is read
+                self.assertNotIn("users.email", statement)
+                self.assertIn("LIMIT", statement.upper())
+                plan = [row[-1] for row in y.engine.execute(
+                    "EXPLAIN QUERY PLAN " + statement, *parameters[0])]
+                self.assertTrue([x for x in plan if "USING INDEX" in x], plan)
+
+                del statements[:]
+                uids = list(range(1, 1101))
+                infos = y.getUserInfos(uids)
+                self.assertEqual(len(infos), 1100)
+                self.assertEqual(infos[11]["username"], "user11")
+                # One query per USERINFO_BATCH_SIZE users
+                self.assertEqual(len(statements), 3)
+                self.assertTrue(all(" IN (" in x for x in statements))
+                # The columns, which are not mapped, are not read
+                self.assertFalse([x for x in statements if "description" in x])
+            finally:
+                event.remove(y.engine, "before_cursor_execute", count_statement)
+            y.session.close()
+        finally:
+            shutil.rmtree(tmpdir)
+
+    @benchmark
+    def test_13_lookup_benchmark(self):
+        # Look up users in a table with 100000 users. The queries are checked
+        # by test_12_lookup_queries.
+        num_users = 100000
+        tmpdir = tempfile.mkdtemp()
+        try:
+            y = self._create_user_table(tmpdir, num_users)
+            logins = [u"user{0:d}".format(i) for i in range(1, num_users, num_users // 50)]
+
+            start = time.time()
+            for login in logins:
+                self.assertTrue(y.getUserId(login))
+            exact_time = time.time() - start
+            start = time.time()
+            for login in logins:
+                y.session.query(y.TABLE).filter(y.TABLE.username.like(login)).all()
+            like_time = time.time() - start
+
+            start = time.time()
+            uids = list(range(1, num_users, 10))
+            infos = y.getUserInfos(uids)
+            batch_time = time.time() - start
+            self.assertEqual(len(infos), len(uids))
+            self.assertEqual(infos[11]["username"], "user11")
+            start = time.time()
+            for uid in uids[:1000]:
+                y.getUserInfo(uid)
+            single_time = (time.time() - start) * len(uids) / 1000
+            log.info(u"Look up {0:d} users: {1:.3f}s by exact match, {2:.3f}s with LIKE. "
+                     u"Read {3:d} users: {4:.3f}s in batches, about {5:.3f}s one "
+                     u"by one".format(len(logins), exact_time, like_time,
+                                      len(uids), batch_time, single_time))
+            y.session.close()
+        finally:
+            shutil.rmtree(tmpdir)
+
     def test_99_testconnection_fail(self):
         y = SQLResolver()
         self.parameters['Database'] = "does_not_exist"
@@ -734,6 +965,131 @@ class SCIMResolverTestCase(MyTestCase):
                           resource_server=self.RESOURCESERVER,
                           access_token="")
 
+    @responses.activate
+    def test_08_access_token_cache(self):
+        from privacyidea.lib.resolvers.SCIMIdResolver import ACCESS_TOKENS
+        ACCESS_TOKENS.clear()
+        tokens = []
+
+        def token_callback(request):
+            tokens.append("TOKEN{0:d}".format(len(tokens)))
+            return 200, {}, json.dumps({"access_token": tokens[-1],
+                                        "expires_in": 600})
+
+        def user_callback(request):
+            if request.headers["Authorization"] != "Bearer " + tokens[-1]:
+                return 401, {}, ""
+            return 200, {}, self.BODY_SINGLE_USER
+
+        responses.add_callback(responses.GET, self.TOKEN_URL,
+                               callback=token_callback)
+        responses.add_callback(responses.GET, self.USER_URL + "/bjensen",
+                               callback=user_callback)
+        config = {'Authserver': self.AUTHSERVER, 'Resourceserver':
+                  self.RESOURCESERVER, 'Client': self.CLIENT, 'Secret':
+                  self.SECRET, 'Mapping': "{}"}
+        # loading the config does not request an access token
+        y = SCIMResolver()
+        y.loadConfig(config)
+        self.assertEqual(tokens, [])
+        self.assertEqual(y.getUserInfo("bjensen").get("surname"), "Jensen")
+        # A second resolver object uses the cached access token
+        y2 = SCIMResolver()
+        y2.loadConfig(config)
+        self.assertEqual(y2.getUserInfo("bjensen").get("surname"), "Jensen")
+        self.assertEqual(tokens, ["TOKEN0"])
+
+        # Shortly before the access token expires, it is refreshed
+        now = time.time()
+        with mock.patch("privacyidea.lib.resolvers.SCIMIdResolver.time") as mock_time:
+            mock_time.time.return_value = now + 590
+            y2.getUserInfo("bjensen")
+            self.assertEqual(tokens, ["TOKEN0", "TOKEN1"])
+            # While the access token is refreshed, the old one is used
+            entry = list(ACCESS_TOKENS.values())[0]
+            entry.refreshing = True
+            mock_time.time.return_value = now + 1180
+            self.assertEqual(y2._get_access_token(), "TOKEN1")
+            # An expired access token is not used
+            mock_time.time.return_value = now + 1200
+            self.assertEqual(y2._get_access_token(), "TOKEN2")
+
+        # If the access token is rejected, a new one is requested
+        tokens.append("REVOKED")
+        self.assertEqual(y.getUserInfo("bjensen").get("surname"), "Jensen")
+        self.assertEqual(tokens[-2:], ["REVOKED", "TOKEN4"])
+        ACCESS_TOKENS.clear()
+
+    @responses.activate
+    def test_09_search_users(self):
+        # A local SCIM service with 250 users, which supports filters and pages
+        from privacyidea.lib.resolvers.SCIMIdResolver import ACCESS_TOKENS, _search_filter
+        ACCESS_TOKENS.clear()
+        users = [{"userName": "user{0:03d}".format(i),
+                  "name": {"givenName": "Given{0:d}".format(i % 10),
+                           "familyName": "Family"}} for i in range(250)]
+        requests_params = []
+
+        def users_callback(request):
+            params = dict(parse_qsl(urlparse(request.url).query))
+            requests_params.append(params)
+            resources = users
+            search_filter = params.get("filter")
+            if search_filter:
+                # we only support a single condition on userName
+                attribute, operator, value = search_filter.split(" ", 2)
+                value = value.strip('"')
+                self.assertEqual(attribute, "userName")
+                resources = [user for user in users if
+                             {"eq": user["userName"] == value,
+                              "sw": user["userName"].startswith(value),
+                              "ew": user["userName"].endswith(value),
+                              "co": value in user["userName"]}[operator]]
+            start = int(params.get("startIndex", 1))
+            count = int(params.get("count", len(resources)))
+            page = resources[start - 1:start - 1 + count]
+            return 200, {}, json.dumps({"totalResults": len(resources),
+                                        "startIndex": start,
+                                        "itemsPerPage": len(page),
+                                        "Resources": page})
+
+        responses.add(responses.GET, self.TOKEN_URL, status=200,
+                      content_type='application/json',
+                      body=self.BODY_ACCESSTOKEN)
+        responses.add_callback(responses.GET, self.USER_URL,
+                               callback=users_callback)
+        y = SCIMResolver()
+        y.loadConfig({'Authserver': self.AUTHSERVER, 'Resourceserver':
+                      self.RESOURCESERVER, 'Client': self.CLIENT, 'Secret':
+                      self.SECRET, 'Mapping': "{}"})
+
+        # The whole list is read in pages
+        user_list = y.getUserList()
+        self.assertEqual(len(user_list), 250)
+        self.assertEqual(user_list[-1]["username"], "user249")
+        self.assertEqual([p["startIndex"] for p in requests_params], ["1", "101", "201"])
+        self.assertEqual(requests_params[0]["count"], "100")
+
+        # The users are searched by the SCIM service
+        del requests_params[:]
+        self.assertEqual(y.getUserList({"username": "user042"})[0]["givenname"], "Given2")
+        self.assertEqual(requests_params[0]["filter"], 'userName eq "user042"')
+        self.assertEqual(len(y.getUserList({"username": "user1*"})), 100)
+        self.assertEqual(len(y.getUserList({"username": "*9"})), 25)
+        self.assertEqual(len(y.getUserList({"username": "*24*"})), 13)
+        self.assertEqual(requests_params[-1]["filter"], 'userName co "24"')
+        self.assertEqual(y.getUserList({"username": "nobody"}), [])
+
+        # The generator only reads the pages, which are needed
+        del requests_params[:]
+        self.assertEqual(next(y.iter_users())["username"], "user000")
+        self.assertEqual(len(requests_params), 1)
+
+        self.assertEqual(_search_filter({"surname": "Fam*", "givenname": '*a"b*',
+                                         "phone": "123", "email": "*"}),
+                         u'name.givenName co "a\\"b" and name.familyName sw "Fam"')
+        ACCESS_TOKENS.clear()
+
 
 class LDAPResolverTestCase(MyTestCase):
     """
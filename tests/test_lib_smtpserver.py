@@ -1,6 +1,9 @@
 """
 This test file tests the lib/smtpserver.py
 """
+import mock
+
+from privacyidea.lib.framework import get_app_local_store
 from privacyidea.lib.queue import get_job_queue
 
 from tests.queuemock import MockQueueTestCase
@@ -8,10 +11,12 @@ from .base import MyTestCase
 from privacyidea.lib.error import ResourceNotFoundError
 from privacyidea.lib.smtpserver import (get_smtpservers, add_smtpserver,
                                         delete_smtpserver, get_smtpserver,
-                                        SMTPServer)
+                                        SMTPServer, SMTPConnectionPool,
+                                        get_smtp_pool, send_emails_batch,
+                                        send_emails_identifier)
 from privacyidea.models import SMTPServer as SMTPServerDB
 from . import smtpmock
-from smtplib import SMTPException
+from smtplib import SMTPException, SMTPServerDisconnected
 
 
 class SMTPServerTestCase(MyTestCase):
@@ -180,3 +185,126 @@ class SMTPServerQueueTestCase(MockQueueTestCase):
 
         delete_smtpserver("myserver")
 
+
+
+class SMTPConnectionPoolTestCase(MyTestCase):
+
+    def setUp(self):
+        self.config = {"server": "mail.example.com", "port": 25,
+                       "sender": "pi@example.com", "tls": False,
+                       "username": "", "timeout": 5}
+        smtpmock.setdata(response={})
+
+    def tearDown(self):
+        get_app_local_store().pop("smtp_pools", None)
+
+    @smtpmock.activate
+    def test_01_no_pooling(self):
+        # By default every email opens a new connection
+        for i in range(3):
+            r = SMTPServer.test_email(self.config, "recp@example.com",
+                                      "Hallo", "Body {0!s}".format(i))
+            self.assertTrue(r)
+        self.assertEqual(len(smtpmock.calls), 3)
+        stats = get_smtp_pool(self.config).get_stats()
+        self.assertEqual(stats["handshakes"], 3)
+        self.assertEqual(stats["handshakes_saved"], 0)
+        self.assertEqual(stats["idle"], 0)
+
+    @smtpmock.activate
+    def test_02_pooled_connection(self):
+        self.app.config["PI_SMTP_POOL_SIZE"] = 2
+        try:
+            for i in range(5):
+                r = SMTPServer.test_email(self.config, "recp@example.com",
+                                          "Hallo", "Body {0!s}".format(i))
+                self.assertTrue(r)
+            self.assertEqual(len(smtpmock.calls), 5)
+            pool = get_smtp_pool(self.config)
+            stats = pool.get_stats()
+            self.assertEqual(stats["handshakes"], 1)
+            self.assertEqual(stats["handshakes_saved"], 4)
+            self.assertEqual(stats["idle"], 1)
+
+            # The idle connection dies. The NOOP health check detects this
+            # and a new connection is opened
+            dead_mail = pool._idle[0][0]
+            dead_mail.noop = mock.Mock(side_effect=SMTPServerDisconnected("closed"))
+            dead_mail.quit = mock.Mock()
+            r = SMTPServer.test_email(self.config, "recp@example.com",
+                                      "Hallo", "Body")
+            self.assertTrue(r)
+            self.assertEqual(len(smtpmock.calls), 6)
+            self.assertEqual(pool.get_stats()["handshakes"], 2)
+            dead_mail.quit.assert_called_once_with()
+
+            # Stale idle connections are not reused
+            pool.max_idle = -1
+            r = SMTPServer.test_email(self.config, "recp@example.com",
+                                      "Hallo", "Body")
+            self.assertTrue(r)
+            self.assertEqual(pool.get_stats()["handshakes"], 3)
+
+            pool.clear()
+            self.assertEqual(pool.get_stats()["idle"], 0)
+        finally:
+            self.app.config.pop("PI_SMTP_POOL_SIZE")
+
+    @smtpmock.activate
+    def test_03_reconnect_on_failure(self):
+        pool = SMTPConnectionPool(size=1)
+        mail, reused = pool.acquire(self.config)
+        self.assertFalse(reused)
+        pool.release(mail)
+        with pool.session(self.config) as session:
+            self.assertTrue(session.reused)
+            # The server closes the connection after the NOOP
+            old_mail = session.mail
+            old_mail.sendmail = mock.Mock(side_effect=SMTPServerDisconnected("closed"))
+            old_mail.quit = mock.Mock(side_effect=SMTPServerDisconnected("closed"))
+            old_mail.close = mock.Mock()
+            r = session.sendmail("pi@example.com", ["recp@example.com"],
+                                 "Subject: Hallo\n\nBody")
+            self.assertEqual(r, {})
+            self.assertIsNot(session.mail, old_mail)
+            # The old connection is closed before the new one is opened
+            old_mail.quit.assert_called_once_with()
+            old_mail.close.assert_called_once_with()
+        stats = pool.get_stats()
+        self.assertEqual(stats["reconnects"], 1)
+        self.assertEqual(stats["handshakes"], 2)
+        self.assertEqual(stats["idle"], 1)
+        self.assertEqual(len(smtpmock.calls), 1)
+        pool.clear()
+
+    @smtpmock.activate
+    def test_04_batch_send(self):
+        messages = [{"recipient": "user{0!s}@example.com".format(i),
+                     "subject": "Hallo",
+                     "body": "Body {0!s}".format(i)} for i in range(10)]
+        messages[3]["mimetype"] = "html"
+        messages[5]["sender"] = "other@example.com"
+        r = send_emails_batch(self.config, messages)
+        self.assertEqual(r, [True] * 10)
+        self.assertEqual(len(smtpmock.calls), 10)
+        self.assertEqual(get_smtp_pool(self.config).get_stats()["handshakes"], 1)
+        self.assertEqual(smtpmock.calls[5].request["sender"], "other@example.com")
+        self.assertEqual(smtpmock.calls[9].request["recipient"], ["user9@example.com"])
+
+        add_smtpserver(identifier="local", server="mail.example.com", port=25,
+                       sender="pi@example.com", enqueue_job=True)
+        r = send_emails_identifier("local", messages[:4])
+        self.assertEqual(r, [True] * 4)
+        self.assertEqual(len(smtpmock.calls), 14)
+        delete_smtpserver("local")
+
+    def test_05_pool_key(self):
+        # The connections of different users or passwords are not shared
+        config1 = dict(self.config, username="pi", password="secret1")
+        config2 = dict(self.config, username="pi", password="secret2")
+        self.assertIsNot(get_smtp_pool(config1), get_smtp_pool(config2))
+        self.assertIs(get_smtp_pool(config1), get_smtp_pool(dict(config1)))
+        # The password is not kept in the key
+        for key in get_app_local_store()["smtp_pools"]:
+            self.assertNotIn("secret1", key)
+            self.assertNotIn("secret2", key)
@@ -0,0 +1,33 @@
+"""
+This tests the files
+  lib/task/authcachejanitor.py
+"""
+import datetime
+
+from .base import MyTestCase
+from privacyidea.lib.authcache import _hash_password
+from privacyidea.lib.task.authcachejanitor import AuthCacheJanitorTask
+from privacyidea.models import AuthCache
+from flask import current_app
+
+
+class TaskAuthCacheJanitorTestCase(MyTestCase):
+
+    def test_01_delete_old_entries(self):
+        now = datetime.datetime.utcnow()
+        AuthCache("janitor1", "realm", "resolver", _hash_password("pw"),
+                  first_auth=now - datetime.timedelta(days=3),
+                  last_auth=now - datetime.timedelta(days=2)).save()
+        AuthCache("janitor2", "realm", "resolver", _hash_password("pw"),
+                  first_auth=now - datetime.timedelta(minutes=10),
+                  last_auth=now - datetime.timedelta(minutes=2)).save()
+
+        task = AuthCacheJanitorTask(current_app.config)
+        self.assertIn("minutes", task.options)
+        self.assertTrue(task.do({"minutes": "60"}))
+        self.assertEqual([entry.username for entry in AuthCache.query.all()],
+                         ["janitor2"])
+        self.assertTrue(task.do({}))
+        self.assertEqual(AuthCache.query.count(), 1)
+        self.assertTrue(task.do({"minutes": "1"}))
+        self.assertEqual(AuthCache.query.count(), 0)
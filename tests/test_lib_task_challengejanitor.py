@@ -0,0 +1,27 @@
+"""
+This tests the files
+  lib/task/challengejanitor.py
+"""
+
+from .base import MyTestCase
+from privacyidea.lib.challenge import get_challenges
+from privacyidea.lib.task.challengejanitor import ChallengeJanitorTask
+from privacyidea.models import Challenge
+from flask import current_app
+
+
+class TaskChallengeJanitorTestCase(MyTestCase):
+
+    def test_01_delete_expired_challenges(self):
+        for i in range(3):
+            Challenge("JAN1", transaction_id="exp{0!s}".format(i),
+                      validitytime=-10).save()
+        Challenge("JAN1", transaction_id="valid", validitytime=100).save()
+
+        task = ChallengeJanitorTask(current_app.config)
+        self.assertIn("chunksize", task.options)
+        self.assertTrue(task.do({"chunksize": "2"}))
+        challenges = get_challenges(serial="JAN1")
+        self.assertEqual(len(challenges), 1)
+        self.assertEqual(challenges[0].transaction_id, "valid")
+        self.assertTrue(task.do({}))
@@ -0,0 +1,38 @@
+"""
+This tests the files
+  lib/task/monitoringjanitor.py
+"""
+import datetime
+
+from dateutil.tz import tzutc
+
+from .base import MyTestCase
+from privacyidea.lib.monitoringstats import write_stats, get_values, delete_stats
+from privacyidea.lib.task.monitoringjanitor import MonitoringJanitorTask
+from flask import current_app
+
+
+class TaskMonitoringJanitorTestCase(MyTestCase):
+
+    def test_01_delete_old_values(self):
+        now = datetime.datetime.now(tzutc())
+        write_stats("janitor", 1, timestamp=now - datetime.timedelta(days=40))
+        write_stats("janitor", 2, timestamp=now - datetime.timedelta(days=10))
+        write_stats("janitor", 3, timestamp=now - datetime.timedelta(minutes=10))
+
+        task = MonitoringJanitorTask(current_app.config)
+        self.assertIn("raw_days", task.options)
+        self.assertIn("5min_days", task.options)
+        self.assertTrue(task.do({"raw_days": "0"}))
+        # The raw values are kept, the old 5 minute buckets are deleted
+        self.assertEqual(len(get_values("janitor")), 3)
+        self.assertEqual(len(get_values("janitor", resolution="5min")), 2)
+        self.assertEqual(len(get_values("janitor", resolution="day")), 3)
+
+        self.assertTrue(task.do({}))
+        self.assertEqual([v for _t, v in get_values("janitor")], [3])
+        self.assertEqual(len(get_values("janitor", resolution="day")), 3)
+
+        self.assertTrue(task.do({"day_days": "20"}))
+        self.assertEqual(len(get_values("janitor", resolution="day")), 2)
+        delete_stats("janitor")
@@ -0,0 +1,32 @@
+"""
+This tests the files
+  lib/task/tokenimportjanitor.py
+"""
+import datetime
+
+from .base import MyTestCase
+from privacyidea.lib.task.tokenimportjanitor import TokenImportJanitorTask
+from privacyidea.models import TokenImportChunk, db
+from flask import current_app
+
+
+class TaskTokenImportJanitorTestCase(MyTestCase):
+
+    def test_01_delete_old_token_files(self):
+        now = datetime.datetime.utcnow()
+        for import_id, days in [("janitor1", 3), ("janitor2", 0)]:
+            for position in [-1, 0]:
+                chunk = TokenImportChunk(import_id, position, u"data")
+                chunk.created = now - datetime.timedelta(days=days, minutes=10)
+                db.session.add(chunk)
+        db.session.commit()
+
+        task = TokenImportJanitorTask(current_app.config)
+        self.assertIn("minutes", task.options)
+        self.assertTrue(task.do({}))
+        self.assertEqual(set(chunk.import_id for chunk in TokenImportChunk.query.all()),
+                         {"janitor2"})
+        self.assertTrue(task.do({"minutes": "60"}))
+        self.assertEqual(TokenImportChunk.query.count(), 2)
+        self.assertTrue(task.do({"minutes": "5"}))
+        self.assertEqual(TokenImportChunk.query.count(), 0)
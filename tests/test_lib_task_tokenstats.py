@@ -0,0 +1,21 @@
+"""
+This tests the files
+  lib/task/tokenstats.py
+"""
+from .base import MyTestCase
+from privacyidea.lib.task.tokenstats import TokenStatsTask
+from privacyidea.lib.tokenstats import get_token_stats
+from privacyidea.models import Token
+from flask import current_app
+
+
+class TaskTokenStatsTestCase(MyTestCase):
+
+    def test_01_reconcile(self):
+        Token("TASKSTATS1", tokentype="hotp").save()
+        self.assertEqual(get_token_stats(), 0)
+        task = TokenStatsTask(current_app.config)
+        self.assertEqual(task.options, {})
+        self.assertTrue(task.do({}))
+        self.assertEqual(get_token_stats(), 1)
+        self.assertEqual(get_token_stats(assigned=False, active=True), 1)
@@ -13,11 +13,11 @@ getTokens4UserOrSerial
 gettokensoftype
 getToken....
 """
-from .base import MyTestCase, FakeAudit
-from privacyidea.lib.user import (User)
+from .base import MyTestCase, FakeAudit, benchmark
+from privacyidea.lib.user import (User, get_username)
 from privacyidea.lib.tokenclass import TokenClass, TOKENKIND
 from privacyidea.lib.tokens.totptoken import TotpTokenClass
-from privacyidea.models import (Token, Challenge, TokenRealm)
+from privacyidea.models import (Token, Challenge, TokenRealm, Realm, db)
 from privacyidea.lib.config import (set_privacyidea_config, get_token_types)
 from privacyidea.lib.policy import set_policy, SCOPE, ACTION, delete_policy
 from privacyidea.lib.utils import b32encode_and_unicode
@@ -25,6 +25,10 @@ import datetime
 import hashlib
 import base64
 import binascii
+import logging
+import mock
+import time
+from sqlalchemy import func, event
 from privacyidea.lib.token import (create_tokenclass_object,
                                    get_tokens,
                                    get_token_type, check_serial,
@@ -53,7 +57,11 @@ from privacyidea.lib.token import (create_tokenclass_object,
                                    set_validity_period_end,
                                    set_validity_period_start, remove_token, delete_tokeninfo,
                                    import_token, get_one_token, get_tokens_from_serial_or_user,
-                                   get_tokens_paginated_generator)
+                                   get_tokens_paginated_generator,
+                                   get_token_dicts_generator,
+                                   get_user_token_summary,
+                                   get_realm_token_summary,
+                                   _create_token_query)
 
 from privacyidea.lib.error import (TokenAdminError, ParameterError,
                                    privacyIDEAError, ResourceNotFoundError)
@@ -64,6 +72,8 @@ PWFILE = "tests/testdata/passwords"
 OTPKEY = "3132333435363738393031323334353637383930"
 OTPKE2 = "31323334353637383930313233343536373839AA"
 
+log = logging.getLogger(__name__)
+
 
 class TokenTestCase(MyTestCase):
     """
@@ -1458,6 +1468,139 @@ class TokenTestCase(MyTestCase):
         # Check that we did not miss any tokens
         self.assertEquals(set(t.token.serial for t in list1 + list2), all_serials)
 
+    def test_57_get_token_dicts_generator(self):
+        user = User("cornelius", self.realm1)
+        for i in range(5):
+            init_token({"serial": "DICT{0!s}".format(i), "type": "hotp",
+                        "otpkey": OTPKEY}, user=user if i < 4 else None)
+        page = get_tokens_paginate(serial="DICT*", sortby="id", psize=10)
+        with mock.patch("privacyidea.lib.token.get_username",
+                        wraps=get_username) as mock_get_username:
+            token_dicts = list(get_token_dicts_generator(serial_wildcard="DICT*",
+                                                         psize=2))
+            # The owner is only looked up once per chunk of tokens
+            self.assertEqual(mock_get_username.call_count, 2)
+        self.assertEqual(token_dicts, page["tokens"])
+        self.assertEqual(token_dicts[0]["username"], "cornelius")
+        self.assertEqual(token_dicts[0]["user_realm"], self.realm1)
+        self.assertEqual(token_dicts[4]["username"], "")
+        self.assertEqual(len(list(get_token_dicts_generator(serial_wildcard="DICT*",
+                                                             assigned=False))), 1)
+        for i in range(5):
+            remove_token("DICT{0!s}".format(i))
+
+    def test_58_token_query_plan(self):
+        # The filters by type, realm, description and owner use the indexes
+        # instead of scanning the token table
+        if db.engine.dialect.name != "sqlite":
+            self.skipTest("The query plan is only checked on SQLite")
+
+        def query_plan(**kwargs):
+            statement = _create_token_query(**kwargs).with_entities(Token.id).statement
+            sql = str(statement.compile(dialect=db.engine.dialect,
+                                        compile_kwargs={"literal_binds": True}))
+            return [row[-1] for row in db.engine.execute("EXPLAIN QUERY PLAN " + sql)]
+
+        for kwargs, index in [({"tokentype": "HOTP"}, "ix_token_tokentype"),
+                              ({"realm": self.realm1}, "ix_tokenrealm_realm_id_token_id"),
+                              ({"description": "Foo"}, "ix_token_description_lower"),
+                              ({"resolver": self.resolvername1}, "ix_tokenowner_resolver_user_id"),
+                              ({"userid": "1000"}, "ix_tokenowner_user_id")]:
+            plan = query_plan(**kwargs)
+            self.assertTrue([x for x in plan if index in x], (kwargs, plan))
+            self.assertFalse([x for x in plan if x.startswith("SCAN token")],
+                             (kwargs, plan))
+
+    @benchmark
+    def test_59_token_filter_benchmark(self):
+        # Filter 50000 tokens by type and realm. The indexes are checked by
+        # test_58_token_query_plan.
+        realm_id = Realm.query.filter_by(name=self.realm1).first().id
+        first_id = (db.session.query(func.max(Token.id)).scalar() or 0) + 1
+        db.session.execute(Token.__table__.insert(),
+                           [{"id": first_id + i, "serial": u"BENCH{0:d}".format(i),
+                             "tokentype": u"type{0:d}".format(i % 20),
+                             "description": u"Bench {0:d}".format(i % 100),
+                             "active": True} for i in range(50000)])
+        db.session.execute(TokenRealm.__table__.insert(),
+                           [{"token_id": first_id + i, "realm_id": realm_id}
+                            for i in range(0, 50000, 100)])
+        db.session.commit()
+
+        start = time.time()
+        for i in range(20):
+            self.assertEqual(_create_token_query(tokentype="TYPE7").count(), 2500)
+        type_time = time.time() - start
+        start = time.time()
+        for i in range(20):
+            self.assertEqual(Token.query.filter(func.lower(Token.tokentype) ==
+                                                "type7").count(), 2500)
+        type_scan_time = time.time() - start
+        self.assertEqual(_create_token_query(tokentype="type7",
+                                             realm=self.realm1).count(), 0)
+        self.assertEqual(_create_token_query(realm=self.realm1.upper(),
+                                             serial_wildcard="BENCH*").count(), 500)
+        self.assertEqual(_create_token_query(description="BENCH 42").count(), 500)
+        log.info(u"Filter 50000 tokens by type: {0:.3f}s with the index, "
+                 u"{1:.3f}s with a scan".format(type_time, type_scan_time))
+
+        db.session.execute(TokenRealm.__table__.delete().where(
+            TokenRealm.token_id >= first_id))
+        db.session.execute(Token.__table__.delete().where(Token.id >= first_id))
+        db.session.commit()
+
+    def test_60_token_summary(self):
+        self.setUp_user_realm2()
+        user = User("cornelius", self.realm1)
+        init_token({"serial": "SUMMARY1", "type": "hotp", "otpkey": self.otpkey},
+                   user=user)
+        init_token({"serial": "SUMMARY2", "type": "totp", "otpkey": self.otpkey},
+                   user=user)
+        enable_token("SUMMARY2", False)
+        set_realms("SUMMARY1", [self.realm1, self.realm2])
+
+        summary = get_user_token_summary(user)
+        self.assertEqual(summary.count(), get_tokens(user=user, count=True))
+        self.assertEqual(summary.count(tokentype="TOTP", active=False),
+                         get_tokens(user=user, tokentype="totp", active=False,
+                                    count=True))
+        self.assertEqual(summary.count(revoked=True),
+                         get_tokens(user=user, revoked=True, count=True))
+        self.assertEqual(summary.count(realm=self.realm2), 1)
+        realm_summary = get_realm_token_summary(self.realm1)
+        self.assertEqual(realm_summary.count(), get_tokens(realm=self.realm1, count=True))
+        self.assertEqual(get_num_tokens_in_realm(self.realm1),
+                         get_tokens(realm=self.realm1, active=True, count=True))
+        self.assertEqual(get_num_tokens_in_realm(self.realm1, active=False),
+                         get_tokens(realm=self.realm1, active=False, count=True))
+
+        # The summaries are reused without a query
+        queries = []
+
+        def count_query(*args):
+            queries.append(args)
+
+        same_user = User("cornelius", self.realm1)
+        event.listen(db.engine, "before_cursor_execute", count_query)
+        try:
+            self.assertIs(get_user_token_summary(same_user), summary)
+            self.assertIs(get_realm_token_summary(self.realm1.upper()), realm_summary)
+        finally:
+            event.remove(db.engine, "before_cursor_execute", count_query)
+        self.assertEqual(queries, [])
+
+        # If a token is changed, the summaries are read again
+        inactive = summary.count(active=False)
+        enable_token("SUMMARY2")
+        self.assertEqual(get_user_token_summary(user).count(active=False),
+                         inactive - 1)
+        remove_token("SUMMARY1")
+        remove_token("SUMMARY2")
+        self.assertEqual(get_user_token_summary(user).count(),
+                         get_tokens(user=user, count=True))
+        self.assertEqual(get_realm_token_summary(self.realm2).count(), 0)
+        self.assertRaises(ParameterError, get_user_token_summary, User())
+
 
 class TokenFailCounterTestCase(MyTestCase):
     """
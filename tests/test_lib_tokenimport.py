@@ -0,0 +1,217 @@
+# coding: utf-8
+"""
+This file contains the tests for the streaming token import.
+
+In particular, this tests
+lib/tokenimport.py
+"""
+import datetime
+import json
+from io import BytesIO
+
+import mock
+
+from sqlalchemy import event
+
+from privacyidea.lib.error import ParameterError, TokenAdminError
+from privacyidea.lib.importotp import (parseOATHcsv, parseYubicoCSV,
+                                       parseSafeNetXML, parsePSKCdata)
+from privacyidea.lib.monitoringstats import get_values, delete_stats
+from privacyidea.lib.queue import get_job_queue
+from privacyidea.lib.token import get_tokens, remove_token
+from privacyidea.lib.tokenimport import (iter_token_file, import_tokens,
+                                         store_token_file, StoredTokenFile,
+                                         import_stored_token_file,
+                                         delete_old_token_files,
+                                         IMPORT_TOKENS_JOB_NAME)
+from privacyidea.lib.utils import to_bytes
+from privacyidea.models import db, TokenImportChunk
+from .base import MyTestCase
+from .queuemock import MockQueueTestCase
+from .test_lib_importotp import (OATHCSV, YUBIKEYCSV, ALADDINXML, XML_PSKC,
+                                 XML_PSKC_AES, XML_PSKC_PASSWORD_PREFIX)
+
+
+def _stream(data):
+    return BytesIO(to_bytes(data))
+
+
+class TokenImportTestCase(MyTestCase):
+
+    def tearDown(self):
+        for tok in get_tokens(serial_wildcard="import*"):
+            remove_token(tok.token.serial)
+
+    def test_01_iter_token_file(self):
+        # The streaming parsers return the same tokens as the old parsers
+        self.assertEqual(dict(iter_token_file(_stream(OATHCSV), "oathcsv")),
+                         parseOATHcsv(OATHCSV))
+        self.assertEqual(dict(iter_token_file(_stream(YUBIKEYCSV), "Yubikey CSV")),
+                         parseYubicoCSV(YUBIKEYCSV))
+        self.assertEqual(dict(iter_token_file(_stream(ALADDINXML), "aladdin-xml")),
+                         parseSafeNetXML(ALADDINXML))
+        self.assertEqual(dict(iter_token_file(_stream(XML_PSKC), "pskc")),
+                         parsePSKCdata(XML_PSKC))
+        psk = "12345678901234567890123456789012"
+        self.assertEqual(dict(iter_token_file(_stream(XML_PSKC_AES), "pskc", psk=psk)),
+                         parsePSKCdata(XML_PSKC_AES, preshared_key_hex=psk))
+        self.assertEqual(dict(iter_token_file(_stream(XML_PSKC_PASSWORD_PREFIX), "pskc",
+                                              password="qwerty")),
+                         parsePSKCdata(XML_PSKC_PASSWORD_PREFIX, password="qwerty"))
+
+    def test_02_iter_token_file_errors(self):
+        self.assertRaises(TokenAdminError, iter_token_file,
+                          _stream(OATHCSV), "unknown")
+        self.assertRaises(TokenAdminError, iter_token_file,
+                          _stream(XML_PSKC_AES), "pskc", psk="1234")
+        self.assertRaises(ParameterError, iter_token_file,
+                          _stream(""), "oathcsv")
+
+    def test_03_import_tokens_in_batches(self):
+        tokens = [(u"import{0:d}".format(i), {"type": "hotp",
+                                               "otpkey": "3132333435",
+                                               "otplen": 6})
+                  for i in range(5)]
+        commits = []
+
+        def count_commit(session):
+            commits.append(session)
+
+        progress = []
+        event.listen(db.session(), "after_commit", count_commit)
+        try:
+            serials = import_tokens(iter(tokens), batch_size=2,
+                                    progress=progress.append)
+        finally:
+            event.remove(db.session(), "after_commit", count_commit)
+        self.assertEqual(serials, [serial for serial, _token in tokens])
+        self.assertEqual(progress, [2, 4, 5])
+        # Each batch is committed once
+        self.assertEqual(len(commits), 3)
+        self.assertEqual(len(get_tokens(serial_wildcard="import*")), 5)
+
+        # The tokens are only counted once, if they are imported again
+        serials = import_tokens(iter(tokens + tokens[:2]))
+        self.assertEqual(len(serials), 5)
+
+    def test_04_import_stored_token_file(self):
+        import_id = store_token_file(_stream(u"import1, 1212\nimport2, 1212, totp, 6\n"
+                                             u"import3, 1212\n"))
+        # The file and the secrets are stored encrypted
+        chunks = TokenImportChunk.query.filter_by(import_id=import_id).all()
+        self.assertEqual(len(chunks), 2)
+        for chunk in chunks:
+            self.assertNotIn("import1", chunk.data)
+        serials = import_stored_token_file(import_id, "oathcsv",
+                                           stats_key="token_import_test")
+        self.assertEqual(serials, ["import1", "import2", "import3"])
+        self.assertEqual(get_values("token_import_test")[-1][1], 3)
+        delete_stats("token_import_test")
+        # The stored file is deleted
+        self.assertEqual(TokenImportChunk.query.filter_by(import_id=import_id).count(), 0)
+        self.assertRaises(ParameterError, import_stored_token_file,
+                          import_id, "oathcsv")
+
+        # A PSKC file with a pre shared key, which is stored in several parts
+        psk = "12345678901234567890123456789012"
+        with mock.patch("privacyidea.lib.tokenimport.STORED_CHUNK_SIZE", 500):
+            import_id = store_token_file(_stream(XML_PSKC_AES), psk=psk)
+        chunks = TokenImportChunk.query.filter_by(import_id=import_id).all()
+        self.assertEqual(len(chunks), 6)
+        for chunk in chunks:
+            self.assertNotIn(psk, chunk.data)
+        stored = StoredTokenFile(import_id)
+        self.assertEqual(stored.read(), to_bytes(XML_PSKC_AES))
+        stored.seek(0)
+        self.assertEqual(stored.read(10), to_bytes(XML_PSKC_AES)[:10])
+        self.assertEqual(stored.tell(), 10)
+        serials = import_stored_token_file(import_id, "pskc")
+        self.assertEqual(sorted(serials),
+                         sorted(parsePSKCdata(XML_PSKC_AES, preshared_key_hex=psk)))
+        self.assertEqual(TokenImportChunk.query.filter_by(import_id=import_id).count(), 0)
+        for serial in serials:
+            remove_token(serial)
+
+    def test_05_delete_old_token_files(self):
+        old_id = store_token_file(_stream(u"import1, 1212\n"))
+        new_id = store_token_file(_stream(u"import2, 1212\n"))
+        # The secrets of the old file were stored two days ago
+        secrets = TokenImportChunk.query.filter_by(import_id=old_id,
+                                                   position=-1).first()
+        secrets.created = datetime.datetime.utcnow() - datetime.timedelta(days=2)
+        db.session.commit()
+        self.assertEqual(delete_old_token_files(60), 1)
+        # All parts of the old file are deleted
+        self.assertEqual(TokenImportChunk.query.filter_by(import_id=old_id).count(), 0)
+        self.assertEqual(TokenImportChunk.query.filter_by(import_id=new_id).count(), 2)
+        self.assertEqual(delete_old_token_files(60), 0)
+        self.assertEqual(delete_old_token_files(0), 1)
+        self.assertEqual(TokenImportChunk.query.count(), 0)
+
+        # The parts, which were already stored, are deleted, if storing fails
+        token_file = mock.Mock()
+        token_file.read.side_effect = [b"import1, 1212\n", IOError("broken")]
+        with mock.patch("privacyidea.lib.tokenimport.STORED_CHUNK_SIZE", 1):
+            self.assertRaises(IOError, store_token_file, token_file)
+        self.assertEqual(TokenImportChunk.query.count(), 0)
+
+
+class TokenImportQueueTestCase(MockQueueTestCase):
+
+    def test_01_background_import(self):
+        with self.app.test_request_context('/auth', data={"username": "testadmin",
+                                                          "password": "testpw"},
+                                           method='POST'):
+            res = self.app.full_dispatch_request()
+            self.assertEqual(res.status_code, 200, res)
+            auth_token = res.json["result"]["value"]["token"]
+
+        with self.app.test_request_context('/token/load/import.oath',
+                                           method="POST",
+                                           data={"type": "oathcsv",
+                                                 "background": "1",
+                                                 "file": (BytesIO(b"import1, 1212\n"
+                                                                  b"import2, 1212\n"),
+                                                          "import.oath")},
+                                           headers={'Authorization': auth_token}):
+            res = self.app.full_dispatch_request()
+            self.assertEqual(res.status_code, 200, res)
+            stats_key = json.loads(res.data.decode('utf8'))["result"]["value"]["stats_key"]
+
+        queue = get_job_queue()
+        self.assertEqual(len(queue.enqueued_jobs), 1)
+        job_name, args, kwargs = queue.enqueued_jobs[0]
+        self.assertEqual(job_name, IMPORT_TOKENS_JOB_NAME)
+        self.assertEqual(kwargs["stats_key"], stats_key)
+        # No secrets are passed to the job queue
+        self.assertNotIn("psk", kwargs)
+        self.assertNotIn("password", kwargs)
+        # The fake queue runs the job immediately and the stored file is deleted
+        self.assertEqual(TokenImportChunk.query.filter_by(import_id=args[0]).count(), 0)
+        self.assertEqual(get_values(stats_key)[-1][1], 2)
+        self.assertEqual(len(get_tokens(serial_wildcard="import*")), 2)
+        delete_stats(stats_key)
+        for serial in ["import1", "import2"]:
+            remove_token(serial)
+
+    def test_02_enqueue_fails(self):
+        with self.app.test_request_context('/auth', data={"username": "testadmin",
+                                                          "password": "testpw"},
+                                           method='POST'):
+            res = self.app.full_dispatch_request()
+            self.assertEqual(res.status_code, 200, res)
+            auth_token = res.json["result"]["value"]["token"]
+
+        with mock.patch("privacyidea.api.token.wrap_job") as mock_wrap_job:
+            mock_wrap_job.return_value.side_effect = RuntimeError("queue is down")
+            with self.app.test_request_context('/token/load/import.oath',
+                                               method="POST",
+                                               data={"type": "oathcsv",
+                                                     "background": "1",
+                                                     "file": (BytesIO(b"import1, 1212\n"),
+                                                              "import.oath")},
+                                               headers={'Authorization': auth_token}):
+                self.assertRaises(RuntimeError, self.app.full_dispatch_request)
+        # The stored file and its secrets are deleted
+        self.assertEqual(TokenImportChunk.query.count(), 0)
+        self.assertEqual(len(get_tokens(serial_wildcard="import*")), 0)
@@ -0,0 +1,219 @@
+"""
+This file contains the tests for the token janitor.
+
+In particular, this tests
+lib/tokenjanitor.py
+"""
+import os
+import shutil
+import tempfile
+from datetime import datetime, timedelta
+
+from dateutil.tz import tzlocal
+from mock import mock
+from sqlalchemy import event
+
+from privacyidea.lib import tokenjanitor
+from privacyidea.lib.error import ParameterError
+from privacyidea.lib.policy import ACTION
+from privacyidea.lib.token import init_token, get_tokens, remove_token
+from privacyidea.lib.tokenclass import AUTH_DATE_FORMAT
+from privacyidea.lib.tokenjanitor import (TokenFilter, Checkpoint, get_token_id_chunks,
+                                          find_tokens_in_chunk, process_tokens,
+                                          apply_token_action)
+from privacyidea.models import db
+from .base import MyTestCase
+
+
+def _get_serials(token_objects):
+    return [token_obj.token.serial for token_obj in token_objects]
+
+
+class TokenJanitorTestCase(MyTestCase):
+    otpkey = "3132333435363738393031323334353637383930"
+
+    def setUp(self):
+        now = datetime.now(tzlocal())
+        for i in range(10):
+            token = init_token({"serial": u"janitor{0:d}".format(i), "type": "hotp",
+                                "otpkey": self.otpkey})
+            token.add_tokeninfo("weight", str(i))
+            if i % 2:
+                # the odd tokens were used a year ago
+                token.add_tokeninfo(ACTION.LASTAUTH,
+                                    (now - timedelta(days=365)).strftime(AUTH_DATE_FORMAT))
+            else:
+                token.add_tokeninfo(ACTION.LASTAUTH, now.strftime(AUTH_DATE_FORMAT))
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        for token in get_tokens(serial_wildcard="janitor*"):
+            remove_token(token.token.serial)
+        shutil.rmtree(self.tempdir)
+
+    def test_01_token_filter(self):
+        everything = TokenFilter()
+        chunk = get_token_id_chunks(everything, 100)[0]
+        self.assertEqual(find_tokens_in_chunk(everything, chunk)[0], 10)
+
+        # The last authentication is checked by the database
+        old = TokenFilter(last_auth="30d")
+        processed, token_objects = find_tokens_in_chunk(old, chunk)
+        self.assertEqual(processed, 5)
+        self.assertEqual(_get_serials(token_objects),
+                         ["janitor1", "janitor3", "janitor5", "janitor7", "janitor9"])
+        # The exact comparison is done in Python
+        processed, token_objects = find_tokens_in_chunk(TokenFilter(last_auth="364d"), chunk)
+        self.assertEqual((processed, len(token_objects)), (5, 5))
+        processed, token_objects = find_tokens_in_chunk(TokenFilter(last_auth="366d"), chunk)
+        self.assertEqual((processed, len(token_objects)), (5, 0))
+
+        # The tokeninfo of all tokens is read with one query
+        statements = []
+
+        def count_statement(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        heavy = TokenFilter(serial="^janitor", description="",
+                            tokeninfo_key="weight",
+                            tokeninfo_filter=[lambda value: int(value) > 5])
+        event.listen(db.engine, "before_cursor_execute", count_statement)
+        try:
+            processed, token_objects = find_tokens_in_chunk(heavy, chunk)
+        finally:
+            event.remove(db.engine, "before_cursor_execute", count_statement)
+        self.assertEqual(_get_serials(token_objects),
+                         ["janitor6", "janitor7", "janitor8", "janitor9"])
+        self.assertEqual(len(statements), 2)
+
+        # Tokens without the tokeninfo key do not match
+        self.assertEqual(find_tokens_in_chunk(
+            TokenFilter(tokeninfo_key="unknown",
+                        tokeninfo_filter=[lambda value: True]), chunk)[0], 0)
+
+    def test_02_checkpoint(self):
+        token_filter = TokenFilter(tokentype="hotp")
+        chunks = get_token_id_chunks(token_filter, 3)
+        # The chunks start at multiples of the chunk size
+        self.assertTrue(all(first_id % 3 == 0 for first_id, _last_id in chunks))
+        self.assertEqual(len(chunks), 4)
+        self.assertTrue(all(last_id - first_id == 2 for first_id, last_id in chunks))
+        self.assertEqual(get_token_id_chunks(TokenFilter(tokentype="totp"), 3), [])
+
+        filename = os.path.join(self.tempdir, "janitor.checkpoint")
+        found = []
+        # The run is interrupted, before the result of the third chunk is
+        # handled. Only the chunks, whose results were handled, are recorded.
+        for i, chunk in enumerate(process_tokens(token_filter, _get_serials, 3,
+                                                 checkpoint=Checkpoint(filename, 3))):
+            if i == 2:
+                break
+            found.extend(chunk.result)
+        self.assertTrue(4 <= len(found) <= 6)
+        self.assertEqual(found, ["janitor{0:d}".format(i) for i in range(len(found))])
+
+        # The run is resumed
+        checkpoint = Checkpoint(filename, 3)
+        self.assertEqual(len(checkpoint.done), 2)
+        for chunk in process_tokens(token_filter, _get_serials, 3, checkpoint=checkpoint):
+            found.extend(chunk.result)
+        self.assertEqual(found, ["janitor{0:d}".format(i) for i in range(10)])
+        self.assertEqual(list(process_tokens(token_filter, _get_serials, 3,
+                                             checkpoint=Checkpoint(filename, 3))), [])
+
+        # The chunk size and the run need to match
+        self.assertRaises(ParameterError, Checkpoint, filename, 4)
+        self.assertRaises(ParameterError, Checkpoint, filename, 3, {"action": "delete"})
+
+    def test_05_resume_delete(self):
+        token_filter = TokenFilter(last_auth="30d")
+        chunks = get_token_id_chunks(token_filter, 3)
+        run = {"last_auth": "30d", "action": "delete"}
+        filename = os.path.join(self.tempdir, "janitor.checkpoint")
+
+        def delete(tlist):
+            return apply_token_action(tlist, "delete")
+
+        # The run is interrupted, while the result of the second chunk is
+        # handled. The second chunk is processed, but not recorded.
+        for i, chunk in enumerate(process_tokens(token_filter, delete, 3,
+                                                 checkpoint=Checkpoint(filename, 3, run))):
+            if i == 1:
+                break
+        self.assertEqual(chunk.first_id, chunks[1][0])
+        self.assertNotEqual(get_token_id_chunks(token_filter, 3), chunks)
+
+        # The resumed run processes the remaining chunks with the same
+        # boundaries, although the first tokens were deleted
+        checkpoint = Checkpoint(filename, 3, run)
+        self.assertEqual(checkpoint.done, set([chunks[0][0]]))
+        resumed = list(process_tokens(token_filter, delete, 3, checkpoint=checkpoint))
+        self.assertEqual([(chunk.first_id, chunk.last_id) for chunk in resumed],
+                         chunks[1:])
+        self.assertEqual(_get_serials(get_tokens(serial_wildcard="janitor*")),
+                         ["janitor0", "janitor2", "janitor4", "janitor6", "janitor8"])
+        self.assertEqual(list(process_tokens(token_filter, delete, 3,
+                                             checkpoint=Checkpoint(filename, 3, run))), [])
+
+    def test_03_workers(self):
+        token_filter = TokenFilter(last_auth="30d")
+        chunks = list(process_tokens(token_filter, _get_serials, 2, workers=3))
+        self.assertEqual(len(chunks), 5)
+        self.assertEqual(sum(chunk.processed for chunk in chunks), 5)
+        self.assertEqual(sorted(serial for chunk in chunks for serial in chunk.result),
+                         ["janitor1", "janitor3", "janitor5", "janitor7", "janitor9"])
+
+        # The workers apply the action
+        chunks = list(process_tokens(token_filter,
+                                     lambda tlist: apply_token_action(tlist, "disable"),
+                                     2, workers=3))
+        self.assertEqual(sum(len(chunk.result) for chunk in chunks), 5)
+        self.assertEqual(_get_serials(get_tokens(active=False)),
+                         ["janitor1", "janitor3", "janitor5", "janitor7", "janitor9"])
+
+        # The chunks are recorded, after their results were handled
+        checkpoint = Checkpoint(os.path.join(self.tempdir, "workers.checkpoint"), 2)
+        results = process_tokens(token_filter, _get_serials, 2, workers=3,
+                                 checkpoint=checkpoint)
+        first = next(results)
+        self.assertEqual(checkpoint.done, set())
+        next(results)
+        self.assertEqual(checkpoint.done, set([first.first_id]))
+        results.close()
+        self.assertEqual(checkpoint.done, set([first.first_id]))
+
+        # A failing chunk stops the run
+        def fail(tlist):
+            raise ValueError("failed")
+        with self.assertRaises(ValueError):
+            list(process_tokens(token_filter, fail, 2, workers=3))
+
+    def test_04_apply_token_action(self):
+        token_objects = find_tokens_in_chunk(TokenFilter(serial="janitor[0-2]$"),
+                                             (1, 1000))[1]
+        self.assertRaises(ParameterError, apply_token_action, token_objects, "export")
+
+        messages = apply_token_action(token_objects, "mark", set_description="old",
+                                      set_tokeninfo_key="janitor",
+                                      set_tokeninfo_value="marked")
+        self.assertEqual(len(messages), 6)
+        self.assertEqual([token.token.description for token in get_tokens(serial_wildcard="janitor*")],
+                         ["old"] * 3 + [""] * 7)
+        self.assertEqual(len(get_tokens(tokeninfo={"janitor": "marked"})), 3)
+
+        # If the action fails for one token, the other tokens are processed
+        original_remove_token = tokenjanitor.remove_token
+
+        def remove_token_but_one(serial):
+            if serial == "janitor1":
+                raise ValueError("Token is in use")
+            return original_remove_token(serial=serial)
+
+        with mock.patch.object(tokenjanitor, "remove_token", side_effect=remove_token_but_one):
+            messages = apply_token_action(token_objects, "delete")
+        self.assertEqual(messages, ["Deleting token janitor0",
+                                    "Failed to process token janitor1.",
+                                    "Token is in use",
+                                    "Deleting token janitor2"])
+        self.assertEqual(_get_serials(get_tokens(serial_wildcard="janitor*"))[:2],
+                         ["janitor1", "janitor3"])
@@ -0,0 +1,130 @@
+"""
+This file contains the tests for the token counters.
+
+In particular, this tests
+lib/tokenstats.py
+"""
+import mock
+
+from privacyidea.lib.token import (init_token, remove_token, assign_token,
+                                   unassign_token, enable_token, revoke_token,
+                                   get_tokens, get_one_token)
+from privacyidea.lib.tokenclass import TOKENKIND
+from privacyidea.lib.tokenstats import (get_token_stats, reconcile_token_stats,
+                                        update_token_stats, TokenStatsKey,
+                                        _add_to_counter)
+from privacyidea.lib.user import User
+from privacyidea.models import Token, TokenStats, db, unit_of_work
+from .base import MyTestCase
+
+
+class TokenStatsTestCase(MyTestCase):
+    otpkey = "3132333435363738393031323334353637383930"
+
+    def _assert_stats(self):
+        # The counters match the token table
+        for kwargs, filters in [({}, {}),
+                                ({"assigned": True}, {"assigned": True}),
+                                ({"assigned": False, "active": True},
+                                 {"assigned": False, "active": True}),
+                                ({"tokenkind": TOKENKIND.HARDWARE},
+                                 {"tokeninfo": {"tokenkind": TOKENKIND.HARDWARE}}),
+                                ({"tokenkind": TOKENKIND.SOFTWARE, "active": False},
+                                 {"tokeninfo": {"tokenkind": TOKENKIND.SOFTWARE},
+                                  "active": False})]:
+            self.assertEqual(get_token_stats(**kwargs),
+                             get_tokens(count=True, **filters), kwargs)
+
+    def test_01_count_tokens(self):
+        self.setUp_user_realms()
+        user = User("cornelius", self.realm1)
+        init_token({"serial": "STATS1", "type": "hotp", "otpkey": self.otpkey})
+        init_token({"serial": "STATS2", "type": "hotp", "otpkey": self.otpkey},
+                   tokenkind=TOKENKIND.HARDWARE)
+        init_token({"serial": "STATS3", "type": "spass"}, user=user)
+        self.assertEqual(get_token_stats(), 3)
+        self.assertEqual(get_token_stats(tokenkind=TOKENKIND.HARDWARE,
+                                         assigned=False), 1)
+        self.assertEqual(get_token_stats(assigned=True, active=True), 1)
+        self._assert_stats()
+
+        # Updating a token does not count it again
+        init_token({"serial": "STATS1", "type": "hotp", "otpkey": self.otpkey})
+        self.assertEqual(get_token_stats(), 3)
+
+        assign_token("STATS2", user)
+        self.assertEqual(get_token_stats(tokenkind=TOKENKIND.HARDWARE,
+                                         assigned=True), 1)
+        self._assert_stats()
+        enable_token("STATS1", False)
+        self.assertEqual(get_token_stats(active=False), 1)
+        self._assert_stats()
+        enable_token("STATS1", False)
+        self.assertEqual(get_token_stats(active=False), 1)
+        revoke_token("STATS3")
+        self.assertEqual(get_token_stats(assigned=True, active=True), 1)
+        self._assert_stats()
+        unassign_token("STATS2")
+        self.assertEqual(get_token_stats(assigned=True), 1)
+        self._assert_stats()
+        remove_token("STATS1")
+        self.assertEqual(get_token_stats(), 2)
+        self._assert_stats()
+        remove_token(user=user)
+        remove_token("STATS2")
+        self.assertEqual(get_token_stats(), 0)
+
+    def test_02_reconcile(self):
+        init_token({"serial": "STATS4", "type": "hotp", "otpkey": self.otpkey})
+        # A token, which is created directly in the database, is not counted
+        Token("STATS5", tokentype="hotp").save()
+        update_token_stats(None, TokenStatsKey(u"virtual", False, False))
+        self.assertEqual(get_token_stats(), 2)
+        self.assertEqual(reconcile_token_stats(), 2)
+        self.assertEqual(get_token_stats(), 2)
+        self.assertEqual(get_token_stats(tokenkind=u""), 1)
+        self._assert_stats()
+        self.assertEqual(reconcile_token_stats(), 0)
+        remove_token("STATS4")
+        remove_token("STATS5")
+        self.assertEqual(get_token_stats(), 0)
+        self.assertEqual(reconcile_token_stats(), 0)
+
+    def test_03_unit_of_work(self):
+        init_token({"serial": "STATS6", "type": "hotp", "otpkey": self.otpkey})
+        init_token({"serial": "STATS7", "type": "hotp", "otpkey": self.otpkey})
+        with mock.patch("privacyidea.lib.tokenstats._add_to_counter",
+                        wraps=_add_to_counter) as mock_add:
+            with unit_of_work():
+                enable_token("STATS6", False)
+                enable_token("STATS7", False)
+                enable_token("STATS6", True)
+                # The counters are only written before the commit
+                mock_add.assert_not_called()
+            # The changes are combined and the counters are updated in a
+            # fixed order
+            keys = [call[0][0] for call in mock_add.call_args_list]
+            self.assertEqual(len(keys), 2)
+            self.assertEqual(keys, sorted(keys))
+        self.assertEqual(get_token_stats(active=False), 1)
+        self._assert_stats()
+
+        # The changes are dropped, if the unit of work is rolled back
+        def _disable_and_fail():
+            with unit_of_work():
+                enable_token("STATS6", False)
+                raise ValueError("failed")
+
+        self.assertRaises(ValueError, _disable_and_fail)
+        self.assertEqual(get_token_stats(active=False), 1)
+        self._assert_stats()
+        remove_token("STATS6")
+        remove_token("STATS7")
+
+    def test_04_delete_registration_token(self):
+        init_token({"serial": "STATS8", "type": "registration"})
+        self.assertEqual(get_token_stats(), 1)
+        # The registration token deletes itself after the authentication
+        get_one_token(serial="STATS8").inc_count_auth_success()
+        self.assertEqual(get_token_stats(), 0)
+        self._assert_stats()